@@ -3,8 +3,13 @@
 #include <thread>
 #include <chrono>
 #include <filesystem>
+#include <ctime>
+#include <cerrno>
 #include <fcntl.h>
+#include <unistd.h>
 #include <sys/stat.h>
+#include <sys/mman.h>
+#include <signal.h>
 
 #include "aspCommon.hpp"
 
@@ -40,6 +45,7 @@ std::list<std::string> list_atmegas() {
           sn.push_back((char) resp.buffer[i]);
         }
         atmega_sns.push_back(sn);
+        atmega::cache_update(sn, dev_name);
       }
     } catch(const std::exception& e) {}
     
@@ -48,7 +54,218 @@ std::list<std::string> list_atmegas() {
   return atmega_sns;
 }
 
+static lock_stats* open_lock_stats(std::string sn) {
+  std::string filename = std::string("/dev/shm/atmega-") + sn + ".stats";
+  
+  mode_t omsk = umask(0);
+  int fd = ::open(filename.c_str(), O_RDWR | O_CREAT, 0666);
+  umask(omsk);
+  if( fd < 0 ) {
+    return NULL;
+  }
+  if( ftruncate(fd, sizeof(lock_stats)) != 0 ) {
+    ::close(fd);
+    return NULL;
+  }
+  
+  void *mapped = mmap(NULL, sizeof(lock_stats), PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+  ::close(fd);
+  if( mapped == MAP_FAILED ) {
+    return NULL;
+  }
+  return (lock_stats*) mapped;
+}
+
+static int32_t claim_from_dead_holder(lock_stats* stats) {
+  // If the lock is held by a process that no longer exists, i.e., one that
+  // was killed before it could release the lock, try to take it over.  The
+  // semaphore count the dead holder took is handed to whichever waiter swaps
+  // its own PID in first, so only one waiter can recover the lock.  If the
+  // PID has already been reused the holder looks alive and the waiter just
+  // times out.  Returns the PID of the dead holder if the lock was taken
+  // over, 0 otherwise.
+  if( stats == NULL ) {
+    return 0;
+  }
+  int32_t dead_pid = __atomic_load_n(&(stats->holder_pid), __ATOMIC_ACQUIRE);
+  if( dead_pid <= 0 ) {
+    return 0;
+  }
+  if( (kill(dead_pid, 0) == 0) || (errno != ESRCH) ) {
+    return 0;
+  }
+  int32_t expected = dead_pid;
+  if( !__atomic_compare_exchange_n(&(stats->holder_pid), &expected, (int32_t) getpid(),
+                                   false, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE) ) {
+    return 0;
+  }
+  return dead_pid;
+}
+
+static std::string read_device_sn(atmega::handle fd, int max_attempts) {
+  // Ask an open ATmega for its serial number, returning an empty string if
+  // it does not answer
+  std::string sn;
+  try {
+    atmega::buffer cmd, resp;
+    cmd.command = atmega::COMMAND_READ_SN;
+    cmd.size = 0;
+    
+    int n = atmega::send_command(fd, &cmd, &resp, max_attempts, ATMEGA_OPEN_WAIT_MS);
+    if( (n > 0) && (resp.command & atmega::COMMAND_FAILURE) == 0 ) {
+      for(int i=0; i<resp.size; i++) {
+        sn.push_back((char) resp.buffer[i]);
+      }
+    }
+  } catch(const std::exception& e) {}
+  return sn;
+}
+
+static uint64_t elapsed_us(std::chrono::steady_clock::time_point start) {
+  auto now = std::chrono::steady_clock::now();
+  return std::chrono::duration_cast<std::chrono::microseconds>(now - start).count();
+}
+
+bool ATmega::_acquire_lock() {
+  mode_t omsk = umask(0);
+  _lock = sem_open(_sn.c_str(), O_CREAT | O_EXCL, 0666, 1);
+  umask(omsk);
+  if( _lock == SEM_FAILED ) {
+    if( errno == EEXIST ) {
+      _lock = sem_open(_sn.c_str(), 0);
+    }
+    if( _lock == SEM_FAILED ) {
+      _lock = NULL;
+      return false;
+    }
+  }
+  
+  _stats = open_lock_stats(_sn);
+  
+  // Block until the lock is released or we time out.  Waiters are woken as
+  // soon as the lock is released rather than on the next poll.
+  auto wait_start = std::chrono::steady_clock::now();
+  bool contended = false;
+  if( sem_trywait(_lock) == -1 ) {
+    contended = true;
+    
+    // Wait in slices of ATMEGA_LOCK_CHECK_MS so that we can notice if the
+    // holder has died without releasing the lock.  If it has we take over
+    // the lock from it.
+    int status = -1;
+    while( elapsed_us(wait_start) < ATMEGA_LOCK_TIMEOUT_MS*1000ULL ) {
+#if defined(__APPLE__) && __APPLE__
+      // No sem_timedwait on macOS so fall back to polling
+      status = sem_trywait(_lock);
+      if( status == -1 ) {
+        std::this_thread::sleep_for(std::chrono::milliseconds(5));
+      }
+#else
+      struct timespec deadline;
+      clock_gettime(CLOCK_REALTIME, &deadline);
+      deadline.tv_nsec += (long) ATMEGA_LOCK_CHECK_MS * 1000000;
+      while( deadline.tv_nsec >= 1000000000 ) {
+        deadline.tv_sec += 1;
+        deadline.tv_nsec -= 1000000000;
+      }
+      status = sem_timedwait(_lock, &deadline);
+#endif
+      if( status == 0 ) {
+        break;
+      }
+      int32_t dead_pid = claim_from_dead_holder(_stats);
+      if( dead_pid != 0 ) {
+        std::cerr << "Recovering lock from PID " << dead_pid << " which no longer exists" << std::endl;
+        __atomic_add_fetch(&(_stats->recovered), 1, __ATOMIC_RELAXED);
+        status = 0;
+        break;
+      }
+    }
+    if( status == -1 ) {
+      std::cerr << "Failed to acquire lock within " << ATMEGA_LOCK_TIMEOUT_MS / 1000 << " s";
+      if( (_stats != NULL) && (_stats->holder_pid != 0) ) {
+        std::cerr << " (held by " << std::string(_stats->holder_name, strnlen(_stats->holder_name, sizeof(_stats->holder_name)))
+                  << ", PID " << _stats->holder_pid << ")";
+      }
+      std::cerr << std::endl;
+      
+      if( _stats != NULL ) {
+        __atomic_add_fetch(&(_stats->timeouts), 1, __ATOMIC_RELAXED);
+        munmap(_stats, sizeof(lock_stats));
+        _stats = NULL;
+      }
+      sem_close(_lock);
+      _lock = NULL;
+      return false;
+    }
+  }
+  
+  // We now hold the lock so we can update the statistics
+  _lock_start = std::chrono::steady_clock::now();
+  if( _stats != NULL ) {
+    uint64_t wait_us = elapsed_us(wait_start);
+    if( _stats->magic != ATMEGA_LOCK_STATS_MAGIC || _stats->version != ATMEGA_LOCK_STATS_VERSION ) {
+      memset(_stats, 0, sizeof(lock_stats));
+      _stats->magic = ATMEGA_LOCK_STATS_MAGIC;
+      _stats->version = ATMEGA_LOCK_STATS_VERSION;
+    }
+    _stats->acquired += 1;
+    if( contended ) {
+      _stats->contended += 1;
+    }
+    _stats->wait_total_us += wait_us;
+    if( wait_us > _stats->wait_max_us ) {
+      _stats->wait_max_us = wait_us;
+    }
+    
+    __atomic_store_n(&(_stats->holder_pid), (int32_t) getpid(), __ATOMIC_RELEASE);
+    memset(&(_stats->holder_name[0]), 0, sizeof(_stats->holder_name));
+#if defined(__APPLE__) && __APPLE__
+    strncpy(&(_stats->holder_name[0]), getprogname(), sizeof(_stats->holder_name)-1);
+#else
+    strncpy(&(_stats->holder_name[0]), program_invocation_short_name, sizeof(_stats->holder_name)-1);
+#endif
+    _stats->holder_since_us = std::chrono::duration_cast<std::chrono::microseconds>(std::chrono::system_clock::now().time_since_epoch()).count();
+  }
+  
+  return true;
+}
+
+void ATmega::_release_lock() {
+  if( _lock == NULL ) {
+    return;
+  }
+  
+  if( _stats != NULL ) {
+    uint64_t hold_us = elapsed_us(_lock_start);
+    _stats->hold_total_us += hold_us;
+    if( hold_us > _stats->hold_max_us ) {
+      _stats->hold_max_us = hold_us;
+    }
+    __atomic_store_n(&(_stats->holder_pid), (int32_t) 0, __ATOMIC_RELEASE);
+    memset(&(_stats->holder_name[0]), 0, sizeof(_stats->holder_name));
+    _stats->holder_since_us = 0;
+    
+    munmap(_stats, sizeof(lock_stats));
+    _stats = NULL;
+  }
+  
+  sem_post(_lock);
+  sem_close(_lock);
+  _lock = NULL;
+}
+
+void ATmega::close() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
+  if( _fd != -1 ) {
+    atmega::close(_fd);
+    _fd = -1;
+  }
+  _release_lock();
+}
+
 bool ATmega::open() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   bool found = false;
   atmega::handle fd = -1;
   if( _sn.find("/dev") == 0 ) {
@@ -90,30 +307,27 @@ bool ATmega::open() {
     
     return found;
   } else {
-    mode_t omsk = umask(0);
-    _lock = sem_open(_sn.c_str(), O_CREAT | O_EXCL, 0666, 1);
-    umask(omsk);
-    if( _lock == SEM_FAILED ) {
-      if( errno == EEXIST ) {
-        _lock = sem_open(_sn.c_str(), 0);
-      } else {
-        _lock = NULL;
-        return false;
-      }
+    if( !_acquire_lock() ) {
+      return false;
     }
     
-    double elapsed_time = 0.0;
-    auto start_time = std::chrono::steady_clock::now();
-    while( sem_trywait(_lock) == -1 ) {
-      std::this_thread::sleep_for(std::chrono::milliseconds(100));
-      
-      auto current_time = std::chrono::steady_clock::now();
-      elapsed_time = std::chrono::duration_cast<std::chrono::milliseconds>(current_time - start_time).count();
-      
-      if( elapsed_time > 10000 ) {
-        std::cerr << "Failed to acquire lock within 10 s" << std::endl;
-        return false;
-      }
+    // Try the device cache first.  A valid entry has already been checked
+    // against the USB device it was recorded for but the tty could have been
+    // handed to a different ATmega since then, so read back the serial
+    // number once before trusting it.  If it does not match fall back to a
+    // full scan.
+    std::string cached_name = atmega::cache_lookup(_sn);
+    if( !cached_name.empty() ) {
+      try {
+        fd = atmega::open(cached_name);
+        if( read_device_sn(fd, 1).compare(_sn) == 0 ) {
+          _fd = fd;
+          return true;
+        }
+        atmega::close(fd);
+      } catch(const std::exception& e) {}
+      fd = -1;
+      atmega::cache_remove(_sn);
     }
     
     for(std::string const& dev_name: atmega::find_devices()) {
@@ -144,6 +358,7 @@ bool ATmega::open() {
             sn.push_back((char) resp.buffer[i]);
           }
           
+          atmega::cache_update(sn, dev_name);
           if( _sn.compare(sn) == 0 ) {
             found = true;
             _fd = fd;
@@ -162,9 +377,7 @@ bool ATmega::open() {
     }
     
     if( !found ) {
-      sem_post(_lock);
-      sem_close(_lock);
-      _lock = NULL;
+      _release_lock();
     }
   }
   
@@ -173,6 +386,7 @@ bool ATmega::open() {
 
 
 std::string ATmega::get_version() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   std::string version;
   if( _fd < 0 ) {
     return version;
@@ -196,6 +410,7 @@ std::string ATmega::get_version() {
 
 
 float ATmega::get_temperature() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   float temp_C = -99.0;
   if( _fd < 0 ) {
     return temp_C;
@@ -221,6 +436,7 @@ float ATmega::get_temperature() {
 }
 
 bool ATmega::transfer_spi(const char* inputs, char* outputs, int size) {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -236,12 +452,13 @@ bool ATmega::transfer_spi(const char* inputs, char* outputs, int size) {
     return false;
   }
   
-  ::memcpy(outputs, &(resp.buffer[0]), resp.size);
+  ::memcpy(outputs, &(resp.buffer[0]), std::min((int) resp.size, size));
   return true;
 }
 
 
 std::list<uint8_t> ATmega::list_rs485_devices() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   std::list<uint8_t> rs485_addresses_list;
   if( _fd < 0 ) {
     return rs485_addresses_list;
@@ -264,6 +481,7 @@ std::list<uint8_t> ATmega::list_rs485_devices() {
 }
 
 bool ATmega::read_rs485(uint8_t addr, char* data, int* size) {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -283,12 +501,19 @@ bool ATmega::read_rs485(uint8_t addr, char* data, int* size) {
     return false;
   }
   
+  // If *size was non-zero on input it is the size of data
+  if( (*size > 0) && (resp.size > *size) ) {
+    std::cerr << "Warning: response of " << resp.size << " B does not fit in " << *size << " B" << std::endl;
+    *size = resp.size;
+    return false;
+  }
   *size = resp.size;
   ::memcpy(data, &(resp.buffer[0]), resp.size);
   return true;
 }
 
 bool ATmega::write_rs485(uint8_t addr, const char* data, int size) {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -313,6 +538,7 @@ bool ATmega::write_rs485(uint8_t addr, const char* data, int size) {
 }
 
 bool ATmega::send_rs485(uint8_t addr, const char* in_data, int in_size, char* out_data, int* out_size) {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -334,6 +560,12 @@ bool ATmega::send_rs485(uint8_t addr, const char* in_data, int in_size, char* ou
     return false;
   }
   
+  // If *out_size was non-zero on input it is the size of out_data
+  if( (*out_size > 0) && (resp.size > *out_size) ) {
+    std::cerr << "Warning: response of " << resp.size << " B does not fit in " << *out_size << " B" << std::endl;
+    *out_size = resp.size;
+    return false;
+  }
   *out_size = resp.size;
   ::memcpy(out_data, &(resp.buffer[0]), resp.size);
   return true;
@@ -341,6 +573,7 @@ bool ATmega::send_rs485(uint8_t addr, const char* in_data, int in_size, char* ou
 
 
 std::list<uint8_t> ATmega::list_i2c_devices() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   std::list<uint8_t> i2c_addresses_list;
   if( _fd < 0 ) {
     return i2c_addresses_list;
@@ -363,6 +596,7 @@ std::list<uint8_t> ATmega::list_i2c_devices() {
 }
 
 bool ATmega::read_i2c(uint8_t addr, uint8_t reg, char* data, int size) {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -393,6 +627,7 @@ bool ATmega::read_i2c(uint8_t addr, uint8_t reg, char* data, int size) {
 }
 
 bool ATmega::write_i2c(uint8_t addr, uint8_t reg, const char* data, int size) {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -422,6 +657,7 @@ bool ATmega::write_i2c(uint8_t addr, uint8_t reg, const char* data, int size) {
 
 
 bool ATmega::clear_fault() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -441,6 +677,7 @@ bool ATmega::clear_fault() {
 
 
 bool ATmega::locate() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
@@ -460,6 +697,7 @@ bool ATmega::locate() {
 
 
 bool ATmega::reset() {
+  std::lock_guard<std::recursive_mutex> guard(_mutex);
   if( _fd < 0 ) {
     return false;
   }
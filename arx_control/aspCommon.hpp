@@ -14,6 +14,8 @@
 #include <cstring>
 #include <cstdint>
 #include <stdexcept>
+#include <chrono>
+#include <mutex>
 #include <semaphore.h>
 
 #include "libatmega.hpp"
@@ -22,6 +24,33 @@
 #define ATMEGA_OPEN_MAX_ATTEMPTS 5
 #define ATMEGA_OPEN_WAIT_MS  105
 
+// ATmega device locking control
+#define ATMEGA_LOCK_TIMEOUT_MS 10000
+#define ATMEGA_LOCK_CHECK_MS 500
+
+
+// Shared memory lock statistics.  There is one of these per ATmega in
+// /dev/shm/atmega-<S/N>.stats and it is updated by whichever process holds
+// the lock.
+#define ATMEGA_LOCK_STATS_MAGIC 0x4B4C5341
+#define ATMEGA_LOCK_STATS_VERSION 2
+
+typedef struct __attribute__((packed)) lock_stats_ {
+  uint32_t magic;
+  uint32_t version;
+  uint64_t acquired;         // number of times the lock was acquired
+  uint64_t contended;        // number of times the lock was already held
+  uint64_t timeouts;         // number of times the lock could not be acquired
+  uint64_t wait_total_us;    // total time spent waiting for the lock
+  uint64_t wait_max_us;      // longest time spent waiting for the lock
+  uint64_t hold_total_us;    // total time the lock was held
+  uint64_t hold_max_us;      // longest time the lock was held
+  int32_t  holder_pid;       // PID of the current holder, 0 if not held
+  char     holder_name[16];  // name of the current holder
+  uint64_t holder_since_us;  // UNIX time the lock was acquired at
+  uint64_t recovered;        // number of times the lock was taken over from a dead holder
+} lock_stats;
+
 
 // ARX board configuration
 #define STANDS_PER_BOARD 8
@@ -53,24 +82,38 @@ std::list<std::string> list_atmegas();
 
 
 // Class to simplify interfacing with a ATmega via the libatmega library
+//
+// Thread safety:  every public method holds a per-object mutex for the whole
+// command/response exchange so a single ATmega can be shared between threads
+// and calls from different threads are serialized rather than interleaved on
+// the serial line.  Sequences of calls, i.e., an iVS page select followed by
+// a read, are not atomic and callers that need that should either use their
+// own ATmega (and IVSSession) per thread or provide their own locking.  The
+// cross-process semaphore taken in open() still guards the device against
+// other processes.
 class ATmega {
 private:
   std::string    _sn;
   atmega::handle _fd;
   sem_t*         _lock;
+  lock_stats*    _stats;
+  
+  std::recursive_mutex _mutex;
+  
+  std::chrono::steady_clock::time_point _lock_start;
+  
+  bool _acquire_lock();
+  void _release_lock();
   
 public:
-  ATmega(std::string sn): _sn(""), _fd(-1), _lock(NULL) {
+  ATmega(std::string sn): _sn(""), _fd(-1), _lock(NULL), _stats(NULL) {
     _sn = sn;
   }
   ~ATmega() {
-    atmega::close(_fd);
-    if( _lock != NULL ) {
-      sem_post(_lock);
-      sem_close(_lock);
-    }
+    close();
   }
   bool open();
+  void close();
   std::string get_version();
   float get_temperature();
   bool transfer_spi(const char* inputs, char* outputs, int size);
@@ -6,42 +6,178 @@
 
 namespace py = pybind11;
 
-PYBIND11_MODULE(atmega_py, m) {
+
+// Check that a buffer is C-contiguous and no larger than max_size bytes and
+// return its size in bytes.  The buffer_info has to be kept alive for as long
+// as its pointer is in use.
+static int buffer_size(const py::buffer_info& info, const char* name, int max_size) {
+    py::ssize_t stride = info.itemsize;
+    for(py::ssize_t i=info.ndim-1; i>=0; i--) {
+        if( (info.shape[i] > 1) && (info.strides[i] != stride) ) {
+            throw py::value_error(std::string(name) + " must be C-contiguous");
+        }
+        stride *= info.shape[i];
+    }
+    
+    py::ssize_t size = info.size * info.itemsize;
+    if( size > max_size ) {
+        throw py::value_error(std::string(name) + " is larger than " + std::to_string(max_size) + " B");
+    }
+    return (int) size;
+}
+
+PYBIND11_MODULE(atmegaWrap, m) {
     m.doc() = "ATmega Python wrapper";
     
+    // All of the calls that talk to the device release the GIL for the
+    // duration of the exchange so that other Python threads keep running.
+    // Arguments are converted before the GIL is released and the results
+    // after it is re-acquired.  See the thread safety notes in aspCommon.hpp.
+    //
+    // The SPI, RS485, and I2C transfers accept any C-contiguous object that
+    // supports the buffer protocol (bytes, bytearray, memoryview, array, 
+    // numpy array) and write their responses directly into the caller's
+    // (writable) output buffer so that frames can be reused between calls.
     py::class_<ATmega>(m, "ATmega")
         .def(py::init<std::string>())
-        .def("open", &ATmega::open)
-        .def("get_version", &ATmega::get_version)
-        .def("transfer_spi", &ATmega::transfer_spi)
-        .def("list_rs485_devices", &ATmega::list_rs485_devices)
-        .def("read_rs485", &ATmega::read_rs485)
-        .def("write_rs485", &ATmega::write_rs485)
-        .def("send_rs485", &ATmega::send_rs485)
-        .def("list_i2c_devices", &ATmega::list_i2c_devices)
-        .def("read_i2c", [](ATmega& self, uint8_t addr, uint8_t reg, int length) {
+        .def("open", &ATmega::open, py::call_guard<py::gil_scoped_release>())
+        .def("close", &ATmega::close, py::call_guard<py::gil_scoped_release>())
+        .def("get_version", &ATmega::get_version, py::call_guard<py::gil_scoped_release>())
+        .def("transfer_spi", [](ATmega& self, py::buffer inputs, py::buffer outputs) {
+            // Both frames are used in place - outputs needs to be writable
+            // and at least as large as inputs
+            py::buffer_info in_info = inputs.request();
+            py::buffer_info out_info = outputs.request(true);
+            int in_size = buffer_size(in_info, "inputs", ATMEGA_MAX_BUFFER_SIZE);
+            int out_size = buffer_size(out_info, "outputs", ATMEGA_MAX_BUFFER_SIZE);
+            if( out_size < in_size ) {
+                throw py::value_error("outputs is smaller than inputs");
+            }
+            
+            py::gil_scoped_release release;
+            return self.transfer_spi((const char*) in_info.ptr, (char*) out_info.ptr, in_size);
+        }, py::arg("inputs"), py::arg("outputs"))
+        .def("list_rs485_devices", &ATmega::list_rs485_devices, py::call_guard<py::gil_scoped_release>())
+        .def("read_rs485", [](ATmega& self, uint8_t addr, py::buffer outputs) -> py::tuple {
+            py::buffer_info out_info = outputs.request(true);
+            int size = buffer_size(out_info, "outputs", ATMEGA_MAX_BUFFER_SIZE);
+            bool success;
+            {
+                py::gil_scoped_release release;
+                success = (size > 0) && self.read_rs485(addr, (char*) out_info.ptr, &size);
+            }
+            return py::make_tuple(success, success ? size : 0);
+        }, py::arg("addr"), py::arg("outputs"))
+        .def("write_rs485", [](ATmega& self, uint8_t addr, py::buffer inputs) {
+            py::buffer_info in_info = inputs.request();
+            int size = buffer_size(in_info, "inputs", ATMEGA_MAX_BUFFER_SIZE-1);
+            
+            py::gil_scoped_release release;
+            return self.write_rs485(addr, (const char*) in_info.ptr, size);
+        }, py::arg("addr"), py::arg("inputs"))
+        .def("send_rs485", [](ATmega& self, uint8_t addr, py::buffer inputs, py::buffer outputs) -> py::tuple {
+            py::buffer_info in_info = inputs.request();
+            py::buffer_info out_info = outputs.request(true);
+            int in_size = buffer_size(in_info, "inputs", ATMEGA_MAX_BUFFER_SIZE-1);
+            int out_size = buffer_size(out_info, "outputs", ATMEGA_MAX_BUFFER_SIZE);
+            bool success;
+            {
+                py::gil_scoped_release release;
+                success = (out_size > 0) && self.send_rs485(addr, (const char*) in_info.ptr, in_size,
+                                                            (char*) out_info.ptr, &out_size);
+            }
+            return py::make_tuple(success, success ? out_size : 0);
+        }, py::arg("addr"), py::arg("inputs"), py::arg("outputs"))
+        .def("list_i2c_devices", &ATmega::list_i2c_devices, py::call_guard<py::gil_scoped_release>())
+        .def("read_i2c", [](ATmega& self, uint8_t addr, uint8_t reg, int length) -> py::tuple {
             std::vector<uint8_t> data(length);
-            bool success = self.read_i2c(addr, reg, (char*)data.data(), length);
+            bool success;
+            {
+                py::gil_scoped_release release;
+                success = self.read_i2c(addr, reg, (char*)data.data(), length);
+            }
             if (success) {
                 return py::make_tuple(true, data);
             } else {
                 return py::make_tuple(false, std::vector<uint8_t>());
             }
         })
+        .def("read_i2c", [](ATmega& self, uint8_t addr, uint8_t reg, py::buffer outputs) {
+            // Fill a caller-provided buffer in place
+            py::buffer_info out_info = outputs.request(true);
+            int size = buffer_size(out_info, "outputs", 255);
+            
+            py::gil_scoped_release release;
+            return self.read_i2c(addr, reg, (char*) out_info.ptr, size);
+        }, py::arg("addr"), py::arg("reg"), py::arg("outputs"))
+        .def("write_i2c", [](ATmega& self, uint8_t addr, uint8_t reg, py::buffer inputs) {
+            py::buffer_info in_info = inputs.request();
+            int size = buffer_size(in_info, "inputs", ATMEGA_MAX_BUFFER_SIZE-2);
+            
+            py::gil_scoped_release release;
+            return self.write_i2c(addr, reg, (const char*) in_info.ptr, size);
+        }, py::arg("addr"), py::arg("reg"), py::arg("inputs"))
         .def("write_i2c", [](ATmega& self, uint8_t addr, uint8_t reg, const std::vector<uint8_t>& data) {
+            if( data.size() > ATMEGA_MAX_BUFFER_SIZE-2 ) {
+                throw py::value_error("data is larger than " + std::to_string(ATMEGA_MAX_BUFFER_SIZE-2) + " B");
+            }
             return self.write_i2c(addr, reg, (const char*)data.data(), data.size());
-        })
-        .def("clear_fault", &ATmega::clear_fault)
-        .def("locate", &ATmega::locate)
-        .def("reset", &ATmega::reset);
+        }, py::call_guard<py::gil_scoped_release>())
+        .def("clear_fault", &ATmega::clear_fault, py::call_guard<py::gil_scoped_release>())
+        .def("locate", &ATmega::locate, py::call_guard<py::gil_scoped_release>())
+        .def("reset", &ATmega::reset, py::call_guard<py::gil_scoped_release>());
     
     // Wrap free functions from aspCommon
-    m.def("list_atmegas", &list_atmegas, "List all ATmega serial numbers");
+    m.def("list_atmegas", &list_atmegas, "List all ATmega serial numbers",
+          py::call_guard<py::gil_scoped_release>());
     
     // Wrap the low-level atmega namespace functions if needed
-    m.def("find_devices", &atmega::find_devices, "Find all available ATmega devices");
+    m.def("find_devices", &atmega::find_devices, "Find all available ATmega devices",
+          py::call_guard<py::gil_scoped_release>());
+    m.def("device_identity", &atmega::device_identity, "Get the USB identity of a device",
+          py::call_guard<py::gil_scoped_release>());
+    m.def("cache_lookup", &atmega::cache_lookup, "Look up the device for a serial number in the device cache");
+    m.def("cache_update", &atmega::cache_update, "Update the device cache");
+    m.def("cache_remove", &atmega::cache_remove, "Remove a serial number from the device cache");
     m.def("strerror", &atmega::strerror, "Decode error message");
     
+    // Serial link statistics for this process as a dictionary keyed by device
+    // name and then by command type
+    m.def("get_link_stats", []() {
+        py::dict output;
+        for(auto& entry: atmega::get_link_stats()) {
+            py::dict device;
+            for(int t=0; t<atmega::STATS_TYPE_COUNT; t++) {
+                const atmega::link_stats& stats = entry.second[t];
+                if( stats.calls == 0 ) {
+                    continue;
+                }
+                uint64_t nvalid = stats.calls - stats.failures;
+                
+                py::dict link;
+                link["calls"] = stats.calls;
+                link["retries"] = stats.retries;
+                link["timeouts"] = stats.timeouts;
+                link["failures"] = stats.failures;
+                link["errors"] = stats.errors;
+                link["bytes_out"] = stats.bytes_out;
+                link["bytes_in"] = stats.bytes_in;
+                link["first_byte_mean"] = nvalid ? stats.first_byte_total_us / 1e6 / nvalid : 0.0;
+                link["first_byte_max"] = stats.first_byte_max_us / 1e6;
+                link["transfer_mean"] = nvalid ? stats.transfer_total_us / 1e6 / nvalid : 0.0;
+                link["transfer_max"] = stats.transfer_max_us / 1e6;
+                link["call_mean"] = stats.call_total_us / 1e6 / stats.calls;
+                link["call_max"] = stats.call_max_us / 1e6;
+                link["first_byte_hist"] = std::vector<uint64_t>(stats.first_byte_hist, stats.first_byte_hist+ATMEGA_STATS_BUCKETS);
+                link["transfer_hist"] = std::vector<uint64_t>(stats.transfer_hist, stats.transfer_hist+ATMEGA_STATS_BUCKETS);
+                device[py::str(atmega::stats_type_name((atmega::StatsType) t))] = link;
+            }
+            output[py::str(entry.first)] = device;
+        }
+        return output;
+    }, "Get the serial link statistics");
+    m.def("reset_link_stats", &atmega::reset_link_stats, "Clear the serial link statistics");
+    
     // Wrap the buffer structure for low-level access if needed
     py::class_<atmega::buffer>(m, "Buffer")
         .def(py::init<>())
@@ -86,11 +222,44 @@ PYBIND11_MODULE(atmega_py, m) {
         .value("FAILURE_TOUT", atmega::COMMAND_FAILURE_TOUT)
         .value("FAILURE_CMD", atmega::COMMAND_FAILURE_CMD);
     
-    // Wrap iVS helper functions as well
-    m.def("ivs_get_smart_modules", &ivs_get_smart_modules);
-    m.def("ivs_select_module", &ivs_select_module);
-    m.def("ivs_wait_not_busy", &ivs_wait_not_busy);
-    m.def("ivs_is_on", &ivs_is_on);
-    m.def("ivs_enable_all_writes", &ivs_enable_all_writes);
-    m.def("ivs_disable_writes", &ivs_disable_writes);
+    // Wrap iVS helper functions as well.  Like the ATmega methods these
+    // release the GIL while they wait on the serial port.
+    m.def("ivs_get_smart_modules", &ivs_get_smart_modules, py::call_guard<py::gil_scoped_release>());
+    m.def("ivs_select_module", &ivs_select_module, py::call_guard<py::gil_scoped_release>());
+    m.def("ivs_wait_not_busy", &ivs_wait_not_busy, py::call_guard<py::gil_scoped_release>());
+    m.def("ivs_is_on", &ivs_is_on, py::call_guard<py::gil_scoped_release>());
+    m.def("ivs_enable_all_writes", &ivs_enable_all_writes, py::call_guard<py::gil_scoped_release>());
+    m.def("ivs_enable_operation_page_writes", &ivs_enable_operation_page_writes, py::call_guard<py::gil_scoped_release>());
+    m.def("ivs_disable_writes", &ivs_disable_writes, py::call_guard<py::gil_scoped_release>());
+    
+    py::class_<IVSSession>(m, "IVSSession")
+        .def(py::init<ATmega*, uint8_t>(), py::keep_alive<1, 2>())
+        .def("get_smart_modules", &IVSSession::get_smart_modules, py::call_guard<py::gil_scoped_release>())
+        .def("select_module", &IVSSession::select_module, py::call_guard<py::gil_scoped_release>())
+        .def("wait_not_busy", &IVSSession::wait_not_busy, py::arg("timeout_ms")=1000, py::call_guard<py::gil_scoped_release>())
+        .def("invalidate", &IVSSession::invalidate)
+        .def("address", &IVSSession::address)
+        .def("current_module", &IVSSession::current_module)
+        .def("transactions", &IVSSession::transactions)
+        .def("get_statistics", [](const IVSSession& self) {
+            py::dict modules;
+            for(auto& entry: self.statistics()) {
+                const ivs_module_stats& stats = entry.second;
+                py::dict module;
+                module["selects"] = stats.selects;
+                module["skipped"] = stats.skipped;
+                module["failures"] = stats.failures;
+                module["select_mean"] = stats.selects ? stats.select_total_us / 1e6 / stats.selects : 0.0;
+                module["select_max"] = stats.select_max_us / 1e6;
+                modules[py::int_(entry.first)] = module;
+            }
+            
+            py::dict output;
+            output["transactions"] = self.transactions();
+            output["busy_waits"] = self.busy_waits();
+            output["busy_mean"] = self.busy_waits() ? self.busy_total_us() / 1e6 / self.busy_waits() : 0.0;
+            output["busy_max"] = self.busy_max_us() / 1e6;
+            output["modules"] = modules;
+            return output;
+        });
 }
@@ -24,7 +24,8 @@ Usage:
                        specifed value in ms
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 
@@ -51,6 +52,8 @@ Options:
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -128,10 +131,11 @@ int main(int argc, char** argv) {
       continue;
     }
     
+    IVSSession ivs(atm, addr);
     std::list<uint8_t> modules;
     if( (mode == MODE_QUERY) || (mode == MODE_VOLTADJUST) || (mode == MODE_ONDELAY) ) {
       // Get a list of smart modules tha we need to update
-      modules = ivs_get_smart_modules(atm, addr);
+      modules = ivs.get_smart_modules();
     }
     
     if( mode != MODE_QUERY ) {
@@ -212,7 +216,7 @@ int main(int argc, char** argv) {
         
         // Query turn on delay
         for(uint8_t& module: modules) {
-          success = ivs_select_module(atm, addr, module);
+          success = ivs.select_module(module);
           if( !success ) {
             std::cerr << "configPSU - page change failed" << std::endl;
             continue;
@@ -329,7 +333,7 @@ int main(int argc, char** argv) {
       case MODE_ONDELAY:
         // Loop over modules
         for(uint8_t& module: modules) {
-          success = ivs_select_module(atm, addr, module);
+          success = ivs.select_module(module);
           if( !success ) {
             std::cerr << "configPSU - page change failed" << std::endl;
             continue;
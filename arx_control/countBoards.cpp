@@ -4,15 +4,20 @@ ARX boards connected to the SPI bus.  The exit code
 contains the number of boards found.
  
 Usage:
-  countBoards <ATmega S/N>
+  countBoards [-e|--expect <boards>] [--stats] <ATmega S/N>
 
 Options:
-  None
+  -e, --expect  Check for the expected number of boards
+                with a single SPI transfer before falling
+                back to a full scan
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 
 #include <iostream>
 #include <string>
+#include <list>
 #include <cstring>
 #include <chrono>
 #include <thread>
@@ -22,16 +27,34 @@ Options:
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
   // Make sure we have the right number of arguments to continue
-  if( argc < 1+1 ) {
-    std::cerr << "countBoards - Need 1 argument, " << argc-1 << " provided" << std::endl;
+  std::list<std::string> arg_str;
+  int expected = 0;
+  for(int i=1; i<argc; i++) {
+    std::string temp = std::string(argv[i]);
+    if( temp[0] != '-' ) {
+      arg_str.push_back(temp);
+    } else {
+      if( ((temp == "-e") || (temp == "--expect")) && (i+1 < argc) ) {
+        expected = std::stoi(std::string(argv[++i]));
+      }
+    }
+  }
+  if( arg_str.size() != 1 ) {
+    std::cerr << "countBoards - Need 1 argument, " << arg_str.size() << " provided" << std::endl;
+    std::exit(EXIT_FAILURE);
+  }
+  if( (expected < 0) || (expected > MAX_BOARDS) ) {
+    std::cerr << "countBoards - Invalid expected board count " << expected << std::endl;
     std::exit(EXIT_FAILURE);
   }
   
-  std::string requestedSN = std::string(argv[1]);
+  std::string requestedSN = arg_str.front();
   
   /************************************
   * ATmega device selection and ready *
@@ -54,7 +77,22 @@ int main(int argc, char** argv) {
   
   commands[0] = SPI_COMMAND_MARKER;
   int num = 0;
-  while( (responses[num] != SPI_COMMAND_MARKER) && (num < (STANDS_PER_BOARD*(MAX_BOARDS+1))) ) {
+  bool verified = false;
+  if( expected > 0 ) {
+    // Quick check - the marker should come back out after exactly the 
+    // expected number of devices
+    num = STANDS_PER_BOARD*expected;
+    
+    success = atm->transfer_spi((char*) commands, (char*) responses, 2*num+2);
+    if( success && (responses[num] == SPI_COMMAND_MARKER) ) {
+      verified = true;
+    } else {
+      num = 0;
+      ::memset(responses, 0, sizeof(uint16_t)*(MAX_BOARDS*STANDS_PER_BOARD+1));
+    }
+  }
+  
+  while( !verified && (responses[num] != SPI_COMMAND_MARKER) && (num < (STANDS_PER_BOARD*(MAX_BOARDS+1))) ) {
     num += STANDS_PER_BOARD;
     
     ::memset(responses, 0, sizeof(uint16_t)*(MAX_BOARDS*STANDS_PER_BOARD+1));
@@ -78,7 +116,11 @@ int main(int argc, char** argv) {
   delete atm;
   
   // Report
-  std::cout << "Found " << num << " boards (" << (num*STANDS_PER_BOARD) << " stands)" << std::endl;
+  if( verified ) {
+    std::cout << "Verified " << num << " boards (" << (num*STANDS_PER_BOARD) << " stands)" << std::endl;
+  } else {
+    std::cout << "Found " << num << " boards (" << (num*STANDS_PER_BOARD) << " stands)" << std::endl;
+  }
   
   return num;
 }
@@ -4,10 +4,11 @@ PIC microcontrollers connected to the RS485.  The exit code
 contains the number of boards found.
  
 Usage:
-  countPICs [-v|--verbose] <ATmega S/N>
+  countPICs [-v|--verbose] [--stats] <ATmega S/N>
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 
@@ -23,6 +24,8 @@ Options:
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -10,7 +10,8 @@ Usage:
   countPSUs
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -24,6 +25,8 @@ Options:
 #include "ivsCommon.hpp"
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /************************************
   * ATmega device selection and ready *
   ************************************/
@@ -10,7 +10,8 @@ Usage:
   countThermometers
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -23,6 +24,8 @@ Options:
 #include "ivsCommon.hpp"
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -21,57 +21,122 @@ std::list<uint8_t> ivs_get_smart_modules(ATmega *atm, uint8_t addr) {
 }
 
 bool ivs_select_module(ATmega *atm, uint8_t addr, uint8_t module) {
-  bool success;
-  uint8_t page = 17;
-  int ntry = 0;
-  while( page != module ) {
-    ntry++;
-    
-    // Move to the correct module page
-    success = atm->write_i2c(addr, 0x00, (char *) &module, 1);
-    if( !success ) {
-      if( ntry < IVS_MAX_RETRY_PAGE ) {
-        std::this_thread::sleep_for(std::chrono::milliseconds(10));
-        continue;
-      } else {
-        return false;
+  IVSSession ivs(atm, addr);
+  return ivs.select_module(module);
+}
+
+bool ivs_wait_not_busy(ATmega *atm, uint8_t addr, int timeout_ms) {
+  IVSSession ivs(atm, addr);
+  return ivs.wait_not_busy(timeout_ms);
+}
+
+static uint64_t elapsed_us(std::chrono::steady_clock::time_point start) {
+  auto now = std::chrono::steady_clock::now();
+  return std::chrono::duration_cast<std::chrono::microseconds>(now - start).count();
+}
+
+bool IVSSession::_read(uint8_t reg, char* data, int size) {
+  _transactions++;
+  return _atm->read_i2c(_addr, reg, data, size);
+}
+
+bool IVSSession::_write(uint8_t reg, const char* data, int size) {
+  _transactions++;
+  return _atm->write_i2c(_addr, reg, data, size);
+}
+
+std::list<uint8_t> IVSSession::get_smart_modules() {
+  std::list<uint8_t> modules;
+  uint16_t data;
+  bool success = this->_read(0xD3, (char *) &data, 2);
+  if( success ) {
+    for(uint8_t i=0; i<16; i++) {
+      if( (data >> i) & 1 ) {
+        modules.push_back(i);
       }
     }
+  }
+  
+  return modules;
+}
+
+bool IVSSession::select_module(uint8_t module) {
+  ivs_module_stats& stats = _stats[module];
+  
+  // Find out where we are if we don't already know
+  uint8_t page;
+  if( _page < 0 ) {
+    if( this->_read(0x00, (char *) &page, 1) ) {
+      _page = page;
+    }
+  }
+  if( _page == module ) {
+    stats.skipped++;
+    return true;
+  }
+  
+  auto tstart = std::chrono::steady_clock::now();
+  for(int ntry=0; ntry<IVS_MAX_RETRY_PAGE; ntry++) {
+    // Move to the correct module page
+    _page = -1;
+    if( !this->_write(0x00, (char *) &module, 1) ) {
+      std::this_thread::sleep_for(std::chrono::milliseconds(10));
+      continue;
+    }
     
-    std::this_thread::sleep_for(std::chrono::milliseconds(25));
-    
-    success = atm->read_i2c(addr, 0x00, (char *) &page, 1);
-    if( !success ) {
-      if( ntry < IVS_MAX_RETRY_PAGE ) {
-        std::this_thread::sleep_for(std::chrono::milliseconds(10));
-        continue;
-      } else {
-        return false;
+    // Poll until the change has taken effect.  The first poll is made after
+    // the typical latency seen so far and then we back off.
+    auto twrite = std::chrono::steady_clock::now();
+    uint64_t interval_us = _select_hint_us;
+    while( elapsed_us(twrite) < IVS_SELECT_TIMEOUT_MS*1000ULL ) {
+      std::this_thread::sleep_for(std::chrono::microseconds(interval_us));
+      
+      if( this->_read(0x00, (char *) &page, 1) && (page == module) ) {
+        uint64_t latency_us = elapsed_us(tstart);
+        _page = module;
+        _select_hint_us = std::max((uint64_t) IVS_POLL_MIN_US, 
+                                   std::min((uint64_t) IVS_POLL_MAX_US, (3*_select_hint_us + elapsed_us(twrite)) / 4));
+                                   
+        stats.selects++;
+        stats.select_total_us += latency_us;
+        if( latency_us > stats.select_max_us ) {
+          stats.select_max_us = latency_us;
+        }
+        return true;
       }
+      
+      interval_us = std::min((uint64_t) IVS_POLL_MAX_US, 2*interval_us);
     }
   }
   
-  return true;
+  stats.failures++;
+  return false;
 }
 
-bool ivs_wait_not_busy(ATmega *atm, uint8_t addr, int timeout_ms) {
+bool IVSSession::wait_not_busy(int timeout_ms) {
   uint8_t data;
+  uint64_t interval_us = IVS_POLL_MIN_US;
   auto tstart = std::chrono::steady_clock::now();
   while (true) {
-    if( !atm->read_i2c(addr, 0x78, (char*) &data, 1) ) {
+    if( !this->_read(0x78, (char*) &data, 1) ) {
       return false;
     }
     
     if( !((data >> 7) & 1) ) {// exit if we aren't busy
+      uint64_t waited_us = elapsed_us(tstart);
+      _busy_waits++;
+      _busy_total_us += waited_us;
+      if( waited_us > _busy_max_us ) {
+        _busy_max_us = waited_us;
+      }
       return true;
     }
     
-    auto tnow = std::chrono::steady_clock::now();
-    auto elapsed = std::chrono::duration_cast<std::chrono::milliseconds>(tnow - tstart).count();
-    if( elapsed > timeout_ms ) {
+    if( elapsed_us(tstart) > timeout_ms*1000ULL ) {
       return false;
     }
     
-    std::this_thread::sleep_for(std::chrono::milliseconds(10));
+    std::this_thread::sleep_for(std::chrono::microseconds(interval_us));
+    interval_us = std::min((uint64_t) IVS_POLL_MAX_US/2, 2*interval_us);
   }
 }
@@ -6,6 +6,7 @@
   supplies over I2C using an ATmega device
 */
 
+#include <map>
 #include <vector>
 #include <chrono>
 #include <thread>
@@ -15,6 +16,13 @@
 
 #define IVS_MAX_RETRY_PAGE 3
 
+// Polling intervals used while waiting on a PSU, in us
+#define IVS_POLL_MIN_US 1000
+#define IVS_POLL_MAX_US 25000
+
+// How long to wait for a page change to take effect, in ms
+#define IVS_SELECT_TIMEOUT_MS 250
+
 // Disable writes
 inline bool ivs_disable_writes(ATmega *atm, uint8_t addr) {
   uint8_t data = ((1 << 7) & 1);
@@ -68,4 +76,54 @@ bool ivs_select_module(ATmega *atm, uint8_t addr, uint8_t module);
 // Wait for the busy flag to clear out of the STATUS_BYTE
 bool ivs_wait_not_busy(ATmega *atm, uint8_t addr, int timeout_ms=1000);
 
+// Per-module statistics kept by IVSSession
+typedef struct {
+  uint32_t selects;          // number of page changes to the module
+  uint32_t skipped;          // number of selects skipped since the module was already selected
+  uint32_t failures;         // number of failed page changes
+  uint64_t select_total_us;  // total time spent changing to the module
+  uint64_t select_max_us;    // maximum time spent changing to the module
+} ivs_module_stats;
+
+/*
+  IVSSession - Class for working with a single iVS power supply that keeps
+  track of which module is currently selected so that redundant page changes
+  can be skipped.  Waits on the PSU poll with intervals that start at the 
+  typical latency seen so far and then back off.
+*/
+
+class IVSSession {
+private:
+  ATmega*  _atm;
+  uint8_t  _addr;
+  int      _page;
+  uint32_t _transactions;
+  uint64_t _select_hint_us;
+  
+  uint32_t _busy_waits;
+  uint64_t _busy_total_us;
+  uint64_t _busy_max_us;
+  
+  std::map<uint8_t, ivs_module_stats> _stats;
+  
+  bool _read(uint8_t reg, char* data, int size);
+  bool _write(uint8_t reg, const char* data, int size);
+  
+public:
+  IVSSession(ATmega *atm, uint8_t addr): _atm(atm), _addr(addr), _page(-1), _transactions(0), 
+                                         _select_hint_us(IVS_POLL_MIN_US), _busy_waits(0), 
+                                         _busy_total_us(0), _busy_max_us(0) {}
+  std::list<uint8_t> get_smart_modules();
+  bool select_module(uint8_t module);
+  bool wait_not_busy(int timeout_ms=1000);
+  inline void invalidate() { _page = -1; }
+  inline uint8_t address() const { return _addr; }
+  inline int current_module() const { return _page; }
+  inline uint32_t transactions() const { return _transactions; }
+  inline uint32_t busy_waits() const { return _busy_waits; }
+  inline uint64_t busy_total_us() const { return _busy_total_us; }
+  inline uint64_t busy_max_us() const { return _busy_max_us; }
+  inline const std::map<uint8_t, ivs_module_stats>& statistics() const { return _stats; }
+};
+
 #endif
@@ -2,7 +2,15 @@
 #include <iostream>
 #include <chrono>
 #include <thread>
+#include <cstdlib>
+#include <fstream>
+#include <sstream>
+#include <map>
+#include <mutex>
+#include <iomanip>
 #include <sys/select.h>
+#include <sys/file.h>
+#include <sys/stat.h>
 
 std::list<std::string> atmega::find_devices() {
   std::list<std::string> devices;
@@ -134,6 +142,210 @@ std::list<std::string> atmega::find_devices() {
   return devices;
 }
 
+std::string atmega::device_identity(std::string device_name) {
+  std::string identity;
+  
+#if !defined(__APPLE__) || !__APPLE__
+  // Walk up from the tty to the USB device and use its bus and device
+  // numbers.  The device number changes every time the device is enumerated
+  // so this also catches unplug/replug events.
+  std::size_t pos = device_name.rfind('/');
+  std::string tty_name = device_name.substr(pos == std::string::npos ? 0 : pos+1);
+  
+  char *real_path = realpath((std::string("/sys/class/tty/") + tty_name + "/device").c_str(), nullptr);
+  if( real_path == nullptr ) {
+    return identity;
+  }
+  std::string sys_path = std::string(real_path);
+  free(real_path);
+  
+  while( sys_path.size() > 1 ) {
+    std::ifstream busnum(sys_path + "/busnum"), devnum(sys_path + "/devnum");
+    if( busnum.is_open() && devnum.is_open() ) {
+      int bus = -1, dev = -1;
+      busnum >> bus;
+      devnum >> dev;
+      if( (bus >= 0) && (dev >= 0) ) {
+        identity = std::to_string(bus) + "-" + std::to_string(dev);
+      }
+      break;
+    }
+    sys_path = sys_path.substr(0, sys_path.rfind('/'));
+  }
+#endif
+  
+  return identity;
+}
+
+namespace {
+  // Read the cache as a map of S/N to (device node, identity) pairs
+  std::map<std::string, std::pair<std::string, std::string> > read_cache(int fd) {
+    std::map<std::string, std::pair<std::string, std::string> > entries;
+    
+    std::string data;
+    char chunk[512];
+    ssize_t n;
+    ::lseek(fd, 0, SEEK_SET);
+    while( (n = ::read(fd, &chunk[0], sizeof(chunk))) > 0 ) {
+      data.append(&chunk[0], n);
+    }
+    
+    std::istringstream lines(data);
+    std::string line;
+    while( std::getline(lines, line) ) {
+      std::istringstream fields(line);
+      std::string sn, device_name, identity;
+      if( fields >> sn >> device_name >> identity ) {
+        entries[sn] = std::make_pair(device_name, identity);
+      }
+    }
+    return entries;
+  }
+  
+  // Write the cache back out
+  void write_cache(int fd, const std::map<std::string, std::pair<std::string, std::string> >& entries) {
+    std::string data;
+    for(auto const& entry: entries) {
+      data += entry.first + " " + entry.second.first + " " + entry.second.second + "\n";
+    }
+    
+    if( ::ftruncate(fd, 0) == 0 ) {
+      ::lseek(fd, 0, SEEK_SET);
+      ssize_t n = ::write(fd, data.c_str(), data.size());
+      (void) n;
+    }
+  }
+  
+  // Open and lock the cache
+  int open_cache(bool exclusive) {
+    mode_t omsk = umask(0);
+    int fd = ::open(ATMEGA_CACHE_PATH, O_RDWR | O_CREAT, 0666);
+    umask(omsk);
+    if( fd < 0 ) {
+      return fd;
+    }
+    if( ::flock(fd, exclusive ? LOCK_EX : LOCK_SH) != 0 ) {
+      ::close(fd);
+      return -1;
+    }
+    return fd;
+  }
+  
+  void close_cache(int fd) {
+    ::flock(fd, LOCK_UN);
+    ::close(fd);
+  }
+  
+  // Link statistics and the device names that go with the open handles
+  std::mutex stats_mutex;
+  std::map<atmega::handle, std::string> handle_names;
+  std::map<std::string, atmega::device_stats> device_link_stats;
+  
+  int stats_bucket(int64_t us) {
+    int bucket = 0;
+    while( (us >>= 1) > 0 && (bucket < ATMEGA_STATS_BUCKETS-1) ) {
+      bucket++;
+    }
+    return bucket;
+  }
+  
+  void record_stats(atmega::handle fd, uint8_t cmd, int attempts, int timeouts,
+                    bool valid, bool error, ssize_t bytes_out, ssize_t bytes_in,
+                    int64_t first_byte_us, int64_t transfer_us, int64_t call_us) {
+    std::lock_guard<std::mutex> guard(stats_mutex);
+    
+    auto name = handle_names.find(fd);
+    std::string device_name = (name != handle_names.end()) ? name->second : std::string("unknown");
+    auto entry = device_link_stats.find(device_name);
+    if( entry == device_link_stats.end() ) {
+      atmega::device_stats empty;
+      ::memset(&empty, 0, sizeof(empty));
+      entry = device_link_stats.emplace(device_name, empty).first;
+    }
+    atmega::link_stats& stats = entry->second[atmega::stats_type(cmd)];
+    
+    stats.calls++;
+    stats.retries += attempts - 1;
+    stats.timeouts += timeouts;
+    stats.failures += valid ? 0 : 1;
+    stats.errors += error ? 1 : 0;
+    stats.bytes_out += bytes_out;
+    stats.bytes_in += bytes_in;
+    if( valid ) {
+      stats.first_byte_total_us += first_byte_us;
+      stats.first_byte_max_us = std::max(stats.first_byte_max_us, (uint64_t) first_byte_us);
+      stats.first_byte_hist[stats_bucket(first_byte_us)]++;
+      stats.transfer_total_us += transfer_us;
+      stats.transfer_max_us = std::max(stats.transfer_max_us, (uint64_t) transfer_us);
+      stats.transfer_hist[stats_bucket(transfer_us)]++;
+    }
+    stats.call_total_us += call_us;
+    stats.call_max_us = std::max(stats.call_max_us, (uint64_t) call_us);
+  }
+  
+  void print_link_stats_at_exit() {
+    atmega::print_link_stats(std::cerr);
+  }
+}
+
+std::string atmega::cache_lookup(std::string sn) {
+  int fd = open_cache(false);
+  if( fd < 0 ) {
+    return std::string("");
+  }
+  auto entries = read_cache(fd);
+  close_cache(fd);
+  
+  auto entry = entries.find(sn);
+  if( entry == entries.end() ) {
+    return std::string("");
+  }
+  
+  std::string identity = atmega::device_identity(entry->second.first);
+  if( identity.empty() || (identity != entry->second.second) ) {
+    return std::string("");
+  }
+  return entry->second.first;
+}
+
+void atmega::cache_update(std::string sn, std::string device_name) {
+  std::string identity = atmega::device_identity(device_name);
+  if( identity.empty() ) {
+    return;
+  }
+  
+  int fd = open_cache(true);
+  if( fd < 0 ) {
+    return;
+  }
+  auto entries = read_cache(fd);
+  
+  // A device node can only belong to one S/N
+  for(auto entry=entries.begin(); entry!=entries.end(); ) {
+    if( entry->second.first == device_name ) {
+      entry = entries.erase(entry);
+    } else {
+      entry++;
+    }
+  }
+  entries[sn] = std::make_pair(device_name, identity);
+  
+  write_cache(fd, entries);
+  close_cache(fd);
+}
+
+void atmega::cache_remove(std::string sn) {
+  int fd = open_cache(true);
+  if( fd < 0 ) {
+    return;
+  }
+  auto entries = read_cache(fd);
+  if( entries.erase(sn) > 0 ) {
+    write_cache(fd, entries);
+  }
+  close_cache(fd);
+}
+
 atmega::handle atmega::open(std::string device_name, bool exclusive_access) {
   atmega::handle fd = ::open(device_name.c_str(), O_RDWR | O_NOCTTY);
   if( fd < 0 ) {
@@ -195,18 +407,24 @@ atmega::handle atmega::open(std::string device_name, bool exclusive_access) {
     }
   }
   
-  // Ready the port
+  // Ready the port.  Pseudo-terminals, i.e., the ones used by aspSimulator,
+  // do not have modem control lines so ENOTTY/EINVAL are not errors.
   int ctl = TIOCM_DTR;
-  if( ::ioctl(fd, TIOCMBIS, &ctl) != 0 ) {
+  if( (::ioctl(fd, TIOCMBIS, &ctl) != 0) && (errno != ENOTTY) && (errno != EINVAL) ) {
     throw(std::runtime_error(std::string("Failed to assert DTR: ") \
                              +std::string(strerror(errno))));
   };
   ctl = TIOCM_RTS;
-  if( ::ioctl(fd, TIOCMBIS, &ctl) != 0 ) {
+  if( (::ioctl(fd, TIOCMBIS, &ctl) != 0) && (errno != ENOTTY) && (errno != EINVAL) ) {
     throw(std::runtime_error(std::string("Failed to assert RTS: ") \
                              +std::string(strerror(errno))));
   }
   
+  {
+    std::lock_guard<std::mutex> guard(stats_mutex);
+    handle_names[fd] = device_name;
+  }
+  
   return fd;
 }
 
@@ -223,15 +441,27 @@ ssize_t atmega::send_command(atmega::handle fd, const atmega::buffer* command, a
   const char *start = "<<<";
   const char *stop = ">>>";
   char *temp = (char*) ::calloc(1, 6+sizeof(buffer));
+  
+  // Link statistics
+  auto call_start = std::chrono::steady_clock::now();
+  int attempts = 0, timeouts = 0;
+  bool valid = false;
+  ssize_t bytes_out = 0, bytes_in = 0;
+  int64_t first_byte_us = 0, transfer_us = 0;
+  
   for(int i=0; i<max_retry+1; i++) {
     if( i > 0 ) {
       std::this_thread::sleep_for(std::chrono::milliseconds(retry_wait_ms));
     }
+    attempts++;
     
     // Send the command
+    auto send_time = std::chrono::steady_clock::now();
+    int64_t attempt_first_us = 0, attempt_last_us = 0;
     nsend = ::write(fd, start, 3);
     nsend += ::write(fd, command, 3+command->size);
     nsend += ::write(fd, stop, 3);
+    bytes_out += std::max(nsend, (ssize_t) 0);
     #if defined(ATMEGA_DEBUG) && ATMEGA_DEBUG
       std::cout << "sent: " << command->buffer << std::endl;
     #endif
@@ -326,6 +556,11 @@ ssize_t atmega::send_command(atmega::handle fd, const atmega::buffer* command, a
           // Update the elapsed time
           auto current_time = std::chrono::steady_clock::now();
           elapsed_time = std::chrono::duration_cast<std::chrono::milliseconds>(current_time - start_time).count();
+          
+          attempt_last_us = std::chrono::duration_cast<std::chrono::microseconds>(current_time - send_time).count();
+          if( nrecv == nbatch ) {
+            attempt_first_us = attempt_last_us;
+          }
         }
       }
     }
@@ -334,17 +569,27 @@ ssize_t atmega::send_command(atmega::handle fd, const atmega::buffer* command, a
     #endif
     
     FD_CLR(fd, &read_fds);
+    bytes_in += std::max(nrecv, (ssize_t) 0);
     
     if( nsend >= 9 && nrecv >= 9 ) {
       if( (strncmp(temp, start, 3) == 0) && (strncmp(temp+nrecv-3, stop, 3) == 0) ) {
         ::memcpy((uint8_t*) response, temp+3, nrecv-6);
+        valid = true;
+        first_byte_us = attempt_first_us;
+        transfer_us = attempt_last_us;
         break;
       }
     }
+    timeouts++;
   }
   
   ::free(temp);
   
+  int64_t call_us = std::chrono::duration_cast<std::chrono::microseconds>(std::chrono::steady_clock::now() - call_start).count();
+  record_stats(fd, command->command, attempts, timeouts, valid,
+               valid && (response->command & atmega::COMMAND_FAILURE),
+               bytes_out, bytes_in, first_byte_us, transfer_us, call_us);
+  
   if( nsend < 9 || nrecv < 9 ) {
     throw(std::runtime_error(std::string("Failed to send command")));
   }
@@ -366,9 +611,97 @@ std::string atmega::strerror(uint8_t cmd) {
   }
 }
 
+atmega::StatsType atmega::stats_type(uint8_t cmd) {
+  switch(cmd) {
+    case COMMAND_TRANSFER_SPI:  return STATS_SPI;
+    case COMMAND_SCAN_RS485:
+    case COMMAND_READ_RS485:
+    case COMMAND_WRITE_RS485:
+    case COMMAND_SEND_RS485:    return STATS_RS485;
+    case COMMAND_SCAN_I2C:
+    case COMMAND_READ_I2C:
+    case COMMAND_WRITE_I2C:     return STATS_I2C;
+    default:                    return STATS_SYSTEM;
+  }
+}
+
+std::string atmega::stats_type_name(atmega::StatsType type) {
+  switch(type) {
+    case STATS_SPI:   return std::string("spi");
+    case STATS_RS485: return std::string("rs485");
+    case STATS_I2C:   return std::string("i2c");
+    default:          return std::string("system");
+  }
+}
+
+std::map<std::string, atmega::device_stats> atmega::get_link_stats() {
+  std::lock_guard<std::mutex> guard(stats_mutex);
+  return device_link_stats;
+}
+
+void atmega::reset_link_stats() {
+  std::lock_guard<std::mutex> guard(stats_mutex);
+  device_link_stats.clear();
+}
+
+void atmega::print_link_stats(std::ostream& out) {
+  auto all_stats = atmega::get_link_stats();
+  
+  out << std::fixed << std::setprecision(2);
+  for(auto const& entry: all_stats) {
+    for(int t=0; t<STATS_TYPE_COUNT; t++) {
+      const link_stats& stats = entry.second[t];
+      if( stats.calls == 0 ) {
+        continue;
+      }
+      uint64_t nvalid = stats.calls - stats.failures;
+      out << entry.first << " " << stats_type_name((StatsType) t) << ": "
+          << stats.calls << " calls, " << stats.retries << " retries, "
+          << stats.timeouts << " timeouts, " << stats.failures << " failures, "
+          << stats.errors << " errors, " << stats.bytes_out << " B out, "
+          << stats.bytes_in << " B in" << std::endl;
+      out << "  first byte: mean " << (nvalid ? stats.first_byte_total_us / 1e3 / nvalid : 0.0)
+          << " ms, max " << stats.first_byte_max_us / 1e3 << " ms" << std::endl;
+      out << "  transfer:   mean " << (nvalid ? stats.transfer_total_us / 1e3 / nvalid : 0.0)
+          << " ms, max " << stats.transfer_max_us / 1e3 << " ms" << std::endl;
+      out << "  call:       mean " << stats.call_total_us / 1e3 / stats.calls
+          << " ms, max " << stats.call_max_us / 1e3 << " ms" << std::endl;
+      for(int b=0; b<ATMEGA_STATS_BUCKETS; b++) {
+        if( (stats.first_byte_hist[b] == 0) && (stats.transfer_hist[b] == 0) ) {
+          continue;
+        }
+        out << "  < " << std::setw(9) << (2 << b) / 1e3 << " ms: first byte " 
+            << stats.first_byte_hist[b] << ", transfer " << stats.transfer_hist[b] << std::endl;
+      }
+    }
+  }
+  out.unsetf(std::ios_base::floatfield);
+}
+
+bool atmega::stats_flag(int* argc, char** argv) {
+  bool found = false;
+  int j = 1;
+  for(int i=1; i<*argc; i++) {
+    if( std::string(argv[i]) == "--stats" ) {
+      found = true;
+      continue;
+    }
+    argv[j++] = argv[i];
+  }
+  if( found ) {
+    *argc = j;
+    argv[j] = nullptr;
+    std::atexit(print_link_stats_at_exit);
+  }
+  return found;
+}
+
 void atmega::close(atmega::handle fd) {
   if( fd >= 0 ) {
     ::tcdrain(fd);
     ::close(fd);
+    
+    std::lock_guard<std::mutex> guard(stats_mutex);
+    handle_names.erase(fd);
   }
 }
@@ -5,6 +5,9 @@
 #include <cstdint>
 #include <stdexcept>
 #include <list>
+#include <map>
+#include <array>
+#include <ostream>
 
 #include <fcntl.h>
 #include <unistd.h>
@@ -33,6 +36,19 @@
 
 #define ATMEGA_MAX_BUFFER_SIZE 530
 
+// Number of log2 buckets in the link latency histograms.  Bucket i counts
+// latencies in [2^i, 2^(i+1)) us with everything below 2 us in bucket 0 and
+// everything above ~8 s in the last bucket.
+#define ATMEGA_STATS_BUCKETS 24
+
+// Serial number to device path cache.  This lives on tmpfs so that it does
+// not survive a reboot.
+#ifndef ATMEGA_CACHE_PATH
+
+#define ATMEGA_CACHE_PATH "/dev/shm/atmega-devices"
+
+#endif
+
 namespace atmega {
   // Device file handle
   typedef int handle;
@@ -75,9 +91,60 @@ namespace atmega {
     uint8_t  buffer[ATMEGA_MAX_BUFFER_SIZE];
   } buffer;
   
+  // Command types that the link statistics are kept for
+  typedef enum StatsType_: uint8_t {
+    STATS_SYSTEM = 0,   // S/N, version, temperature, echo, lock, ...
+    STATS_SPI,
+    STATS_RS485,
+    STATS_I2C,
+    STATS_TYPE_COUNT
+  } StatsType;
+  
+  // Serial link statistics for one command type on one device.  The times
+  // are measured from when the command starts being written to when the
+  // first byte of the response arrives (first_byte), to when the last byte
+  // arrives (transfer), and to when send_command returns (call).
+  typedef struct link_stats_ {
+    uint64_t calls;
+    uint64_t retries;     // attempts beyond the first
+    uint64_t timeouts;    // attempts without a complete, valid response
+    uint64_t failures;    // calls that never got a valid response
+    uint64_t errors;      // valid responses that report a command failure
+    uint64_t bytes_out;
+    uint64_t bytes_in;
+    uint64_t first_byte_total_us;
+    uint64_t first_byte_max_us;
+    uint64_t transfer_total_us;
+    uint64_t transfer_max_us;
+    uint64_t call_total_us;
+    uint64_t call_max_us;
+    uint64_t first_byte_hist[ATMEGA_STATS_BUCKETS];
+    uint64_t transfer_hist[ATMEGA_STATS_BUCKETS];
+  } link_stats;
+  
+  // Link statistics for a device, indexed by StatsType
+  typedef std::array<link_stats, STATS_TYPE_COUNT> device_stats;
+  
   // List all devices found
   std::list<std::string> find_devices();
   
+  // Return a string that uniquely identifies the USB device behind a device
+  // node for as long as it stays plugged in, or an empty string if it cannot
+  // be determined
+  std::string device_identity(std::string device_name);
+  
+  // Look up the device node for a serial number in the cache.  Entries whose
+  // USB identity has changed since they were cached, i.e., the device has
+  // been unplugged or re-enumerated, are treated as missing.  Returns an empty
+  // string if there is no valid entry.
+  std::string cache_lookup(std::string sn);
+  
+  // Add or update the cache entry for a serial number
+  void cache_update(std::string sn, std::string device_name);
+  
+  // Remove the cache entry for a serial number
+  void cache_remove(std::string sn);
+  
   // Open a device and get it ready for running commands
   handle open(std::string device_name, bool exclusive_access=true);
   
@@ -88,6 +155,27 @@ namespace atmega {
   // Decode a response error message
   std::string strerror(uint8_t cmd);
   
+  // Return the type of a command for the link statistics
+  StatsType stats_type(uint8_t cmd);
+  
+  // Return the name of a command type, i.e., "spi"
+  std::string stats_type_name(StatsType type);
+  
+  // Return a copy of the link statistics, keyed by device name, for this 
+  // process
+  std::map<std::string, device_stats> get_link_stats();
+  
+  // Clear the link statistics
+  void reset_link_stats();
+  
+  // Write a human readable summary of the link statistics
+  void print_link_stats(std::ostream& out);
+  
+  // Remove a "--stats" flag from the command line, updating argc, and, if it
+  // was present, arrange for the link statistics to be written to stderr 
+  // when the program exits.  Returns whether or not the flag was found.
+  bool stats_flag(int* argc, char** argv);
+  
   // Close an open device
   void close(handle fd);
 }
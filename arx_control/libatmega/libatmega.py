@@ -1,13 +1,39 @@
+"""
+Pure Python implementation of libatmega for talking to the ATmega devices.
+
+This follows libatmega.cpp and can be used where the C++ library cannot be
+built or as a reference when benchmarking it.  Responses are read frame by
+frame:  the header is read first and then exactly as many bytes as it says
+the response contains so that a command returns as soon as its response is
+in rather than waiting for the port to go quiet.
+"""
+
 import os
 import sys
 import glob
+import time
+import errno
+import select
+import builtins
 import ctypes
-import serial
+import fcntl
 import struct
-import subprocess
+import termios
+import threading
 from enum import IntEnum
 
-from typing import List
+from typing import List, Optional
+
+
+# Maximum size of the payload of a command/response
+MAX_BUFFER_SIZE = 530
+
+# Serial number to device path cache shared with the C++ tools
+CACHE_PATH = '/dev/shm/atmega-devices'
+
+# USB vendor and product IDs of the ATmega devices
+_VENDOR_IDS = ('0403', '2341', '2886')
+_PRODUCT_IDS = ('6001', '0001', '802f')
 
 
 class Command(IntEnum):
@@ -20,18 +46,27 @@ class Command(IntEnum):
     COMMAND_READ_VER = 0x02
     COMMAND_READ_MLEN = 0x03
     COMMAND_ECHO = 0x04
+    COMMAND_READ_TEMPERATURE = 0x05
     COMMAND_TRANSFER_SPI = 0x11
-    COMMAND_READ_ADCS = 0x21
+    COMMAND_SCAN_RS485 = 0x21
+    COMMAND_READ_RS485 = 0x22
+    COMMAND_WRITE_RS485 = 0x23
+    COMMAND_SEND_RS485 = 0x24
     COMMAND_SCAN_I2C = 0x31
     COMMAND_READ_I2C = 0x32
     COMMAND_WRITE_I2C = 0x33
     COMMAND_LOCK = 0xA1
     COMMAND_UNLOCK = 0xA2
     COMMAND_WRITE_SN = 0xA3
+    COMMAND_CLR_FAULT = 0xA4
+    COMMAND_LOCATE = 0xA5
+    COMMAND_RESET = 0xA7
     COMMAND_FAILURE = 0xF0
     COMMAND_FAILURE_ARG = 0xFA
     COMMAND_FAILURE_STA = 0xFB
     COMMAND_FAILURE_BUS = 0xFC
+    COMMAND_FAILURE_RS485 = 0xFD
+    COMMAND_FAILURE_TOUT = 0xFE
     COMMAND_FAILURE_CMD = 0xFF
 
 
@@ -43,7 +78,35 @@ class Buffer(ctypes.LittleEndianStructure):
     _pack_ = 1  # Pack the structure tightly
     _fields_ = [("command", ctypes.c_uint8),
                 ("size",    ctypes.c_uint16),
-                ("buffer",  ctypes.c_char * 530)]
+                ("buffer",  ctypes.c_char * MAX_BUFFER_SIZE)]
+
+
+# Frame markers
+_START = b'<<<'
+_STOP = b'>>>'
+
+
+def _usb_device_path(device: str) -> Optional[str]:
+    """
+    Return the sysfs path of the USB device behind a tty device node or None
+    if it cannot be found.
+    """
+    
+    path = os.path.realpath(f"/sys/class/tty/{os.path.basename(device)}/device")
+    while len(path) > 1:
+        if os.path.exists(os.path.join(path, 'devnum')):
+            return path
+        path = os.path.dirname(path)
+    return None
+
+
+def _read_sysfs(path: str, name: str) -> str:
+    """
+    Read a single sysfs attribute.
+    """
+    
+    with builtins.open(os.path.join(path, name), 'r') as fh:
+        return fh.read().strip()
 
 
 def find_devices() -> List[str]:
@@ -56,48 +119,455 @@ def find_devices() -> List[str]:
     
     devices = []
     for dev in possible_devices:
-        udev_info = subprocess.check_output(['udevadm', 'info', f"--name={dev}"])
-        udev_info = udev_info.decode()
-        
-        match = 0
-        for line in udev_info.split('\n'):
-            if line.find('ID_VENDOR_ID=0403') != -1 or line.find('ID_VENDOR_ID=2341') != -1:
-                match |= 1
-            elif line.find('ID_MODEL_ID=6001') != -1 or line.find('ID_MODEL_ID=0001') != -1:
-                match |= 2
-                
-        if match == 3:
+        path = _usb_device_path(dev)
+        if path is None:
+            continue
+            
+        try:
+            vendor_id = _read_sysfs(path, 'idVendor')
+            product_id = _read_sysfs(path, 'idProduct')
+        except (IOError, OSError):
+            continue
+            
+        if vendor_id in _VENDOR_IDS and product_id in _PRODUCT_IDS:
             devices.append(dev)
             
     return devices
 
 
-def open(device: str) -> serial.Serial:
+def device_identity(device: str) -> str:
+    """
+    Return a string that uniquely identifies the USB device behind a device
+    node for as long as it stays plugged in, or an empty string if it cannot
+    be determined.
+    """
+    
+    path = _usb_device_path(device)
+    if path is None:
+        return ''
+        
+    try:
+        return f"{int(_read_sysfs(path, 'busnum'))}-{int(_read_sysfs(path, 'devnum'))}"
+    except (IOError, OSError, ValueError):
+        return ''
+
+
+def _read_cache(fh) -> dict:
+    """
+    Read the cache as a dictionary of (device node, identity) tuples keyed by
+    serial number.
+    """
+    
+    fh.seek(0)
+    entries = {}
+    for line in fh:
+        fields = line.split()
+        if len(fields) == 3:
+            entries[fields[0]] = (fields[1], fields[2])
+    return entries
+
+
+def _write_cache(fh, entries: dict) -> None:
+    """
+    Write the cache back out.
+    """
+    
+    fh.seek(0)
+    fh.truncate()
+    for sn in sorted(entries):
+        fh.write(f"{sn} {entries[sn][0]} {entries[sn][1]}\n")
+    fh.flush()
+
+
+def _open_cache(exclusive: bool=False):
     """
-    Open an ATmega device and get it ready for command processing.
+    Open and lock the cache.
     """
     
-    return serial.Serial(device, baudrate=115200, bytesize=8, parity='N', stopbits=1, timeout=0.1)
+    omask = os.umask(0)
+    try:
+        fd = os.open(CACHE_PATH, os.O_RDWR | os.O_CREAT, 0o666)
+    finally:
+        os.umask(omask)
+    fh = os.fdopen(fd, 'r+')
+    fcntl.flock(fh, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+    return fh
 
 
-def send_command(handle: serial.Serial, command: Buffer, max_retry: int=0, retry_wait_ms: int=50) -> Buffer:
+def cache_lookup(sn: str) -> str:
     """
-    Send a command buffer to an ATmega device and return the response.
+    Look up the device node for a serial number in the cache.  Entries whose
+    USB identity has changed since they were cached, i.e., the device has been
+    unplugged or re-enumerated, are treated as missing.  Returns an empty
+    string if there is no valid entry.
     """
     
-    # Send the command with the <<< and >>> command markers
-    nsend = handle.write(bytes('<<<'))
-    nsend += handle.write(bytes(command)[:3+command.size])
-    nsend += handle.write(bytes('>>>'))
+    try:
+        with _open_cache() as fh:
+            entries = _read_cache(fh)
+    except (IOError, OSError):
+        return ''
+        
+    try:
+        device, identity = entries[sn]
+    except KeyError:
+        return ''
+        
+    current = device_identity(device)
+    if current == '' or current != identity:
+        return ''
+    return device
+
+
+def cache_update(sn: str, device: str) -> None:
+    """
+    Add or update the cache entry for a serial number.
+    """
     
-    # Read in the response
-    handle.read(3)
-    resp = handle.read_all()
+    identity = device_identity(device)
+    if identity == '':
+        return
+        
+    try:
+        with _open_cache(exclusive=True) as fh:
+            entries = _read_cache(fh)
+            entries = {k:v for k,v in entries.items() if v[0] != device}
+            entries[sn] = (device, identity)
+            _write_cache(fh, entries)
+    except (IOError, OSError):
+        pass
+
+
+def cache_remove(sn: str) -> None:
+    """
+    Remove the cache entry for a serial number.
+    """
+    
+    try:
+        with _open_cache(exclusive=True) as fh:
+            entries = _read_cache(fh)
+            if entries.pop(sn, None) is not None:
+                _write_cache(fh, entries)
+    except (IOError, OSError):
+        pass
+
+
+class Handle(object):
+    """
+    Open ATmega device.  Each handle owns the file descriptor, a preallocated
+    response Buffer, and a lock that serializes the commands sent through it
+    so that it can be shared between threads.
+    """
+    
+    def __init__(self, device: str, fd: int):
+        self.device = device
+        self.fd = fd
+        self.response = Buffer()
+        self.lock = threading.RLock()
+        
+        self._marker = bytearray(3)
+        self._view = memoryview(self.response).cast('B')
+        
+    def fileno(self) -> int:
+        return self.fd
+        
+    @property
+    def closed(self) -> bool:
+        return self.fd < 0
+        
+    def close(self) -> None:
+        """
+        Close the device.
+        """
+        
+        with self.lock:
+            if self.fd >= 0:
+                try:
+                    termios.tcdrain(self.fd)
+                except termios.error:
+                    pass
+                os.close(self.fd)
+                self.fd = -1
+                
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def open(device: str, exclusive_access: bool=True) -> Handle:
+    """
+    Open an ATmega device and get it ready for command processing.  This
+    configures the port the same way as libatmega.cpp:  raw 8N1 at 115200
+    baud with no flow control, (optionally) exclusive access, and DTR and RTS
+    asserted.  Raises a RuntimeError if the device cannot be opened.
+    """
+    
+    try:
+        fd = os.open(device, os.O_RDWR | os.O_NOCTTY)
+    except OSError as e:
+        raise RuntimeError(f"Failed to open device: {os.strerror(e.errno)}")
+        
+    try:
+        try:
+            iflag, oflag, cflag, lflag, ispeed, ospeed, cc = termios.tcgetattr(fd)
+        except termios.error as e:
+            raise RuntimeError(f"Failed to get attributes: {e.args[-1]}")
+            
+        # Size, parity, and hardware flow control
+        cflag &= ~(termios.CSIZE | termios.PARENB | termios.CSTOPB | termios.CRTSCTS)
+        cflag |= termios.CS8 | termios.CREAD | termios.CLOCAL
+        
+        # Data intepretting (or not) and software flow control
+        lflag &= ~(termios.ICANON | termios.ECHO | termios.ECHOE | termios.ECHOK | termios.ECHONL | termios.ISIG)
+        iflag &= ~(termios.IXON | termios.IXOFF | termios.IXANY)
+        iflag &= ~(termios.IGNBRK | termios.BRKINT | termios.PARMRK | termios.INPCK | termios.ISTRIP
+                   | termios.INLCR | termios.IGNCR | termios.ICRNL)
+        oflag = 0
+        
+        # Waiting parameters - reads never block since select() is used
+        cc[termios.VTIME] = 1
+        cc[termios.VMIN] = 0
+        
+        # Speed
+        ispeed = ospeed = termios.B115200
+        
+        try:
+            termios.tcsetattr(fd, termios.TCSANOW, [iflag, oflag, cflag, lflag, ispeed, ospeed, cc])
+        except termios.error as e:
+            raise RuntimeError(f"Failed to set attributes: {e.args[-1]}")
+            
+        if exclusive_access:
+            # Grab the port if needed
+            try:
+                fcntl.ioctl(fd, termios.TIOCEXCL)
+            except OSError as e:
+                raise RuntimeError(f"Failed to set exclusive access: {os.strerror(e.errno)}")
+                
+        # Ready the port.  Pseudo-terminals do not have modem control lines
+        # so ENOTTY/EINVAL are not errors.
+        for name,bit in (('DTR', termios.TIOCM_DTR), ('RTS', termios.TIOCM_RTS)):
+            try:
+                fcntl.ioctl(fd, termios.TIOCMBIS, struct.pack('I', bit))
+            except OSError as e:
+                if e.errno not in (errno.ENOTTY, errno.EINVAL):
+                    raise RuntimeError(f"Failed to assert {name}: {os.strerror(e.errno)}")
+    except RuntimeError:
+        os.close(fd)
+        raise
+        
+    return Handle(device, fd)
+
+
+_HANDLES = {}
+_HANDLES_LOCK = threading.Lock()
+
+
+def get_handle(device: str, exclusive_access: bool=True) -> Handle:
+    """
+    Return the persistent handle for a device, opening (or re-opening) it if
+    needed.  The handle stays open until close() or close_all() is called.
+    """
+    
+    with _HANDLES_LOCK:
+        handle = _HANDLES.get(device, None)
+        if handle is None or handle.closed:
+            handle = open(device, exclusive_access=exclusive_access)
+            _HANDLES[device] = handle
+        return handle
+
+
+def close_all() -> None:
+    """
+    Close all of the persistent handles.
+    """
+    
+    with _HANDLES_LOCK:
+        for handle in _HANDLES.values():
+            handle.close()
+        _HANDLES.clear()
+
+
+def command_timeout_ms(command: Buffer) -> int:
+    """
+    Return how long, in ms, to wait for the response to a command.  These are
+    the same as in libatmega.cpp.
+    """
+    
+    cmd = command.command
+    if cmd in (Command.COMMAND_READ_SN, Command.COMMAND_WRITE_SN):
+        # EEPROM operations are slow
+        return 125
+    elif cmd in (Command.COMMAND_READ_I2C, Command.COMMAND_WRITE_I2C):
+        # I2C read/write has a 100 ms timeout
+        return 125
+    elif cmd == Command.COMMAND_SCAN_I2C:
+        # I2C scan has a 630 ms timeout
+        return 655
+    elif cmd in (Command.COMMAND_READ_RS485, Command.COMMAND_WRITE_RS485):
+        # RS485 read/write has a 1025 ms timeout
+        return 1025
+    elif cmd == Command.COMMAND_SEND_RS485:
+        # RS485 send has a variable timeout based on the command - most are 100 ms
+        data = command.buffer[1:command.size]
+        if command.size >= 5:
+            if data[:4] in (b'OWSE', b'OWTE'):
+                return 1050
+            elif data[:1] == b'*' or data[:4] in (b'RSET', b'SLEP'):
+                return 50       # No return expected
+        elif command.size == 2 and data[:1] == b'W':
+            return 50           # No return expected
+        return 150
+    elif cmd == Command.COMMAND_SCAN_RS485:
+        # RS485 scan has a 5 *s* timeout
+        return 5050
+    return 50
+
+
+def _read_exact(fd: int, view: memoryview, deadline: float) -> int:
+    """
+    Read exactly len(view) bytes into view, waiting until deadline (in
+    time.monotonic() seconds).  Returns the number of bytes read.
+    """
+    
+    nrecv, nleft = 0, len(view)
+    while nleft > 0:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            break
+        try:
+            ready, _, _ = select.select([fd,], [], [], timeout)
+        except InterruptedError:
+            continue
+        if not ready:
+            break
+            
+        nbatch = os.readv(fd, [view[nrecv:],])
+        if nbatch > 0:
+            nrecv += nbatch
+            nleft -= nbatch
+    return nrecv
+
+
+def _receive(handle: Handle, response: Buffer, timeout_ms: int) -> int:
+    """
+    Receive a single framed response directly into response.  Returns the
+    number of bytes received, including the markers, or -1 if the frame is
+    malformed.
+    """
+    
+    if response is handle.response:
+        view = handle._view
+    else:
+        view = memoryview(response).cast('B')
+    marker = memoryview(handle._marker)
+    
+    # Start marker, command, and size
+    deadline = time.monotonic() + timeout_ms / 1000.0
+    nrecv = _read_exact(handle.fd, marker, deadline)
+    if nrecv < 3:
+        return nrecv
+    if handle._marker != _START:
+        return -1
+    nrecv += _read_exact(handle.fd, view[:3], deadline)
+    if nrecv < 6:
+        return nrecv
+    if response.size > MAX_BUFFER_SIZE:
+        return -1
+        
+    # Payload and stop marker.  Once the header is in allow for the time it 
+    # takes for the rest of the frame to come in at 115200 baud.
+    deadline = max(deadline, time.monotonic() + 0.05 + (response.size+3)*10/115200.0)
+    nrecv += _read_exact(handle.fd, view[3:3+response.size], deadline)
+    nrecv += _read_exact(handle.fd, marker, deadline)
+    if nrecv < 9 + response.size:
+        return nrecv
+    if handle._marker != _STOP:
+        return -1
+    return nrecv
+
+
+def send_command(handle: Handle, command: Buffer, max_retry: int=0, retry_wait_ms: int=50,
+                 response: Optional[Buffer]=None) -> Buffer:
+    """
+    Send a command buffer to an ATmega device and return the response.  The
+    response is read directly into the handle's preallocated Buffer, or into
+    response if one is provided, and is only valid until the next command is
+    sent.  Only as many bytes as the response frame says it contains are 
+    read so the call returns as soon as the full frame has arrived.  If no
+    valid response is received after max_retry retries the command of the
+    response is set to COMMAND_FAILURE.  Raises a RuntimeError if nothing 
+    could be sent or received, like libatmega.cpp.
+    """
+    
+    if response is None:
+        response = handle.response
+    frame = [_START, memoryview(command).cast('B')[:3+command.size], _STOP]
+    timeout_ms = command_timeout_ms(command)
+    
+    with handle.lock:
+        if handle.closed:
+            raise RuntimeError("Device is not open")
+            
+        nsend = nrecv = 0
+        for i in range(max_retry+1):
+            if i > 0:
+                time.sleep(retry_wait_ms / 1000.0)
+                
+            # Empty the response and set the command value to 0xF0
+            ctypes.memset(ctypes.addressof(response), 0, 3)
+            response.command = Command.COMMAND_FAILURE
+            
+            # Drop anything left over from an earlier, timed out command
+            termios.tcflush(handle.fd, termios.TCIFLUSH)
+            
+            # Send the command with the <<< and >>> command markers
+            try:
+                nsend = os.writev(handle.fd, frame)
+            except OSError:
+                nsend = 0
+                continue
+                
+            # Read in the response
+            nrecv = _receive(handle, response, timeout_ms)
+            if nrecv == 9 + response.size:
+                break
+                
+        if nrecv < 0:
+            ## Malformed frame on the last attempt
+            ctypes.memset(ctypes.addressof(response), 0, 3)
+            response.command = Command.COMMAND_FAILURE
+        elif nsend < 9 or nrecv < 9:
+            raise RuntimeError("Failed to send command")
+        elif nrecv < 9 + response.size:
+            response.command = Command.COMMAND_FAILURE
+            
+    return response
+
+
+def strerror(cmd: int) -> str:
+    """
+    Decode a response error message.
+    """
     
-    return Buffer.from_buffer_copy(resp[:-3])
+    return {Command.COMMAND_SUCCESS:       "Command successful",
+            Command.COMMAND_FAILURE:       "General command failure (reason not specified)",
+            Command.COMMAND_FAILURE_ARG:   "Invalid argument count",
+            Command.COMMAND_FAILURE_STA:   "Invalid device state",
+            Command.COMMAND_FAILURE_BUS:   "An error occurred during the I2C transaction",
+            Command.COMMAND_FAILURE_RS485: "Invalid RS485-specific command",
+            Command.COMMAND_FAILURE_TOUT:  "Timeout reading from RS485",
+            Command.COMMAND_FAILURE_CMD:   "Invalid command"}.get(cmd, "Unknown error code")
 
 
-def close(handle: serial.Serial) -> None:
+def close(handle: Handle) -> None:
     """
     Close an open ATmega device.
     """
@@ -6,7 +6,8 @@ Usage:
   listATmegaSN <device name>
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -23,6 +24,8 @@ Options:
 
 
 int main(int argc, char* argv[]) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -68,6 +71,7 @@ int main(int argc, char* argv[]) {
           sn.push_back((char) resp.buffer[i]);
         }
         std::cout << "Found " << sn << " at " << dev_name;
+        atmega::cache_update(sn, dev_name);
       }
       
       if( temps ) {
@@ -6,7 +6,8 @@ Usage:
   listATmegaSN <device name>
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -21,6 +22,8 @@ Options:
 
 
 int main(int argc, char* argv[]) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -10,7 +10,8 @@ Usage:
   * Valid power states are 00 (off) and 11 (on)
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -26,6 +27,8 @@ Options:
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -11,7 +11,8 @@ Usage:
   readPSUs <ATmega S/N> <I2C address>
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -124,6 +125,8 @@ std::string getModuleStatus(uint8_t statusCode) {
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -161,7 +164,8 @@ int main(int argc, char** argv) {
     }
     
     // Get a list of smart modules for polling
-    std::list<uint8_t> modules = ivs_get_smart_modules(atm, addr);
+    IVSSession ivs(atm, addr);
+    std::list<uint8_t> modules = ivs.get_smart_modules();
     
     // Enable writing to all of the supported command so we can change 
     // modules/poll module type
@@ -176,7 +180,7 @@ int main(int argc, char** argv) {
     std::string moduleName, modulePower, moduleStatus;
     float voltage = 0.0, current = 0.0;
     for(uint8_t& module: modules) {
-      success = ivs_select_module(atm, addr, module);
+      success = ivs.select_module(module);
       if( !success ) {
         std::cerr << "readPSU - page change failed" << std::endl;
         continue;
@@ -275,8 +279,7 @@ int main(int argc, char** argv) {
               << " " << voltage << " " << current << std::endl;
     
     // Set the module number back to 0
-    data = 0;
-    success = atm->write_i2c(addr, 0x00, (char *) &data, 1);
+    success = ivs.select_module(0);
     if( !success ) {
       std::cout << "readPSU - page change failed" << std::endl;
       continue;
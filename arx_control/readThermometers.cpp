@@ -10,7 +10,8 @@ Usage:
   readThermometers <ATmega S/N>
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 #include <iostream>
@@ -25,6 +26,8 @@ Options:
 #include "ivsCommon.hpp"
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -59,7 +62,8 @@ int main(int argc, char** argv) {
     }
     
     #ifdef __INCLUDE_MODULE_TEMPS__
-      std::list<uint8_t> modules = ivs_get_smart_modules(atm, addr);
+      IVSSession ivs(atm, addr);
+      std::list<uint8_t> modules = ivs.get_smart_modules();
       
       // Enable writing to the PAGE address (0x00) so we can change modules
       success = ivs_enable_operation_page_writes(atm, addr);
@@ -70,7 +74,7 @@ int main(int argc, char** argv) {
       
       // Loop over modules
       for(uint8_t& module: modules) {
-        success = ivs_select_module(atm, addr, module);
+        success = ivs.select_module(module);
         if( !success ) {
           std::cerr << "readThermometers - page change failed" << std::endl;
           continue;
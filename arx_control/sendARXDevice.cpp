@@ -10,7 +10,8 @@ Usage:
   0x1234)
   
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 
@@ -26,6 +27,8 @@ Options:
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -4,10 +4,11 @@ specified device address.  An exit code of zero indicates that
 no errors were encountered.
  
 Usage:
-  sendPICDevice [-q|--quiet] [-d|--decode] <ATmega S/N> <address> <command>
+  sendPICDevice [-q|--quiet] [-d|--decode] [--stats] <ATmega S/N> <address> <command>
   
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 
@@ -60,6 +61,8 @@ void config_to_raw(chan_config& config, uint16_t* raw) {
 
 
 int main(int argc, char** argv) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
    * Command line parsing   *
    *************************/
@@ -6,7 +6,8 @@ Usage:
   readARXDevice <device name>
 
 Options:
-  None
+  --stats       Write the serial link statistics to
+                stderr on exit
 *****************************************************/
 
 
@@ -23,6 +24,8 @@ Options:
 
 
 int main(int argc, char* argv[]) {
+  atmega::stats_flag(&argc, argv);
+  
   /*************************
   * Command line parsing   *
   *************************/
@@ -186,6 +189,10 @@ int main(int argc, char* argv[]) {
     std::exit(EXIT_FAILURE);
   }
   
+  // Update the device cache so that the old serial number no longer maps to
+  // this device
+  atmega::cache_update(device_sn, device_name);
+  
   /*******************
   * Cleanup and exit *
   *******************/
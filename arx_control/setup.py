@@ -14,7 +14,7 @@ class dummy_install(install):
 
 
 ExtensionModules = [Extension('atmegaConfig', ['atmegaConfig.cpp'], include_dirs=['libatmega'], libraries=['m', 'atmega'], extra_compile_args=['-std=c++17'], extra_link_args=['-Llibatmega']),
-                    PBE('atmegaWrap', ['atmegaWrap.cpp'], include_dirs=['libatmega'], libraries=["atmega"],  extra_compile_args=['-std=c++17'], extra_link_args=['-Llibatmega'])]
+                    PBE('atmegaWrap', ['atmegaWrap.cpp', 'aspCommon.cpp', 'ivsCommon.cpp'], include_dirs=['libatmega'], libraries=["atmega"],  extra_compile_args=['-std=c++17'], extra_link_args=['-Llibatmega'])]
 
 
 setup(
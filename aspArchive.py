@@ -0,0 +1,472 @@
+
+"""
+Module for maintaining long-term rollups of the ASP telemetry.
+
+Raw samples are reduced incrementally into 1-minute and 1-hour bins that
+store the number of samples and the min/mean/max of each channel.  Finished
+bins are written to compressed, columnar segment files under /data/archive
+once a block is full or, for the tiers with bins shorter than 
+ARCHIVE_BLOCK_AGE, once the oldest finished bin is more than 
+ARCHIVE_BLOCK_AGE seconds old:
+  * <series>/1m/YYYYMMDD.seg - one file per day for the 1-minute tier
+  * <series>/1h/YYYYMM.seg   - one file per month for the 1-hour tier
+Each segment is a sequence of independent blocks.  A block has a small,
+uncompressed header with the time range and channel names covered by the block
+followed by a zlib-compressed payload of float64 columns (time, count, and then
+min, mean, and max for each channel).  Range queries only need to decompress
+the blocks that overlap with the requested time range.  A bin that was written
+out partially at shutdown and then continued after a restart ends up as two
+rows with the same start time, these are merged back together by the queries.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import zlib
+import errno
+import array
+import atexit
+import struct
+import logging
+import calendar
+import threading
+
+from aspClock import getClock
+
+
+__version__ = '0.1'
+__all__ = ['ARCHIVE_PATH', 'ARCHIVE_BLOCK_AGE', 'ROLLUP_TIERS', 'RollupSeries', 'TelemetryArchiver',
+           'getTelemetryArchiver', 'readSegment', 'queryArchive']
+
+
+aspArchiveLogger = logging.getLogger('__main__')
+
+
+# Default location for the archive
+ARCHIVE_PATH = '/data/archive'
+
+# Default for how long finished bins can wait to be written, in s
+ARCHIVE_BLOCK_AGE = 600.0
+
+# Rollup tiers as (name, bin width in s, rows per block, segment filename format)
+ROLLUP_TIERS = (('1m',   60, 60, '%Y%m%d'),
+                ('1h', 3600, 24, '%Y%m'))
+
+# Block header layout
+_BLOCK_MAGIC = b'ASPB'
+_BLOCK_VERSION = 1
+_BLOCK_STRUCT = struct.Struct('<4sHHIddII')
+
+
+def _pack(values):
+    """
+    Pack a list of floats as little endian float64s.
+    """
+    
+    a = array.array('d', values)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack(data):
+    """
+    Unpack little endian float64s into an array.
+    """
+    
+    a = array.array('d')
+    a.frombytes(data)
+    if sys.byteorder != 'little':
+        a.byteswap()
+    return a
+
+
+class _RollupBin(object):
+    """
+    Class to accumulate the min/mean/max of a set of channels over a single
+    bin.  NaN values are ignored.
+    """
+    
+    def __init__(self, start, nChannels):
+        self.start = start
+        self.count = 0
+        self.mins = [math.inf for i in range(nChannels)]
+        self.maxs = [-math.inf for i in range(nChannels)]
+        self.sums = [0.0 for i in range(nChannels)]
+        self.ns = [0 for i in range(nChannels)]
+        
+    def add(self, values):
+        self.count += 1
+        for i,v in enumerate(values):
+            if v != v:
+                continue
+            if v < self.mins[i]:
+                self.mins[i] = v
+            if v > self.maxs[i]:
+                self.maxs[i] = v
+            self.sums[i] += v
+            self.ns[i] += 1
+            
+    def getRow(self):
+        """
+        Return the bin as a row of (start, count, min0, mean0, max0, ...).
+        """
+        
+        row = [float(self.start), float(self.count)]
+        for mn,mx,s,n in zip(self.mins, self.maxs, self.sums, self.ns):
+            if n:
+                row.extend((mn, s/n, mx))
+            else:
+                row.extend((math.nan, math.nan, math.nan))
+        return row
+
+
+class _RollupTier(object):
+    """
+    Class for a single rollup tier of a series.
+    """
+    
+    def __init__(self, name, width, blockRows, segmentFormat):
+        self.name = name
+        self.width = width
+        self.blockRows = blockRows
+        self.segmentFormat = segmentFormat
+        
+        self.current = None
+        self.rows = []
+        self.segment = None
+        
+    def getSegment(self, t):
+        return time.strftime(self.segmentFormat, time.gmtime(t))
+
+
+class RollupSeries(object):
+    """
+    Class for building the rollups of a single telemetry series and writing
+    them to the archive.  The finished bins of a tier are written as a block
+    once there are enough of them to fill a block.  For tiers whose bins are
+    shorter than maxBlockAge seconds they are also written once the oldest
+    one has been finished for maxBlockAge seconds.  The coarser tiers rely on
+    flush(final=True) at shutdown instead so that they are not broken up into
+    many small blocks.
+    """
+    
+    def __init__(self, name, channels, path=ARCHIVE_PATH, tiers=ROLLUP_TIERS, maxBlockAge=ARCHIVE_BLOCK_AGE):
+        self.name = name
+        self.channels = [str(c) for c in channels]
+        self.path = path
+        self.maxBlockAge = float(maxBlockAge)
+        
+        self.tiers = [_RollupTier(*tier) for tier in tiers]
+        
+    def add(self, values, timestamp=None):
+        """
+        Add a raw sample to all of the rollup tiers.
+        """
+        
+        if timestamp is None:
+            timestamp = getClock().time()
+        if len(values) != len(self.channels):
+            raise ValueError("Expected %i values but found %i" % (len(self.channels), len(values)))
+            
+        for tier in self.tiers:
+            start = math.floor(timestamp / tier.width) * tier.width
+            if tier.current is not None and tier.current.start != start:
+                self._finishBin(tier)
+            if tier.current is None:
+                tier.current = _RollupBin(start, len(self.channels))
+            tier.current.add(values)
+            
+            if tier.width < self.maxBlockAge and tier.rows \
+               and timestamp - (tier.rows[0][0] + tier.width) >= self.maxBlockAge:
+                self._writeBlock(tier)
+                
+    def _finishBin(self, tier):
+        """
+        Move the current bin of a tier into the list of rows to write.
+        """
+        
+        segment = tier.getSegment(tier.current.start)
+        if tier.rows and segment != tier.segment:
+            ## Blocks never span segments
+            self._writeBlock(tier)
+        tier.segment = segment
+        tier.rows.append(tier.current.getRow())
+        tier.current = None
+        
+        if len(tier.rows) >= tier.blockRows:
+            self._writeBlock(tier)
+            
+    def _writeBlock(self, tier):
+        """
+        Write the finished rows of a tier out as a block.
+        """
+        
+        if not tier.rows:
+            return True
+            
+        rows, tier.rows = tier.rows, []
+        columns = []
+        for c in range(len(rows[0])):
+            columns.append(_pack([row[c] for row in rows]))
+        payload = zlib.compress(b''.join(columns), 6)
+        names = json.dumps(self.channels).encode('utf-8')
+        header = _BLOCK_STRUCT.pack(_BLOCK_MAGIC, _BLOCK_VERSION, len(self.channels), len(rows),
+                                    rows[0][0], rows[-1][0] + tier.width, len(names), len(payload))
+                                    
+        dirname = os.path.join(self.path, self.name, tier.name)
+        filename = os.path.join(dirname, '%s.seg' % tier.segment)
+        try:
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            with open(filename, 'ab') as fh:
+                fh.write(header + names + payload)
+        except (IOError, OSError) as e:
+            aspArchiveLogger.error("%s: could not write to archive %s - %s", type(self).__name__, filename, str(e))
+            return False
+        return True
+        
+    def flush(self, final=False):
+        """
+        Write out all finished bins.  If final is True, i.e., on shutdown, the 
+        bins that are still accumulating are also closed and written.  After
+        a restart samples for the same bins go into new rows with the same 
+        start time.
+        """
+        
+        status = True
+        for tier in self.tiers:
+            if final and tier.current is not None:
+                self._finishBin(tier)
+            status &= self._writeBlock(tier)
+        return status
+
+
+class TelemetryArchiver(object):
+    """
+    Class for managing the RollupSeries instances used by the monitors.  A
+    series is created the first time it is added to and is flushed and
+    recreated if its channels change.
+    """
+    
+    def __init__(self, path=ARCHIVE_PATH, maxBlockAge=ARCHIVE_BLOCK_AGE):
+        self.path = path
+        self.maxBlockAge = float(maxBlockAge)
+        
+        self._series = {}
+        self._lock = threading.Lock()
+        
+    def add(self, name, channels, values, timestamp=None):
+        """
+        Add a raw sample to the named series.  Returns True if the sample was
+        added, False otherwise.
+        """
+        
+        try:
+            with self._lock:
+                series = self._series.get(name, None)
+                if series is None or series.channels != list(channels) or series.path != self.path:
+                    if series is not None:
+                        series.flush(final=True)
+                    series = RollupSeries(name, channels, path=self.path, maxBlockAge=self.maxBlockAge)
+                    self._series[name] = series
+                series.maxBlockAge = self.maxBlockAge
+                series.add(values, timestamp=timestamp)
+        except Exception as e:
+            aspArchiveLogger.error("%s: could not add to '%s' - %s", type(self).__name__, name, str(e))
+            return False
+        return True
+        
+    def flush(self, final=False):
+        """
+        Write out all finished bins for all series.  If final is True the bins
+        that are still accumulating are also written.
+        """
+        
+        status = True
+        with self._lock:
+            for series in self._series.values():
+                status &= series.flush(final=final)
+        return status
+
+
+_TELEMETRY_ARCHIVER = None
+_TELEMETRY_ARCHIVER_LOCK = threading.Lock()
+
+
+def getTelemetryArchiver():
+    """
+    Return the TelemetryArchiver instance shared by all of the monitors.
+    """
+    
+    global _TELEMETRY_ARCHIVER
+    
+    with _TELEMETRY_ARCHIVER_LOCK:
+        if _TELEMETRY_ARCHIVER is None:
+            _TELEMETRY_ARCHIVER = TelemetryArchiver()
+            atexit.register(_TELEMETRY_ARCHIVER.flush, final=True)
+        return _TELEMETRY_ARCHIVER
+
+
+def readSegment(filename, start=None, stop=None):
+    """
+    Generator that reads the blocks in a segment file that overlap with the
+    time range [start, stop) and yields a three-element tuple of the channel
+    names, the bin start times, and a dictionary of columns keyed by 'count'
+    and by '<channel>/min', '<channel>/mean', and '<channel>/max'.  Blocks
+    outside of the time range are skipped without being decompressed.
+    """
+    
+    with open(filename, 'rb') as fh:
+        while True:
+            header = fh.read(_BLOCK_STRUCT.size)
+            if len(header) < _BLOCK_STRUCT.size:
+                break
+            magic, version, nChannels, nRows, tStart, tStop, nameSize, payloadSize = _BLOCK_STRUCT.unpack(header)
+            if magic != _BLOCK_MAGIC or version != _BLOCK_VERSION:
+                aspArchiveLogger.warning("Corrupted block found in %s, stopping", filename)
+                break
+                
+            if (start is not None and tStop <= start) or (stop is not None and tStart >= stop):
+                fh.seek(nameSize + payloadSize, os.SEEK_CUR)
+                continue
+                
+            names = fh.read(nameSize)
+            payload = fh.read(payloadSize)
+            if len(payload) < payloadSize:
+                ## Partial write at the end of the file
+                break
+            channels = json.loads(names.decode('utf-8'))
+            data = _unpack(zlib.decompress(payload))
+            
+            columns = {}
+            times = data[0:nRows]
+            columns['count'] = data[nRows:2*nRows]
+            for i,c in enumerate(channels):
+                for j,stat in enumerate(('min', 'mean', 'max')):
+                    k = 2 + 3*i + j
+                    columns['%s/%s' % (c, stat)] = data[k*nRows:(k+1)*nRows]
+                    
+            # Trim to the requested range
+            first, last = 0, nRows
+            while first < last and start is not None and times[first] < start:
+                first += 1
+            while last > first and stop is not None and times[last-1] >= stop:
+                last -= 1
+            if first != 0 or last != nRows:
+                times = times[first:last]
+                for key in columns:
+                    columns[key] = columns[key][first:last]
+                    
+            yield channels, times, columns
+
+
+def _getSegmentStarts(tier, start, stop):
+    """
+    Return a list of segment names that cover the time range [start, stop).
+    """
+    
+    name, width, blockRows, segmentFormat = tier
+    tm = time.gmtime(start)
+    if segmentFormat == '%Y%m':
+        t = calendar.timegm((tm.tm_year, tm.tm_mon, 1, 0, 0, 0))
+    else:
+        t = calendar.timegm((tm.tm_year, tm.tm_mon, tm.tm_mday, 0, 0, 0))
+        
+    segments = []
+    while t < stop:
+        segment = time.strftime(segmentFormat, time.gmtime(t))
+        if segment not in segments:
+            segments.append(segment)
+        t += 86400
+    return segments
+
+
+def _mergeRows(times, columns):
+    """
+    Merge rows that share the same bin start time, i.e., a bin that was 
+    written partially before a restart and then continued after it.  The
+    counts are summed, the means are weighted by the counts, and the min. and
+    max. are the min. of the mins and the max. of the maxes.  Returns a 
+    two-element tuple of the merged times and columns.
+    """
+    
+    if len(set(times)) == len(times):
+        return times, columns
+        
+    order = sorted(range(len(times)), key=lambda i: times[i])
+    groups = []
+    for i in order:
+        if groups and times[groups[-1][0]] == times[i]:
+            groups[-1].append(i)
+        else:
+            groups.append([i,])
+            
+    counts = columns.get('count', None)
+    merged = {key:array.array('d') for key in columns}
+    for group in groups:
+        weights = [counts[i] if counts is not None else 1.0 for i in group]
+        for key,column in columns.items():
+            values = [column[i] for i in group]
+            valid = [(v,w) for v,w in zip(values, weights) if v == v]
+            if key == 'count':
+                value = sum(values)
+            elif not valid:
+                value = math.nan
+            elif key.endswith('/min'):
+                value = min(v for v,w in valid)
+            elif key.endswith('/max'):
+                value = max(v for v,w in valid)
+            else:
+                wTotal = sum(w for v,w in valid)
+                if wTotal > 0:
+                    value = sum(v*w for v,w in valid) / wTotal
+                else:
+                    value = sum(v for v,w in valid) / len(valid)
+            merged[key].append(value)
+            
+    return array.array('d', [times[group[0]] for group in groups]), merged
+
+
+def queryArchive(name, start, stop, tier='1m', channels=None, path=ARCHIVE_PATH):
+    """
+    Query the archive for the named series over the time range [start, stop)
+    and return a two-element tuple of the bin start times and a dictionary of
+    columns.  The columns are keyed by 'count' and by '<channel>/min',
+    '<channel>/mean', and '<channel>/max'.  If channels is not None only those
+    channels are returned.  Rows with the same bin start time are merged.
+    """
+    
+    try:
+        tierInfo = [t for t in ROLLUP_TIERS if t[0] == tier][0]
+    except IndexError:
+        raise ValueError("Unknown rollup tier '%s'" % tier)
+        
+    times = array.array('d')
+    columns = {}
+    for segment in _getSegmentStarts(tierInfo, start, stop):
+        filename = os.path.join(path, name, tier, '%s.seg' % segment)
+        if not os.path.exists(filename):
+            continue
+            
+        for blockChannels, blockTimes, blockColumns in readSegment(filename, start=start, stop=stop):
+            nPrevious = len(times)
+            times.extend(blockTimes)
+            
+            keys = ['count',]
+            for c in (blockChannels if channels is None else channels):
+                keys.extend(['%s/min' % c, '%s/mean' % c, '%s/max' % c])
+            for key in keys:
+                if key not in columns:
+                    columns[key] = array.array('d', [math.nan for i in range(nPrevious)])
+                columns[key].extend(blockColumns.get(key, [math.nan for i in range(len(blockTimes))]))
+            for key in columns:
+                if len(columns[key]) < len(times):
+                    columns[key].extend([math.nan for i in range(len(times) - len(columns[key]))])
+                    
+    return _mergeRows(times, columns)
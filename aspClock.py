@@ -0,0 +1,244 @@
+
+"""
+Module for the clock used by the ASP software for timestamps, timeouts, and
+sleeps.
+
+By default the system clock is used.  A VirtualClock can be installed with
+setClock() so that the monitor periods, retry waits, and INI/SHT sleeps take
+no real time, i.e., for running long soak tests against the hardware
+simulator.  Time on a VirtualClock only moves forward when it is advanced,
+either by hand with advance() or, if autoAdvance is True, automatically by
+jumping to the next wakeup once all of the threads waiting on the clock have
+been quiet for settle seconds of real time.
+"""
+
+import time
+import logging
+import threading
+
+
+__version__ = '0.1'
+__all__ = ['SystemClock', 'VirtualClock', 'setClock', 'getClock']
+
+
+aspClockLogger = logging.getLogger('__main__')
+
+
+class SystemClock(object):
+    """
+    Class for a clock that uses the system time.
+    """
+    
+    def time(self):
+        """
+        Return the current wall clock time in seconds since the epoch.
+        """
+        
+        return time.time()
+        
+    def monotonic(self):
+        """
+        Return the value of a clock that never goes backwards in seconds.
+        """
+        
+        return time.monotonic()
+        
+    def sleep(self, interval):
+        """
+        Sleep for the specified number of seconds.
+        """
+        
+        if interval > 0:
+            time.sleep(interval)
+            
+    def wait(self, waitable, timeout=None):
+        """
+        Wait on a threading.Event or threading.Condition for up to timeout
+        seconds.  Returns the same value that waitable.wait() would.
+        """
+        
+        return waitable.wait(timeout)
+
+
+class VirtualClock(object):
+    """
+    Class for a clock where time only moves when it is advanced.  The clock
+    starts at start seconds since the epoch, or the current time if start is
+    None.  If autoAdvance is True a thread jumps the clock to the earliest
+    wakeup once no thread has started or finished waiting on the clock for
+    settle seconds of real time.  Work that is done outside of the clock,
+    i.e., real I/O, should take less than settle seconds so that the clock
+    does not move on while it is in progress.
+    """
+    
+    def __init__(self, start=None, autoAdvance=True, settle=0.005):
+        self.autoAdvance = autoAdvance
+        self.settle = float(settle)
+        
+        self._epoch = time.time() if start is None else float(start)
+        self._origin = time.monotonic()
+        self._elapsed = 0.0
+        
+        self._cond = threading.Condition()
+        self._sleepers = {}
+        self._activity = 0
+        
+        self.thread = None
+        self.alive = threading.Event()
+        
+        # Statistics
+        self.nWaits = 0
+        self.nAdvances = 0
+        
+    def time(self):
+        with self._cond:
+            return self._epoch + self._elapsed
+            
+    def monotonic(self):
+        with self._cond:
+            return self._origin + self._elapsed
+            
+    def sleep(self, interval):
+        self.wait(None, interval)
+        
+    def wait(self, waitable, timeout=None):
+        """
+        Wait on a threading.Event or threading.Condition, or just wait if
+        waitable is None, for up to timeout seconds of virtual time.  Returns
+        the same value that waitable.wait() would.
+        """
+        
+        if timeout is None:
+            return waitable.wait()
+        if timeout <= 0:
+            return self._timedOut(waitable)
+            
+        key = object()
+        with self._cond:
+            self._sleepers[key] = self._elapsed + timeout
+            self._activity += 1
+            self.nWaits += 1
+        if self.autoAdvance:
+            self._startAdvancer()
+            
+        try:
+            while True:
+                with self._cond:
+                    if self._elapsed >= self._sleepers[key]:
+                        return self._timedOut(waitable)
+                    if waitable is None:
+                        self._cond.wait()
+                        continue
+                        
+                ## Check in on the clock every settle seconds while waiting
+                if waitable.wait(self.settle):
+                    return True
+        finally:
+            with self._cond:
+                del self._sleepers[key]
+                self._activity += 1
+                
+    @staticmethod
+    def _timedOut(waitable):
+        """
+        Return what waitable.wait() returns when it times out.
+        """
+        
+        if isinstance(waitable, threading.Event):
+            return waitable.is_set()
+        return False if waitable is not None else None
+        
+    def advance(self, interval):
+        """
+        Move the clock forward by the specified number of seconds and wake up
+        any threads whose wait has ended.
+        """
+        
+        with self._cond:
+            self._elapsed += max(0.0, interval)
+            self.nAdvances += 1
+            self._cond.notify_all()
+            
+    def _startAdvancer(self):
+        """
+        Start the thread that advances the clock if it is not running.
+        """
+        
+        with self._cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.advanceThread)
+                self.thread.daemon = 1
+                self.alive.set()
+                self.thread.start()
+                
+    def stop(self):
+        """
+        Stop advancing the clock automatically, waiting until the advancing
+        thread has finished.
+        """
+        
+        if self.thread is not None:
+            self.alive.clear()
+            self.thread.join()
+            self.thread = None
+            
+    def advanceThread(self):
+        """
+        Thread that jumps the clock to the earliest wakeup once the threads
+        waiting on it have settled.
+        """
+        
+        seen = None
+        while self.alive.is_set():
+            time.sleep(self.settle)
+            
+            with self._cond:
+                if not self._sleepers or self._activity != seen:
+                    seen = self._activity
+                    continue
+                    
+                wakeup = min(self._sleepers.values())
+                if wakeup > self._elapsed:
+                    self._elapsed = wakeup
+                    self.nAdvances += 1
+                    self._cond.notify_all()
+                seen = None
+                
+    def getStatistics(self):
+        """
+        Return a dictionary of the elapsed virtual time, the number of threads
+        waiting, and the wait and advance counts.
+        """
+        
+        with self._cond:
+            return {'elapsed': self._elapsed,
+                    'waiting': len(self._sleepers),
+                    'waits': self.nWaits,
+                    'advances': self.nAdvances}
+
+
+_CLOCK = SystemClock()
+_CLOCK_LOCK = threading.Lock()
+
+
+def setClock(clock=None):
+    """
+    Select the clock used by the ASP software.  If clock is None the system
+    clock is used.
+    """
+    
+    global _CLOCK
+    
+    with _CLOCK_LOCK:
+        _CLOCK = clock if clock is not None else SystemClock()
+        aspClockLogger.info("Using the %s", type(_CLOCK).__name__)
+        
+    return _CLOCK
+
+
+def getClock():
+    """
+    Return the clock used by the ASP software.
+    """
+    
+    return _CLOCK
@@ -3,13 +3,19 @@
 Module for storing the miscellaneous functions used by asp_cmnd for running ASP.
 """
 
-import os
-import time
 import logging
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from aspSUB20 import *
 from aspThreads import *
+from aspClock import getClock
+from aspTelemetry import getTelemetryWriter
+from aspHistory import getHistoryRecorder
+from aspArchive import ARCHIVE_PATH, ARCHIVE_BLOCK_AGE, getTelemetryArchiver
+from aspInventory import INVENTORY_FILE, getHardwareInventory
+from aspUSB import getUSBPresenceTracker
+from aspTrace import RecordingTransport, ReplayTransport
 
 
 __version__ = '0.8'
@@ -125,6 +131,13 @@ class AnalogProcessor(object):
         self.currentState['powerThreads'] = None
         self.currentState['chassisThreads'] = None
         
+        ## INI phase timings
+        self.currentState['iniTimings'] = []
+        
+        ## SHT completion
+        self.shtDone = threading.Event()
+        self.shtDone.set()
+        
         # Board and stand counts
         self.num_boards = 0
         self.num_stands = 0
@@ -133,6 +146,9 @@ class AnalogProcessor(object):
         # Update the configuration
         self.updateConfig()
         
+        # Watch for SUB-20s being added or removed
+        getUSBPresenceTracker().addCallback(self.processUSBChange)
+        
     def updateConfig(self, config=None):
         """
         Update the stored configuration.
@@ -140,6 +156,65 @@ class AnalogProcessor(object):
         
         if config is not None:
             self.config = config
+            
+        # Update how often the telemetry logs are written out
+        getTelemetryWriter().flushInterval = float(self.config.get('telemetry_flush_interval', 30.0))
+        
+        # Update how many rows are kept in the telemetry history
+        getHistoryRecorder().capacity = int(self.config.get('history_capacity', 10080))
+        
+        # Update where, and how often, the long-term telemetry rollups are saved
+        getTelemetryArchiver().path = self.config.get('archive_path', ARCHIVE_PATH)
+        getTelemetryArchiver().maxBlockAge = float(self.config.get('archive_block_age', ARCHIVE_BLOCK_AGE))
+        
+        # Update the circuit breakers used for the SUB-20 functions
+        getRetryPolicy().updateConfig(threshold=self.config.get('breaker_threshold', 3),
+                                      cooldown=self.config.get('breaker_cooldown', 10.0),
+                                      maxCooldown=self.config.get('breaker_max_cooldown', 300.0))
+                                      
+        # Update where the hardware inventory is kept
+        inventory = getHardwareInventory()
+        filename = self.config.get('inventory_file', INVENTORY_FILE)
+        if inventory.filename != filename:
+            inventory.filename = filename
+            inventory.load()
+            
+        # Update how the SUB-20 functions talk to the hardware
+        name = self.config.get('transport', 'tools')
+        if name == 'simulator' and getSimulator() is None:
+            ## Only load the simulator when it is asked for
+            from aspSimulator import HardwareSimulator
+            HardwareSimulator.fromConfig(self.config).install()
+        try:
+            if name == 'replay':
+                filename = self.config.get('transport_replay', '')
+                transport = getTransport()
+                if isinstance(transport, RecordingTransport):
+                    transport = transport.transport
+                if not isinstance(transport, ReplayTransport) or transport.filename != filename:
+                    transport = setTransport(ReplayTransport(filename))
+                transport.speed = float(self.config.get('transport_replay_speed', 1.0))
+            else:
+                transport = setTransport(name)
+        except (IOError, OSError, RuntimeError, ValueError) as e:
+            aspFunctionsLogger.error("Cannot use the '%s' transport, falling back to 'tools': %s", name, str(e))
+            transport = setTransport('tools')
+            
+        # Update the recording of the hardware I/O
+        filename = self.config.get('transport_record', '')
+        if isinstance(transport, RecordingTransport) and transport.filename != filename:
+            transport = setTransport(transport.transport)
+        if filename and not isinstance(transport, RecordingTransport):
+            try:
+                transport = setTransport(RecordingTransport(transport, filename))
+            except (IOError, OSError) as e:
+                aspFunctionsLogger.error("Cannot record the hardware I/O to %s: %s", filename, str(e))
+                
+        if isinstance(transport, RecordingTransport):
+            transport = transport.transport
+        if isinstance(transport, NativeTransport):
+            transport.idleTimeout = float(self.config.get('transport_idle_timeout', 5.0))
+            
         return True
         
     def getState(self):
@@ -182,42 +257,76 @@ class AnalogProcessor(object):
         """
         
         # Start the timer
-        tStart = time.time()
+        tStart = getClock().time()
         
         # Update system state
         self.currentState['ready'] = False
         self.currentState['status'] = 'BOOTING'
         self.currentState['info'] = 'Running INI sequence'
         self.currentState['activeProcess'].append('INI')
+        self.currentState['iniTimings'] = []
         
+        # Give any devices that have been marked as missing another chance
+        getRetryPolicy().reset()
+        
+        # Phase timing helper
+        tPhase = [getClock().time(),]
+        def endPhase(name):
+            tNow = getClock().time()
+            self.currentState['iniTimings'].append((name, tNow - tPhase[0]))
+            aspFunctionsLogger.debug("INI phase '%s' finished in %.3f s", name, tNow - tPhase[0])
+            tPhase[0] = tNow
+            
         # Make sure the SUB-20 is present
-        if os.system('lsusb -d 2886: >/dev/null') == 0:
+        if getUSBPresenceTracker().isPresent():
             # Good, we can continue
-            
-            # Turn off the power supplies
-            self.__rxpProcess(00, internal=True)
-            self.__fepProcess(00, internal=True)
-            time.sleep(5)
-            
-            # Turn on the power supplies
-            self.__rxpProcess(11, internal=True)
-            self.__fepProcess(11, internal=True)
-            time.sleep(1)
-            
-            # Board check - found vs. expected from INI
-            boardsFound = spiCountBoards(self.config['sub20_antenna_mapping'],
+            endPhase('usb-check')
+            
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                # Turn off the power supplies and wait for them to go down
+                for f in [pool.submit(self.__rxpProcess, 00, internal=True),
+                          pool.submit(self.__fepProcess, 00, internal=True)]:
+                    f.result()
+                if not self.__psuWaitProcess(pool, 00):
+                    aspFunctionsLogger.warning("INI: the power supplies did not turn off, continuing anyway")
+                endPhase('power-off')
+                
+                # Turn on the power supplies and wait for them to come up
+                for f in [pool.submit(self.__rxpProcess, 11, internal=True),
+                          pool.submit(self.__fepProcess, 11, internal=True)]:
+                    f.result()
+                psuReady = self.__psuWaitProcess(pool, 11)
+                endPhase('power-on')
+                
+                # Board check - found vs. expected from INI.  The counts are
+                # validated against the hardware inventory first and the
+                # chains are only rescanned if they disagree.
+                inventory = getHardwareInventory()
+                spiCount = pool.submit(inventory.countBoards, self.config['sub20_antenna_mapping'],
+                                       maxRetry=self.config['max_spi_retry'],
+                                       waitRetry=self.config['wait_spi_retry'])
+                rs485Count = pool.submit(inventory.countPICs, self.config['sub20_antenna_mapping'],
                                          maxRetry=self.config['max_spi_retry'],
                                          waitRetry=self.config['wait_spi_retry'])
-            boardsFound2 = rs485CountBoards(self.config['sub20_antenna_mapping'],
-                                            maxRetry=self.config['max_spi_retry'],
-                                            waitRetry=self.config['wait_spi_retry'])
+                boardsFound = spiCount.result()
+                boardsFound2 = rs485Count.result()
             if boardsFound2 != boardsFound:
                 ## Try again...
-                boardsFound2 = rs485CountBoards(self.config['sub20_antenna_mapping'],
-                                                maxRetry=self.config['max_spi_retry'],
-                                                waitRetry=self.config['wait_spi_retry'])
+                boardsFound2 = inventory.countPICs(self.config['sub20_antenna_mapping'],
+                                                   maxRetry=self.config['max_spi_retry'],
+                                                   waitRetry=self.config['wait_spi_retry'],
+                                                   force=True)
+            endPhase('board-count')
+            
+            if not psuReady:
+                self.currentState['status'] = 'ERROR'
+                self.currentState['info'] = 'SUMMARY! 0x%02X %s - Power supplies did not turn on' % (0x0C, subsystemErrorCodes[0x0C])
+                self.currentState['lastLog'] = 'INI: finished with error'
+                self.currentState['ready'] = False
+                
+                aspFunctionsLogger.critical("INI failed; the power supplies did not turn on")
                 
-            if boardsFound == boardsFound2 and boardsFound == nBoards:
+            elif boardsFound == boardsFound2 and boardsFound == nBoards:
                 # Board and stand counts.  NOTE: Stand counts are capped at 260
                 self.num_boards = nBoards
                 self.num_stands = nBoards * self.config['stands_per_board']
@@ -275,6 +384,7 @@ class AnalogProcessor(object):
                 status &= self.currentState['spiThread'].process_command(0, SPI_cfg_output_P20_21_22_23)        # Set outputs
                 status &= self.currentState['spiThread'].process_command(0, SPI_cfg_output_P24_25_26_27)        # Set outputs
                 status &= self.currentState['spiThread'].process_command(0, SPI_cfg_output_P28_29_30_31)        # Set outputs
+                endPhase('spi-config')
                 
                 # Start the threads
                 for t in self.currentState['powerThreads']:
@@ -282,11 +392,12 @@ class AnalogProcessor(object):
                 self.currentState['tempThread'].start()
                 for t in self.currentState['chassisThreads']:
                     t.start()
-                    
+                endPhase('monitor-start')
+                
                 if status:
                     self.currentState['status'] = 'NORMAL'
                     self.currentState['info'] = 'System operating normally'
-                    self.currentState['lastLog'] = 'INI: finished in %.3f s' % (time.time() - tStart,)
+                    self.currentState['lastLog'] = 'INI: finished in %.3f s' % (getClock().time() - tStart,)
                     self.currentState['ready'] = True
                     
                 else:
@@ -312,13 +423,32 @@ class AnalogProcessor(object):
             self.currentState['ready'] = False
             
             aspFunctionsLogger.critical("INI failed due to missing SUB-20 device(s)")
-        
+            
         # Update the current state
-        aspFunctionsLogger.info("Finished the INI process in %.3f s", time.time() - tStart)
+        aspFunctionsLogger.info("Finished the INI process in %.3f s (%s)", getClock().time() - tStart, 
+                                ', '.join(['%s: %.3f s' % phase for phase in self.currentState['iniTimings']]))
         self.currentState['activeProcess'].remove('INI')
         
         return True, 0
-    
+        
+    def __psuWaitProcess(self, pool, state):
+        """
+        Wait for both the ARX and FEE power supplies to reach the requested 
+        state using the provided thread pool.  Returns True if both reached the
+        state, False otherwise.
+        """
+        
+        timeout = self.config.get('psu_settle_timeout', 10.0)
+        offVoltage = self.config.get('psu_off_voltage', 1.0)
+        
+        waits = [pool.submit(psuWaitState, self.config['sub20_i2c_mapping'], address, state, 
+                             timeout=timeout, offVoltage=offVoltage)
+                 for address in (self.config['arx_ps_address'], self.config['fee_ps_address'])]
+        status = True
+        for w in waits:
+            status &= w.result()
+        return status
+        
     def sht(self, mode=''):
         """
         Issue the SHT command to ASP.
@@ -334,18 +464,27 @@ class AnalogProcessor(object):
             self.currentState['lastLog'] = 'SHT: %s - unknown mode %s' % (commandExitCodes[0x07], mode)
             return False, 0x07
             
+        self.shtDone.clear()
         thread = threading.Thread(target=self.__shtProcess, kwargs={'mode': mode})
         thread.setDaemon(1)
         thread.start()
         return True, 0
         
+    def waitForSHT(self, timeout=None):
+        """
+        Wait for a SHT that is in progress to finish.  Returns True if SHT has 
+        finished, False if the timeout was reached first.
+        """
+        
+        return getClock().wait(self.shtDone, timeout)
+        
     def __shtProcess(self, mode=""):
         """
         Thread base to shutdown ASP.  Update the current system state as needed.
         """
         
         # Start the timer
-        tStart = time.time()
+        tStart = getClock().time()
         
         # Update system state
         self.currentState['status'] = 'SHUTDWN'
@@ -353,37 +492,46 @@ class AnalogProcessor(object):
         self.currentState['activeProcess'].append('SHT')
         self.currentState['ready'] = False
         
-        # Stop most threads.
-        if self.currentState['powerThreads'] is not None:
-            for t in self.currentState['powerThreads']:
-                t.stop()
-        if self.currentState['tempThread'] is not None:
-            self.currentState['tempThread'].stop()
-        if self.currentState['chassisThreads'] is not None:
-            for t in self.currentState['chassisThreads']:
-                t.stop()
+        try:
+            # Stop the monitoring threads, all at once
+            monitors = []
+            if self.currentState['powerThreads'] is not None:
+                monitors.extend(self.currentState['powerThreads'])
+            if self.currentState['tempThread'] is not None:
+                monitors.append(self.currentState['tempThread'])
+            if self.currentState['chassisThreads'] is not None:
+                monitors.extend(self.currentState['chassisThreads'])
+            if monitors:
+                with ThreadPoolExecutor(max_workers=len(monitors)) as pool:
+                    for f in [pool.submit(t.stop) for t in monitors]:
+                        f.result()
+                        
+            # Do SPI bus stuff (only if the boards are on and this isn't a SCRAM)
+            if mode.find('SCRAM') == -1 and self.currentState['spiThread'] is not None:
+                if self.getARXPowerSupplyStatus()[1] == 'ON ':
+                    status = self.currentState['spiThread'].process_command(0, SPI_cfg_shutdown)        # Into sleep mode
+                    getClock().sleep(max(0.0, min(self.config.get('sht_settle_time', 5.0), 30.0)))
+                    
+            # Stop the SPI command processor
+            if self.currentState['spiThread'] is not None:
+                self.currentState['spiThread'].stop()
                 
-        # Do SPI bus stuff (only if the boards are on)
-        if self.getARXPowerSupplyStatus()[1] == 'ON ':
-            status = self.currentState['spiThread'].process_command(0, SPI_cfg_shutdown)        # Into sleep mode
-            time.sleep(5)
+            # Power off the power supplies
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                for f in [pool.submit(self.__rxpProcess, 00, internal=True),
+                          pool.submit(self.__fepProcess, 00, internal=True)]:
+                    f.result()
+                    
+            self.currentState['status'] = 'SHUTDWN'
+            self.currentState['info'] = 'System has been shut down'
+            self.currentState['lastLog'] = 'System has been shut down'
             
-        # Stop the SPI command processor
-        if self.currentState['spiThread'] is not None:
-            self.currentState['spiThread'].stop()
+        finally:
+            # Update the current state
+            aspFunctionsLogger.info("Finished the SHT process in %.3f s", getClock().time() - tStart)
+            self.currentState['activeProcess'].remove('SHT')
+            self.shtDone.set()
             
-        # Power off the power supplies
-        self.__rxpProcess(00, internal=True)
-        self.__fepProcess(00, internal=True)
-        
-        self.currentState['status'] = 'SHUTDWN'
-        self.currentState['info'] = 'System has been shut down'
-        self.currentState['lastLog'] = 'System has been shut down'
-        
-        # Update the current state
-        aspFunctionsLogger.info("Finished the SHT process in %.3f s", time.time() - tStart)
-        self.currentState['activeProcess'].remove('SHT')
-        
         return True, 0
         
     def setFilter(self, stand, filterCode):
@@ -851,6 +999,31 @@ class AnalogProcessor(object):
             self.currentState['lastLog'] = 'Invalid stand ID (%i)' % stand
             return False, ()
             
+    def getFEECurrentStatistics(self, stand):
+        """
+        Return the rolling statistics of the FEE current draw (pol 1, pol 2) for a given 
+        stand as a two-element tuple (success, values) where success is a boolean related 
+        to if the statistics were found.  Each element of values is a four-element tuple of
+        EWMA, windowed min., windowed max. (all in A), and rate of change (A/s).  See the 
+        currentState['lastLog'] entry for the reason for failure if the returned success 
+        value is False.
+        """
+        
+        if stand > 0 and stand <= self.num_stands:
+            if self.currentState['chassisThreads'] is None:
+                self.currentState['lastLog'] = 'FEEPOL1STATS: Monitoring processes are not running'
+                return False, ()
+                
+            stats = self.currentState['chassisThreads'][0].getFEECurrentStatistics(stand)
+            if stats[0][0] is None or stats[1][0] is None:
+                self.currentState['lastLog'] = 'FEEPOL1STATS: No data available for stand %i' % stand
+                return False, ()
+                
+            return True, stats
+        else:
+            self.currentState['lastLog'] = 'Invalid stand ID (%i)' % stand
+            return False, ()
+            
     def getRFPower(self, stand):
         """
         Returns the RF power into a 50 ohm load (pol 1, pol 2) for a given stand as a two-
@@ -1156,6 +1329,75 @@ class AnalogProcessor(object):
                 self.currentState['lastLog'] = 'SENSOR-NAME-%i: Invalid temperature sensor' % sensorNumb
                 return False, 0.0
                 
+    def getTempSensorStatistics(self, sensorNumb):
+        """
+        Return the rolling statistics of a temperature sensor as a two-element tuple 
+        (success, values) where success is a boolean related to if the values were found 
+        and values is a four-element tuple of EWMA, windowed min., windowed max. (all in C),
+        and rate of change (C/s).  See the currentState['lastLog'] entry for the reason for 
+        failure if the returned success value is False.
+        """
+        
+        if self.currentState['tempThread'] is None:
+            self.currentState['lastLog'] = 'SENSOR-STATS-%i: Monitoring process is not running' % sensorNumb
+            return False, ()
+            
+        else:
+            if sensorNumb > 0 and sensorNumb <= self.currentState['tempThread'].getSensorCount():
+                value = self.currentState['tempThread'].getTemperatureStatistics(sensorNumb-1)
+                if value[0] is None:
+                    self.currentState['lastLog'] = 'SENSOR-STATS-%i: No data available' % sensorNumb
+                    return False, ()
+                    
+                return True, value
+                
+            else:
+                self.currentState['lastLog'] = 'SENSOR-STATS-%i: Invalid temperature sensor' % sensorNumb
+                return False, ()
+                
+    def getMonitorStatistics(self):
+        """
+        Return the timing statistics for the various monitoring jobs as a two-element
+        tuple (success, values) where success is a boolean related to if the values were
+        found and values is a dictionary keyed by the monitor job name.
+        """
+        
+        return True, getMonitorScheduler().getStatistics()
+        
+    def getRetryStatistics(self):
+        """
+        Return the retry and circuit breaker statistics for the SUB-20 functions
+        as a two-element tuple (success, values) where success is a boolean
+        related to if the values were found and values is a dictionary keyed by
+        device, i.e., '<S/N>/spi', '<S/N>/0x1F', or '<S/N>/<board>'.
+        """
+        
+        return True, getRetryPolicy().getStatistics()
+        
+    def getBusStatistics(self):
+        """
+        Return the bus access statistics for the SUB-20s as a two-element tuple
+        (success, values) where success is a boolean related to if the values
+        were found and values is a dictionary keyed by the SUB-20 S/N.  Each
+        entry has the statistics for the in-process bus scheduler ('scheduler'),
+        for the device lock shared between processes ('lock'), for the
+        batched I2C reads ('i2c'), for the serial link to the ATmega
+        ('link'), and for the transport used to reach the hardware 
+        ('transport').
+        """
+        
+        sub20SNs = set(self.config['sub20_antenna_mapping'].keys())
+        sub20SNs.add(self.config['sub20_i2c_mapping'])
+        
+        stats = {}
+        for sub20SN in sorted(sub20SNs):
+            stats[sub20SN] = {'scheduler': getBusScheduler(sub20SN).getStatistics(),
+                              'lock': atmegaLockStatistics(sub20SN),
+                              'i2c': getI2CSession(sub20SN).getStatistics(),
+                              'link': atmegaLinkStatistics(sub20SN),
+                              'transport': getTransport().getStatistics(sub20SN)}
+        return True, stats
+        
     def processWarningTemperature(self, temp=None, clear=False):
         """
         Function to set ASP to WARNING if the temperature is creeping up.  This 
@@ -1270,13 +1512,31 @@ class AnalogProcessor(object):
                     
         return True
         
+    def processUSBChange(self, action, device):
+        """
+        Function to respond to a SUB-20 being added to or removed from the USB
+        bus.
+        """
+        
+        if action == 'remove':
+            # Don't wait for the monitors to notice
+            if self.currentState['status'] not in ('SHUTDWN', 'BOOTING'):
+                self.processMissingSUB20()
+        else:
+            # Give it a chance right away rather than waiting for the circuit
+            # breakers to cool down
+            aspFunctionsLogger.info('SUB-20 has been added to the list of USB devices')
+            getRetryPolicy().reset()
+            
+        return True
+        
     def processMissingSUB20(self):
         """
         Function to put the system into ERROR if the SUB-20 is missing or dead.
         """
         
         # Try it out
-        if os.system('lsusb -d 2886: >/dev/null') == 0:
+        if getUSBPresenceTracker().isPresent():
             # Nope, it's really there
             return False
             
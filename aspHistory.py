@@ -0,0 +1,487 @@
+
+"""
+Module for storing recent ASP telemetry in fixed-size, memory-mapped ring
+buffers so that the live and recent values can be read by other processes
+without parsing the text logs.
+
+Each series, i.e., 'temp', 'psu-0x1F', or 'fee-power', is stored in its own
+file under /dev/shm/asp-history.  The file starts with a fixed size header:
+  * an 8 byte magic string
+  * the format version, number of channels, ring capacity, and header size as
+    little endian uint32s
+  * a uint64 sequence counter that is odd while a row is being written
+  * a uint64 count of the total number of rows written
+  * the channel names as a JSON-encoded list
+which is followed by the ring itself.  Each row of the ring is a float64
+timestamp followed by one float64 value per channel.  Readers access the ring
+through a memoryview cast to doubles and use the sequence counter to detect
+(and retry) reads that overlap with a write.
+"""
+
+import os
+import json
+import mmap
+import math
+import time
+import errno
+import struct
+import logging
+import threading
+
+from aspClock import getClock
+
+
+__version__ = '0.1'
+__all__ = ['HISTORY_PATH', 'PSU_STATUS_FLAGS', 'encodePSUState', 'HistoryStore',
+           'HistoryReader', 'HistoryRecorder', 'getHistoryRecorder']
+
+
+aspHistoryLogger = logging.getLogger('__main__')
+
+
+# Default location for the ring buffers
+HISTORY_PATH = '/dev/shm/asp-history'
+
+# Header layout
+_MAGIC = b'ASPHIST\x00'
+_FORMAT_VERSION = 1
+_HEADER_STRUCT = struct.Struct('<8sIIIIQQ')
+_HEADER_SIZE = 4096
+_SEQ_OFFSET = 24
+_COUNT_OFFSET = 32
+_U64 = struct.Struct('<Q')
+
+# Bits used to store the power supply status strings
+PSU_STATUS_FLAGS = {'OverTemperature': 0x01,
+                    'OverCurrent':     0x02,
+                    'OverVolt':        0x04,
+                    'UnderVolt':       0x08,
+                    'ModuleFault':     0x10}
+
+
+def encodePSUState(onoff, status):
+    """
+    Convert the on/off and status strings from psuRead into a two-element
+    tuple of floats suitable for storing in a HistoryStore.  The on/off state
+    is 1.0 for on and 0.0 for off and the status is a bitmask of the fault
+    flags in PSU_STATUS_FLAGS.  Unknown values are stored as NaN.
+    """
+    
+    onoff = onoff.strip()
+    if onoff == 'ON':
+        onoff = 1.0
+    elif onoff == 'OFF':
+        onoff = 0.0
+    else:
+        onoff = float('nan')
+        
+    if status == 'UNK':
+        status = float('nan')
+    else:
+        flags = 0
+        for mode,bit in PSU_STATUS_FLAGS.items():
+            if status.find(mode) != -1:
+                flags |= bit
+        status = float(flags)
+        
+    return onoff, status
+
+
+def _getFilename(name, path=HISTORY_PATH):
+    """
+    Return the filename of the ring buffer for the named series.
+    """
+    
+    return os.path.join(path, '%s.ring' % name)
+
+
+class _RingView(object):
+    """
+    Base class with the header parsing and read access that is shared by
+    HistoryStore and HistoryReader.
+    """
+    
+    def _parseHeader(self):
+        magic, version, nChannels, capacity, headerSize, seq, count = _HEADER_STRUCT.unpack_from(self._mm, 0)
+        if magic != _MAGIC:
+            raise ValueError("%s is not an ASP history file" % self.filename)
+        if version != _FORMAT_VERSION:
+            raise ValueError("%s has an unsupported format version %i" % (self.filename, version))
+            
+        names = self._mm[_HEADER_STRUCT.size:headerSize].rstrip(b'\x00')
+        self.channels = json.loads(names.decode('utf-8'))
+        self.capacity = capacity
+        self.headerSize = headerSize
+        self.rowLength = 1 + nChannels
+        self._index = {name:i+1 for i,name in enumerate(self.channels)}
+        
+        self.data = memoryview(self._mm)[self.headerSize:].cast('d')
+        
+    def _getSequence(self):
+        return _U64.unpack_from(self._mm, _SEQ_OFFSET)[0]
+        
+    def _getCount(self):
+        return _U64.unpack_from(self._mm, _COUNT_OFFSET)[0]
+        
+    def _getColumns(self, channels):
+        """
+        Convert a channel name, or a list of channel names, into a list of
+        column indicies.  None selects all channels.
+        """
+        
+        if channels is None:
+            return list(range(1, self.rowLength))
+        if isinstance(channels, str):
+            channels = [channels,]
+        try:
+            return [self._index[c] for c in channels]
+        except KeyError as e:
+            raise KeyError("Unknown channel %s" % str(e))
+            
+    def _readRows(self, first, last, cols, step=1):
+        """
+        Return the rows with logical indicies first through last-1 (stepping
+        by step) as a list of tuples of (timestamp, values...).
+        """
+        
+        data, rowLength, capacity = self.data, self.rowLength, self.capacity
+        rows = []
+        for i in range(first, last, step):
+            base = (i % capacity)*rowLength
+            rows.append((data[base],) + tuple(data[base+c] for c in cols))
+        return rows
+        
+    def _consistent(self, func, maxTries=100):
+        """
+        Run func(count) with a consistent view of the ring, retrying if a
+        write happened while it was running.
+        """
+        
+        for attempt in range(maxTries):
+            seq = self._getSequence()
+            if seq & 1:
+                time.sleep(0.001)
+                continue
+                
+            result = func(self._getCount())
+            if self._getSequence() == seq:
+                return result
+        raise RuntimeError("Could not get a consistent read from %s" % self.filename)
+        
+    def _bisect(self, first, last, t):
+        """
+        Return the first logical index in [first, last) whose timestamp is
+        greater than or equal to t.
+        """
+        
+        data, rowLength, capacity = self.data, self.rowLength, self.capacity
+        while first < last:
+            mid = (first + last) // 2
+            if data[(mid % capacity)*rowLength] < t:
+                first = mid + 1
+            else:
+                last = mid
+        return first
+        
+    def __len__(self):
+        return min(self._getCount(), self.capacity)
+        
+    def latest(self, channels=None):
+        """
+        Return the most recent row as a tuple of (timestamp, values...) or None
+        if nothing has been written yet.
+        """
+        
+        cols = self._getColumns(channels)
+        
+        def _latest(count):
+            if count == 0:
+                return None
+            return self._readRows(count-1, count, cols)[0]
+            
+        return self._consistent(_latest)
+        
+    def range(self, start=None, stop=None, channels=None):
+        """
+        Return a list of the rows with timestamps in [start, stop) as tuples of
+        (timestamp, values...).  A start or stop of None is unbounded.
+        """
+        
+        cols = self._getColumns(channels)
+        
+        def _range(count):
+            first = max(0, count - self.capacity)
+            last = count
+            if start is not None:
+                first = self._bisect(first, last, start)
+            if stop is not None:
+                last = self._bisect(first, last, stop)
+            return self._readRows(first, last, cols)
+            
+        return self._consistent(_range)
+        
+    def decimate(self, interval, start=None, stop=None, channels=None):
+        """
+        Return the rows in [start, stop) averaged into bins of interval
+        seconds as a list of tuples of (bin start, mean values...).  NaN values
+        are ignored when averaging.
+        """
+        
+        rows = self.range(start=start, stop=stop, channels=channels)
+        
+        output = []
+        binStart, sums, counts = None, None, None
+        for row in rows:
+            b = math.floor(row[0] / interval) * interval
+            if b != binStart:
+                if binStart is not None:
+                    output.append((binStart,) + tuple(s/c if c else float('nan') for s,c in zip(sums, counts)))
+                binStart = b
+                sums = [0.0 for v in row[1:]]
+                counts = [0 for v in row[1:]]
+            for i,v in enumerate(row[1:]):
+                if v == v:
+                    sums[i] += v
+                    counts[i] += 1
+        if binStart is not None:
+            output.append((binStart,) + tuple(s/c if c else float('nan') for s,c in zip(sums, counts)))
+        return output
+        
+    def close(self):
+        """
+        Release the memory map.
+        """
+        
+        if self._mm is not None:
+            if self.data is not None:
+                self.data.release()
+                self.data = None
+            self._mm.close()
+            self._mm = None
+
+
+class HistoryStore(_RingView):
+    """
+    Class for writing a series to a memory-mapped ring buffer.  If a ring
+    with the same number of channels and capacity already exists it is reused
+    so that the history survives a restart of asp_cmnd, otherwise a new ring
+    is created and moved into place.  The channel names are not part of the
+    layout and can be changed with setChannels().
+    """
+    
+    def __init__(self, name, channels, capacity=10080, path=HISTORY_PATH):
+        self.name = name
+        self.filename = _getFilename(name, path=path)
+        
+        channels = [str(c) for c in channels]
+        names = self._encodeChannels(channels)
+        rowSize = 8*(1 + len(channels))
+        size = _HEADER_SIZE + int(capacity)*rowSize
+        
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+                
+        self._mm = None
+        self.data = None
+        try:
+            fd = os.open(self.filename, os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        else:
+            try:
+                if os.fstat(fd).st_size == size:
+                    self._mm = mmap.mmap(fd, size)
+                    try:
+                        self._parseHeader()
+                        if self.rowLength != 1 + len(channels) or self.capacity != capacity:
+                            raise ValueError("Layout mis-match")
+                    except ValueError:
+                        self.close()
+            finally:
+                os.close(fd)
+                
+        if self._mm is None:
+            # Start fresh.  The new ring is built off to the side and then 
+            # renamed over the old one so that any reader that still has the 
+            # old one mapped is not affected.
+            tempname = '%s.%i.tmp' % (self.filename, os.getpid())
+            fd = os.open(tempname, os.O_RDWR|os.O_CREAT|os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, size)
+                self._mm = mmap.mmap(fd, size)
+                _HEADER_STRUCT.pack_into(self._mm, 0, _MAGIC, _FORMAT_VERSION, len(channels),
+                                         int(capacity), _HEADER_SIZE, 0, 0)
+                self._mm[_HEADER_STRUCT.size:_HEADER_STRUCT.size+len(names)] = names
+                os.rename(tempname, self.filename)
+            except Exception:
+                if self._mm is not None:
+                    self._mm.close()
+                    self._mm = None
+                os.unlink(tempname)
+                raise
+            finally:
+                os.close(fd)
+            self._parseHeader()
+            
+        # A write that was interrupted, i.e., by a crash, leaves the sequence
+        # counter odd.  The partial row was never counted so just move the
+        # counter on to the next even value.
+        seq = self._getSequence()
+        if seq & 1:
+            _U64.pack_into(self._mm, _SEQ_OFFSET, seq + 1)
+            
+        self._lock = threading.Lock()
+        if self.channels != channels:
+            self._writeChannels(names)
+            
+    @staticmethod
+    def _encodeChannels(channels):
+        names = json.dumps([str(c) for c in channels]).encode('utf-8')
+        if _HEADER_STRUCT.size + len(names) > _HEADER_SIZE:
+            raise ValueError("Too many channel names to fit in the header")
+        return names
+        
+    def _writeChannels(self, names):
+        """
+        Write the encoded channel names to the header and update the channel
+        index.
+        """
+        
+        start = _HEADER_STRUCT.size
+        with self._lock:
+            seq = self._getSequence()
+            _U64.pack_into(self._mm, _SEQ_OFFSET, seq + 1)
+            self._mm[start:_HEADER_SIZE] = names + b'\x00'*(_HEADER_SIZE - start - len(names))
+            _U64.pack_into(self._mm, _SEQ_OFFSET, seq + 2)
+            
+            self.data.release()
+            self._parseHeader()
+            
+    def setChannels(self, channels):
+        """
+        Change the names of the channels without changing the data already in
+        the ring.
+        """
+        
+        if len(channels) != self.rowLength - 1:
+            raise ValueError("Expected %i channel names but found %i" % (self.rowLength-1, len(channels)))
+            
+        names = self._encodeChannels(channels)
+        self._writeChannels(names)
+        
+    def append(self, values, timestamp=None):
+        """
+        Add a row of values to the ring.
+        """
+        
+        if timestamp is None:
+            timestamp = getClock().time()
+        if len(values) != self.rowLength - 1:
+            raise ValueError("Expected %i values but found %i" % (self.rowLength-1, len(values)))
+            
+        with self._lock:
+            seq = self._getSequence()
+            count = self._getCount()
+            base = (count % self.capacity)*self.rowLength
+            
+            _U64.pack_into(self._mm, _SEQ_OFFSET, seq + 1)
+            self.data[base] = float(timestamp)
+            for i,v in enumerate(values):
+                self.data[base+1+i] = float(v)
+            _U64.pack_into(self._mm, _COUNT_OFFSET, count + 1)
+            _U64.pack_into(self._mm, _SEQ_OFFSET, seq + 2)
+
+
+class HistoryReader(_RingView):
+    """
+    Class for read-only access to a ring buffer written by a HistoryStore.
+    The raw ring is available as the data attribute, a memoryview of doubles
+    that is rowLength values wide.
+    """
+    
+    def __init__(self, name, path=HISTORY_PATH):
+        self.name = name
+        self.filename = _getFilename(name, path=path)
+        
+        self.data = None
+        fd = os.open(self.filename, os.O_RDONLY)
+        try:
+            self._mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self._parseHeader()
+        
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class HistoryRecorder(object):
+    """
+    Class for managing the HistoryStore instances used by the monitors.  A
+    store is created the first time a series is recorded and is recreated if
+    the number of channels in that series changes.  If only the channel names
+    change the store is relabeled.
+    """
+    
+    def __init__(self, capacity=10080, path=HISTORY_PATH):
+        self.capacity = int(capacity)
+        self.path = path
+        
+        self._stores = {}
+        self._lock = threading.Lock()
+        
+    def record(self, name, channels, values, timestamp=None):
+        """
+        Add a row of values to the named series.  Returns True if the row was
+        recorded, False otherwise.
+        """
+        
+        try:
+            with self._lock:
+                store = self._stores.get(name, None)
+                if store is None or store.rowLength != 1 + len(channels) or store.capacity != self.capacity:
+                    if store is not None:
+                        store.close()
+                    store = HistoryStore(name, channels, capacity=self.capacity, path=self.path)
+                    self._stores[name] = store
+                elif store.channels != [str(c) for c in channels]:
+                    store.setChannels(channels)
+            store.append(values, timestamp=timestamp)
+        except Exception as e:
+            aspHistoryLogger.error("%s: could not record '%s' - %s", type(self).__name__, name, str(e))
+            return False
+        return True
+        
+    def close(self):
+        """
+        Close all of the stores.
+        """
+        
+        with self._lock:
+            for store in self._stores.values():
+                store.close()
+            self._stores = {}
+
+
+_HISTORY_RECORDER = None
+_HISTORY_RECORDER_LOCK = threading.Lock()
+
+
+def getHistoryRecorder():
+    """
+    Return the HistoryRecorder instance shared by all of the monitors.
+    """
+    
+    global _HISTORY_RECORDER
+    
+    with _HISTORY_RECORDER_LOCK:
+        if _HISTORY_RECORDER is None:
+            _HISTORY_RECORDER = HistoryRecorder()
+        return _HISTORY_RECORDER
@@ -0,0 +1,231 @@
+
+"""
+Module for keeping a persistent inventory of the ASP hardware.
+
+The inventory is keyed by the SUB-20/ATmega serial number and stores what was
+found the last time the hardware was discovered:
+  * device - the device path of the ATmega
+  * boards - the number of ARX boards on the SPI chain
+  * pics - the RS485 addresses of the PIC devices
+  * thermometers - the number of PSU temperature sensors on the I2C bus
+  * psus - the I2C addresses of the power supplies
+  * psu_modules - the number of power supply modules
+  * updated - when the entry was last updated
+During INI each chain is checked against the inventory with a single, cheap
+probe and is only rediscovered if the probe disagrees with the inventory.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+
+from aspSUB20 import atmegaList, spiCountBoards, rs485ListBoards, rs485Probe, psuRead, psuList, psuCountTemperature
+from aspSUB20 import MAX_SPI_RETRY, WAIT_SPI_RETRY, MAX_RS485_RETRY, WAIT_RS485_RETRY
+
+
+__version__ = '0.1'
+__all__ = ['INVENTORY_FILE', 'HardwareInventory', 'getHardwareInventory']
+
+
+aspInventoryLogger = logging.getLogger('__main__')
+
+
+# Default location for the inventory
+INVENTORY_FILE = '/lwa/runtime/asp_inventory.json'
+
+
+class HardwareInventory(object):
+    """
+    Class for loading, validating, and saving the hardware inventory.
+    """
+    
+    def __init__(self, filename=INVENTORY_FILE):
+        self.filename = filename
+        
+        self._entries = {}
+        self._lock = threading.RLock()
+        
+        # Statistics
+        self.nProbes = 0
+        self.nRediscoveries = 0
+        
+        self.load()
+        
+    def load(self):
+        """
+        Load the inventory from disk.  Returns True if the inventory was
+        loaded, False otherwise.
+        """
+        
+        with self._lock:
+            self._entries = {}
+            try:
+                with open(self.filename, 'r') as fh:
+                    entries = json.load(fh)
+                if not isinstance(entries, dict):
+                    raise ValueError("Expected a dictionary")
+                self._entries = entries
+            except (IOError, OSError):
+                return False
+            except ValueError as e:
+                aspInventoryLogger.warning("%s: ignoring invalid inventory %s - %s", type(self).__name__, self.filename, str(e))
+                return False
+        return True
+        
+    def save(self):
+        """
+        Write the inventory to disk.  The inventory is written to a temporary
+        file first and then moved into place so that it is never left
+        partially written.  Returns True if the inventory was saved, False
+        otherwise.
+        """
+        
+        with self._lock:
+            tempname = '%s.tmp' % self.filename
+            try:
+                dirname = os.path.dirname(self.filename)
+                if dirname and not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                with open(tempname, 'w') as fh:
+                    json.dump(self._entries, fh, indent=2, sort_keys=True)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                os.rename(tempname, self.filename)
+            except (IOError, OSError) as e:
+                aspInventoryLogger.error("%s: could not save inventory %s - %s", type(self).__name__, self.filename, str(e))
+                return False
+        return True
+        
+    def get(self, sub20SN, key, default=None):
+        """
+        Return a single value from the inventory for the specified SUB-20.
+        """
+        
+        with self._lock:
+            return self._entries.get(str(sub20SN), {}).get(key, default)
+            
+    def update(self, sub20SN, **kwds):
+        """
+        Update the inventory entry for the specified SUB-20 and save the
+        inventory if anything changed.
+        """
+        
+        with self._lock:
+            entry = self._entries.setdefault(str(sub20SN), {})
+            changed = any([entry.get(k, None) != v for k,v in kwds.items()])
+            entry.update(kwds)
+            entry['updated'] = time.time()
+            if changed:
+                self.save()
+                
+    def _refreshDevices(self):
+        """
+        Update the device paths of all ATmegas.
+        """
+        
+        for sub20SN,device in atmegaList().items():
+            self.update(sub20SN, device=device)
+            
+    def countBoards(self, sub20Mapper, maxRetry=MAX_SPI_RETRY, waitRetry=WAIT_SPI_RETRY):
+        """
+        Return the number of ARX boards found on the SPI chains of all
+        SUB-20s.  The chains that are in the inventory are verified with a
+        single SPI transfer and only rescanned if that fails.
+        """
+        
+        nBoards = 0
+        for sub20SN in sorted(sub20Mapper):
+            expected = self.get(sub20SN, 'boards', 0)
+            if expected:
+                self.nProbes += 1
+                
+            n = spiCountBoards({sub20SN: sub20Mapper[sub20SN]}, maxRetry=maxRetry, waitRetry=waitRetry,
+                               expected={sub20SN: expected})
+            if n == 0:
+                return 0
+            if n != expected:
+                aspInventoryLogger.info("%s: SPI chain on %s changed from %i to %i boards", type(self).__name__, sub20SN, expected, n)
+                self.nRediscoveries += 1
+                self._refreshDevices()
+            self.update(sub20SN, boards=n)
+            nBoards += n
+            
+        return nBoards
+        
+    def countPICs(self, sub20Mapper, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY, force=False):
+        """
+        Return the number of PIC devices found on the RS485 buses of all
+        SUB-20s.  The buses that are in the inventory are verified by sending
+        an ECHO to each known address in a single call and are only rescanned
+        if that fails or if force is True.
+        """
+        
+        nBoards = 0
+        for sub20SN in sorted(sub20Mapper):
+            pics = self.get(sub20SN, 'pics', [])
+            if pics and not force:
+                self.nProbes += 1
+                if rs485Probe(sub20SN, pics, maxRetry=0, waitRetry=waitRetry):
+                    nBoards += len(pics)
+                    continue
+                    
+            self.nRediscoveries += 1
+            found = rs485ListBoards(sub20SN, maxRetry=maxRetry, waitRetry=waitRetry)
+            if not found:
+                return 0
+            if found != pics:
+                aspInventoryLogger.info("%s: RS485 bus on %s changed from %i to %i PICs", type(self).__name__, sub20SN, len(pics), len(found))
+                self._refreshDevices()
+            self.update(sub20SN, pics=found)
+            nBoards += len(found)
+            
+        return nBoards
+        
+    def countThermometers(self, sub20SN, force=False):
+        """
+        Return the number of PSU temperature sensors on the I2C bus of the
+        specified SUB-20.  If the bus is in the inventory it is verified by
+        reading the status of the first known power supply and is only
+        rescanned if that fails or if force is True.
+        """
+        
+        psus = self.get(sub20SN, 'psus', [])
+        nTemps = self.get(sub20SN, 'thermometers', 0)
+        if psus and nTemps and not force:
+            self.nProbes += 1
+            if psuRead(sub20SN, psus[0], maxRetry=0):
+                return nTemps
+                
+        self.nRediscoveries += 1
+        psus, nModules = psuList(sub20SN)
+        nTemps = psuCountTemperature(sub20SN)
+        if nTemps:
+            self.update(sub20SN, psus=psus, psu_modules=nModules, thermometers=nTemps)
+        return nTemps
+        
+    def getStatistics(self):
+        """
+        Return a dictionary of the probe and rediscovery counts.
+        """
+        
+        return {'probes': self.nProbes,
+                'rediscoveries': self.nRediscoveries}
+
+
+_HARDWARE_INVENTORY = None
+_HARDWARE_INVENTORY_LOCK = threading.Lock()
+
+
+def getHardwareInventory():
+    """
+    Return the HardwareInventory instance shared by INI and the monitors.
+    """
+    
+    global _HARDWARE_INVENTORY
+    
+    with _HARDWARE_INVENTORY_LOCK:
+        if _HARDWARE_INVENTORY is None:
+            _HARDWARE_INVENTORY = HardwareInventory()
+        return _HARDWARE_INVENTORY
@@ -3,19 +3,44 @@
 Module for storing the various SUB-20 function calls
 """
 
+import os
 import re
+import abc
+import math
 import time
+import array
+import heapq
+import atexit
 import random
+import struct
 import inspect
 import logging
+import itertools
 import threading
 import subprocess
+from contextlib import contextmanager
 from collections import deque
 
+from aspClock import getClock
+
+try:
+    import atmegaWrap
+except ImportError:
+    try:
+        from arx_control import atmegaWrap
+    except ImportError:
+        atmegaWrap = None
+
 __version__ = '0.7'
-__all__ = ['spiCountBoards', 'SPICommandCallback', 'SPIProcessingThread',
-           'psuSend', 'psuRead', 'psuCountTemperature', 'psuTemperature',
-           'rs485CountBoards', 'rs485Reset', 'rs485Sleep', 'rs485Wake', 'rs485Check',
+__all__ = ['BUS_PRIORITY_SAFETY', 'BUS_PRIORITY_CONTROL', 'BUS_PRIORITY_MONITOR', 'BUS_PRIORITY_BULK',
+           'OperationCancelled', 'CancelToken', 'terminateChildren', 'setSimulator', 'getSimulator',
+           'Transport', 'ToolTransport', 'NativeTransport', 'setTransport', 'getTransport',
+           'BusScheduler', 'getBusScheduler', 'RetryPolicy', 'getRetryPolicy',
+           'atmegaList', 'atmegaLockStatistics', 'atmegaLinkStatistics', 'spiCountBoards', 'SPICommandCallback', 'SPIFrames', 'getSPIFrames',
+           'SPIProcessingThread',
+           'psuSend', 'psuRead', 'psuWaitState', 'psuList', 'psuCountTemperature', 'psuTemperature',
+           'I2CSession', 'getI2CSession',
+           'rs485CountBoards', 'rs485ListBoards', 'rs485Probe', 'rs485Reset', 'rs485Sleep', 'rs485Wake', 'rs485Check',
            'rs485SetTime', 'rs485GetTime', 'rs485Power', 'rs485RFPower', 'rs485Temperature',
            'SPI_cfg_normal', 'SPI_cfg_shutdown', 
            'SPI_cfg_output_P12_13_14_15', 'SPI_cfg_output_P16_17_18_19', 'SPI_cfg_output_P20_21_22_23', 'SPI_cfg_output_P24_25_26_27', 'SPI_cfg_output_P28_29_30_31',
@@ -25,7 +50,8 @@ __all__ = ['spiCountBoards', 'SPICommandCallback', 'SPIProcessingThread',
            'SPI_P24_on', 'SPI_P24_off', 'SPI_P25_on', 'SPI_P25_off', 'SPI_P26_on', 'SPI_P26_off', 'SPI_P27_on', 'SPI_P27_off',
            'SPI_P28_on', 'SPI_P28_off', 'SPI_P29_on', 'SPI_P29_off', 'SPI_P30_on', 'SPI_P30_off', 'SPI_P31_on', 'SPI_P31_off',
            'SPI_NoOp',
-           'MAX_SPI_RETRY', 'MAX_I2C_RETRY', 'MAX_RS485_RETRY']
+           'MAX_SPI_RETRY', 'MAX_I2C_RETRY', 'MAX_RS485_RETRY',
+           'TIMEOUT_SPI', 'TIMEOUT_I2C', 'TIMEOUT_RS485', 'TIMEOUT_SCAN']
 
 
 aspSUB20Logger = logging.getLogger('__main__')
@@ -88,6 +114,9 @@ SPI_P31_off = 0x003F
 
 SPI_NoOp = 0x0000
 
+# Marker word that leads every SPI frame
+_SPI_COMMAND_MARKER = 0x0120
+
 # I2C control
 MAX_I2C_RETRY = 4
 WAIT_I2C_RETRY = 0.25
@@ -96,68 +125,1608 @@ WAIT_I2C_RETRY = 0.25
 MAX_RS485_RETRY = 4
 WAIT_RS485_RETRY = 0.25
 
+# Deadlines, in seconds, for a single call to the external tools
+TIMEOUT_SPI = 30.0
+TIMEOUT_I2C = 30.0
+TIMEOUT_RS485 = 30.0
+TIMEOUT_SCAN = 120.0
+
+
+def _sleep(interval, margin_percent=5, token=None):
+    """
+    Helper function to give a slightly random sleep time to help break things
+    up.  If a CancelToken is provided the sleep ends early if the token is
+    cancelled.
+    """
+    
+    interval = interval * random.uniform(1-margin_percent/100., 1+margin_percent/100.)
+    if token is not None:
+        token.wait(interval)
+    else:
+        getClock().sleep(interval)
+
+
+class OperationCancelled(RuntimeError):
+    """
+    Exception raised when an operation is cancelled through its CancelToken.
+    """
+    
+    pass
+
+
+class CancelToken(object):
+    """
+    Class for cancelling hardware operations that are in progress.  A token 
+    is passed to the SUB-20 functions and, once it is cancelled:
+     * any external tool started with the token is terminated
+     * waits for the bus and waits between retries end early
+     * no further attempts are made
+    """
+    
+    def __init__(self):
+        self._event = threading.Event()
+        
+    def cancel(self):
+        """
+        Cancel all operations using this token.
+        """
+        
+        self._event.set()
+        
+    def isCancelled(self):
+        """
+        Return whether or not the token has been cancelled.
+        """
+        
+        return self._event.is_set()
+        
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds for the token to be cancelled.  Returns True
+        if the token was cancelled, False otherwise.
+        """
+        
+        return getClock().wait(self._event, timeout)
+
+
+# How often a running external tool is checked for cancellation
+_CANCEL_POLL_INTERVAL = 0.25
+
+# External tools started by this process
+_CHILDREN = set()
+_CHILDREN_LOCK = threading.Lock()
+
+
+def _terminate(p, grace=1.0):
+    """
+    Terminate a single external tool, escalating to a kill if it has not
+    exited after grace seconds.  Returns the output of the tool.
+    """
+    
+    try:
+        p.terminate()
+        return p.communicate(timeout=grace)
+    except subprocess.TimeoutExpired:
+        p.kill()
+        return p.communicate()
+
+
+# Hardware simulator in use, if any, and the real atmegaWrap module
+_SIMULATOR = None
+_ATMEGAWRAP = atmegaWrap
+
+# Transport selected with setTransport() and the one in use
+_TRANSPORT_NAME = 'tools'
+_TRANSPORT = None
+_TRANSPORT_LOCK = threading.Lock()
+
+
+def setSimulator(simulator):
+    """
+    Route the external tools and the atmegaWrap calls through an 
+    aspSimulator.HardwareSimulator instead of the hardware.  Passing None
+    goes back to the hardware.
+    """
+    
+    global _SIMULATOR, atmegaWrap, _TRANSPORT_NAME, _TRANSPORT
+    
+    _SIMULATOR = simulator
+    atmegaWrap = simulator.getATmegaWrap() if simulator is not None else _ATMEGAWRAP
+    aspSUB20Logger.info("Using %s", 'the hardware simulator' if simulator is not None else 'the hardware')
+    
+    # Rebuild the transport the next time it is needed
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is not None:
+            _TRANSPORT.close()
+            _TRANSPORT = None
+        if simulator is None and _TRANSPORT_NAME == 'simulator':
+            _TRANSPORT_NAME = 'tools'
+
+
+def getSimulator():
+    """
+    Return the aspSimulator.HardwareSimulator in use, or None if the hardware
+    is being used.
+    """
+    
+    return _SIMULATOR
+
+
+def _run(command, timeout, token=None):
+    """
+    Run an external tool and return a three-element tuple of its return code,
+    standard output, and standard error.  If the tool has not finished after
+    timeout seconds, or if the CancelToken is cancelled, only that tool is
+    terminated and the return code is negative.
+    """
+    
+    transport = _TRANSPORT
+    if transport is not None:
+        return transport.run(command, timeout, token=token)
+    return _spawn(command, timeout, token=token)
+
+
+def _spawn(command, timeout, token=None):
+    """
+    Start an external tool, or pass it to the hardware simulator, and wait
+    for it to finish.  See _run().
+    """
+    
+    if _SIMULATOR is not None:
+        return _SIMULATOR.run(command, timeout, token=token)
+        
+    p = subprocess.Popen(command,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         text=True)
+    with _CHILDREN_LOCK:
+        _CHILDREN.add(p)
+        
+    try:
+        tDeadline = time.monotonic() + timeout
+        while True:
+            tRemaining = tDeadline - time.monotonic()
+            try:
+                output, output2 = p.communicate(timeout=max(0.0, min(_CANCEL_POLL_INTERVAL, tRemaining)))
+                return p.returncode, output, output2
+            except subprocess.TimeoutExpired:
+                if token is not None and token.isCancelled():
+                    reason = 'cancelled'
+                    break
+                elif tRemaining <= 0:
+                    reason = 'timed out after %.1f s' % timeout
+                    aspSUB20Logger.warning("'%s' did not finish within %.1f s, terminating PID %i", ' '.join(command), timeout, p.pid)
+                    break
+                    
+        output, output2 = _terminate(p)
+        return (p.returncode if p.returncode < 0 else -1), output, '%s%s' % (output2, reason)
+        
+    finally:
+        with _CHILDREN_LOCK:
+            _CHILDREN.discard(p)
+
+
+def terminateChildren(grace=1.0):
+    """
+    Terminate any external tools started by this process that are still
+    running.  Other copies of the tools, i.e., ones started from the command
+    line, are left alone.
+    """
+    
+    with _CHILDREN_LOCK:
+        children = list(_CHILDREN)
+        
+    for p in children:
+        try:
+            p.terminate()
+        except OSError:
+            pass
+            
+    tDeadline = time.monotonic() + grace
+    for p in children:
+        while p.poll() is None and time.monotonic() < tDeadline:
+            time.sleep(0.05)
+        if p.poll() is None:
+            try:
+                p.kill()
+            except OSError:
+                pass
+
+
+atexit.register(terminateChildren)
+
+
+# Bus access priorities, highest first
+BUS_PRIORITY_SAFETY = 0
+BUS_PRIORITY_CONTROL = 1
+BUS_PRIORITY_MONITOR = 2
+BUS_PRIORITY_BULK = 3
+
+_BUS_PRIORITY_NAMES = {BUS_PRIORITY_SAFETY:  'safety',
+                       BUS_PRIORITY_CONTROL: 'control',
+                       BUS_PRIORITY_MONITOR: 'monitor',
+                       BUS_PRIORITY_BULK:    'bulk'}
+
+
+class BusScheduler(object):
+    """
+    Class for ordering access to a single SUB-20/ATmega between the threads of
+    this process.  Each access is made in one of four priority lanes:
+     * BUS_PRIORITY_SAFETY for SCRAM and power off
+     * BUS_PRIORITY_CONTROL for commands and INI
+     * BUS_PRIORITY_MONITOR for the periodic monitoring
+     * BUS_PRIORITY_BULK for the long RS485 telemetry sweeps
+    When the bus is released it goes to the waiter in the highest priority 
+    lane, first come first served within a lane.  Long sweeps acquire the bus
+    once per board so that higher priority accesses are slotted in between
+    boards rather than waiting for the whole sweep.
+    """
+    
+    def __init__(self, sub20SN):
+        self.sub20SN = sub20SN
+        
+        self._cond = threading.Condition()
+        self._busy = False
+        self._waiting = []
+        self._counter = itertools.count()
+        
+        # Statistics
+        self._stats = {}
+        for priority in _BUS_PRIORITY_NAMES:
+            self._stats[priority] = {'count': 0, 'wait_total': 0.0, 'wait_max': 0.0, 'hold_total': 0.0, 'hold_max': 0.0}
+        self._holdStart = None
+        self._holdPriority = None
+        
+    def acquire(self, priority=BUS_PRIORITY_CONTROL, token=None):
+        """
+        Block until the bus is available for the specified priority.  If a
+        CancelToken is provided and it is cancelled while waiting an 
+        OperationCancelled exception is raised.
+        """
+        
+        tStart = getClock().monotonic()
+        ticket = (priority, next(self._counter))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            while self._busy or self._waiting[0] != ticket:
+                if token is not None:
+                    if token.isCancelled():
+                        self._waiting.remove(ticket)
+                        heapq.heapify(self._waiting)
+                        self._cond.notify_all()
+                        raise OperationCancelled("Cancelled while waiting for the bus")
+                    self._cond.wait(_CANCEL_POLL_INTERVAL)
+                else:
+                    self._cond.wait()
+            heapq.heappop(self._waiting)
+            self._busy = True
+            
+            tNow = getClock().monotonic()
+            stats = self._stats[priority]
+            stats['count'] += 1
+            stats['wait_total'] += tNow - tStart
+            stats['wait_max'] = max(stats['wait_max'], tNow - tStart)
+            self._holdStart = tNow
+            self._holdPriority = priority
+            
+    def release(self):
+        """
+        Release the bus and hand it to the next waiter.
+        """
+        
+        with self._cond:
+            hold = getClock().monotonic() - self._holdStart
+            stats = self._stats[self._holdPriority]
+            stats['hold_total'] += hold
+            stats['hold_max'] = max(stats['hold_max'], hold)
+            
+            self._busy = False
+            self._cond.notify_all()
+            
+    @contextmanager
+    def access(self, priority=BUS_PRIORITY_CONTROL, token=None):
+        """
+        Context manager for holding the bus at the specified priority.
+        """
+        
+        self.acquire(priority, token=token)
+        try:
+            yield self
+        finally:
+            self.release()
+            
+    def getStatistics(self):
+        """
+        Return a dictionary of access statistics keyed by the priority lane
+        name.  The wait and hold times are in seconds.
+        """
+        
+        with self._cond:
+            output = {}
+            for priority,stats in self._stats.items():
+                count = stats['count']
+                output[_BUS_PRIORITY_NAMES[priority]] = {'count': count,
+                                                         'waiting': len([t for t in self._waiting if t[0] == priority]),
+                                                         'wait_mean': stats['wait_total'] / count if count else 0.0,
+                                                         'wait_max': stats['wait_max'],
+                                                         'hold_mean': stats['hold_total'] / count if count else 0.0,
+                                                         'hold_max': stats['hold_max']}
+            return output
+
+
+_BUS_SCHEDULERS = {}
+_BUS_SCHEDULERS_LOCK = threading.Lock()
+
+
+def getBusScheduler(sub20SN):
+    """
+    Return the BusScheduler instance for the specified SUB-20.
+    """
+    
+    with _BUS_SCHEDULERS_LOCK:
+        try:
+            return _BUS_SCHEDULERS[str(sub20SN)]
+        except KeyError:
+            scheduler = BusScheduler(str(sub20SN))
+            _BUS_SCHEDULERS[str(sub20SN)] = scheduler
+            return scheduler
+
+
+class _CircuitBreaker(object):
+    """
+    Class for tracking the health of a single device.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    
+    def __init__(self, cooldown):
+        self.state = self.CLOSED
+        self.consecutiveFailures = 0
+        self.cooldown = cooldown
+        self.openUntil = 0.0
+        self.successRate = 1.0
+        
+        # Statistics
+        self.operations = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.trips = 0
+        self.rejected = 0
+
+
+class _RetryOperation(object):
+    """
+    Iterator over the attempts allowed for a single operation on a device.
+    The caller calls success() once an attempt works and then stops
+    iterating.  If the iteration runs out the operation has failed.  If a
+    CancelToken is provided the iteration stops once it is cancelled and the
+    outcome is not recorded.  If bypass is True the circuit breaker is
+    ignored, see RetryPolicy.operation().
+    """
+    
+    def __init__(self, policy, key, maxRetry, waitRetry, token=None, bypass=False):
+        self.policy = policy
+        self.key = key
+        self.maxRetry = maxRetry
+        self.waitRetry = waitRetry
+        self.token = token
+        self.bypass = bypass
+        
+        self.attempts = 0
+        self.succeeded = False
+        
+    def _isCancelled(self):
+        return self.token is not None and self.token.isCancelled()
+        
+    def __iter__(self):
+        if self._isCancelled():
+            return
+            
+        nAttempts = self.policy._begin(self.key, self.maxRetry, bypass=self.bypass)
+        for attempt in range(nAttempts):
+            if attempt != 0:
+                _sleep(self.policy.getBackoff(self.waitRetry, attempt), token=self.token)
+                if self._isCancelled():
+                    return
+            self.attempts += 1
+            yield attempt
+            if self.succeeded or self._isCancelled():
+                return
+            self.policy._attempt(self.key, False)
+            
+        if nAttempts > 0:
+            self.policy._finish(self.key, False, self.attempts, bypass=self.bypass)
+            
+    def success(self):
+        """
+        Mark the operation as having succeeded.
+        """
+        
+        self.succeeded = True
+        self.policy._attempt(self.key, True)
+        self.policy._finish(self.key, True, self.attempts, bypass=self.bypass)
+
+
+class RetryPolicy(object):
+    """
+    Class for deciding how many times, and how often, an operation on a
+    device is retried.  Each device (a SUB-20 bus, a PSU, or an ARX board)
+    has a circuit breaker:
+     * closed - operations are retried with exponential backoff up to 
+       maxRetry times.  Once an operation on the device has failed outright
+       the number of retries is cut back in proportion to the observed 
+       per-attempt success rate of the device, so that a failing device does
+       not use up the full retry budget every time.
+     * open - after threshold consecutive operations have failed the device is
+       considered missing and operations fail immediately without touching the
+       hardware.
+     * half-open - once the cooldown has passed a single attempt is let 
+       through as a probe.  If it works the breaker is closed again, otherwise
+       it is reopened with twice the cooldown, up to maxCooldown.
+    """
+    
+    def __init__(self, threshold=3, cooldown=10.0, maxCooldown=300.0):
+        self.threshold = int(threshold)
+        self.cooldown = float(cooldown)
+        self.maxCooldown = float(maxCooldown)
+        
+        self._breakers = {}
+        self._lock = threading.Lock()
+        
+    def updateConfig(self, threshold=None, cooldown=None, maxCooldown=None):
+        """
+        Update the breaker threshold and cooldown times.
+        """
+        
+        with self._lock:
+            if threshold is not None:
+                self.threshold = int(threshold)
+            if cooldown is not None:
+                self.cooldown = float(cooldown)
+            if maxCooldown is not None:
+                self.maxCooldown = float(maxCooldown)
+                
+    def _getBreaker(self, key):
+        try:
+            return self._breakers[key]
+        except KeyError:
+            breaker = _CircuitBreaker(self.cooldown)
+            self._breakers[key] = breaker
+            return breaker
+            
+    def _begin(self, key, maxRetry, bypass=False):
+        """
+        Return how many attempts the next operation on a device is allowed.
+        """
+        
+        with self._lock:
+            breaker = self._getBreaker(key)
+            if bypass:
+                return max(0, maxRetry) + 1
+                
+            tNow = getClock().time()
+            if breaker.state != _CircuitBreaker.CLOSED:
+                if tNow < breaker.openUntil:
+                    breaker.rejected += 1
+                    return 0
+                    
+                ## Let a single probe through and hold off everyone else until
+                ## it is done (or until another cooldown has passed)
+                breaker.state = _CircuitBreaker.HALF_OPEN
+                breaker.openUntil = tNow + breaker.cooldown
+                return 1
+                
+            if maxRetry <= 0:
+                return 1
+            if breaker.consecutiveFailures == 0:
+                ## Healthy device - full retry budget
+                return maxRetry + 1
+                
+            ## Failing device - scale the retries by the success rate
+            nRetry = int(math.ceil(maxRetry*breaker.successRate))
+            return max(0, min(maxRetry, nRetry)) + 1
+            
+    def _attempt(self, key, success):
+        """
+        Record the outcome of a single attempt.
+        """
+        
+        with self._lock:
+            breaker = self._getBreaker(key)
+            breaker.successRate += 0.1*((1.0 if success else 0.0) - breaker.successRate)
+            
+    def _finish(self, key, success, nAttempts, bypass=False):
+        """
+        Record the outcome of an operation and update the breaker.  A failed
+        operation that bypassed the breaker is counted but does not trip it.
+        """
+        
+        with self._lock:
+            breaker = self._getBreaker(key)
+            breaker.operations += 1
+            breaker.retries += max(0, nAttempts - 1)
+            if success:
+                breaker.successes += 1
+                breaker.consecutiveFailures = 0
+                if breaker.state != _CircuitBreaker.CLOSED:
+                    aspSUB20Logger.info("%s: '%s' is responding again, closing its circuit breaker", type(self).__name__, key)
+                    breaker.state = _CircuitBreaker.CLOSED
+                    breaker.cooldown = self.cooldown
+            elif bypass:
+                breaker.failures += 1
+            else:
+                breaker.failures += 1
+                breaker.consecutiveFailures += 1
+                if breaker.state == _CircuitBreaker.HALF_OPEN:
+                    breaker.state = _CircuitBreaker.OPEN
+                    breaker.cooldown = min(2*breaker.cooldown, self.maxCooldown)
+                    breaker.openUntil = getClock().time() + breaker.cooldown
+                    breaker.trips += 1
+                elif breaker.state == _CircuitBreaker.CLOSED and breaker.consecutiveFailures >= self.threshold:
+                    aspSUB20Logger.warning("%s: '%s' failed %i operations in a row, opening its circuit breaker for %.1f s", type(self).__name__, key, breaker.consecutiveFailures, breaker.cooldown)
+                    breaker.state = _CircuitBreaker.OPEN
+                    breaker.openUntil = getClock().time() + breaker.cooldown
+                    breaker.trips += 1
+                    
+    def getBackoff(self, waitRetry, attempt):
+        """
+        Return how long to wait before the specified retry.
+        """
+        
+        return waitRetry * min(2**(attempt-1), 16)
+        
+    def operation(self, key, maxRetry, waitRetry, token=None, bypass=False):
+        """
+        Return an iterator over the attempts allowed for an operation on the
+        specified device.  If bypass is True the operation is always given 
+        maxRetry+1 attempts, even if the breaker is open, and a failure does 
+        not count towards tripping the breaker.  This is for operations that
+        have to reach the hardware, like powering off a PSU, and for polling
+        that is expected to fail for a while.
+        """
+        
+        return _RetryOperation(self, key, maxRetry, waitRetry, token=token, bypass=bypass)
+        
+    def reset(self):
+        """
+        Close all circuit breakers and forget the observed success rates.
+        """
+        
+        with self._lock:
+            self._breakers = {}
+            
+    def getStatistics(self):
+        """
+        Return a dictionary of breaker states and counters keyed by device.
+        """
+        
+        with self._lock:
+            output = {}
+            for key,breaker in self._breakers.items():
+                output[key] = {'state': breaker.state,
+                               'success_rate': breaker.successRate,
+                               'operations': breaker.operations,
+                               'successes': breaker.successes,
+                               'failures': breaker.failures,
+                               'retries': breaker.retries,
+                               'trips': breaker.trips,
+                               'rejected': breaker.rejected}
+            return output
+
+
+_RETRY_POLICY = None
+_RETRY_POLICY_LOCK = threading.Lock()
+
+
+def getRetryPolicy():
+    """
+    Return the RetryPolicy instance shared by all of the SUB-20 functions.
+    """
+    
+    global _RETRY_POLICY
+    
+    with _RETRY_POLICY_LOCK:
+        if _RETRY_POLICY is None:
+            _RETRY_POLICY = RetryPolicy()
+        return _RETRY_POLICY
+
+
+def _retry(key, maxRetry, waitRetry, token=None, bypass=False):
+    """
+    Shortcut for getRetryPolicy().operation().
+    """
+    
+    return getRetryPolicy().operation(key, maxRetry, waitRetry, token=token, bypass=bypass)
+
+
+def atmegaList():
+    """
+    Return a dictionary of the device paths of all ATmega devices keyed by 
+    serial number.
+    """
+    
+    devices = {}
+    try:
+        ## NOTE: listATmegaSN talks to every device so it does not go through
+        ##       any one bus scheduler
+        returncode, output, output2 = _run(['/usr/local/bin/listATmegaSN',], TIMEOUT_SCAN)
+        
+        for line in output.split('\n'):
+            fields = line.split()
+            if len(fields) >= 4 and fields[0] == 'Found' and fields[2] == 'at':
+                devices[fields[1]] = fields[3]
+                
+    except Exception as e:
+        aspSUB20Logger.warning("Could not list ATmega devices: %s", str(e))
+        
+    return devices
+
+
+# Layout of the shared memory lock statistics in aspCommon.hpp
+_LOCK_STATS_STRUCT = struct.Struct('<IIQQQQQQQi16sQQ')
+_LOCK_STATS_MAGIC = 0x4B4C5341
+_LOCK_STATS_VERSION = 2
+
+
+def atmegaLockStatistics(sub20SN):
+    """
+    Return a dictionary of the device lock statistics for the specified 
+    SUB-20/ATmega.  This includes how many times the lock was acquired, how 
+    many of those had to wait, how many attempts timed out, how many times
+    the lock was recovered from a holder that died, the mean and 
+    maximum wait and hold times in seconds, and who currently holds the lock.
+    Returns None if no statistics are available.
+    """
+    
+    try:
+        with open('/dev/shm/atmega-%s.stats' % sub20SN, 'rb') as fh:
+            data = fh.read(_LOCK_STATS_STRUCT.size)
+        magic, version, acquired, contended, timeouts, waitTotal, waitMax, holdTotal, holdMax, pid, name, since, recovered = _LOCK_STATS_STRUCT.unpack(data)
+    except (IOError, OSError, struct.error):
+        return None
+    if magic != _LOCK_STATS_MAGIC or version != _LOCK_STATS_VERSION:
+        return None
+        
+    holder = None
+    if pid != 0:
+        holder = {'pid': pid,
+                  'name': name.split(b'\x00', 1)[0].decode('ascii', 'replace'),
+                  'since': since / 1e6}
+                  
+    return {'acquired': acquired,
+            'contended': contended,
+            'timeouts': timeouts,
+            'recovered': recovered,
+            'wait_mean': waitTotal / 1e6 / acquired if acquired else 0.0,
+            'wait_max': waitMax / 1e6,
+            'hold_mean': holdTotal / 1e6 / acquired if acquired else 0.0,
+            'hold_max': holdMax / 1e6,
+            'holder': holder}
+
+
+def atmegaLinkStatistics(sub20SN):
+    """
+    Return the serial link statistics for the calls made to the specified 
+    SUB-20 from this process through the atmegaWrap module as a dictionary
+    keyed by command type ('system', 'spi', 'rs485', and 'i2c').  Returns an
+    empty dictionary if atmegaWrap is not available or there have been no
+    calls.  The external tools report their own statistics with --stats.
+    """
+    
+    if atmegaWrap is None:
+        return {}
+        
+    device = atmegaWrap.cache_lookup(str(sub20SN))
+    if not device:
+        return {}
+    return atmegaWrap.get_link_stats().get(device, {})
+
+
+def spiCountBoards(sub20Mapper, maxRetry=MAX_SPI_RETRY, waitRetry=WAIT_SPI_RETRY, expected=None):
+    """
+    Count the number of ARX stands on all known SUB-20s.  If expected is a 
+    dictionary of board counts keyed by SUB-20 S/N those counts are checked 
+    first with a single SPI transfer and the full scan is only done if the 
+    check fails.
+    """
+    
+    if expected is None:
+        expected = {}
+        
+    nBoards = 0
+    overallStatus = True
+    for sub20SN in sorted(sub20Mapper):
+        cmd = ['/usr/local/bin/countBoards', str(sub20SN)]
+        if expected.get(sub20SN, None):
+            cmd = ['/usr/local/bin/countBoards', '--expect', str(expected[sub20SN]), str(sub20SN)]
+            
+        status = False
+        op = _retry('%s/spi' % sub20SN, maxRetry, waitRetry)
+        for attempt in op:
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                returncode, output, output2 = _run(cmd, TIMEOUT_SCAN)
+            
+            if returncode <= 0:
+                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, returncode, output, output2)
+                status = False
+            else:
+                nBoards += returncode
+                status = True
+                op.success()
+                break
+             
+        overallStatus &= status
+        
+    if not overallStatus:
+        nBoards = 0
+        
+    return nBoards
+
+
+class SPICommandCallback(object):
+    """
+    Class for executing callbacks after a sucessful SPI command.
+    """
+    
+    def __init__(self, func, *args, **kwds):
+        self._func = func
+        self._args = args
+        self._kwds = kwds
+        
+    def __call__(self):
+        return self._func(*self._args, **self._kwds)
+
+
+class SPIFrames(object):
+    """
+    Class for the preallocated command and response frames used for the SPI
+    chain of a single SUB-20.  The frames are filled in place and passed 
+    directly to atmegaWrap.ATmega.transfer_spi so that nothing is allocated
+    per transfer.  The layout follows CommandQueue in aspCommon.hpp:  the
+    marker word followed by one word per device, last device first.  The
+    frames should only be used while holding the bus for the SUB-20.
+    """
+    
+    def __init__(self, deviceCount):
+        self.deviceCount = deviceCount
+        self.commands = array.array('H', [0 for i in range(deviceCount+1)])
+        self.responses = array.array('H', [0 for i in range(deviceCount+1)])
+        self._zeros = array.array('H', [0 for i in range(deviceCount)])
+        
+    def clear(self):
+        """
+        Reset the command frame to the marker followed by no-ops.
+        """
+        
+        self.commands[0] = _SPI_COMMAND_MARKER
+        self.commands[1:] = self._zeros
+        
+    def plan(self, devices, values, read=False):
+        """
+        Generator that fills the command frame for each of the transfers
+        needed to send the values to the devices and yields the frame.  If a
+        device appears more than once its values are sent in order over
+        consecutive transfers.  If read is True the values are register
+        reads rather than commands.
+        """
+        
+        queues = {}
+        for dev,value in zip(devices, values):
+            if dev < 1 or dev > self.deviceCount:
+                raise ValueError("Invalid device number %i" % dev)
+            if read:
+                value |= 0x0080
+            try:
+                queues[dev].append(value)
+            except KeyError:
+                queues[dev] = deque([value,])
+                
+        while queues:
+            self.clear()
+            for dev in list(queues.keys()):
+                self.commands[self.deviceCount - dev + 1] = queues[dev].popleft()
+                if not queues[dev]:
+                    del queues[dev]
+            yield self.commands
+            
+    def getMarker(self):
+        """
+        Return the marker word from the response frame.
+        """
+        
+        return self.responses[self.deviceCount]
+        
+    def getReads(self):
+        """
+        Return a dictionary of the register values in the response frame
+        keyed by device number.  Devices that returned nothing are skipped.
+        """
+        
+        data = {}
+        for j in range(self.deviceCount):
+            value = self.responses[self.deviceCount-1-j]
+            if value != 0:
+                data[j+1] = value ^ 0x0080
+        return data
+
+
+_SPI_FRAMES = {}
+_SPI_FRAMES_LOCK = threading.Lock()
+
+
+def getSPIFrames(sub20SN, deviceCount):
+    """
+    Return the SPIFrames instance for the specified SUB-20, replacing it if
+    the number of devices on the chain has changed.
+    """
+    
+    with _SPI_FRAMES_LOCK:
+        frames = _SPI_FRAMES.get(str(sub20SN), None)
+        if frames is None or frames.deviceCount != deviceCount:
+            frames = SPIFrames(deviceCount)
+            _SPI_FRAMES[str(sub20SN)] = frames
+        return frames
+
+
+# Layout of the register values printed by readARXDevice
+_REGISTER_RE = re.compile(r'(?P<device>\d*): (?P<register>0x[0-9a-fA-F]*)')
+
+
+def _i2cWord(data):
+    """
+    Convert the bytes from a two byte I2C read into an integer.
+    """
+    
+    return data[0] | (data[1] << 8)
+
+
+def _formatPICReply(command, status, size, reply, decode=False):
+    """
+    Format the reply from a PIC the same way that sendPICDevice does in 
+    verbose mode.  If decode is True the reply is also decoded for the 
+    commands that are used here:  ECHO, GTIM, CURA, POWA, OWTE, TEMP, and 
+    OWDC.
+    """
+    
+    lines = ["Received: %iB with status %i" % (size, status),
+             "Response: \"%s\"" % reply.replace('\\', '\\\\').replace('"', '\\"')]
+    if decode:
+        if command[:4] == 'ECHO':
+            lines.append("Echo response: %s" % reply[4:])
+        elif command == 'GTIM':
+            lines.append("Board Time: %i s" % int(reply, 16))
+        elif command in ('CURA', 'POWA', 'OWTE'):
+            for i in range(size//4):
+                value = int(reply[4*i:4*i+4], 16)
+                if command == 'CURA':
+                    lines.append("%i: %.1f mA" % (i+1, value*3.3/1024/2.06*1000))
+                elif command == 'POWA':
+                    value = (value*3.3/1024/2.296)**2/50*1000*1000
+                    lines.append("%i: %.1f uW %.1f dBm" % (i+1, value, 10*math.log10(value/1000) if value > 0 else -math.inf))
+                else:
+                    lines.append("%i: %.1f C" % (i+1, value*0.0625))
+        elif command == 'TEMP':
+            lines.append("PIC Temperature: %.1f C" % (int(reply, 16)*0.1))
+        elif command == 'OWDC':
+            lines.append("Number of Temp. Sensors: %i" % int(reply, 16))
+    return '\n'.join(lines) + '\n'
+
+
+class Transport(abc.ABC):
+    """
+    Base class for the ways of talking to the hardware behind a SUB-20.  A 
+    transport makes a single attempt at each operation and raises a 
+    RuntimeError if it fails.  The retries, the circuit breakers, and the bus
+    scheduling are left to the SUB-20 functions that use it so the caller 
+    needs to hold the bus for the SUB-20.  The scans done during INI, i.e., 
+    countBoards and countPICs, always use the external tools.
+    
+    Subclasses must implement the SPI, power supply, and RS485 operations.
+    i2cSweep() is optional and only needs to be provided if batched is True.
+    """
+    
+    name = None
+    
+    # Whether or not i2cSweep() is available
+    batched = False
+    
+    def __init__(self):
+        self._stats = {}
+        self._statsLock = threading.Lock()
+        
+    def _record(self, sub20SN, success):
+        """
+        Update the call and failure counts for a SUB-20.
+        """
+        
+        with self._statsLock:
+            stats = self._stats.setdefault(str(sub20SN), {'calls': 0, 'failures': 0})
+            stats['calls'] += 1
+            if not success:
+                stats['failures'] += 1
+                
+    @contextmanager
+    def _counted(self, sub20SN):
+        """
+        Context manager that counts a single operation on a SUB-20.
+        """
+        
+        try:
+            yield
+        except Exception:
+            self._record(sub20SN, False)
+            raise
+        self._record(sub20SN, True)
+        
+    @abc.abstractmethod
+    def spiTransfer(self, sub20SN, deviceCount, devices, values, token=None):
+        """
+        Send SPI commands to the devices on the chain of a SUB-20.
+        """
+        
+        raise NotImplementedError
+        
+    @abc.abstractmethod
+    def spiRead(self, sub20SN, deviceCount, devices, registers, token=None):
+        """
+        Read SPI registers from the devices on the chain of a SUB-20 and 
+        return a dictionary of register values keyed by device number.
+        """
+        
+        raise NotImplementedError
+        
+    @abc.abstractmethod
+    def psuRead(self, sub20SN, psuAddress, token=None):
+        """
+        Read the power supply at the provided I2C address and return a 
+        dictionary in the format returned by psuRead().
+        """
+        
+        raise NotImplementedError
+        
+    @abc.abstractmethod
+    def psuWrite(self, sub20SN, psuAddress, state, token=None):
+        """
+        Turn the power supply at the provided I2C address on (11) or off 
+        (00).
+        """
+        
+        raise NotImplementedError
+        
+    @abc.abstractmethod
+    def psuTemperature(self, sub20SN, token=None):
+        """
+        Read the power supply temperatures and return a list in the format
+        returned by psuTemperature().
+        """
+        
+        raise NotImplementedError
+        
+    def i2cSweep(self, sub20SN, token=None):
+        """
+        Read everything on the I2C bus and return a two-element tuple of a 
+        dictionary of power supply data keyed by I2C address and a list of
+        temperatures.  This is optional and is only available if batched
+        is True.
+        """
+        
+        raise NotImplementedError
+        
+    @abc.abstractmethod
+    def rs485Send(self, sub20SN, address, command, decode=False, token=None):
+        """
+        Send a command to the PIC at the provided RS485 address and return 
+        what sendPICDevice would print for it, decoded if decode is True.
+        """
+        
+        raise NotImplementedError
+        
+    @abc.abstractmethod
+    def rs485Echo(self, sub20SN, addresses, token=None):
+        """
+        Send an ECHO to all of the PICs at the provided RS485 addresses.
+        """
+        
+        raise NotImplementedError
+        
+    def release(self, sub20SN=None):
+        """
+        Release any devices that the transport is holding open for one, or
+        if sub20SN is None all, SUB-20s.
+        """
+        
+        pass
+        
+    @contextmanager
+    def suspend(self):
+        """
+        Context manager that keeps the transport from holding any devices 
+        open for as long as it is active.
+        """
+        
+        yield
+        
+    def run(self, command, timeout, token=None):
+        """
+        Run an external tool, see _run().
+        """
+        
+        ## Let go of any ATmegas that are held open in-process so that the 
+        ## tool is not kept waiting on the device lock
+        with self.suspend():
+            return _spawn(command, timeout, token=token)
+            
+    def close(self):
+        """
+        Release everything and stop any background activity.
+        """
+        
+        self.release()
+        
+    def getModuleStatistics(self, sub20SN):
+        """
+        Return a dictionary of the per-module page change statistics from the
+        last pass over the I2C bus keyed by power supply address.
+        """
+        
+        return {}
+        
+    def getStatistics(self, sub20SN):
+        """
+        Return a dictionary of the name of the transport and the number of 
+        operations and failures for the specified SUB-20.
+        """
+        
+        with self._statsLock:
+            stats = dict(self._stats.get(str(sub20SN), {'calls': 0, 'failures': 0}))
+        stats['transport'] = self.name
+        return stats
+
+
+class ToolTransport(Transport):
+    """
+    Transport that runs the command line tools in /usr/local/bin for every
+    operation.
+    """
+    
+    name = 'tools'
+    
+    def __init__(self, path='/usr/local/bin'):
+        Transport.__init__(self)
+        self.path = path
+        
+    def _call(self, tool, args, timeout, token=None):
+        """
+        Run a tool and return its standard output.  Raises a RuntimeError if
+        the tool fails.
+        """
+        
+        command = [os.path.join(self.path, tool),] + [str(arg) for arg in args]
+        returncode, output, output2 = self.run(command, timeout, token=token)
+        if token is not None and token.isCancelled():
+            raise OperationCancelled("%s was cancelled" % tool)
+        if returncode != 0:
+            raise RuntimeError("%s returned %i: %s" % (tool, returncode, (output2 or output).strip().replace('\n', ' - ')))
+        return output
+        
+    def spiTransfer(self, sub20SN, deviceCount, devices, values, token=None):
+        args = [sub20SN, deviceCount]
+        for dev,value in zip(devices, values):
+            args.extend([dev, "0x%04X" % value])
+            
+        with self._counted(sub20SN):
+            self._call('sendARXDevice', args, TIMEOUT_SPI, token=token)
+            
+    def spiRead(self, sub20SN, deviceCount, devices, registers, token=None):
+        args = [sub20SN, deviceCount]
+        for dev,reg in zip(devices, registers):
+            args.extend([dev, "0x%04X" % reg])
+            
+        with self._counted(sub20SN):
+            output = self._call('readARXDevice', args, TIMEOUT_SPI, token=token)
+            
+        data = {}
+        for line in output.split('\n'):
+            mtch = _REGISTER_RE.search(line)
+            if mtch:
+                data[int(mtch.group('device'), 10)] = int(mtch.group('register'), 16)
+        return data
+        
+    def psuRead(self, sub20SN, psuAddress, token=None):
+        with self._counted(sub20SN):
+            output = self._call('readPSU', [sub20SN, '0x%02X' % psuAddress], TIMEOUT_I2C, token=token)
+            
+        psu, desc, onoffHuh, statusHuh, voltageV, currentA, = output.replace('\n', '').split(None, 5)
+        return {'address': psu,
+                'description': desc,
+                'voltage': float(voltageV),
+                'current': float(currentA),
+                'onoff': '%-3s' % onoffHuh,
+                'status': statusHuh
+               }
+               
+    def psuWrite(self, sub20SN, psuAddress, state, token=None):
+        with self._counted(sub20SN):
+            self._call('onoffPSU', [sub20SN, '0x%02X' % psuAddress, state], TIMEOUT_I2C, token=token)
+            
+    def psuTemperature(self, sub20SN, token=None):
+        with self._counted(sub20SN):
+            output = self._call('readThermometers', [sub20SN,], TIMEOUT_I2C, token=token)
+            
+        temps = []
+        for line in output.split('\n'):
+            if len(line) < 4:
+                continue
+            psu, desc, tempC = line.split(None, 2)
+            temps.append({'address': psu,
+                          'description': desc,
+                          'temp_C': float(tempC)
+                         })
+        return temps
+        
+    def rs485Send(self, sub20SN, address, command, decode=False, token=None):
+        args = ['-v', '-d'] if decode else []
+        with self._counted(sub20SN):
+            return self._call('sendPICDevice', args + [sub20SN, address, command], TIMEOUT_RS485, token=token)
+            
+    def rs485Echo(self, sub20SN, addresses, token=None):
+        args = ['-q', sub20SN]
+        for addr in addresses:
+            args.extend([addr, 'ECHO'])
+            
+        with self._counted(sub20SN):
+            self._call('sendPICDevice', args, TIMEOUT_RS485, token=token)
+
+
+class _NativeSession(object):
+    """
+    Class for an ATmega that NativeTransport keeps open along with the 
+    buffers used with it.
+    """
+    
+    def __init__(self, sub20SN):
+        self.sub20SN = str(sub20SN)
+        self.atm = None
+        self.lock = threading.RLock()
+        self.lastUsed = 0.0
+        
+        # Buffers that the I2C reads are done into
+        self.byte = bytearray(1)
+        self.word = bytearray(2)
+        
+        # Per-module page change statistics from the last I2C pass
+        self.moduleStatistics = {}
+        
+        # Statistics
+        self.nOpens = 0
+        
+    def close(self):
+        """
+        Close the ATmega, if it is open.
+        """
+        
+        with self.lock:
+            if self.atm is not None:
+                try:
+                    self.atm.close()
+                finally:
+                    self.atm = None
+
+
+class NativeTransport(Transport):
+    """
+    Transport that talks to the ATmegas in-process through the atmegaWrap 
+    module.  Each ATmega is kept open between operations so that bursts of 
+    commands only pay for the open, and the device lock, once.  An ATmega is
+    closed:
+     * after an operation on it fails, so that the next one reopens it
+     * once it has been idle for idleTimeout seconds so that the command line
+       tools can get to it
+     * while any of the external tools are running, see suspend()
+    An idleTimeout of zero closes the ATmega after every operation.
+    """
+    
+    name = 'native'
+    batched = True
+    
+    def __init__(self, wrap, idleTimeout=5.0):
+        Transport.__init__(self)
+        if wrap is None:
+            raise RuntimeError("The atmegaWrap module is not available")
+        self.wrap = wrap
+        self.idleTimeout = float(idleTimeout)
+        
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._suspended = 0
+        
+        self.thread = None
+        self.alive = threading.Event()
+        
+    def _getSession(self, sub20SN):
+        """
+        Return the _NativeSession for a SUB-20.
+        """
+        
+        with self._lock:
+            try:
+                return self._sessions[str(sub20SN)]
+            except KeyError:
+                session = _NativeSession(sub20SN)
+                self._sessions[str(sub20SN)] = session
+                return session
+                
+    @contextmanager
+    def _open(self, sub20SN, token=None):
+        """
+        Context manager that yields the open _NativeSession for a SUB-20,
+        opening the ATmega if needed.
+        """
+        
+        if token is not None and token.isCancelled():
+            raise OperationCancelled("Cancelled before talking to ATmega S/N %s" % sub20SN)
+            
+        session = self._getSession(sub20SN)
+        with session.lock:
+            try:
+                if session.atm is None:
+                    atm = self.wrap.ATmega(str(sub20SN))
+                    if not atm.open():
+                        raise RuntimeError("Failed to open ATmega S/N %s" % sub20SN)
+                    session.atm = atm
+                    session.nOpens += 1
+                    
+                yield session
+                
+            except Exception:
+                self._record(sub20SN, False)
+                session.close()
+                raise
+            else:
+                self._record(sub20SN, True)
+            finally:
+                session.lastUsed = getClock().monotonic()
+                if self._suspended or self.idleTimeout <= 0:
+                    session.close()
+                    
+        if self.idleTimeout > 0:
+            self._startReaper()
+            
+    def _startReaper(self):
+        """
+        Start the thread that closes idle ATmegas if it is not running.
+        """
+        
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.reaperThread)
+                self.thread.daemon = 1
+                self.alive.set()
+                self.thread.start()
+                
+    @staticmethod
+    def _closeIfIdle(session, idleTimeout=None):
+        """
+        Close an ATmega if it is not in use and, if idleTimeout is not None,
+        has been idle for at least idleTimeout seconds.
+        """
+        
+        if not session.lock.acquire(blocking=False):
+            return
+        try:
+            if idleTimeout is None or getClock().monotonic() - session.lastUsed >= idleTimeout:
+                session.close()
+        finally:
+            session.lock.release()
+            
+    def reaperThread(self):
+        """
+        Thread that closes the ATmegas that have been idle for more than
+        idleTimeout seconds.
+        """
+        
+        while self.alive.is_set():
+            getClock().sleep(min(1.0, max(0.05, self.idleTimeout/2.0)))
+            
+            with self._lock:
+                sessions = list(self._sessions.values())
+            for session in sessions:
+                self._closeIfIdle(session, self.idleTimeout)
+                
+    @contextmanager
+    def suspend(self):
+        """
+        Context manager that closes all of the ATmegas and keeps them closed
+        between operations for as long as it is active.  This is used while
+        the external tools are running so that they are not kept waiting on
+        the device lock.
+        """
+        
+        with self._lock:
+            self._suspended += 1
+            sessions = list(self._sessions.values())
+        try:
+            ## ATmegas that are in use are closed once the operation finishes
+            for session in sessions:
+                self._closeIfIdle(session)
+            yield
+        finally:
+            with self._lock:
+                self._suspended -= 1
+                
+    def release(self, sub20SN=None):
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            if sub20SN is None or session.sub20SN == str(sub20SN):
+                session.close()
+                
+    def close(self):
+        if self.thread is not None:
+            self.alive.clear()
+            self.thread.join()
+            self.thread = None
+        self.release()
+        
+    def _spi(self, atm, sub20SN, deviceCount, devices, values, read=False):
+        """
+        Send commands or register reads to the devices on a SPI chain,
+        following what sendARXDevice and readARXDevice do.  Returns a 
+        dictionary of register values keyed by device number for reads and
+        an empty dictionary otherwise.
+        """
+        
+        frames = getSPIFrames(sub20SN, deviceCount)
+        
+        data = {}
+        for commands in frames.plan(devices, values, read=read):
+            for stage in range(2 if read else 1):
+                if stage == 1:
+                    ## Clock the register values out with no-ops
+                    frames.clear()
+                if not atm.transfer_spi(commands, frames.responses):
+                    raise RuntimeError("SPI transfer failed on ATmega S/N %s" % sub20SN)
+                if frames.getMarker() != _SPI_COMMAND_MARKER:
+                    raise RuntimeError("SPI transfer returned a marker of 0x%04X instead of 0x%04X" % (frames.getMarker(), _SPI_COMMAND_MARKER))
+            if read:
+                data.update(frames.getReads())
+        return data
+        
+    def spiTransfer(self, sub20SN, deviceCount, devices, values, token=None):
+        with self._open(sub20SN, token=token) as session:
+            self._spi(session.atm, sub20SN, deviceCount, devices, values)
+            
+    def spiRead(self, sub20SN, deviceCount, devices, registers, token=None):
+        with self._open(sub20SN, token=token) as session:
+            return self._spi(session.atm, sub20SN, deviceCount, devices, registers, read=True)
+            
+    def _readPSU(self, session, addr):
+        """
+        Read the status, voltage, and current of all modules in the power 
+        supply at the provided I2C address.  This follows what readPSU does.
+        """
+        
+        atm = session.atm
+        ivs = self.wrap.IVSSession(atm, addr)
+        modules = ivs.get_smart_modules()
+        if not self.wrap.ivs_enable_all_writes(atm, addr):
+            raise RuntimeError("Write settings failed for PSU 0x%02X" % addr)
+            
+        names, power, status = [], 'UNK', []
+        voltage, current = 0.0, 0.0
+        for module in modules:
+            if not ivs.select_module(module):
+                continue
+            names.append('Module%i' % module)
+            
+            if not atm.read_i2c(addr, 0xDB, session.byte):
+                continue
+            power = 'ON' if session.byte[0] & 1 else 'OFF'
+            status.append('&'.join([flag for bit,flag in ((1, 'UnderVolt'), (2, 'OK'), (3, 'OverCurrent'),
+                                                         (4, 'OverTemperature'), (5, 'WarningTemperature'),
+                                                         (6, 'OverVolt'), (7, 'ModuleFault'))
+                                    if (session.byte[0] >> bit) & 1]) or 'UNK')
+                                    
+            if not atm.read_i2c(addr, 0x8B, session.word):
+                continue
+            voltage += _i2cWord(session.word) / 100.0
+            
+            if not atm.read_i2c(addr, 0x8C, session.word):
+                continue
+            current += _i2cWord(session.word) / 100.0
+            
+        if names:
+            voltage /= len(names)
+            
+        # Set the module number back to 0 and write-protect
+        if not ivs.select_module(0) or not self.wrap.ivs_disable_writes(atm, addr):
+            raise RuntimeError("Could not restore the settings for PSU 0x%02X" % addr)
+        session.moduleStatistics['0x%02X' % addr] = ivs.get_statistics()
+        
+        return {'address': '0x%X' % addr,
+                'description': '|'.join(names),
+                'voltage': voltage,
+                'current': current,
+                'onoff': '%-3s' % power,
+                'status': '|'.join(status)
+               }
+               
+    def _readTemperatures(self, session, addr):
+        """
+        Read the case and primary side temperatures of the power supply at 
+        the provided I2C address.  This follows what readThermometers does.
+        """
+        
+        temps = []
+        for reg,desc in ((0x8D, 'Case'), (0x8E, 'PrimarySide')):
+            if not session.atm.read_i2c(addr, reg, session.word):
+                break
+            temps.append({'address': '0x%X' % addr,
+                          'description': desc,
+                          'temp_C': _i2cWord(session.word) / 4.0
+                         })
+        return temps
+        
+    def psuRead(self, sub20SN, psuAddress, token=None):
+        with self._open(sub20SN, token=token) as session:
+            if psuAddress not in session.atm.list_i2c_devices():
+                raise RuntimeError("Cannot find PSU at address 0x%02X" % psuAddress)
+            return self._readPSU(session, psuAddress)
+            
+    def psuWrite(self, sub20SN, psuAddress, state, token=None):
+        if int(state) not in (0, 11):
+            raise ValueError("Unknown state %i (valid values are 00 and 11)" % int(state))
+            
+        with self._open(sub20SN, token=token) as session:
+            atm = session.atm
+            if psuAddress not in atm.list_i2c_devices():
+                raise RuntimeError("Cannot find PSU at address 0x%02X" % psuAddress)
+                
+            # This follows what onoffPSU does
+            if not self.wrap.ivs_enable_operation_page_writes(atm, psuAddress):
+                raise RuntimeError("Write settings failed for PSU 0x%02X" % psuAddress)
+            session.byte[0] = 0 if int(state) == 0 else (1 << 7)
+            if not atm.write_i2c(psuAddress, 0x01, session.byte):
+                raise RuntimeError("On/off toggle failed for PSU 0x%02X" % psuAddress)
+            getClock().sleep(0.020)
+            if not atm.read_i2c(psuAddress, 0x01, session.byte):
+                raise RuntimeError("Page change failed for PSU 0x%02X" % psuAddress)
+            if not self.wrap.ivs_disable_writes(atm, psuAddress):
+                raise RuntimeError("Write settings failed for PSU 0x%02X" % psuAddress)
+                
+    def psuTemperature(self, sub20SN, token=None):
+        temps = []
+        with self._open(sub20SN, token=token) as session:
+            for addr in session.atm.list_i2c_devices():
+                if addr > 0x1F:
+                    continue
+                temps.extend(self._readTemperatures(session, addr))
+        return temps
+        
+    def i2cSweep(self, sub20SN, token=None):
+        psus, temps = {}, []
+        with self._open(sub20SN, token=token) as session:
+            for addr in session.atm.list_i2c_devices():
+                if addr > 0x1F:
+                    continue
+                psus[addr] = self._readPSU(session, addr)
+                temps.extend(self._readTemperatures(session, addr))
+        return psus, temps
+        
+    def _sendPIC(self, atm, sub20SN, address, command):
+        """
+        Send a command to a PIC and return a three-element tuple of the 
+        status, the reply size, and the reply.  This follows what 
+        sendPICDevice does.
+        """
+        
+        if command == 'WAKE':
+            command = 'W'
+            
+        buffer = bytearray(80)
+        success, size = atm.send_rs485(int(address), command.encode(), buffer)
+        if not success:
+            raise RuntimeError("RS485 send to %s on ATmega S/N %s failed" % (address, sub20SN))
+        reply = bytes(buffer[1:size]).split(b'\x00', 1)[0].decode('ascii', 'replace')
+        return buffer[0], size, reply
+        
+    def rs485Send(self, sub20SN, address, command, decode=False, token=None):
+        with self._open(sub20SN, token=token) as session:
+            status, size, reply = self._sendPIC(session.atm, sub20SN, address, command)
+        return _formatPICReply(command, status, size, reply, decode=decode)
+        
+    def rs485Echo(self, sub20SN, addresses, token=None):
+        with self._open(sub20SN, token=token) as session:
+            for addr in addresses:
+                self._sendPIC(session.atm, sub20SN, addr, 'ECHO')
+                
+    def getModuleStatistics(self, sub20SN):
+        return dict(self._getSession(sub20SN).moduleStatistics)
+        
+    def getStatistics(self, sub20SN):
+        stats = Transport.getStatistics(self, sub20SN)
+        session = self._getSession(sub20SN)
+        stats['opens'] = session.nOpens
+        stats['open'] = session.atm is not None
+        return stats
+
 
-def _sleep(interval, margin_percent=5):
+def _buildTransport(name):
     """
-    Helper function to give a slightly random sleep time to help break things
-    up.
+    Create a new Transport from its name.
     """
     
-    time.sleep(interval * random.uniform(1-margin_percent/100., 1+margin_percent/100.))
+    if name == 'auto':
+        name = 'native' if atmegaWrap is not None else 'tools'
+        
+    if name == 'tools':
+        return ToolTransport()
+    elif name == 'native':
+        return NativeTransport(atmegaWrap)
+    elif name == 'simulator':
+        if _SIMULATOR is None:
+            raise RuntimeError("No hardware simulator is installed")
+        return _SIMULATOR.getTransport()
+    raise ValueError("Unknown transport '%s'" % name)
 
 
-def spiCountBoards(sub20Mapper, maxRetry=MAX_SPI_RETRY, waitRetry=WAIT_SPI_RETRY):
+def setTransport(transport):
     """
-    Count the number of ARX stands on all known SUB-20s.
+    Select how the SUB-20 functions talk to the hardware.  transport is 
+    either a Transport instance or one of:
+     * 'tools' - run the command line tools in /usr/local/bin
+     * 'native' - use the atmegaWrap module in-process
+     * 'simulator' - use the installed aspSimulator.HardwareSimulator
+     * 'auto' - 'native' if the atmegaWrap module is available, otherwise 
+       'tools'
     """
     
-    nBoards = 0
-    overallStatus = True
-    for sub20SN in sorted(sub20Mapper):
-        attempt = 0
-        status = False
-        while ((not status) and (attempt <= maxRetry)):
-            if attempt != 0:
-                _sleep(waitRetry)
-                
-            p = subprocess.Popen(['/usr/local/bin/countBoards', str(sub20SN)],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 text=True)
-            output, output2 = p.communicate()
-            
-            if p.returncode == 0:
-                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, p.returncode, output, output2)
-                status = False
-            else:
-                nBoards += p.returncode
-                status = True
-            attempt += 1
-             
-        overallStatus &= status
+    global _TRANSPORT_NAME, _TRANSPORT
+    
+    if isinstance(transport, Transport):
+        name, new = transport.name, transport
+    else:
+        name = str(transport)
+        with _TRANSPORT_LOCK:
+            if name == _TRANSPORT_NAME and _TRANSPORT is not None:
+                return _TRANSPORT
+        new = _buildTransport(name)
         
-    if not overallStatus:
-        nBoards = 0
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is not None and _TRANSPORT is not new:
+            if _TRANSPORT.name != new.name:
+                aspSUB20Logger.info("Switching from the '%s' transport to the '%s' transport", _TRANSPORT.name, new.name)
+            _TRANSPORT.close()
+        _TRANSPORT_NAME, _TRANSPORT = name, new
         
-    return nBoards
+    return new
 
 
-class SPICommandCallback(object):
+def getTransport():
     """
-    Class for executing callbacks after a sucessful SPI command.
+    Return the Transport that the SUB-20 functions use.  If the selected 
+    transport is no longer available, i.e., the hardware simulator was 
+    removed, the command line tools are used instead.
     """
     
-    def __init__(self, func, *args, **kwds):
-        self._func = func
-        self._args = args
-        self._kwds = kwds
-        
-    def __call__(self):
-        return self._func(*self._args, **self._kwds)
+    global _TRANSPORT
+    
+    with _TRANSPORT_LOCK:
+        if _TRANSPORT is None:
+            try:
+                _TRANSPORT = _buildTransport(_TRANSPORT_NAME)
+            except (RuntimeError, ValueError) as e:
+                aspSUB20Logger.error("Cannot use the '%s' transport, using 'tools' instead: %s", _TRANSPORT_NAME, str(e))
+                _TRANSPORT = ToolTransport()
+        return _TRANSPORT
 
 
 class SPIProcessingThread(object):
     """
-    Class for batch execution of SPI commands.
+    Class for batch execution of SPI commands.  The commands are sent 
+    through the Transport from getTransport().
     """
     
     _lock = threading.Lock()
@@ -174,46 +1743,49 @@ class SPIProcessingThread(object):
             
         self.thread = None
         self.alive = threading.Event()
+        self.running = threading.Event()
         
-    def start(self):
+    def start(self, timeout=5.0):
         if self.thread is not None:
             self.stop()
             
         self.thread = threading.Thread(target=self.processingThread)
         self.thread.daemon = 1
         self.alive.set()
+        self.running.clear()
         self.thread.start()
         
-        time.sleep(1)
-        
+        ## Wait for the thread to enter its loop rather than for a fixed time
+        if not getClock().wait(self.running, timeout):
+            aspSUB20Logger.warning("SPI processing thread did not start within %.1f s", timeout)
+            
+            
     def stop(self):
         if self.thread is not None:
             self.alive.clear()
             self.thread.join()
+            self.running.clear()
             
     @staticmethod
     def _run_command(sub20SN, device_count, devices, spi_commands, maxRetry=MAX_SPI_RETRY, waitRetry=WAIT_SPI_RETRY):
-        command = ["/usr/local/bin/sendARXDevice", str(sub20SN), str(device_count)]
-        for dev,cmd in zip(devices,spi_commands):
-            command.append(str(dev))
-            command.append("0x%04X" % cmd)
-            
-        attempt = 0
         status = False
-        while ((not status) and (attempt <= maxRetry)):
-            if attempt != 0:
-                _sleep(waitRetry)
-                
+        op = _retry('%s/spi' % sub20SN, maxRetry, waitRetry)
+        for attempt in op:
             try:
-                subprocess.check_call(command)
+                with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                    getTransport().spiTransfer(sub20SN, device_count, devices, spi_commands)
                 status = True
+                op.success()
+                break
                 
-            except subprocess.CalledProcessError:
+            except ValueError as e:
+                aspSUB20Logger.error("%s: invalid SPI command for SUB-20 S/N %s - %s", inspect.stack()[0][3], sub20SN, str(e))
+                break
+            except RuntimeError:
                 pass
-            attempt += 1
-            
+                
         return status
-            
+        
     def process_command(self, device, command, callback=None):
         status = True
         
@@ -253,22 +1825,35 @@ class SPIProcessingThread(object):
                         dev = device - self._sub20Mapper[sub20SN][0] + 1
                         self._queue[sub20SN].append((dev,command,callback))
                         
+    def _take_batch(self, sub20SN):
+        """
+        Remove everything queued for a SUB-20 and return it as a four-element
+        tuple of the number of devices on the chain, the devices, the 
+        commands, and the queue entries.  Returns None if nothing is queued.
+        """
+        
+        with self._lock:
+            if len(self._queue[sub20SN]) == 0:
+                return None
+            to_execute = self._queue[sub20SN]
+            self._queue[sub20SN] = deque()
+            
+        device_count = self._sub20Mapper[sub20SN][1] - self._sub20Mapper[sub20SN][0] + 1
+        return (device_count,
+                [entry[0] for entry in to_execute],
+                [entry[1] for entry in to_execute],
+                to_execute)
+                
     def processingThread(self):
+        self.running.set()
         while self.alive.is_set():
             for sub20SN in sorted(self._sub20Mapper):
-                to_execute = None
-                with self._lock:
-                    if len(self._queue[sub20SN]) > 0:
-                        to_execute = self._queue[sub20SN]
-                        self._queue[sub20SN] = deque()
-                        
-                if to_execute is not None:
-                    device_count = self._sub20Mapper[sub20SN][1] - self._sub20Mapper[sub20SN][0] + 1
-                    status = self._run_command(sub20SN, device_count,
-                                               [entry[0] for entry in to_execute],
-                                               [entry[1] for entry in to_execute],
+                batch = self._take_batch(sub20SN)
+                if batch is not None:
+                    device_count, devices, commands, to_execute = batch
+                    status = self._run_command(sub20SN, device_count, devices, commands,
                                                maxRetry=self._maxRetry, waitRetry=self._waitRetry)
-                    
+                                               
                     if status:
                         for device,command,callback in to_execute:
                             if callback is None:
@@ -278,41 +1863,33 @@ class SPIProcessingThread(object):
                             except Exception as e:
                                 aspSUB20Logger.warning("Failed to process callback for device %i, comamnd %04X: %s", device, command, str(e))
                                 
-            time.sleep(self._pollInterval)
+            getClock().sleep(self._pollInterval)
             
     @staticmethod
-    def _read_register(sub20SN, device_count, devices, spi_registers, maxRetry=MAX_SPI_RETRY, waitRetry=WAIT_SPI_RETRY):
-        command = ["/usr/local/bin/readARXDevice", str(sub20SN), str(device_count)]
-        for dev,reg in zip(devices,spi_registers):
-            command.append(str(dev))
-            command.append("0x%04X" % reg)
-            
-        regRE = re.compile(r'(?P<device>\d*): (?P<register>0x[0-9a-fA-F]*)')
-        
-        attempt = 0
+    def _read_register(sub20SN, device_count, devices, spi_registers, maxRetry=MAX_SPI_RETRY, waitRetry=WAIT_SPI_RETRY, token=None):
         status = False
         data = {}
-        while ((not status) and (attempt <= maxRetry)):
-            if attempt != 0:
-                _sleep(waitRetry)
-                
+        op = _retry('%s/spi' % sub20SN, maxRetry, waitRetry, token=token)
+        for attempt in op:
             try:
-                resp = subprocess.check_output(command, text=True)
-                for line in resp.split('\n'):
-                    mtch = regRE.search(line)
-                    if mtch:
-                        dev = int(mtch.group('device'), 10)
-                        reg = int(mtch.group('register'), 16)
-                        data[dev] = reg
-                        status = True
-                        
-            except subprocess.CalledProcessError:
+                with getBusScheduler(sub20SN).access(BUS_PRIORITY_MONITOR, token=token):
+                    data.update(getTransport().spiRead(sub20SN, device_count, devices, spi_registers, token=token))
+                status = len(data) > 0
+                if status:
+                    op.success()
+                    break
+                    
+            except OperationCancelled:
+                break
+            except ValueError as e:
+                aspSUB20Logger.error("%s: invalid SPI register for SUB-20 S/N %s - %s", inspect.stack()[0][3], sub20SN, str(e))
+                break
+            except RuntimeError:
                 pass
-            attempt += 1
-            
+                
         return data
         
-    def read_register(self, device, register):
+    def read_register(self, device, register, token=None):
         data = {}
         
         with self._lock:
@@ -324,7 +1901,7 @@ class SPIProcessingThread(object):
                     for dev in range(self._sub20Mapper[sub20SN][0], self._sub20Mapper[sub20SN][1]+1):
                         devices.append(dev - self._sub20Mapper[sub20SN][0] + 1)
                         commands.append(register)
-                    sub_data = self._read_register(sub20SN, device_count, devices, commands, maxRetry=self._maxRetry, waitRetry=self._waitRetry)
+                    sub_data = self._read_register(sub20SN, device_count, devices, commands, maxRetry=self._maxRetry, waitRetry=self._waitRetry, token=token)
                     data.update(sub_data)
                         
             else:
@@ -334,7 +1911,7 @@ class SPIProcessingThread(object):
                     if device >= self._sub20Mapper[sub20SN][0] and device <= self._sub20Mapper[sub20SN][1]:
                         devices = [device - self._sub20Mapper[sub20SN][0] + 1,]
                         commands = [register,]
-                        sub_data = self._read_register(sub20SN, device_count, devices, commands, maxRetry=self._maxRetry, waitRetry=self._waitRetry)
+                        sub_data = self._read_register(sub20SN, device_count, devices, commands, maxRetry=self._maxRetry, waitRetry=self._waitRetry, token=token)
                         data.update(sub_data)
                         
         if not data:
@@ -348,67 +1925,117 @@ class SPIProcessingThread(object):
 def psuSend(sub20SN, psuAddress, state, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY):
     """
     Set the state of the power supply unit at the provided I2C address.
+    Writes have their own circuit breaker, separate from the one for reads,
+    and turning a supply off always goes to the hardware.
     """
     
     status = False
-    for attempt in range(maxRetry+1):
-        if attempt != 0:
-            _sleep(waitRetry)
-            
+    op = _retry('%s/0x%02X/write' % (sub20SN, psuAddress), maxRetry, waitRetry, bypass=(int(state) == 0))
+    for attempt in op:
         try:
-            p = subprocess.Popen(['/usr/local/bin/onoffPSU', str(sub20SN), '0x%02X' % psuAddress, str(state)],
-                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                    text=True)
-            output, output2 = p.communicate()
-            
-            if p.returncode == 0:
-                status = True
-                break
-            else:
-                aspSUB20Logger.warning("psuSend: command returned %i; '%s;%s'", p.returncode, output, output2)
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_SAFETY if int(state) == 0 else BUS_PRIORITY_CONTROL):
+                getTransport().psuWrite(sub20SN, psuAddress, state)
                 
+            getI2CSession(sub20SN).invalidate()
+            status = True
+            op.success()
+            break
+            
         except Exception as e:
             aspSUB20Logger.warning("Could not send command to PSU %s: %s", psuAddress, str(e))
             
     return status
 
 
-def psuRead(sub20SN, psuAddress, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY):
+def psuRead(sub20SN, psuAddress, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY, priority=BUS_PRIORITY_MONITOR, token=None, bypass=False):
     """
     Read the status, voltage, and current of the power supply unit at the
     provided I2C address.
     """
     
     data = {}
-    for attempt in range(maxRetry+1):
-        if attempt != 0:
-            _sleep(waitRetry)
-            
+    op = _retry('%s/0x%02X' % (sub20SN, psuAddress), maxRetry, waitRetry, token=token, bypass=bypass)
+    for attempt in op:
         try:
-            p = subprocess.Popen(['/usr/local/bin/readPSU', str(sub20SN), '0x%02X' % psuAddress],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 text=True)
-            output, output2 = p.communicate()
-            
-            if p.returncode == 0:
-                psu, desc, onoffHuh, statusHuh, voltageV, currentA, = output.replace('\n', '').split(None, 5)
-                data = {'address': psu,
-                        'description': desc,
-                        'voltage': float(voltageV),
-                        'current': float(currentA),
-                        'onoff': '%-3s' % onoffHuh,
-                        'status': statusHuh
-                       }
-                break
-            else:
-                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, p.returncode, output, output2)
+            with getBusScheduler(sub20SN).access(priority, token=token):
+                data = getTransport().psuRead(sub20SN, psuAddress, token=token)
                 
+            op.success()
+            break
+            
+        except OperationCancelled:
+            break
         except Exception as e:
             aspSUB20Logger.warning("Could not read PSU status: %s", str(e))
             
     return data
                 
 
+def psuWaitState(sub20SN, psuAddress, state, timeout=10.0, offVoltage=1.0, pollInterval=0.25):
+    """
+    Poll the power supply unit at the provided I2C address until it reaches 
+    the requested power state or until timeout seconds have passed.  For the
+    off state (00) the supply needs to report OFF and have an output voltage 
+    below offVoltage.  For the on state (11) the supply needs to report ON and 
+    have an output voltage that is non-zero and that agrees with the previous 
+    reading to within 2%.  Returns True if the state was reached, False 
+    otherwise.
+    """
+    
+    wantOn = (int(state) != 0)
+    
+    tDeadline = getClock().time() + timeout
+    lastVoltage = None
+    while True:
+        data = psuRead(sub20SN, psuAddress, maxRetry=0, priority=BUS_PRIORITY_CONTROL, bypass=True)
+        if data:
+            onoff = data['onoff'].strip()
+            voltage = data['voltage']
+            if wantOn:
+                if onoff == 'ON' and voltage > 0 \
+                   and lastVoltage is not None and abs(voltage - lastVoltage) <= 0.02*voltage:
+                    return True
+                lastVoltage = voltage
+            else:
+                if onoff == 'OFF' and voltage < offVoltage:
+                    return True
+                    
+        if getClock().time() + pollInterval > tDeadline:
+            break
+        getClock().sleep(pollInterval)
+        
+    aspSUB20Logger.warning("psuWaitState: PSU 0x%02X did not reach state %02i within %.1f s", psuAddress, int(state), timeout)
+    return False
+
+
+def psuList(sub20SN):
+    """
+    Return a two-element tuple of the I2C addresses of the power supplies and 
+    the number of power supply modules found on the specified SUB-20.
+    """
+    
+    addresses = []
+    nModules = 0
+    try:
+        with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+            returncode, output, output2 = _run(['/usr/local/bin/countPSUs',], TIMEOUT_SCAN)
+        
+        current = None
+        for line in output.split('\n'):
+            fields = line.split()
+            if line.startswith('Found ATmega device S/N:'):
+                current = fields[-1]
+            elif current == str(sub20SN) and len(fields) == 2 and fields[0] == '->' and fields[1].startswith('0x'):
+                addresses.append(int(fields[1], 16))
+            elif current == str(sub20SN) and len(fields) == 4 and fields[2] == 'PSU':
+                nModules = int(fields[1])
+                
+    except Exception as e:
+        aspSUB20Logger.warning("Could not list PSUs: %s", str(e))
+        
+    return addresses, nModules
+
+
 def psuCountTemperature(sub20SN, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY):
     """
     Return the number of temperature sensors associated with the power supply
@@ -416,20 +2043,17 @@ def psuCountTemperature(sub20SN, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETR
     """
     
     ntemp = 0
-    for attempt in range(maxRetry+1):
-        if attempt != 0:
-            _sleep(waitRetry)
-            
+    op = _retry('%s/i2c' % sub20SN, maxRetry, waitRetry)
+    for attempt in op:
         try:
-            p = subprocess.Popen(['/usr/local/bin/countThermometers', str(sub20SN)],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                text=True)
-            output, output2 = p.communicate()
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                returncode, output, output2 = _run(['/usr/local/bin/countThermometers', str(sub20SN)], TIMEOUT_SCAN)
             
-            if p.returncode == 0:
-                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, p.returncode, output, output2)
+            if returncode <= 0:
+                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, returncode, output, output2)
             else:
-                ntemp = p.returncode
+                ntemp = returncode
+                op.success()
                 break;
                 
         except Exception as e:
@@ -438,41 +2062,162 @@ def psuCountTemperature(sub20SN, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETR
     return ntemp
 
 
-def psuTemperature(sub20SN, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY):
+def psuTemperature(sub20SN, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY, token=None):
     """
     Return a list of dictionaries containing power supply unit info and temperatures.
     """
     
     temps = []
-    for attempt in range(maxRetry+1):
-        if attempt == 0:
-            _sleep(waitRetry)
-            
+    op = _retry('%s/i2c' % sub20SN, maxRetry, waitRetry, token=token)
+    for attempt in op:
         try:
-            p = subprocess.Popen(['/usr/local/bin/readThermometers', str(sub20SN)],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                text=True)
-            output, output2 = p.communicate()
-            
-            if p.returncode != 0:
-                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, p.returncode, output, output2)
-            else:
-                for i,line in enumerate(output.split('\n')):
-                    if len(line) < 4:
-                        continue
-                    psu, desc, tempC = line.split(None, 2)
-                    temps.append({'address': psu,
-                                'description': desc,
-                                'temp_C': float(tempC)
-                                })
-                break
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_MONITOR, token=token):
+                temps = getTransport().psuTemperature(sub20SN, token=token)
                 
+            op.success()
+            break
+            
+        except OperationCancelled:
+            break
         except Exception as e:
             aspSUB20Logger.warning("Could not poll PSU temperature sensors: %s", str(e))
             
     return temps
 
 
+class I2CSession(object):
+    """
+    Class for reading all of the power supplies and thermometers on the I2C
+    bus of a single SUB-20 in one pass, with a single device open and lock.
+    The result of the last pass is shared between the PowerStatus and 
+    TemperatureSensors monitors so that, when they run at the same time, 
+    only the first of them touches the hardware.  If the Transport in use 
+    cannot read the whole bus in one pass the power supplies and thermometers
+    are read one at a time with psuRead() and psuTemperature() instead.
+    """
+    
+    def __init__(self, sub20SN, maxRetry=MAX_I2C_RETRY, waitRetry=WAIT_I2C_RETRY):
+        self.sub20SN = sub20SN
+        self.maxRetry = maxRetry
+        self.waitRetry = waitRetry
+        
+        self._lock = threading.Lock()
+        self._last = None
+        self._lastTime = 0.0
+        
+        # Statistics
+        self.nSweeps = 0
+        self.nShared = 0
+        self.nFailures = 0
+        self.lastDuration = None
+        
+    def sweep(self, maxAge=0.0, token=None):
+        """
+        Return the two-element tuple of power supply data and temperatures 
+        from the last pass over the I2C bus if it is less than maxAge seconds
+        old, otherwise make a new pass.  Returns None if the pass failed.
+        """
+        
+        with self._lock:
+            if self._last is not None and getClock().monotonic() - self._lastTime <= maxAge:
+                self.nShared += 1
+                return self._last
+                
+            op = _retry('%s/i2c' % self.sub20SN, self.maxRetry, self.waitRetry, token=token)
+            for attempt in op:
+                try:
+                    with getBusScheduler(self.sub20SN).access(BUS_PRIORITY_MONITOR, token=token):
+                        tStart = getClock().monotonic()
+                        result = getTransport().i2cSweep(self.sub20SN, token=token)
+                        tStop = getClock().monotonic()
+                        
+                    self._last = result
+                    self._lastTime = tStop
+                    self.nSweeps += 1
+                    self.lastDuration = tStop - tStart
+                    op.success()
+                    return result
+                    
+                except OperationCancelled:
+                    break
+                except Exception as e:
+                    aspSUB20Logger.warning("%s: SUB-20 S/N %s pass %i of %i failed: %s", type(self).__name__, self.sub20SN, attempt, self.maxRetry, str(e))
+                    
+            self.nFailures += 1
+            return None
+            
+    def invalidate(self):
+        """
+        Forget the result of the last pass, i.e., after a power supply has 
+        been turned on or off.
+        """
+        
+        with self._lock:
+            self._last = None
+            
+    def readPSU(self, psuAddress, maxAge=0.0, token=None):
+        """
+        Return the status, voltage, and current of the power supply at the 
+        provided I2C address in the same format as psuRead().
+        """
+        
+        if not getTransport().batched:
+            return psuRead(self.sub20SN, psuAddress, maxRetry=self.maxRetry, waitRetry=self.waitRetry, token=token)
+            
+        result = self.sweep(maxAge=maxAge, token=token)
+        if result is None or result[0].get(psuAddress, None) is None:
+            return {}
+        return dict(result[0][psuAddress])
+        
+    def readTemperatures(self, maxAge=0.0, token=None):
+        """
+        Return a list of the power supply temperatures in the same format as
+        psuTemperature().
+        """
+        
+        if not getTransport().batched:
+            return psuTemperature(self.sub20SN, maxRetry=self.maxRetry, waitRetry=self.waitRetry, token=token)
+            
+        result = self.sweep(maxAge=maxAge, token=token)
+        if result is None:
+            return []
+        return [dict(entry) for entry in result[1]]
+        
+    def getStatistics(self):
+        """
+        Return a dictionary of how many passes were made, how many reads were
+        answered from the last pass, how many passes failed, how long the
+        last pass took in seconds, and the per-module page change statistics
+        for each power supply from the last pass.
+        """
+        
+        transport = getTransport()
+        return {'batched': transport.batched,
+                'sweeps': self.nSweeps,
+                'shared': self.nShared,
+                'failures': self.nFailures,
+                'last_duration': self.lastDuration,
+                'psus': transport.getModuleStatistics(self.sub20SN)}
+
+
+_I2C_SESSIONS = {}
+_I2C_SESSIONS_LOCK = threading.Lock()
+
+
+def getI2CSession(sub20SN):
+    """
+    Return the I2CSession instance for the specified SUB-20.
+    """
+    
+    with _I2C_SESSIONS_LOCK:
+        try:
+            return _I2C_SESSIONS[str(sub20SN)]
+        except KeyError:
+            session = I2CSession(str(sub20SN))
+            _I2C_SESSIONS[str(sub20SN)] = session
+            return session
+
+
 def rs485CountBoards(sub20Mapper, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
     """
     Count the number of PIC devices on all known SUB-20s.
@@ -481,24 +2226,20 @@ def rs485CountBoards(sub20Mapper, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485
     nBoards = 0
     overallStatus = True
     for sub20SN in sorted(sub20Mapper):
-        attempt = 0
         status = False
-        while ((not status) and (attempt <= maxRetry)):
-            if attempt != 0:
-                _sleep(waitRetry)
-                
-            p = subprocess.Popen(['/usr/local/bin/countPICs', str(sub20SN)],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                 text=True)
-            output, output2 = p.communicate()
+        op = _retry('%s/rs485' % sub20SN, maxRetry, waitRetry)
+        for attempt in op:
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                returncode, output, output2 = _run(['/usr/local/bin/countPICs', str(sub20SN)], TIMEOUT_SCAN)
             
-            if p.returncode == 0:
-                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, p.returncode, output, output2)
+            if returncode <= 0:
+                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, returncode, output, output2)
                 status = False
             else:
-                nBoards += p.returncode
+                nBoards += returncode
                 status = True
-            attempt += 1
+                op.success()
+                break
             
         overallStatus &= status
         
@@ -508,6 +2249,58 @@ def rs485CountBoards(sub20Mapper, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485
     return nBoards
 
 
+def rs485ListBoards(sub20SN, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
+    """
+    Return a list of the RS485 addresses of the PIC devices found on the 
+    specified SUB-20.
+    """
+    
+    addresses = []
+    op = _retry('%s/rs485' % sub20SN, maxRetry, waitRetry)
+    for attempt in op:
+        try:
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                returncode, output, output2 = _run(['/usr/local/bin/countPICs', '-v', str(sub20SN)], TIMEOUT_SCAN)
+            
+            if returncode <= 0:
+                aspSUB20Logger.warning("%s: SUB-20 S/N %s command %i of %i returned %i; '%s;%s'", inspect.stack()[0][3], sub20SN, attempt, maxRetry, returncode, output, output2)
+            else:
+                addresses = [int(line) for line in output.split('\n')[2:] if line.strip().isdigit()]
+                op.success()
+                break
+                
+        except Exception as e:
+            aspSUB20Logger.warning("Could not list PIC devices: %s", str(e))
+            
+    return addresses
+
+
+def rs485Probe(sub20SN, addresses, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
+    """
+    Check that all of the PIC devices at the provided RS485 addresses on the 
+    specified SUB-20 respond to an ECHO command.  All of the addresses are 
+    checked with a single call to the Transport.  Returns True if all of the 
+    devices responded, False otherwise.
+    """
+    
+    if not addresses:
+        return False
+        
+    op = _retry('%s/rs485' % sub20SN, maxRetry, waitRetry)
+    for attempt in op:
+        try:
+            with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                getTransport().rs485Echo(sub20SN, addresses)
+                
+            op.success()
+            return True
+            
+        except Exception as e:
+            aspSUB20Logger.warning("Could not probe PIC devices: %s", str(e))
+            
+    return False
+
+
 def rs485Reset(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
     """
     Set a reset command to all of the ARX boards connected to the RS485 bus.
@@ -519,26 +2312,22 @@ def rs485Reset(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETR
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', str(sub20SN), str(board), ' RSET'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                        getTransport().rs485Send(sub20SN, board, ' RSET')
                         
+                    board_success = True
+                    op.success()
+                    break
+                    
                 except Exception as e:
                     aspSUB20Logger.warning("Could not reset board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             
     # Check for completion of reset
-    time.sleep(10) # Wait a little bit
+    getClock().sleep(10) # Wait a little bit
     reset_check, failed = rs485Check(portName, antennaMapping, verbose=False)
     success &= reset_check
     
@@ -556,22 +2345,18 @@ def rs485Sleep(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETR
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', str(sub20SN), str(board), ' SLEP'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                        getTransport().rs485Send(sub20SN, board, ' SLEP')
                         
+                    board_success = True
+                    op.success()
+                    break
+                    
                 except Exception as e:
                     aspSUB20Logger.warning("Could not sleep board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             
     return success
@@ -588,26 +2373,22 @@ def rs485Wake(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', str(sub20SN), str(board), 'WAKE'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                        getTransport().rs485Send(sub20SN, board, 'WAKE')
                         
+                    board_success = True
+                    op.success()
+                    break
+                    
                 except Exception as e:
                     aspSUB20Logger.warning("Could not wake board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             
     # Check for completion of wake
-    time.sleep(10) # Wait a little bit
+    getClock().sleep(10) # Wait a little bit
     wake_check, failed = rs485Check(portName, antennaMapping, verbose=False)
     success &= wake_check
     
@@ -630,23 +2411,22 @@ def rs485Check(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETR
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', '-v', '-d', str(sub20SN), str(board), 'ECHO%s' % data],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0 and output.find(data) != -1:
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_MONITOR):
+                        output = getTransport().rs485Send(sub20SN, board, 'ECHO%s' % data, decode=True)
+                        
+                    if output.find(data) != -1:
                         board_success = True
+                        op.success()
                         break
                     else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                        raise RuntimeError("Unexpected response: %s" % output.strip().replace('\n', ' - '))
                         
                 except Exception as e:
                     if verbose:
                         aspSUB20Logger.warning("Could not echo '%s' to board %s: %s", data, board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             if not board_success:
                 failed.append(antennaMapping[board_key])
@@ -663,30 +2443,26 @@ def rs485SetTime(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RE
      * the time set
     """
     
-    data = "%08X" % int(time.time())
+    data = "%08X" % int(getClock().time())
     success = True
     failed = []
     for sub20SN in sorted(sub20Mapper2.keys()):
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', str(sub20SN), str(board), ' STIM%s' % data],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_CONTROL):
+                        getTransport().rs485Send(sub20SN, board, ' STIM%s' % data)
                         
+                    board_success = True
+                    op.success()
+                    break
+                    
                 except Exception as e:
                     if verbose:
                         aspSUB20Logger.warning("Could not set time to '%s' on board %s: %s", data, board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             if not board_success:
                 failed.append(antennaMapping[board_key])
@@ -712,26 +2488,25 @@ def rs485GetTime(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RE
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', '-v', '-d', str(sub20SN), str(board), 'GTIM'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_MONITOR):
+                        output = getTransport().rs485Send(sub20SN, board, 'GTIM', decode=True)
+                        
                     mtch = gtimRE.search(output)
                     if mtch is not None:
                         gtim_data = mtch.group('gtim')
                         data.append(int(gtim_data, 10))
                         board_success = True
+                        op.success()
                         break
                     else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                        raise RuntimeError("Unexpected response: %s" % output.strip().replace('\n', ' - '))
                         
                 except Exception as e:
                     if verbose:
                         aspSUB20Logger.warning("Could not get time from board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             if not board_success:
                 data.append(0)
@@ -739,7 +2514,7 @@ def rs485GetTime(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RE
     return success, data
 
 
-def rs485Power(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
+def rs485Power(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY, token=None):
     """
     Poll all of the ARX boards connected to the RS485 bus and return a two-
     element tuple of:
@@ -755,34 +2530,32 @@ def rs485Power(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETR
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry, token=token)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', '-v', '-d', str(sub20SN), str(board), 'CURA'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        for line in filter(lambda x: x.find(' mA') != -1, output.split('\n')):
-                            mtch = curaRE.search(line)
-                            if mtch is not None:
-                                fees.append(float(mtch.group('curr')))
-                            else:
-                                fees.append(-1.0)
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_BULK, token=token):
+                        output = getTransport().rs485Send(sub20SN, board, 'CURA', decode=True, token=token)
                         
+                    for line in filter(lambda x: x.find(' mA') != -1, output.split('\n')):
+                        mtch = curaRE.search(line)
+                        if mtch is not None:
+                            fees.append(float(mtch.group('curr')))
+                        else:
+                            fees.append(-1.0)
+                    board_success = True
+                    op.success()
+                    break
+                    
+                except OperationCancelled:
+                    break
                 except Exception as e:
                     aspSUB20Logger.warning("Could not get power info. for board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             
     return success, fees
 
 
-def rs485RFPower(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
+def rs485RFPower(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY, token=None):
     """
     Poll all of the ARX boards connected to the RS485 bus and return a two-
     element tuple of:
@@ -798,34 +2571,32 @@ def rs485RFPower(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RE
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry, token=token)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', '-v', '-d', str(sub20SN), str(board), 'POWA'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        for line in filter(lambda x: x.find(' uW') != -1, output.split('\n')):
-                            mtch = powaRE.search(line)
-                            if mtch is not None:
-                                rf_powers.append(float(mtch.group('pow')))
-                            else:
-                                rf_powers.append(-1.0)
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_BULK, token=token):
+                        output = getTransport().rs485Send(sub20SN, board, 'POWA', decode=True, token=token)
                         
+                    for line in filter(lambda x: x.find(' uW') != -1, output.split('\n')):
+                        mtch = powaRE.search(line)
+                        if mtch is not None:
+                            rf_powers.append(float(mtch.group('pow')))
+                        else:
+                            rf_powers.append(-1.0)
+                    board_success = True
+                    op.success()
+                    break
+                    
+                except OperationCancelled:
+                    break
                 except Exception as e:
                     aspSUB20Logger.warning("Could not get RF power info. for board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             
     return success, rf_powers
 
 
-def rs485Temperature(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY):
+def rs485Temperature(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS485_RETRY, token=None):
     """
     Poll all of the Rev H ARX boards connected to the RS485 bus and return a
     two-element tuple of:
@@ -841,28 +2612,26 @@ def rs485Temperature(sub20Mapper2, maxRetry=MAX_RS485_RETRY, waitRetry=WAIT_RS48
         for board_key in sub20Mapper2[sub20SN]:
             board = (int(board_key) % 126) or 126
             board_success = False
-            for attempt in range(maxRetry+1):
+            op = _retry('%s/%i' % (sub20SN, board), maxRetry, waitRetry, token=token)
+            for attempt in op:
                 try:
-                    p = subprocess.Popen(['/usr/local/bin/sendPICDevice', '-v', '-d', str(sub20SN), str(board), 'OWTE'],
-                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                         text=True)
-                    output, output2 = p.communicate()
-                    
-                    if p.returncode == 0:
-                        for line in filter(lambda x: x.find(' C') != -1, output.split('\n')):
-                            mtch = owteRE.search(line)
-                            if mtch is not None:
-                                temps.append(float(mtch.group('temp')))
-                            else:
-                                temps.append(-99.0)
-                        board_success = True
-                        break
-                    else:
-                        raise RuntimeError("Non-zero return code: %s" % output2.strip().replace('\n', ' - '))
+                    with getBusScheduler(sub20SN).access(BUS_PRIORITY_BULK, token=token):
+                        output = getTransport().rs485Send(sub20SN, board, 'OWTE', decode=True, token=token)
                         
+                    for line in filter(lambda x: x.find(' C') != -1, output.split('\n')):
+                        mtch = owteRE.search(line)
+                        if mtch is not None:
+                            temps.append(float(mtch.group('temp')))
+                        else:
+                            temps.append(-99.0)
+                    board_success = True
+                    op.success()
+                    break
+                    
+                except OperationCancelled:
+                    break
                 except Exception as e:
                     aspSUB20Logger.warning("Could not get temperature info. for board %s: %s", board_key, str(e))
-                    _sleep(waitRetry)
             success &= board_success
             
     return success, temps
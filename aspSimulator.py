@@ -0,0 +1,2082 @@
+
+"""
+Module for simulating the SUB-20/ATmega devices and the hardware behind them
+so that the ASP software can be run without any hardware attached.
+
+Each simulated ATmega (SimulatedATmega) processes the same framed commands as
+the firmware in arx_control/libatmega/firmware and drives models of:
+  * the MAX7301 port expanders on the ARX boards (MAX7301Chain) on the SPI bus
+  * the iVS power supplies (IVSPowerSupply) on the I2C bus
+  * the PIC microcontrollers on the ARX boards (PICBoard) on the RS485 bus
+The ARX boards only respond while the ARX power supply is on and the FEE
+currents are zero unless the FEE power supply is on.  Every command type can
+have a latency added to it with SimulatedATmega.setLatency() and faults can be
+injected with SimulatedATmega.addFault().  All of the random choices are made
+from a seeded random number generator so that runs can be repeated.
+
+There are three ways to use the simulator:
+  1. HardwareSimulator.install() routes aspSUB20 through the simulator, both
+     the external tools and the atmegaWrap module, and makes the simulated
+     devices visible to the USB presence tracker.  This lets AnalogProcessor
+     run the full INI/command/SHT cycle in a single process.
+  2. HardwareSimulator.getATmegaWrap() returns a drop-in replacement for the
+     atmegaWrap module that can be used directly and 
+     HardwareSimulator.getTransport() returns the aspSUB20 transport that 
+     uses it, i.e., the "simulator" transport.
+  3. HardwareSimulator.serve() exposes a simulated ATmega on a pseudo-terminal
+     that speaks the serial protocol so that the real C++ tools and
+     libatmega.py can be pointed at it.
+"""
+
+import io
+import os
+import tty
+import math
+import time
+import array
+import errno
+import random
+import select
+import shutil
+import struct
+import logging
+import tempfile
+import threading
+
+import aspSUB20
+from aspSUB20 import SPIFrames, NativeTransport
+from aspUSB import SUB20_VENDOR_ID, getUSBPresenceTracker
+from aspClock import getClock
+
+
+__version__ = '0.1'
+__all__ = ['COMMAND_TYPES', 'SimulatedFault', 'MAX7301Chain', 'IVSPowerSupply', 'PICBoard', 'SimulatedATmega',
+           'SimulatedATmegaWrap', 'SimulatedTools', 'SimulatedTransport', 'PTYServer', 'HardwareSimulator']
+
+
+aspSimulatorLogger = logging.getLogger('__main__')
+
+
+# ATmega commands and response codes, see arx_control/libatmega/libatmega.hpp
+COMMAND_SUCCESS = 0x00
+COMMAND_READ_SN = 0x01
+COMMAND_READ_VER = 0x02
+COMMAND_READ_MLEN = 0x03
+COMMAND_ECHO = 0x04
+COMMAND_READ_TEMPERATURE = 0x05
+COMMAND_TRANSFER_SPI = 0x11
+COMMAND_SCAN_RS485 = 0x21
+COMMAND_READ_RS485 = 0x22
+COMMAND_WRITE_RS485 = 0x23
+COMMAND_SEND_RS485 = 0x24
+COMMAND_SCAN_I2C = 0x31
+COMMAND_READ_I2C = 0x32
+COMMAND_WRITE_I2C = 0x33
+COMMAND_LOCK = 0xA1
+COMMAND_UNLOCK = 0xA2
+COMMAND_WRITE_SN = 0xA3
+COMMAND_CLR_FAULT = 0xA4
+COMMAND_LOCATE = 0xA5
+COMMAND_RESET = 0xA7
+COMMAND_FAILURE = 0xF0
+COMMAND_FAILURE_ARG = 0xFA
+COMMAND_FAILURE_STA = 0xFB
+COMMAND_FAILURE_BUS = 0xFC
+COMMAND_FAILURE_RS485 = 0xFD
+COMMAND_FAILURE_TOUT = 0xFE
+COMMAND_FAILURE_CMD = 0xFF
+
+# Firmware limits and timeouts, see arx_control/libatmega/firmware/firmware.ino
+MAX_CMD_LEN = 530
+MAX_SN_LEN = 8
+FIRMWARE_VERSION = 'v0.0.1'
+RS485_SHORT_TIMEOUT = 0.125
+RS485_LONG_TIMEOUT = 1.025
+RS485_NOREPLY_TIMEOUT = 0.025
+I2C_TIMEOUT = 0.100
+
+# How long it takes to move a byte over each of the buses in s
+_SPI_BYTE_TIME = 8.0/500e3
+_I2C_BYTE_TIME = 9.0/100e3
+_RS485_BYTE_TIME = 10.0/19200
+
+# PIC reply markers
+_ACK = 0x06
+_NAK = 0x15
+
+# ARX board layout, see arx_control/aspCommon.hpp
+_SPI_COMMAND_MARKER = 0x0120
+_STANDS_PER_BOARD = 8
+_MAX_BOARDS = 32
+
+# iVS page change handling, see arx_control/ivsCommon.hpp
+_IVS_MAX_RETRY_PAGE = 3
+_IVS_POLL_MIN = 0.001
+_IVS_POLL_MAX = 0.025
+_IVS_SELECT_TIMEOUT = 0.250
+
+# Command types used for latencies, faults, and the link statistics
+COMMAND_TYPES = ('system', 'spi', 'rs485', 'i2c')
+
+# Default response code for faults of mode 'error'
+_FAULT_STATUS = {'system': COMMAND_FAILURE,
+                 'spi':    COMMAND_FAILURE_BUS,
+                 'rs485':  COMMAND_FAILURE_TOUT,
+                 'i2c':    COMMAND_FAILURE_BUS}
+
+
+def _commandType(command):
+    """
+    Return the command type of an ATmega command.
+    """
+    
+    if command == COMMAND_TRANSFER_SPI:
+        return 'spi'
+    elif COMMAND_SCAN_RS485 <= command <= COMMAND_SEND_RS485:
+        return 'rs485'
+    elif COMMAND_SCAN_I2C <= command <= COMMAND_WRITE_I2C:
+        return 'i2c'
+    return 'system'
+
+
+def _commandTimeout(command, payload):
+    """
+    Return how long, in s, libatmega waits for the response to a command.
+    """
+    
+    if command in (COMMAND_READ_SN, COMMAND_WRITE_SN, COMMAND_READ_I2C, COMMAND_WRITE_I2C):
+        return 0.125
+    elif command == COMMAND_SCAN_I2C:
+        return 0.655
+    elif command in (COMMAND_READ_RS485, COMMAND_WRITE_RS485):
+        return 1.025
+    elif command == COMMAND_SEND_RS485:
+        data = payload[1:]
+        if data[:4] in (b'OWSE', b'OWTE'):
+            return 1.050
+        elif data[:1] == b'*' or data[:4] in (b'RSET', b'SLEP') or data == b'W':
+            return 0.050
+        return 0.150
+    elif command == COMMAND_SCAN_RS485:
+        return 5.050
+    return 0.050
+
+
+def _statsBucket(interval):
+    """
+    Return the link statistics histogram bucket for an interval in s, the
+    same as libatmega.
+    """
+    
+    us, bucket = int(interval*1e6), 0
+    while us > 1 and bucket < 23:
+        us >>= 1
+        bucket += 1
+    return bucket
+
+
+def _strtod(value):
+    """
+    Convert a command line argument to an integer the way the tools do with
+    std::strtod.
+    """
+    
+    if value.lower().startswith('0x'):
+        return int(value, 16)
+    return int(float(value))
+
+
+def _inputBuffer(data, name, maxSize):
+    """
+    Check an input buffer the same way atmegaWrap does and return it as a
+    memoryview of bytes.
+    """
+    
+    view = memoryview(data)
+    if not view.c_contiguous:
+        raise ValueError("%s must be C-contiguous" % name)
+    if view.nbytes > maxSize:
+        raise ValueError("%s is larger than %i B" % (name, maxSize))
+    return view.cast('B')
+
+
+def _outputBuffer(data, name, maxSize):
+    """
+    Check an output buffer the same way atmegaWrap does and return it as a
+    writable memoryview of bytes.
+    """
+    
+    view = memoryview(data)
+    if view.readonly:
+        raise BufferError("%s must be writable" % name)
+    return _inputBuffer(view, name, maxSize)
+
+
+class SimulatedFault(object):
+    """
+    Class describing a fault to inject into the commands of a single type.
+    The mode controls what happens when the fault fires:
+     * 'drop' - the command is processed but no response is sent
+     * 'error' - the command fails with the provided response code
+     * 'corrupt' - a single bit of the response payload is flipped
+     * 'delay' - the response is sent delay seconds late
+    Faults fire with the provided probability and, if count is not None, are
+    removed after firing count times.  If match is not None only commands
+    whose payload starts with match are affected.
+    """
+    
+    def __init__(self, kind, mode, probability=1.0, count=None, match=None, status=None, delay=0.0):
+        if kind not in COMMAND_TYPES:
+            raise ValueError("Unknown command type '%s'" % kind)
+        if mode not in ('drop', 'error', 'corrupt', 'delay'):
+            raise ValueError("Unknown fault mode '%s'" % mode)
+            
+        self.kind = kind
+        self.mode = mode
+        self.probability = float(probability)
+        self.count = count
+        self.match = bytes(match) if match is not None else None
+        self.status = status
+        self.delay = float(delay)
+        
+        self.nFired = 0
+        
+    def matches(self, kind, payload):
+        """
+        Return whether or not the fault applies to a command.
+        """
+        
+        return kind == self.kind and (self.match is None or payload[:len(self.match)] == self.match)
+        
+    def isExhausted(self):
+        """
+        Return whether or not the fault has fired as many times as it should.
+        """
+        
+        return self.count is not None and self.nFired >= self.count
+
+
+class MAX7301Chain(object):
+    """
+    Class for the daisy chain of MAX7301 port expanders on the ARX boards.
+    The chain is a shift register of one 16-bit word per device and each word
+    is sent low byte first:  the register address, with 0x80 set for reads,
+    followed by the data.  When the chip select is released every device
+    latches the word it holds - writes update the register and reads load the
+    register value into the word so that it is clocked out by the next
+    transfer.  If the chain has a supply it only works while that supply is on
+    and all of the registers are lost when it is turned off.
+    """
+    
+    def __init__(self, deviceCount, supply=None):
+        self.deviceCount = int(deviceCount)
+        self.supply = supply
+        
+        self._powerCycles = None
+        self.reset()
+        
+    def reset(self):
+        """
+        Return the chain to its power on state, i.e., all registers cleared
+        and the devices shut down.
+        """
+        
+        self.registers = [bytearray(128) for i in range(self.deviceCount)]
+        self._shift = bytearray(2*self.deviceCount)
+        
+    def isPowered(self):
+        """
+        Return whether or not the chain has power.
+        """
+        
+        if self.supply is None:
+            return True
+        if not self.supply.isOutputOn():
+            return False
+        if self._powerCycles != self.supply.powerCycles:
+            ## Everything is lost when the boards lose power
+            self._powerCycles = self.supply.powerCycles
+            self.reset()
+        return True
+        
+    def transfer(self, data):
+        """
+        Shift a frame through the chain, latch it, and return what came out of
+        the end of the chain.
+        """
+        
+        if not self.isPowered():
+            return bytes(len(data))
+            
+        stream = self._shift + data
+        output = bytes(stream[:len(data)])
+        self._shift = stream[len(data):]
+        
+        for i in range(self.deviceCount):
+            address, value = self._shift[2*i], self._shift[2*i+1]
+            registers = self.registers[self.deviceCount-1-i]
+            if address & 0x80:
+                self._shift[2*i+1] = registers[address & 0x7F]
+            elif address != 0x00:
+                registers[address] = value
+        return output
+        
+    def getRegister(self, device, register):
+        """
+        Return the value of a register on a device.  Devices are numbered
+        from one.
+        """
+        
+        return self.registers[device-1][register & 0x7F]
+        
+    def getPort(self, device, port):
+        """
+        Return the state of a port, 4 through 31, on a device.
+        """
+        
+        return self.registers[device-1][0x20 + port] & 1
+        
+    def isConfigured(self, device):
+        """
+        Return whether or not a device is running with all of its ports
+        configured as outputs.
+        """
+        
+        registers = self.registers[device-1]
+        return (registers[0x04] & 1) == 1 and all([registers[r] == 0x55 for r in range(0x0B, 0x10)])
+
+
+class IVSPowerSupply(object):
+    """
+    Class for an iVS power supply on the I2C bus.  The PMBus registers used
+    by the tools are implemented, including the page register with its
+    settling time, the WRITE_PROTECT modes, and the output ramping up and down
+    over rampTime seconds when it is switched.  Extra status flags, i.e.,
+    1<<3 for OverCurrent, can be set through statusFlags and the supply can
+    be made to stop answering by setting responding to False.
+    """
+    
+    def __init__(self, address, modules=(0, 1), voltage=15.0, current=10.0, temperatures=(35.0, 40.0, 38.0), rampTime=0.25, pageLatency=0.002, clock=None):
+        self.address = int(address)
+        self.modules = list(modules)
+        self.voltage = float(voltage)
+        self.current = float(current)
+        self.temperatures = list(temperatures)
+        self.rampTime = float(rampTime)
+        self.pageLatency = float(pageLatency)
+        self.clock = clock if clock is not None else time
+        
+        self.statusFlags = 0
+        self.responding = True
+        self.on = False
+        self.powerCycles = 0
+        self.writeProtect = 0x80
+        
+        self._switchTime = None
+        self._page = 0
+        self._pageTarget = 0
+        self._pageTime = None
+        
+    def getOutputFraction(self):
+        """
+        Return the output voltage as a fraction of the nominal voltage.
+        """
+        
+        if self._switchTime is None or self.rampTime <= 0:
+            return 1.0 if self.on else 0.0
+            
+        fraction = min(1.0, (self.clock.monotonic() - self._switchTime) / self.rampTime)
+        if fraction >= 1.0:
+            self._switchTime = None
+        return fraction if self.on else 1.0 - fraction
+        
+    def isOutputOn(self):
+        """
+        Return whether or not the output is up.
+        """
+        
+        return self.getOutputFraction() >= 0.9
+        
+    def setOn(self, on):
+        """
+        Turn the output on or off.
+        """
+        
+        on = bool(on)
+        if on != self.on:
+            if not on:
+                self.powerCycles += 1
+            self.on = on
+            self._switchTime = self.clock.monotonic()
+            
+    def _getPage(self):
+        """
+        Return the current page, applying any page change that has settled.
+        """
+        
+        if self._pageTime is not None and self.clock.monotonic() - self._pageTime >= self.pageLatency:
+            self._page = self._pageTarget
+            self._pageTime = None
+        return self._page
+        
+    def _isWritable(self, register):
+        """
+        Return whether or not a register can be written to with the current
+        WRITE_PROTECT setting.
+        """
+        
+        if register == 0x10:
+            return True
+        elif self.writeProtect & 0x80:
+            return False
+        elif self.writeProtect & 0x40:
+            return register == 0x01 or (register == 0x00 and self.writeProtect & 0x01)
+        elif self.writeProtect & 0x20:
+            return register in (0x00, 0x01, 0x02, 0x21)
+        return True
+        
+    def _getModuleStatus(self, fraction):
+        """
+        Return the module status byte (0xDB) for the current page.
+        """
+        
+        if self._page not in self.modules:
+            return 0
+            
+        status = self.statusFlags
+        if self.on:
+            status |= 1
+        if fraction >= 0.9:
+            status |= 1<<2
+        else:
+            status |= 1<<1
+        return status
+        
+    def read(self, register, size):
+        """
+        Read size bytes from a register.  Returns None if the supply does not
+        answer.
+        """
+        
+        if not self.responding:
+            return None
+            
+        page = self._getPage()
+        fraction = self.getOutputFraction()
+        nModules = max(1, len(self.modules))
+        onPage = page in self.modules
+        if register == 0x00:
+            value = page
+        elif register == 0x01:
+            value = 0x80 if self.on else 0x00
+        elif register == 0x10:
+            value = self.writeProtect
+        elif register == 0x78:
+            value = 0x80 if self._pageTime is not None else 0x00
+        elif register == 0xD3:
+            value = sum([1<<m for m in self.modules])
+        elif register == 0xDB:
+            value = self._getModuleStatus(fraction)
+        elif register == 0x8B:
+            value = int(round(self.voltage*fraction*100)) if onPage else 0
+        elif register == 0x8C:
+            value = int(round(self.current/nModules*fraction*100)) if onPage else 0
+        elif register == 0x89:
+            value = int(round(self.current/nModules*fraction/0.95*100)) if onPage else 0
+        elif register == 0x8D:
+            value = int(round(self.temperatures[0]*4))
+        elif register == 0x8E:
+            value = int(round(self.temperatures[1]*4))
+        elif register == 0x8F:
+            value = int(round(self.temperatures[2]))
+        else:
+            value = 0
+        return (value & ((1 << (8*size)) - 1)).to_bytes(size, 'little')
+        
+    def write(self, register, data):
+        """
+        Write data to a register.  Returns False if the write was not
+        acknowledged.
+        """
+        
+        if not self.responding or not self._isWritable(register) or len(data) == 0:
+            return False
+            
+        if register == 0x00:
+            self._getPage()
+            self._pageTarget = data[0]
+            if self.pageLatency > 0:
+                self._pageTime = self.clock.monotonic()
+            else:
+                self._page = data[0]
+        elif register == 0x01:
+            self.setOn(data[0] & 0x80)
+        elif register == 0x10:
+            self.writeProtect = data[0]
+        return True
+
+
+class PICBoard(object):
+    """
+    Class for the PIC microcontroller on an ARX board.  Replies are an ACK
+    (0x06) followed by ASCII hex values encoded the way sendPICDevice decodes
+    them for boards other than Rev H.  The board only answers while its
+    supply is on and it is not asleep.  The FEE currents read as zero unless
+    the FEE supply is on.
+    """
+    
+    def __init__(self, address, channels=16, currents=None, powers=None, temperatures=(25.0, 25.5, 26.0), supply=None, feeSupply=None, clock=None):
+        self.address = int(address)
+        self.channels = int(channels)
+        self.currents = list(currents) if currents is not None else [60.0 for i in range(self.channels)]
+        self.powers = list(powers) if powers is not None else [1.0 for i in range(self.channels)]
+        self.temperatures = list(temperatures)
+        self.supply = supply
+        self.feeSupply = feeSupply
+        self.clock = clock if clock is not None else time
+        
+        self.picTemperature = 30.0
+        self.responding = True
+        self.asleep = False
+        self._timeOffset = 0.0
+        
+        # Statistics
+        self.nCommands = 0
+        self.lastCommand = b''
+        
+    def isPowered(self):
+        """
+        Return whether or not the board has power.
+        """
+        
+        return self.supply is None or self.supply.isOutputOn()
+        
+    def handle(self, data):
+        """
+        Handle a command and return the reply, or None if the board does not
+        reply.
+        """
+        
+        if not self.responding or not self.isPowered():
+            return None
+            
+        ## Some of the callers pad the command with a space
+        data = bytes(data).lstrip(b' ')
+        if data[:1] == b'W':
+            self.asleep = False
+            return None
+        if self.asleep:
+            return None
+            
+        self.nCommands += 1
+        self.lastCommand = data
+        
+        name, argument = data[:4], data[4:]
+        if name == b'RSET':
+            self.asleep = False
+            self._timeOffset = -self.clock.time()
+            return None
+        elif name == b'SLEP':
+            self.asleep = True
+            return None
+        elif name == b'ECHO':
+            reply = data
+        elif name == b'GTIM':
+            reply = b'%08X' % (int(self.clock.time() + self._timeOffset) & 0xFFFFFFFF)
+        elif name == b'STIM':
+            try:
+                self._timeOffset = int(argument, 16) - self.clock.time()
+            except ValueError:
+                return bytes([_NAK]) + data
+            reply = argument
+        elif name == b'CURA':
+            fee = self.feeSupply is None or self.feeSupply.isOutputOn()
+            reply = b''.join([b'%04X' % self._encodeCurrent(c if fee else 0.0) for c in self.currents])
+        elif name == b'POWA':
+            reply = b''.join([b'%04X' % self._encodePower(p) for p in self.powers])
+        elif name == b'OWTE':
+            reply = b''.join([b'%04X' % (int(round(t/0.0625)) & 0xFFFF) for t in self.temperatures])
+        elif name == b'OWDC':
+            reply = b'%02X' % len(self.temperatures)
+        elif name == b'TEMP':
+            reply = b'%04X' % (int(round(self.picTemperature*10)) & 0xFFFF)
+        else:
+            return bytes([_NAK]) + data
+        return bytes([_ACK]) + reply
+        
+    @staticmethod
+    def _encodeCurrent(current):
+        """
+        Convert a FEE current in mA to the value returned by CURA.
+        """
+        
+        return max(0, min(0xFFFF, int(round(current/1000.0*2.06*1024/3.3))))
+        
+    @staticmethod
+    def _encodePower(power):
+        """
+        Convert an RF power in uW to the value returned by POWA.
+        """
+        
+        voltage = math.sqrt(max(0.0, power)*50/1e6)*2.296
+        return max(0, min(0xFFFF, int(round(voltage*1024/3.3))))
+
+
+class SimulatedATmega(object):
+    """
+    Class for a single simulated SUB-20/ATmega and the hardware attached to
+    it.  Commands are handled by process() one at a time, the same way as the
+    firmware does, including the time the bus transfers and firmware
+    timeouts take if busTiming is True.  Extra latencies can be added with
+    setLatency() and faults with addFault().
+    """
+    
+    def __init__(self, sn, device, chain=None, clock=None, seed=None):
+        self.sn = str(sn)[:MAX_SN_LEN]
+        self.device = device
+        self.chain = chain
+        self.clock = clock if clock is not None else time
+        
+        self.psus = {}
+        self.pics = {}
+        self.temperature = 32.5
+        self.present = True
+        self.busTiming = True
+        self.locked = True
+        self.fault = False
+        self.locating = False
+        
+        self._latency = dict([(kind, (0.0, 0.0, 0.0)) for kind in COMMAND_TYPES])
+        self._faults = []
+        self._random = random.Random(seed)
+        self._rs485Reply = None
+        self._lock = threading.Lock()
+        
+        # Statistics
+        self.nCommands = dict([(kind, 0) for kind in COMMAND_TYPES])
+        self.nFaults = 0
+        
+    def addPSU(self, psu):
+        """
+        Attach an IVSPowerSupply to the I2C bus.
+        """
+        
+        self.psus[psu.address] = psu
+        return psu
+        
+    def addPIC(self, pic):
+        """
+        Attach a PICBoard to the RS485 bus.
+        """
+        
+        self.pics[pic.address] = pic
+        return pic
+        
+    def setLatency(self, kind, latency, jitter=0.0, perByte=0.0):
+        """
+        Add a latency of latency seconds, plus up to jitter seconds, plus
+        perByte seconds for every byte sent or received, to every command of
+        the provided type.
+        """
+        
+        if kind not in COMMAND_TYPES:
+            raise ValueError("Unknown command type '%s'" % kind)
+        self._latency[kind] = (float(latency), float(jitter), float(perByte))
+        
+    def addFault(self, kind, mode, **kwds):
+        """
+        Add a fault to inject and return the new SimulatedFault.  See
+        SimulatedFault for the arguments.
+        """
+        
+        fault = SimulatedFault(kind, mode, **kwds)
+        with self._lock:
+            self._faults.append(fault)
+        return fault
+        
+    def removeFault(self, fault):
+        """
+        Remove a fault added with addFault().
+        """
+        
+        with self._lock:
+            try:
+                self._faults.remove(fault)
+            except ValueError:
+                pass
+                
+    def clearFaults(self):
+        """
+        Remove all faults.
+        """
+        
+        with self._lock:
+            self._faults = []
+            
+    def _fireFaults(self, kind, payload):
+        """
+        Return a list of the faults that fire for a command.
+        """
+        
+        fired = []
+        for fault in list(self._faults):
+            if not fault.matches(kind, payload):
+                continue
+            if fault.probability < 1.0 and self._random.random() >= fault.probability:
+                continue
+                
+            fault.nFired += 1
+            self.nFaults += 1
+            fired.append(fault)
+            if fault.isExhausted():
+                self._faults.remove(fault)
+        return fired
+        
+    def process(self, command, payload=b''):
+        """
+        Process a single command and return a two-element tuple of the
+        response code and payload, or None if there is no response.
+        """
+        
+        payload = bytes(payload)
+        kind = _commandType(command)
+        with self._lock:
+            status, response, delay = self._dispatch(command, payload)
+            if not self.busTiming:
+                delay = 0.0
+            self.nCommands[kind] += 1
+            
+            for fault in self._fireFaults(kind, payload):
+                delay += fault.delay
+                if fault.mode == 'drop':
+                    status = None
+                elif fault.mode == 'error' and status is not None:
+                    status = fault.status if fault.status is not None else _FAULT_STATUS[kind]
+                    response = b''
+                elif fault.mode == 'corrupt' and response:
+                    i = self._random.randrange(len(response))
+                    response = response[:i] + bytes([response[i] ^ (1 << self._random.randrange(8))]) + response[i+1:]
+                    
+            latency, jitter, perByte = self._latency[kind]
+            delay += latency + perByte*(len(payload) + len(response))
+            if jitter > 0:
+                delay += self._random.uniform(0.0, jitter)
+            if delay > 0:
+                self.clock.sleep(delay)
+                
+        if status is None:
+            return None
+        return status, response
+        
+    def _dispatch(self, command, payload):
+        """
+        Run a command and return a three-element tuple of the response code
+        (None for no response), the response payload, and how long the
+        command took in s.
+        """
+        
+        nargs = len(payload)
+        if command == COMMAND_SUCCESS:
+            return None, b'', 0.0
+            
+        elif command == COMMAND_READ_SN:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            return COMMAND_SUCCESS, self.sn.encode().ljust(MAX_SN_LEN, b'\x00'), 0.0
+            
+        elif command == COMMAND_READ_VER:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            return COMMAND_SUCCESS, FIRMWARE_VERSION.encode(), 0.0
+            
+        elif command == COMMAND_READ_MLEN:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            return COMMAND_SUCCESS, struct.pack('<H', MAX_CMD_LEN), 0.0
+            
+        elif command == COMMAND_ECHO:
+            return COMMAND_SUCCESS, payload, 0.0
+            
+        elif command == COMMAND_READ_TEMPERATURE:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            return COMMAND_SUCCESS, struct.pack('<f', self.temperature), 0.0
+            
+        elif command == COMMAND_TRANSFER_SPI:
+            if nargs == 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            if self.chain is None:
+                return COMMAND_SUCCESS, bytes(nargs), nargs*_SPI_BYTE_TIME
+            return COMMAND_SUCCESS, self.chain.transfer(payload), nargs*_SPI_BYTE_TIME
+            
+        elif command == COMMAND_SCAN_RS485:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            found = [addr for addr in sorted(self.pics) if self.pics[addr].handle(b'ECHO') is not None]
+            return COMMAND_SUCCESS, bytes(found), len(found)*0.006 + (126-len(found))*(0.005+RS485_NOREPLY_TIMEOUT)
+            
+        elif command == COMMAND_WRITE_RS485:
+            if nargs < 2:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            pic = self.pics.get(payload[0], None)
+            self._rs485Reply = pic.handle(payload[1:]) if pic is not None else None
+            return COMMAND_SUCCESS, b'', (nargs+2)*_RS485_BYTE_TIME
+            
+        elif command == COMMAND_READ_RS485:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            reply, self._rs485Reply = self._rs485Reply, None
+            if reply is None or len(reply) <= 1:
+                return COMMAND_FAILURE_TOUT, b'', RS485_LONG_TIMEOUT
+            if reply[0] != _ACK:
+                return COMMAND_FAILURE_RS485, b'', len(reply)*_RS485_BYTE_TIME
+            return COMMAND_SUCCESS, reply, len(reply)*_RS485_BYTE_TIME
+            
+        elif command == COMMAND_SEND_RS485:
+            if nargs < 2:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            data = payload[1:].lstrip(b' ')
+            pic = self.pics.get(payload[0], None)
+            reply = pic.handle(data) if pic is not None else None
+            delay = (nargs+2)*_RS485_BYTE_TIME
+            if reply is None or len(reply) <= 1:
+                ## Some commands never get a reply
+                if data == b'W' or data in (b'RSET', b'SLEP'):
+                    return COMMAND_SUCCESS, b'', delay + RS485_NOREPLY_TIMEOUT
+                elif data[:1] == b'*':
+                    return COMMAND_SUCCESS, b'', delay + RS485_SHORT_TIMEOUT
+                elif data in (b'OWSE', b'OWTE'):
+                    return COMMAND_FAILURE_TOUT, b'', delay + RS485_LONG_TIMEOUT
+                return COMMAND_FAILURE_TOUT, b'', delay + RS485_SHORT_TIMEOUT
+            delay += len(reply)*_RS485_BYTE_TIME
+            if reply[0] != _ACK:
+                return COMMAND_FAILURE_RS485, b'', delay
+            return COMMAND_SUCCESS, reply[:80], delay
+            
+        elif command == COMMAND_SCAN_I2C:
+            if nargs != 0:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            found = [addr for addr in sorted(self.psus) if self.psus[addr].responding]
+            return COMMAND_SUCCESS, bytes(found), 127*2*_I2C_BYTE_TIME
+            
+        elif command == COMMAND_READ_I2C:
+            if nargs != 3:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            addr, register, size = payload
+            psu = self.psus.get(addr, None)
+            data = psu.read(register, size) if psu is not None else None
+            if data is None:
+                self.fault = True
+                return COMMAND_FAILURE_BUS, b'', I2C_TIMEOUT
+            return COMMAND_SUCCESS, data, (3+size)*_I2C_BYTE_TIME
+            
+        elif command == COMMAND_WRITE_I2C:
+            if nargs < 3:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            psu = self.psus.get(payload[0], None)
+            if psu is None or not psu.write(payload[1], payload[2:]):
+                self.fault = True
+                return COMMAND_FAILURE_BUS, b'', nargs*_I2C_BYTE_TIME
+            return COMMAND_SUCCESS, b'', nargs*_I2C_BYTE_TIME
+            
+        elif command == COMMAND_LOCK:
+            self.locked = True
+            return COMMAND_SUCCESS, b'', 0.0
+            
+        elif command == COMMAND_UNLOCK:
+            self.locked = False
+            return COMMAND_SUCCESS, b'', 0.0
+            
+        elif command == COMMAND_WRITE_SN:
+            if nargs == 0 or nargs > MAX_SN_LEN:
+                return COMMAND_FAILURE_ARG, b'', 0.0
+            if self.locked:
+                return COMMAND_FAILURE_STA, b'', 0.0
+            self.sn = payload.rstrip(b'\x00').decode('ascii', 'replace')
+            return COMMAND_SUCCESS, self.sn.encode().ljust(MAX_SN_LEN, b'\x00'), 0.0
+            
+        elif command == COMMAND_CLR_FAULT:
+            self.fault = False
+            return COMMAND_SUCCESS, b'', 0.0
+            
+        elif command == COMMAND_LOCATE:
+            self.locating = not self.locating
+            return COMMAND_SUCCESS, b'', 0.0
+            
+        elif command == COMMAND_RESET:
+            self._rs485Reply = None
+            self.locked = True
+            self.fault = False
+            self.locating = False
+            return None, b'', 0.0
+            
+        return COMMAND_FAILURE_CMD, b'', 0.0
+
+
+class SimulatedATmegaClient(object):
+    """
+    Class that stands in for atmegaWrap.ATmega.  Commands that go unanswered
+    are retried the same way as in libatmega.
+    """
+    
+    def __init__(self, wrap, sn):
+        self._wrap = wrap
+        self._sn = str(sn)
+        self._atm = None
+        
+    def _send(self, command, payload=b''):
+        """
+        Send a command and return a two-element tuple of the response code
+        and payload, or None if there was no response.
+        """
+        
+        wrap = self._wrap
+        clock = wrap.simulator
+        
+        tStart = clock.monotonic()
+        attempts, timeouts = 0, 0
+        result, firstByte = None, 0.0
+        for i in range(wrap.maxRetry+1):
+            if not self._atm.present:
+                break
+            if i > 0:
+                clock.sleep(wrap.retryWait)
+                
+            attempts += 1
+            tSend = clock.monotonic()
+            result = self._atm.process(command, payload)
+            if result is not None:
+                firstByte = clock.monotonic() - tSend
+                clock.sleep(tSend + wrap.sendWait - clock.monotonic())
+                break
+                
+            timeouts += 1
+            clock.sleep(tSend + _commandTimeout(command, payload) - clock.monotonic())
+            
+        wrap._record(self._atm.device, _commandType(command), attempts, timeouts, result,
+                     len(payload), len(result[1]) if result is not None else 0, firstByte, clock.monotonic() - tStart)
+        return result
+        
+    def _call(self, command, payload=b''):
+        """
+        Send a command and return the response payload, or None if the
+        command failed.
+        """
+        
+        if self._atm is None:
+            return None
+        result = self._send(command, payload)
+        if result is None or (result[0] & COMMAND_FAILURE):
+            return None
+        return result[1]
+        
+    def open(self):
+        atm = self._wrap.simulator.getDevice(self._sn)
+        if atm is None or not atm.present:
+            return False
+            
+        self._atm = atm
+        if self._call(COMMAND_READ_SN) is None:
+            self._atm = None
+            return False
+        return True
+        
+    def close(self):
+        self._atm = None
+        
+    def get_version(self):
+        version = self._call(COMMAND_READ_VER)
+        return version.decode('ascii', 'replace') if version is not None else ''
+        
+    def transfer_spi(self, inputs, outputs):
+        inputs = _inputBuffer(inputs, 'inputs', MAX_CMD_LEN)
+        outputs = _outputBuffer(outputs, 'outputs', MAX_CMD_LEN)
+        if outputs.nbytes < inputs.nbytes:
+            raise ValueError("outputs is smaller than inputs")
+            
+        response = self._call(COMMAND_TRANSFER_SPI, inputs.tobytes())
+        if response is None or len(response) != inputs.nbytes:
+            return False
+        outputs[:len(response)] = response
+        return True
+        
+    def list_rs485_devices(self):
+        response = self._call(COMMAND_SCAN_RS485)
+        return list(response) if response is not None else []
+        
+    def read_rs485(self, addr, outputs):
+        outputs = _outputBuffer(outputs, 'outputs', MAX_CMD_LEN)
+        response = self._call(COMMAND_READ_RS485)
+        if response is None or outputs.nbytes == 0 or len(response) > outputs.nbytes:
+            return (False, 0)
+        outputs[:len(response)] = response
+        return (True, len(response))
+        
+    def write_rs485(self, addr, inputs):
+        inputs = _inputBuffer(inputs, 'inputs', MAX_CMD_LEN-1)
+        return self._call(COMMAND_WRITE_RS485, bytes([addr]) + inputs.tobytes()) is not None
+        
+    def send_rs485(self, addr, inputs, outputs):
+        inputs = _inputBuffer(inputs, 'inputs', MAX_CMD_LEN-1)
+        outputs = _outputBuffer(outputs, 'outputs', MAX_CMD_LEN)
+        response = self._call(COMMAND_SEND_RS485, bytes([addr]) + inputs.tobytes())
+        if response is None or outputs.nbytes == 0 or len(response) > outputs.nbytes:
+            return (False, 0)
+        outputs[:len(response)] = response
+        return (True, len(response))
+        
+    def list_i2c_devices(self):
+        response = self._call(COMMAND_SCAN_I2C)
+        return list(response) if response is not None else []
+        
+    def read_i2c(self, addr, reg, outputs):
+        if isinstance(outputs, int):
+            response = self._call(COMMAND_READ_I2C, bytes([addr, reg, outputs]))
+            self._wrap.simulator.sleep(self._wrap.i2cWait)
+            if response is None:
+                return (False, [])
+            return (True, list(response))
+            
+        outputs = _outputBuffer(outputs, 'outputs', 255)
+        response = self._call(COMMAND_READ_I2C, bytes([addr, reg, outputs.nbytes]))
+        self._wrap.simulator.sleep(self._wrap.i2cWait)
+        if response is None:
+            return False
+        outputs[:len(response)] = response
+        return True
+        
+    def write_i2c(self, addr, reg, inputs):
+        if isinstance(inputs, (list, tuple)):
+            if len(inputs) > MAX_CMD_LEN-2:
+                raise ValueError("data is larger than %i B" % (MAX_CMD_LEN-2))
+            data = bytes(inputs)
+        else:
+            data = _inputBuffer(inputs, 'inputs', MAX_CMD_LEN-2).tobytes()
+        response = self._call(COMMAND_WRITE_I2C, bytes([addr, reg]) + data)
+        self._wrap.simulator.sleep(self._wrap.i2cWait)
+        return response is not None
+        
+    def clear_fault(self):
+        return self._call(COMMAND_CLR_FAULT) is not None
+        
+    def locate(self):
+        return self._call(COMMAND_LOCATE) is not None
+        
+    def reset(self):
+        if self._atm is None:
+            return False
+        self._atm.process(COMMAND_RESET)
+        return True
+
+
+class SimulatedIVSSession(object):
+    """
+    Class that stands in for atmegaWrap.IVSSession.  This follows IVSSession
+    in arx_control/ivsCommon.cpp.
+    """
+    
+    def __init__(self, atm, addr, clock):
+        self._atm = atm
+        self._addr = addr
+        self._clock = clock
+        
+        self._page = -1
+        self._transactions = 0
+        self._selectHint = _IVS_POLL_MIN
+        self._busyWaits = 0
+        self._busyTotal = 0.0
+        self._busyMax = 0.0
+        self._stats = {}
+        
+    def _read(self, reg, size):
+        self._transactions += 1
+        success, data = self._atm.read_i2c(self._addr, reg, size)
+        return bytes(data) if success else None
+        
+    def _write(self, reg, data):
+        self._transactions += 1
+        return self._atm.write_i2c(self._addr, reg, list(data))
+        
+    def get_smart_modules(self):
+        data = self._read(0xD3, 2)
+        if data is None:
+            return []
+        mask = struct.unpack('<H', data)[0]
+        return [i for i in range(16) if (mask >> i) & 1]
+        
+    def select_module(self, module):
+        stats = self._stats.setdefault(module, {'selects': 0, 'skipped': 0, 'failures': 0, 'total': 0.0, 'max': 0.0})
+        
+        if self._page < 0:
+            data = self._read(0x00, 1)
+            if data is not None:
+                self._page = data[0]
+        if self._page == module:
+            stats['skipped'] += 1
+            return True
+            
+        tStart = self._clock.monotonic()
+        for ntry in range(_IVS_MAX_RETRY_PAGE):
+            self._page = -1
+            if not self._write(0x00, [module]):
+                self._clock.sleep(0.010)
+                continue
+                
+            tWrite = self._clock.monotonic()
+            interval = self._selectHint
+            while self._clock.monotonic() - tWrite < _IVS_SELECT_TIMEOUT:
+                self._clock.sleep(interval)
+                
+                data = self._read(0x00, 1)
+                if data is not None and data[0] == module:
+                    latency = self._clock.monotonic() - tStart
+                    self._page = module
+                    self._selectHint = max(_IVS_POLL_MIN, min(_IVS_POLL_MAX, (3*self._selectHint + self._clock.monotonic() - tWrite) / 4))
+                    
+                    stats['selects'] += 1
+                    stats['total'] += latency
+                    stats['max'] = max(stats['max'], latency)
+                    return True
+                    
+                interval = min(_IVS_POLL_MAX, 2*interval)
+                
+        stats['failures'] += 1
+        return False
+        
+    def wait_not_busy(self, timeout_ms=1000):
+        interval = _IVS_POLL_MIN
+        tStart = self._clock.monotonic()
+        while True:
+            data = self._read(0x78, 1)
+            if data is None:
+                return False
+                
+            if not (data[0] >> 7) & 1:
+                waited = self._clock.monotonic() - tStart
+                self._busyWaits += 1
+                self._busyTotal += waited
+                self._busyMax = max(self._busyMax, waited)
+                return True
+                
+            if self._clock.monotonic() - tStart > timeout_ms/1000.0:
+                return False
+                
+            self._clock.sleep(interval)
+            interval = min(_IVS_POLL_MAX/2, 2*interval)
+            
+    def invalidate(self):
+        self._page = -1
+        
+    def address(self):
+        return self._addr
+        
+    def current_module(self):
+        return self._page
+        
+    def transactions(self):
+        return self._transactions
+        
+    def get_statistics(self):
+        modules = {}
+        for module,stats in self._stats.items():
+            modules[module] = {'selects': stats['selects'],
+                               'skipped': stats['skipped'],
+                               'failures': stats['failures'],
+                               'select_mean': stats['total'] / stats['selects'] if stats['selects'] else 0.0,
+                               'select_max': stats['max']}
+        return {'transactions': self._transactions,
+                'busy_waits': self._busyWaits,
+                'busy_mean': self._busyTotal / self._busyWaits if self._busyWaits else 0.0,
+                'busy_max': self._busyMax,
+                'modules': modules}
+
+
+class SimulatedATmegaWrap(object):
+    """
+    Class that stands in for the atmegaWrap module and talks to the devices
+    of a HardwareSimulator.  If libraryDelays is True the fixed waits that
+    libatmega and aspCommon add to every call, i.e., the 10 ms after sending
+    a command and the 55 ms after every I2C transfer, are included.
+    """
+    
+    def __init__(self, simulator, libraryDelays=True):
+        self.simulator = simulator
+        
+        self.maxRetry = 5
+        self.sendWait = 0.010 if libraryDelays else 0.0
+        self.retryWait = 0.105 if libraryDelays else 0.0
+        self.i2cWait = 0.055 if libraryDelays else 0.0
+        
+        self._linkStats = {}
+        self._lock = threading.Lock()
+        
+    def ATmega(self, sn):
+        return SimulatedATmegaClient(self, sn)
+        
+    def IVSSession(self, atm, addr):
+        return SimulatedIVSSession(atm, addr, self.simulator)
+        
+    def list_atmegas(self):
+        return [atm.sn for atm in self.simulator.getDevices() if atm.present]
+        
+    def find_devices(self):
+        return [atm.device for atm in self.simulator.getDevices() if atm.present]
+        
+    def cache_lookup(self, sn):
+        atm = self.simulator.getDevice(sn)
+        return atm.device if atm is not None and atm.present else ''
+        
+    def strerror(self, code):
+        return {COMMAND_SUCCESS:       'Command successful',
+                COMMAND_FAILURE:       'General command failure (reason not specified)',
+                COMMAND_FAILURE_ARG:   'Invalid argument count',
+                COMMAND_FAILURE_STA:   'Invalid device state',
+                COMMAND_FAILURE_BUS:   'An error occurred during the I2C transaction',
+                COMMAND_FAILURE_RS485: 'Invalid RS485-specific command',
+                COMMAND_FAILURE_TOUT:  'Timeout reading from RS485',
+                COMMAND_FAILURE_CMD:   'Invalid command'}.get(code, 'Unknown error')
+                
+    def _record(self, device, kind, attempts, timeouts, result, bytesOut, bytesIn, firstByte, elapsed):
+        """
+        Update the link statistics for a single call.
+        """
+        
+        with self._lock:
+            entry = self._linkStats.setdefault(device, {})
+            stats = entry.setdefault(kind, {'calls': 0, 'retries': 0, 'timeouts': 0, 'failures': 0, 'errors': 0,
+                                            'bytes_out': 0, 'bytes_in': 0,
+                                            'first_byte_total': 0.0, 'first_byte_max': 0.0,
+                                            'call_total': 0.0, 'call_max': 0.0,
+                                            'first_byte_hist': [0 for i in range(24)],
+                                            'transfer_hist': [0 for i in range(24)]})
+            stats['calls'] += 1
+            stats['retries'] += max(0, attempts-1)
+            stats['timeouts'] += timeouts
+            stats['bytes_out'] += attempts*(9 + bytesOut)
+            if result is None:
+                stats['failures'] += 1
+            else:
+                stats['errors'] += 1 if result[0] & COMMAND_FAILURE else 0
+                stats['bytes_in'] += 9 + bytesIn
+                stats['first_byte_total'] += firstByte
+                stats['first_byte_max'] = max(stats['first_byte_max'], firstByte)
+                stats['first_byte_hist'][_statsBucket(firstByte)] += 1
+                stats['transfer_hist'][0] += 1
+            stats['call_total'] += elapsed
+            stats['call_max'] = max(stats['call_max'], elapsed)
+            
+    def get_link_stats(self):
+        with self._lock:
+            output = {}
+            for device,entry in self._linkStats.items():
+                output[device] = {}
+                for kind,stats in entry.items():
+                    nValid = stats['calls'] - stats['failures']
+                    output[device][kind] = {'calls': stats['calls'],
+                                            'retries': stats['retries'],
+                                            'timeouts': stats['timeouts'],
+                                            'failures': stats['failures'],
+                                            'errors': stats['errors'],
+                                            'bytes_out': stats['bytes_out'],
+                                            'bytes_in': stats['bytes_in'],
+                                            'first_byte_mean': stats['first_byte_total'] / nValid if nValid else 0.0,
+                                            'first_byte_max': stats['first_byte_max'],
+                                            'transfer_mean': 0.0,
+                                            'transfer_max': 0.0,
+                                            'call_mean': stats['call_total'] / stats['calls'],
+                                            'call_max': stats['call_max'],
+                                            'first_byte_hist': list(stats['first_byte_hist']),
+                                            'transfer_hist': list(stats['transfer_hist'])}
+            return output
+            
+    def reset_link_stats(self):
+        with self._lock:
+            self._linkStats = {}
+            
+    def ivs_get_smart_modules(self, atm, addr):
+        return self.IVSSession(atm, addr).get_smart_modules()
+        
+    def ivs_select_module(self, atm, addr, module):
+        return self.IVSSession(atm, addr).select_module(module)
+        
+    def ivs_wait_not_busy(self, atm, addr, timeout_ms=1000):
+        return self.IVSSession(atm, addr).wait_not_busy(timeout_ms)
+        
+    def ivs_is_on(self, atm, addr):
+        success, data = atm.read_i2c(addr, 0x01, 1)
+        if not success:
+            ## Like ivs_is_on, say it is on if we cannot tell
+            return True
+        return bool((data[0] >> 7) & 1)
+        
+    def ivs_enable_all_writes(self, atm, addr):
+        return atm.write_i2c(addr, 0x10, [0])
+        
+    def ivs_enable_operation_page_writes(self, atm, addr):
+        return atm.write_i2c(addr, 0x10, [(1 << 6) | 1])
+        
+    def ivs_disable_writes(self, atm, addr):
+        ## NOTE: This matches ivsCommon.hpp, which writes ((1 << 7) & 1)
+        return atm.write_i2c(addr, 0x10, [(1 << 7) & 1])
+
+
+class SimulatedTools(object):
+    """
+    Class that stands in for the command line tools in /usr/local/bin.  The
+    tools used by aspSUB20 are available and produce the same output and
+    return codes as the real ones.  startupLatency is how long, in s, each
+    tool takes to start.
+    """
+    
+    def __init__(self, wrap, startupLatency=0.0):
+        self.wrap = wrap
+        self.startupLatency = float(startupLatency)
+        
+        self._tools = {'listATmegaSN':      self._listATmegaSN,
+                       'countBoards':       self._countBoards,
+                       'sendARXDevice':     self._sendARXDevice,
+                       'readARXDevice':     self._readARXDevice,
+                       'onoffPSU':          self._onoffPSU,
+                       'readPSU':           self._readPSU,
+                       'countPSUs':         self._countPSUs,
+                       'countThermometers': self._countThermometers,
+                       'readThermometers':  self._readThermometers,
+                       'countPICs':         self._countPICs,
+                       'sendPICDevice':     self._sendPICDevice}
+                       
+        # Statistics
+        self.nRuns = 0
+        
+    def run(self, command, timeout, token=None):
+        """
+        Run a tool and return a three-element tuple of its return code,
+        standard output, and standard error, the same as aspSUB20._run().
+        """
+        
+        name = os.path.basename(command[0])
+        args = [arg for arg in command[1:] if arg != '--stats']
+        try:
+            tool = self._tools[name]
+        except KeyError:
+            return 127, '', "%s: not available in the simulator\n" % name
+            
+        if token is not None and token.isCancelled():
+            return -1, '', 'cancelled'
+            
+        self.wrap.simulator.sleep(self.startupLatency)
+        output, output2 = io.StringIO(), io.StringIO()
+        try:
+            returncode = tool(args, output, output2)
+        except (ValueError, IndexError) as e:
+            output2.write("%s - %s\n" % (name, str(e)))
+            returncode = 1
+        self.nRuns += 1
+        return returncode & 0xFF, output.getvalue(), output2.getvalue()
+        
+    def _open(self, sn):
+        """
+        Open an ATmega and return it, or None if it cannot be opened.
+        """
+        
+        atm = self.wrap.ATmega(sn)
+        if not atm.open():
+            return None
+        return atm
+        
+    def _listATmegaSN(self, args, output, output2):
+        temps = '-t' in args or '--temperatures' in args
+        for device in self.wrap.find_devices():
+            atm = self.wrap.ATmega(device)
+            if not atm.open():
+                continue
+            sn = atm._call(COMMAND_READ_SN)
+            if sn is None:
+                continue
+            sn = sn.rstrip(b'\x00').decode('ascii', 'replace')
+            output.write("Found %s at %s" % (sn, device))
+            if temps:
+                temperature = atm._call(COMMAND_READ_TEMPERATURE)
+                if temperature is not None:
+                    output.write(" at %.3g C" % struct.unpack('<f', temperature)[0])
+            output.write("\n")
+            atm.close()
+        return 0
+        
+    def _countBoards(self, args, output, output2):
+        expected = 0
+        for flag in ('-e', '--expect'):
+            if flag in args[:-1]:
+                i = args.index(flag)
+                expected = int(args[i+1])
+                args = args[:i] + args[i+2:]
+        args = [arg for arg in args if arg[0] != '-']
+        if len(args) != 1:
+            output2.write("countBoards - Need 1 argument, %i provided\n" % len(args))
+            return 1
+        if expected < 0 or expected > _MAX_BOARDS:
+            output2.write("countBoards - Invalid expected board count %i\n" % expected)
+            return 1
+        atm = self._open(args[0])
+        if atm is None:
+            output.write("countBoards - failed to open %s\n" % args[0])
+            return 0
+            
+        ## One extra board so that the search can run off the end of the chain
+        size = _STANDS_PER_BOARD*(_MAX_BOARDS+1) + 1
+        commands = array.array('H', [0 for i in range(size)])
+        commands[0] = _SPI_COMMAND_MARKER
+        responses = array.array('H', [0 for i in range(size)])
+        zeros = array.array('H', [0 for i in range(size)])
+        
+        num, verified = 0, False
+        if expected > 0:
+            ## Quick check - the marker should come back out after exactly the
+            ## expected number of devices
+            num = _STANDS_PER_BOARD*expected
+            if atm.transfer_spi(commands[:num+1], responses) and responses[num] == _SPI_COMMAND_MARKER:
+                verified = True
+            else:
+                num = 0
+                responses[:] = zeros
+        while not verified and responses[num] != _SPI_COMMAND_MARKER and num < _STANDS_PER_BOARD*(_MAX_BOARDS+1):
+            num += _STANDS_PER_BOARD
+            responses[:] = zeros
+            if not atm.transfer_spi(commands[:num+1], responses):
+                output2.write("coundBoards - SPI write failed\n")
+        if num > _STANDS_PER_BOARD*_MAX_BOARDS:
+            num = 0
+        num //= _STANDS_PER_BOARD
+        atm.close()
+        
+        output.write("%s %i boards (%i stands)\n" % ('Verified' if verified else 'Found', num, num*_STANDS_PER_BOARD))
+        return num
+        
+    def _spi(self, name, args, output, output2, read=False):
+        """
+        Common code for sendARXDevice and readARXDevice.
+        """
+        
+        if len(args) < 4:
+            output2.write("%s - Need at least 4 arguments, %i provided\n" % (name, len(args)))
+            return 1
+        deviceCount = _strtod(args[1])
+        frames = SPIFrames(deviceCount)
+        try:
+            plan = list(frames.plan([_strtod(a) for a in args[2::2]], [_strtod(a) for a in args[3::2]], read=read))
+            plan = [array.array('H', commands) for commands in plan]
+        except ValueError as e:
+            output2.write("%s - %s\n" % (name, str(e)))
+            return 1
+            
+        atm = self._open(args[0])
+        if atm is None:
+            output2.write("%s - failed to open %s\n" % (name, args[0]))
+            return 1
+            
+        for commands in plan:
+            for stage in range(2 if read else 1):
+                if stage == 1:
+                    commands[1:] = array.array('H', [0 for i in range(deviceCount)])
+                if not atm.transfer_spi(commands, frames.responses):
+                    output2.write("%s - SPI write #%i failed\n" % (name, stage+1))
+                    return 1
+                if frames.getMarker() != _SPI_COMMAND_MARKER:
+                    output2.write("%s - SPI write returned a marker of %x instead of %x\n" % (name, frames.getMarker(), _SPI_COMMAND_MARKER))
+                    return 1
+            if read:
+                for j in range(deviceCount):
+                    value = frames.responses[deviceCount-1-j]
+                    if value != 0:
+                        output.write("%i: 0x%x\n" % (j+1, value ^ 0x0080))
+        atm.close()
+        return 0
+        
+    def _sendARXDevice(self, args, output, output2):
+        return self._spi('sendARXDevice', args, output, output2)
+        
+    def _readARXDevice(self, args, output, output2):
+        return self._spi('readARXDevice', args, output, output2, read=True)
+        
+    def _onoffPSU(self, args, output, output2):
+        if len(args) < 3:
+            output2.write("onoffPSU - Need 3 arguments, %i provided\n" % len(args))
+            return 1
+        address, state = _strtod(args[1]), _strtod(args[2])
+        if state not in (0, 11):
+            output2.write("onoffPSU - Unknown state %i (valid values are 00 and 11)\n" % state)
+            return 1
+        atm = self._open(args[0])
+        if atm is None:
+            output2.write("onoffPSU - failed to open %s\n" % args[0])
+            return 1
+            
+        found = False
+        for addr in atm.list_i2c_devices():
+            if addr != address:
+                continue
+                
+            output.write("0x%X is in state %i\n" % (addr, self.wrap.ivs_is_on(atm, addr)))
+            if not self.wrap.ivs_enable_operation_page_writes(atm, addr):
+                output2.write("onoffPSU - write settings failed\n")
+                continue
+            if not atm.write_i2c(addr, 0x01, [0 if state == 0 else 1 << 7]):
+                output2.write("onoffPSU - on/off toggle failed\n")
+                continue
+            self.wrap.simulator.sleep(0.020)
+            success, data = atm.read_i2c(addr, 0x01, 1)
+            if not success:
+                output2.write("onoffPSU - page change failed\n")
+                continue
+            output.write("0x%X is now in state %i\n" % (addr, (data[0] >> 7) & 1))
+            if not self.wrap.ivs_disable_writes(atm, addr):
+                output2.write("onoffPSU - write settings failed\n")
+                continue
+            found = True
+        atm.close()
+        
+        if not found:
+            output2.write("onoffPSU - Cannot find device at address 0x%X\n" % address)
+            return 1
+        return 0
+        
+    def _readPSU(self, args, output, output2):
+        if len(args) < 2:
+            output.write("readPSU - Need 2 arguments, %i provided\n" % len(args))
+            return 1
+        address = _strtod(args[1])
+        atm = self._open(args[0])
+        if atm is None:
+            output.write("readPSU - failed to open %s\n" % args[0])
+            return 1
+            
+        found = False
+        for addr in atm.list_i2c_devices():
+            if addr != address:
+                continue
+                
+            ivs = self.wrap.IVSSession(atm, addr)
+            modules = ivs.get_smart_modules()
+            if not self.wrap.ivs_enable_all_writes(atm, addr):
+                output.write("readPSU - write settings failed\n")
+                continue
+                
+            names, power, status = [], '', []
+            voltage, current = 0.0, 0.0
+            for module in modules:
+                if not ivs.select_module(module):
+                    output2.write("readPSU - page change failed\n")
+                    continue
+                names.append('Module%i' % module)
+                
+                success, data = atm.read_i2c(addr, 0xDB, 1)
+                if not success:
+                    output.write("readPSU - get status failed\n")
+                    continue
+                power = 'ON' if data[0] & 1 else 'OFF'
+                status.append('&'.join([flag for bit,flag in ((1, 'UnderVolt'), (2, 'OK'), (3, 'OverCurrent'),
+                                                             (4, 'OverTemperature'), (5, 'WarningTemperature'),
+                                                             (6, 'OverVolt'), (7, 'ModuleFault'))
+                                        if (data[0] >> bit) & 1]))
+                                        
+                success, data = atm.read_i2c(addr, 0x8B, 2)
+                if not success:
+                    output.write("readPSU - get output voltage failed\n")
+                    continue
+                voltage += (data[0] | (data[1] << 8)) / 100.0
+                
+                success, data = atm.read_i2c(addr, 0x8C, 2)
+                if not success:
+                    output.write("readPSU - get output current failed\n")
+                    continue
+                current += (data[0] | (data[1] << 8)) / 100.0
+                
+            if names:
+                voltage /= len(names)
+            output.write("0x%X %s %s %s %g %g\n" % (addr, '|'.join(names), power, '|'.join(status), voltage, current))
+            
+            if not ivs.select_module(0):
+                output.write("readPSU - page change failed\n")
+                continue
+            if not self.wrap.ivs_disable_writes(atm, addr):
+                output.write("readPSU - write settings failed\n")
+                continue
+            found = True
+        atm.close()
+        
+        if not found:
+            output.write("readPSU - Cannot find device at address 0x%X\n" % address)
+            return 1
+        return 0
+        
+    def _countPSUs(self, args, output, output2):
+        total = 0
+        for sn in self.wrap.list_atmegas():
+            atm = self._open(sn)
+            if atm is None:
+                continue
+            output.write("Found ATmega device S/N: %s\n" % sn)
+            
+            addrs = atm.list_i2c_devices()
+            output.write("-> found %i I2C devices:\n" % len(addrs))
+            nModules = 0
+            for addr in addrs:
+                output.write(" -> 0x%X\n" % addr)
+                nModules += len(self.wrap.ivs_get_smart_modules(atm, addr))
+            output.write("-> %i PSU modules\n" % nModules)
+            if addrs:
+                output.write("I2C devices appear to be on %s\n" % sn)
+            total += nModules
+            atm.close()
+        return total
+        
+    def _countThermometers(self, args, output, output2):
+        atm = self._open(args[0])
+        if atm is None:
+            output2.write("countThermometers - failed to open %s\n" % args[0])
+            return 0
+        total = 2*len([addr for addr in atm.list_i2c_devices() if addr <= 0x1F])
+        atm.close()
+        return total
+        
+    def _readThermometers(self, args, output, output2):
+        atm = self._open(args[0])
+        if atm is None:
+            output2.write("readThermometers - failed to open %s\n" % args[0])
+            return 1
+            
+        for addr in atm.list_i2c_devices():
+            if addr > 0x1F:
+                continue
+            for i,(reg,desc) in enumerate(((0x8D, 'Case'), (0x8E, 'PrimarySide'))):
+                success, data = atm.read_i2c(addr, reg, 2)
+                if not success:
+                    output2.write("readThermometers - get temperature #%i failed\n" % (i+1))
+                    break
+                output.write("0x%X %s %g\n" % (addr, desc, (data[0] | (data[1] << 8)) / 4.0))
+        atm.close()
+        return 0
+        
+    def _countPICs(self, args, output, output2):
+        verbose = '-v' in args or '--verbose' in args
+        args = [arg for arg in args if arg[0] != '-']
+        atm = self._open(args[0])
+        if atm is None:
+            output.write("countPICs - failed to open %s\n" % args[0])
+            return 0
+            
+        addrs = atm.list_rs485_devices()
+        atm.close()
+        
+        output.write("Found %i PICs\n" % len(addrs))
+        if verbose:
+            output.write("Addresses found:\n")
+            for addr in addrs:
+                output.write(" %i\n" % addr)
+        return len(addrs)
+        
+    def _sendPICDevice(self, args, output, output2):
+        verbose = not ('-q' in args or '--quiet' in args)
+        decode = '-d' in args or '--decode' in args
+        args = [arg for arg in args if arg[0] != '-']
+        if len(args) < 3 or len(args) % 2 == 0:
+            output2.write("sendPICDevice - Need at 3 arguments, %i provided\n" % len(args))
+            return 1
+        atm = self._open(args[0])
+        if atm is None:
+            output2.write("sendPICDevice - failed to open %s\n" % args[0])
+            return 1
+            
+        for addr,command in zip(args[1::2], args[2::2]):
+            if command == 'WAKE':
+                command = 'W'
+            buffer = bytearray(80)
+            success, size = atm.send_rs485(int(addr), command.encode(), buffer)
+            if not success:
+                output2.write("sendPICDevice - send failed \n")
+                return 1
+            if not verbose:
+                continue
+                
+            reply = bytes(buffer[1:]).split(b'\x00')[0].decode('ascii', 'replace')
+            output.write(aspSUB20._formatPICReply(command, buffer[0], size, reply, decode=decode))
+        atm.close()
+        return 0
+
+
+class SimulatedTransport(NativeTransport):
+    """
+    Transport for aspSUB20 that talks to the simulated devices of a 
+    HardwareSimulator in-process, the same way that NativeTransport talks to
+    the real ones.
+    """
+    
+    name = 'simulator'
+    
+    def __init__(self, simulator, idleTimeout=5.0):
+        NativeTransport.__init__(self, simulator.getATmegaWrap(), idleTimeout=idleTimeout)
+        self.simulator = simulator
+
+
+class PTYServer(object):
+    """
+    Class for exposing a SimulatedATmega on a pseudo-terminal that speaks the
+    same framed serial protocol as the firmware.  The path to connect to is
+    available as device after start() is called.
+    """
+    
+    def __init__(self, atmega):
+        self.atmega = atmega
+        
+        self.device = None
+        self._master = None
+        self._slave = None
+        self.thread = None
+        self.alive = threading.Event()
+        
+        # Statistics
+        self.nFrames = 0
+        self.nDiscarded = 0
+        
+    def start(self):
+        """
+        Open the pseudo-terminal and start answering commands.
+        """
+        
+        if self.thread is not None:
+            self.stop()
+            
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.device = os.ttyname(self._slave)
+        
+        self.thread = threading.Thread(target=self.serveThread)
+        self.thread.daemon = 1
+        self.alive.set()
+        self.thread.start()
+        
+    def stop(self):
+        """
+        Stop answering commands and close the pseudo-terminal.
+        """
+        
+        if self.thread is not None:
+            self.alive.clear()
+            self.thread.join()
+            self.thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+        self.device = None
+        
+    def _nextFrame(self, data):
+        """
+        Remove the next complete frame from data and return a two-element
+        tuple of the command and payload, or None if there is no complete
+        frame yet.  Anything that is not part of a frame is discarded.
+        """
+        
+        while True:
+            start = data.find(b'<<<')
+            if start < 0:
+                self.nDiscarded += max(0, len(data) - 2)
+                del data[:-2]
+                return None
+            if start > 0:
+                self.nDiscarded += start
+                del data[:start]
+                
+            if len(data) < 6:
+                return None
+            command, size = struct.unpack_from('<BH', data, 3)
+            if size > MAX_CMD_LEN:
+                self.nDiscarded += 3
+                del data[:3]
+                continue
+            if len(data) < 6 + size + 3:
+                return None
+            if data[6+size:6+size+3] != b'>>>':
+                self.nDiscarded += 3
+                del data[:3]
+                continue
+                
+            payload = bytes(data[6:6+size])
+            del data[:6+size+3]
+            self.nFrames += 1
+            return command, payload
+            
+    def serveThread(self):
+        """
+        Thread that reads frames from the pseudo-terminal and answers them.
+        """
+        
+        data = bytearray()
+        while self.alive.is_set():
+            try:
+                ready, _, _ = select.select([self._master,], [], [], 0.25)
+                if not ready:
+                    continue
+                data.extend(os.read(self._master, 4096))
+            except (OSError, ValueError) as e:
+                if getattr(e, 'errno', None) in (errno.EINTR, errno.EIO):
+                    continue
+                aspSimulatorLogger.warning("%s: stopping for %s - %s", type(self).__name__, self.device, str(e))
+                break
+                
+            while True:
+                frame = self._nextFrame(data)
+                if frame is None:
+                    break
+                result = self.atmega.process(*frame)
+                if result is None:
+                    continue
+                    
+                status, response = result
+                message = b'<<<' + struct.pack('<BH', status, len(response)) + response + b'>>>'
+                while message:
+                    message = message[os.write(self._master, message):]
+
+
+class HardwareSimulator(object):
+    """
+    Class for a set of simulated SUB-20/ATmega devices.  All of the models
+    use the simulator as their clock so that time can be taken from a clock
+    other than the system one by passing something with monotonic(), time(),
+    and sleep() methods.  If clock is None the clock from aspClock.getClock()
+    is used so that the simulator follows a VirtualClock installed with
+    aspClock.setClock().  seed makes the latencies and faults repeatable.
+    """
+    
+    def __init__(self, seed=None, libraryDelays=True, clock=None):
+        self.seed = seed
+        self.clock = clock
+        
+        self._random = random.Random(seed)
+        self._devices = []
+        self._servers = {}
+        self._lock = threading.RLock()
+        
+        self.atmegaWrap = SimulatedATmegaWrap(self, libraryDelays=libraryDelays)
+        self.tools = SimulatedTools(self.atmegaWrap)
+        self.transport = None
+        
+        self.sysfsPath = None
+        self._savedSysfsPath = None
+        
+    @classmethod
+    def fromConfig(cls, config, seed=None, libraryDelays=True, clock=None):
+        """
+        Build a simulator that matches an AnalogProcessor configuration.  The
+        ARX boards and PICs are powered by the ARX power supply and the FEE
+        currents by the FEE power supply.  Both power supplies start off.
+        """
+        
+        sim = cls(seed=seed, libraryDelays=libraryDelays, clock=clock)
+        
+        i2cSN = str(config['sub20_i2c_mapping'])
+        antennaMapping = config['sub20_antenna_mapping']
+        rs485Mapping = config.get('sub20_rs485_mapping', {})
+        for sn in sorted(set([i2cSN,]) | set(antennaMapping) | set(rs485Mapping)):
+            sim.addATmega(sn)
+            
+        atm = sim.getDevice(i2cSN)
+        arx = atm.addPSU(IVSPowerSupply(config['arx_ps_address'], clock=sim))
+        fee = atm.addPSU(IVSPowerSupply(config['fee_ps_address'], current=20.0, clock=sim))
+        
+        for sn,(first,last) in antennaMapping.items():
+            sim.getDevice(sn).chain = MAX7301Chain(last-first+1, supply=arx)
+            
+        channels = 2*config.get('stands_per_board', _STANDS_PER_BOARD)
+        for sn,boards in rs485Mapping.items():
+            for key in boards:
+                currents = [60.0 + sim._random.uniform(-5.0, 5.0) for i in range(channels)]
+                powers = [sim._random.uniform(0.5, 2.0) for i in range(channels)]
+                sim.getDevice(sn).addPIC(PICBoard((int(key) % 126) or 126, channels=channels, currents=currents,
+                                                  powers=powers, supply=arx, feeSupply=fee, clock=sim))
+        return sim
+        
+    def _getClock(self):
+        return self.clock if self.clock is not None else getClock()
+        
+    def monotonic(self):
+        return self._getClock().monotonic()
+        
+    def time(self):
+        return self._getClock().time()
+        
+    def sleep(self, interval):
+        if interval > 0:
+            self._getClock().sleep(interval)
+            
+    def addATmega(self, sn, chain=None):
+        """
+        Add a new simulated ATmega and return it.
+        """
+        
+        with self._lock:
+            atm = SimulatedATmega(sn, '/dev/simATmega%i' % len(self._devices), chain=chain, clock=self,
+                                  seed=self._random.random())
+            self._devices.append(atm)
+            self._updateSysfs(atm)
+        return atm
+        
+    def getDevice(self, key):
+        """
+        Return the simulated ATmega with the provided serial number or device
+        path, or None if there is no such device.
+        """
+        
+        key = str(key)
+        with self._lock:
+            for atm in self._devices:
+                if key in (atm.sn, atm.device):
+                    return atm
+                for device,server in self._servers.items():
+                    if server.atmega is atm and server.device == key:
+                        return atm
+        return None
+        
+    def getDevices(self):
+        """
+        Return a list of all simulated ATmegas.
+        """
+        
+        with self._lock:
+            return list(self._devices)
+            
+    def _updateSysfs(self, atm):
+        """
+        Add or remove the sysfs entry for an ATmega so that the USB presence
+        tracker sees it.
+        """
+        
+        if self.sysfsPath is None:
+            return
+            
+        path = os.path.join(self.sysfsPath, '1-%i' % (self._devices.index(atm)+1))
+        if atm.present:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            for name,value in (('idVendor', SUB20_VENDOR_ID), ('idProduct', '802f'), ('serial', atm.sn)):
+                with open(os.path.join(path, name), 'w') as fh:
+                    fh.write('%s\n' % value)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+            
+    def _setPresent(self, sn, present):
+        atm = self.getDevice(sn)
+        if atm is None:
+            raise ValueError("Unknown ATmega '%s'" % sn)
+            
+        with self._lock:
+            atm.present = present
+            self._updateSysfs(atm)
+        if self._savedSysfsPath is not None:
+            getUSBPresenceTracker().rescan()
+            
+    def plug(self, sn):
+        """
+        Plug a simulated ATmega back in.
+        """
+        
+        self._setPresent(sn, True)
+        
+    def unplug(self, sn):
+        """
+        Unplug a simulated ATmega.
+        """
+        
+        self._setPresent(sn, False)
+        
+    def getATmegaWrap(self):
+        """
+        Return the stand-in for the atmegaWrap module.
+        """
+        
+        return self.atmegaWrap
+        
+    def getTransport(self):
+        """
+        Return the aspSUB20 transport that talks to the simulated devices.
+        """
+        
+        with self._lock:
+            if self.transport is None:
+                self.transport = SimulatedTransport(self)
+            return self.transport
+            
+    def run(self, command, timeout, token=None):
+        """
+        Run one of the command line tools against the simulated hardware,
+        the same as aspSUB20._run().
+        """
+        
+        return self.tools.run(command, timeout, token=token)
+        
+    def serve(self, sn):
+        """
+        Expose a simulated ATmega on a pseudo-terminal and return the path to
+        it.
+        """
+        
+        atm = self.getDevice(sn)
+        if atm is None:
+            raise ValueError("Unknown ATmega '%s'" % sn)
+            
+        with self._lock:
+            server = self._servers.get(atm.sn, None)
+            if server is None:
+                server = PTYServer(atm)
+                server.start()
+                self._servers[atm.sn] = server
+                aspSimulatorLogger.info("%s: serving ATmega S/N %s on %s", type(self).__name__, atm.sn, server.device)
+            return server.device
+            
+    def stopServing(self, sn=None):
+        """
+        Stop exposing one, or if sn is None all, simulated ATmegas on
+        pseudo-terminals.
+        """
+        
+        with self._lock:
+            for key in list(self._servers.keys()):
+                if sn is None or str(sn) == key:
+                    self._servers.pop(key).stop()
+                    
+    def install(self):
+        """
+        Route aspSUB20 through the simulator and make the simulated devices
+        visible to the USB presence tracker.  uninstall() undoes this.
+        """
+        
+        with self._lock:
+            if self.sysfsPath is None:
+                self.sysfsPath = tempfile.mkdtemp(prefix='aspSimulator-')
+            for atm in self._devices:
+                self._updateSysfs(atm)
+                
+        aspSUB20.setSimulator(self)
+        
+        tracker = getUSBPresenceTracker()
+        if self._savedSysfsPath is None:
+            self._savedSysfsPath = tracker.sysfsPath
+        tracker.sysfsPath = self.sysfsPath
+        tracker.rescan()
+        
+    def uninstall(self):
+        """
+        Restore aspSUB20 and the USB presence tracker to use the real
+        hardware.
+        """
+        
+        aspSUB20.setSimulator(None)
+        self.stopServing()
+        
+        if self._savedSysfsPath is not None:
+            tracker = getUSBPresenceTracker()
+            tracker.sysfsPath = self._savedSysfsPath
+            tracker.rescan()
+            self._savedSysfsPath = None
+        if self.sysfsPath is not None:
+            shutil.rmtree(self.sysfsPath, ignore_errors=True)
+            self.sysfsPath = None
@@ -0,0 +1,191 @@
+
+"""
+Module for keeping incremental, windowed statistics of the ASP telemetry.
+"""
+
+import math
+from collections import deque
+
+from aspClock import getClock
+
+
+__version__ = '0.1'
+__all__ = ['RollingStatistics', 'StatisticsBank']
+
+
+class RollingStatistics(object):
+    """
+    Class for keeping rolling statistics of a single value.  Each update is
+    O(1) (amortized) and the following are tracked:
+     * an exponentially weighted moving average with a time constant of tau
+       seconds
+     * the minimum and maximum over the last window seconds
+     * the rate of change in units per second over the last window seconds
+    NaN and None values are ignored.
+    """
+    
+    def __init__(self, window=3600.0, tau=180.0):
+        self.window = float(window)
+        self.tau = float(tau)
+        self.reset()
+        
+    def reset(self):
+        """
+        Clear all of the statistics.
+        """
+        
+        self.ewma = None
+        self.last = None
+        self.lastTime = None
+        self._samples = deque()
+        self._mins = deque()
+        self._maxs = deque()
+        
+    def update(self, value, timestamp=None):
+        """
+        Add a new value.
+        """
+        
+        if value is None or value != value:
+            return False
+        if timestamp is None:
+            timestamp = getClock().time()
+        value = float(value)
+        
+        # EWMA that allows for irregular sampling
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            dt = max(0.0, timestamp - self.lastTime)
+            alpha = 1.0 - math.exp(-dt / self.tau) if self.tau > 0 else 1.0
+            self.ewma += alpha*(value - self.ewma)
+        self.last = value
+        self.lastTime = timestamp
+        
+        # Windowed min/max via monotonic deques
+        self._samples.append((timestamp, value))
+        while self._mins and self._mins[-1][1] >= value:
+            self._mins.pop()
+        self._mins.append((timestamp, value))
+        while self._maxs and self._maxs[-1][1] <= value:
+            self._maxs.pop()
+        self._maxs.append((timestamp, value))
+        
+        # Expire old samples
+        cutoff = timestamp - self.window
+        for d in (self._samples, self._mins, self._maxs):
+            while d and d[0][0] < cutoff:
+                d.popleft()
+        return True
+        
+    def getEWMA(self):
+        """
+        Return the exponentially weighted moving average.
+        """
+        
+        return self.ewma
+        
+    def getMin(self):
+        """
+        Return the minimum over the window.
+        """
+        
+        try:
+            return self._mins[0][1]
+        except IndexError:
+            return None
+            
+    def getMax(self):
+        """
+        Return the maximum over the window.
+        """
+        
+        try:
+            return self._maxs[0][1]
+        except IndexError:
+            return None
+            
+    def getRate(self):
+        """
+        Return the rate of change in units per second over the window.
+        """
+        
+        if len(self._samples) < 2:
+            return None
+        t0, v0 = self._samples[0]
+        t1, v1 = self._samples[-1]
+        if t1 <= t0:
+            return None
+        return (v1 - v0) / (t1 - t0)
+        
+    def getStatistics(self):
+        """
+        Return a four-element tuple of EWMA, windowed minimum, windowed
+        maximum, and rate of change.
+        """
+        
+        return (self.getEWMA(), self.getMin(), self.getMax(), self.getRate())
+
+
+class StatisticsBank(object):
+    """
+    Class for keeping RollingStatistics for a set of channels that are
+    updated together.  The bank is reset if the number of channels changes.
+    """
+    
+    def __init__(self, window=3600.0, tau=180.0):
+        self.window = float(window)
+        self.tau = float(tau)
+        self._stats = []
+        
+    def __len__(self):
+        return len(self._stats)
+        
+    def __getitem__(self, idx):
+        return self._stats[idx]
+        
+    def updateConfig(self, window=None, tau=None):
+        """
+        Update the window and time constant used for all channels.
+        """
+        
+        if window is not None:
+            self.window = float(window)
+        if tau is not None:
+            self.tau = float(tau)
+        for s in self._stats:
+            s.window = self.window
+            s.tau = self.tau
+            
+    def update(self, values, timestamp=None):
+        """
+        Add a new set of values.
+        """
+        
+        if timestamp is None:
+            timestamp = getClock().time()
+        if len(values) != len(self._stats):
+            self._stats = [RollingStatistics(window=self.window, tau=self.tau) for v in values]
+        for s,v in zip(self._stats, values):
+            s.update(v, timestamp=timestamp)
+            
+    def reset(self):
+        """
+        Clear the statistics for all channels.
+        """
+        
+        self._stats = []
+        
+    def getEWMA(self):
+        """
+        Return a list of the EWMA for each channel.
+        """
+        
+        return [s.getEWMA() for s in self._stats]
+        
+    def getStatistics(self, idx):
+        """
+        Return the statistics tuple for a single channel.
+        """
+        
+        return self._stats[idx].getStatistics()
@@ -0,0 +1,330 @@
+
+"""
+Module for buffering and writing the ASP telemetry logs, i.e., /data/temp.txt,
+/data/psu-0xNN.txt, /data/board-temp.txt, and /data/fee-power.txt.
+"""
+
+import os
+import atexit
+import logging
+import threading
+
+from aspClock import getClock
+
+
+__version__ = '0.1'
+__all__ = ['TelemetryFile', 'TelemetryWriter', 'getTelemetryWriter']
+
+
+aspTelemetryLogger = logging.getLogger('__main__')
+
+
+class TelemetryFile(object):
+    """
+    Class for a single telemetry log that is kept open between writes.  Before
+    each flush the log is checked to see if it has been rotated (the path now
+    points to a different inode or is missing) or truncated (the file is now
+    shorter than what has been written to it) and is reopened as needed.
+    """
+    
+    def __init__(self, filename, maxLines=1000):
+        self.filename = filename
+        self.maxLines = int(maxLines)
+        
+        self._fh = None
+        self._id = None
+        self._size = 0
+        self._lines = []
+        
+        # Statistics
+        self.nLines = 0
+        self.nFlushes = 0
+        self.nReopens = 0
+        self.nDropped = 0
+        self.lastError = None
+        
+    def _open(self):
+        """
+        Open the log for appending and record its identity.
+        """
+        
+        self._fh = open(self.filename, 'a')
+        st = os.fstat(self._fh.fileno())
+        self._id = (st.st_dev, st.st_ino)
+        self._size = st.st_size
+        
+    def _close(self):
+        """
+        Close the log if it is open.
+        """
+        
+        if self._fh is not None:
+            try:
+                self._fh.close()
+            except (IOError, OSError):
+                pass
+            self._fh = None
+            self._id = None
+            self._size = 0
+            
+    def _check(self):
+        """
+        Make sure that the open file handle still refers to the file at
+        self.filename and that it has not been truncated.
+        """
+        
+        if self._fh is None:
+            self._open()
+            return True
+            
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            ## Rotated away and not recreated
+            st = None
+            
+        if st is None or (st.st_dev, st.st_ino) != self._id:
+            aspTelemetryLogger.debug("%s: %s has been rotated, reopening", type(self).__name__, self.filename)
+            self._close()
+            self._open()
+            self.nReopens += 1
+        elif st.st_size < self._size:
+            ## Truncated in place (copytruncate) - the file is opened for
+            ## appending so we only need to update what we think its size is
+            aspTelemetryLogger.debug("%s: %s has been truncated", type(self).__name__, self.filename)
+            self._size = st.st_size
+            self.nReopens += 1
+        return True
+        
+    def write(self, line):
+        """
+        Buffer a single line for writing.  Returns True if the buffer has
+        reached its maximum size and should be flushed.
+        """
+        
+        self._lines.append(line)
+        if len(self._lines) > 2*self.maxLines:
+            ## We have not been able to write for a while, drop the oldest
+            drop = len(self._lines) - 2*self.maxLines
+            del self._lines[:drop]
+            self.nDropped += drop
+        return len(self._lines) >= self.maxLines
+        
+    def flush(self):
+        """
+        Write out any buffered lines.  Returns True if the lines were written,
+        False otherwise.  Lines that could not be written are kept for the
+        next flush.
+        """
+        
+        if not self._lines:
+            return True
+            
+        data = ''.join(self._lines)
+        try:
+            self._check()
+            self._fh.write(data)
+            self._fh.flush()
+        except (IOError, OSError) as e:
+            aspTelemetryLogger.error("%s: could not write to logfile %s - %s", type(self).__name__, self.filename, str(e))
+            self._close()
+            self.lastError = str(e)
+            return False
+            
+        self._size += len(data)
+        self.nLines += len(self._lines)
+        self.nFlushes += 1
+        self._lines = []
+        self.lastError = None
+        return True
+        
+    def close(self):
+        """
+        Flush and close the log.
+        """
+        
+        self.flush()
+        self._close()
+        
+    def getStatistics(self):
+        """
+        Return a dictionary of the write statistics for this log.
+        """
+        
+        return {'buffered': len(self._lines),
+                'lines': self.nLines,
+                'flushes': self.nFlushes,
+                'reopens': self.nReopens,
+                'dropped': self.nDropped,
+                'last_error': self.lastError}
+
+
+class TelemetryWriter(object):
+    """
+    Class for collecting rows for the various telemetry logs and writing them
+    out in batches.  Rows are buffered in memory and written at most every
+    flushInterval seconds (or when maxLines rows have been buffered for a
+    log) by a background thread.
+    
+    Rows are formatted using a single, cached format string per combination of
+    log format and row length so that each row is built with one '%' operation
+    rather than one per value.
+    """
+    
+    def __init__(self, flushInterval=30.0, maxLines=1000):
+        self.flushInterval = float(flushInterval)
+        self.maxLines = int(maxLines)
+        
+        self._files = {}
+        self._formats = {}
+        self._lock = threading.RLock()
+        
+        self.thread = None
+        self.alive = threading.Event()
+        self.pending = threading.Event()
+        self._startLock = threading.Lock()
+        
+    def start(self):
+        """
+        Start the background flushing thread.
+        """
+        
+        if self.thread is not None:
+            self.stop()
+            
+        self.thread = threading.Thread(target=self.flushThread)
+        self.thread.daemon = 1
+        self.alive.set()
+        self.thread.start()
+        
+    def stop(self):
+        """
+        Stop the background flushing thread, waiting until it's finished, and
+        write out anything that is still buffered.
+        """
+        
+        if self.thread is not None:
+            self.alive.clear()
+            self.pending.set()
+            self.thread.join()
+            self.thread = None
+            
+        self.flush()
+        
+    def _getFormat(self, fmt, nValues):
+        """
+        Return the format string for a row of nValues values.  fmt can either
+        be a single format to use for all values or a sequence with one format
+        per value.
+        """
+        
+        key = (fmt, nValues)
+        try:
+            return self._formats[key]
+        except KeyError:
+            if isinstance(fmt, str):
+                fmts = [fmt,]*nValues
+            else:
+                fmts = list(fmt)
+                if len(fmts) != nValues:
+                    raise ValueError("Expected %i formats but found %i" % (nValues, len(fmts)))
+            rowFormat = '%s,' + ','.join(fmts) + '\n'
+            self._formats[key] = rowFormat
+            return rowFormat
+            
+    def write(self, filename, values, fmt='%.2f', timestamp=None):
+        """
+        Add a row of values to the specified log.  The row is written as the
+        timestamp (defaulting to the current time) followed by the values.
+        """
+        
+        if timestamp is None:
+            timestamp = getClock().time()
+        if not isinstance(fmt, str):
+            fmt = tuple(fmt)
+        values = tuple(values)
+        line = self._getFormat(fmt, len(values)) % ((timestamp,) + values)
+        
+        with self._lock:
+            try:
+                log = self._files[filename]
+            except KeyError:
+                log = TelemetryFile(filename, maxLines=self.maxLines)
+                self._files[filename] = log
+            full = log.write(line)
+            
+        ## The monitors write from their own threads so make sure that only 
+        ## one of them starts the flushing thread
+        with self._startLock:
+            if self.thread is None:
+                self.start()
+        if full:
+            self.pending.set()
+            
+    def flush(self, filename=None):
+        """
+        Write out the buffered rows for a single log or, if filename is None,
+        for all logs.  Returns True if everything was written, False
+        otherwise.
+        """
+        
+        status = True
+        with self._lock:
+            if filename is not None:
+                logs = [self._files[filename],] if filename in self._files else []
+            else:
+                logs = list(self._files.values())
+            for log in logs:
+                status &= log.flush()
+        return status
+        
+    def close(self):
+        """
+        Stop the background flushing thread and close all of the logs.
+        """
+        
+        self.stop()
+        with self._lock:
+            for log in self._files.values():
+                log.close()
+            self._files = {}
+            
+    def getStatistics(self):
+        """
+        Return a dictionary of write statistics keyed by the log filename.
+        """
+        
+        with self._lock:
+            return {f:l.getStatistics() for f,l in self._files.items()}
+            
+    def flushThread(self):
+        """
+        Thread that periodically writes out the buffered rows.
+        """
+        
+        while self.alive.is_set():
+            getClock().wait(self.pending, self.flushInterval)
+            self.pending.clear()
+            
+            try:
+                self.flush()
+            except Exception as e:
+                aspTelemetryLogger.error("%s: flushThread failed with: %s", type(self).__name__, str(e))
+
+
+_TELEMETRY_WRITER = None
+_TELEMETRY_WRITER_LOCK = threading.Lock()
+
+
+def getTelemetryWriter():
+    """
+    Return the TelemetryWriter instance shared by all of the monitors.
+    """
+    
+    global _TELEMETRY_WRITER
+    
+    with _TELEMETRY_WRITER_LOCK:
+        if _TELEMETRY_WRITER is None:
+            _TELEMETRY_WRITER = TelemetryWriter()
+            atexit.register(_TELEMETRY_WRITER.close)
+        return _TELEMETRY_WRITER
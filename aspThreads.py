@@ -3,9 +3,9 @@
 Module implementing the various ASP monitoring threads.
 """
 
-import os
 import sys
-import time
+import heapq
+import itertools
 import logging
 import threading
 import traceback
@@ -16,23 +16,347 @@ except ImportError:
     from io import StringIO
 
 from aspSUB20 import *
+from aspClock import getClock
+from aspTelemetry import getTelemetryWriter
+from aspHistory import encodePSUState, getHistoryRecorder
+from aspArchive import getTelemetryArchiver
+from aspStatistics import StatisticsBank
+from aspInventory import getHardwareInventory
 
 
 __version__ = '0.7'
-__all__ = ['TemperatureSensors', 'PowerStatus', 'ChassisStatus']
+__all__ = ['MonitorScheduler', 'getMonitorScheduler',
+           'TemperatureSensors', 'PowerStatus', 'ChassisStatus']
 
 
 aspThreadsLogger = logging.getLogger('__main__')
 
 
+# How long stop() waits for a poll in progress to be cancelled
+MONITOR_STOP_TIMEOUT = 10.0
+
+
+def _recordHistory(name, channels, values, timestamp=None):
+    """
+    Save a set of values to both the short-term history and the long-term
+    rollup archive.
+    """
+    
+    getHistoryRecorder().record(name, channels, values, timestamp=timestamp)
+    getTelemetryArchiver().add(name, channels, values, timestamp=timestamp)
+
+
+class MonitorJob(object):
+    """
+    Class to hold a periodic job registered with a MonitorScheduler along
+    with its timing statistics.
+    """
+    
+    def __init__(self, name, func, period, offset=0.0):
+        self.name = name
+        self.func = func
+        self.period = float(period)
+        self.offset = float(offset)
+        
+        # Scheduling state
+        self.deadline = None
+        self.generation = 0
+        self.thread = None
+        
+        # Timing statistics
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.failures = 0
+        self.lastStart = None
+        self.lastDuration = None
+        self.meanDuration = 0.0
+        self.maxDuration = 0.0
+        self.lastLateness = None
+        self.maxLateness = 0.0
+        
+    def nextDeadline(self, now):
+        """
+        Return the first aligned run time for this job that is after the
+        provided time.
+        """
+        
+        n = (now - self.offset) // self.period + 1
+        return n*self.period + self.offset
+        
+    def isRunning(self):
+        """
+        Return whether or not the job is currently executing.
+        """
+        
+        return self.thread is not None and self.thread.is_alive()
+        
+    def run(self, lateness=0.0):
+        """
+        Run the job once and update the timing statistics.
+        """
+        
+        tStart = getClock().time()
+        try:
+            self.func()
+        except Exception as e:
+            self.failures += 1
+            aspThreadsLogger.error("%s: job '%s' failed with: %s", type(self).__name__, self.name, str(e))
+        tStop = getClock().time()
+        
+        duration = tStop - tStart
+        self.runs += 1
+        self.lastStart = tStart
+        self.lastDuration = duration
+        self.meanDuration += (duration - self.meanDuration) / self.runs
+        self.maxDuration = max(self.maxDuration, duration)
+        self.lastLateness = lateness
+        self.maxLateness = max(self.maxLateness, lateness)
+        
+        if duration > self.period:
+            aspThreadsLogger.warning("%s: job '%s' took %.3f s which is longer than its %.3f s period", type(self).__name__, self.name, duration, self.period)
+            
+    def getStatistics(self):
+        """
+        Return a dictionary of the timing statistics for this job.
+        """
+        
+        return {'period': self.period,
+                'offset': self.offset,
+                'next_run': self.deadline,
+                'running': self.isRunning(),
+                'runs': self.runs,
+                'overruns': self.overruns,
+                'skipped': self.skipped,
+                'failures': self.failures,
+                'last_start': self.lastStart,
+                'last_duration': self.lastDuration,
+                'mean_duration': self.meanDuration,
+                'max_duration': self.maxDuration,
+                'last_lateness': self.lastLateness,
+                'max_lateness': self.maxLateness}
+
+
+class MonitorScheduler(object):
+    """
+    Class for running the periodic monitoring jobs from a single timing thread.
+    
+    Jobs are started at wall clock times that are aligned to a multiple of
+    their period (plus an optional offset) so that the samples from the
+    different monitors line up in time.  Each run is executed in its own worker
+    thread so that a slow job, like an RS485 sweep, does not delay the others.
+    If a job is still running when its next run is due that run is counted as
+    an overrun and skipped.  If the scheduler wakes up more than maxJitter
+    seconds after a run was due, i.e., after a clock step, the run is skipped
+    rather than executed out of alignment.
+    """
+    
+    def __init__(self, maxJitter=5.0):
+        self.maxJitter = maxJitter
+        
+        self._jobs = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._generation = itertools.count(1)
+        
+        self.thread = None
+        self.alive = threading.Event()
+        self._startLock = threading.Lock()
+        
+    def start(self):
+        """
+        Start the scheduling thread.
+        """
+        
+        if self.thread is not None:
+            self.stop()
+            
+        self.thread = threading.Thread(target=self.scheduleThread)
+        self.thread.daemon = 1
+        self.alive.set()
+        self.thread.start()
+        
+    def stop(self):
+        """
+        Stop the scheduling thread, waiting until it's finished.  Jobs that are
+        currently running are allowed to complete.
+        """
+        
+        if self.thread is not None:
+            with self._cond:
+                self.alive.clear()
+                self._cond.notify_all()
+            self.thread.join()
+            self.thread = None
+            
+    def register(self, name, func, period, offset=0.0, runNow=True):
+        """
+        Register a new periodic job with the scheduler.  If runNow is True the
+        job is run once immediately and then at its aligned times.  Returns the
+        MonitorJob instance.
+        """
+        
+        ## Jobs can be registered from several threads at once, i.e., during
+        ## INI, so make sure that only one of them starts the scheduler
+        with self._startLock:
+            if self.thread is None:
+                self.start()
+                
+        self.unregister(name)
+        
+        job = MonitorJob(name, func, period, offset=offset)
+        with self._cond:
+            job.generation = next(self._generation)
+            self._jobs[name] = job
+            if runNow:
+                job.deadline = getClock().time()
+            else:
+                job.deadline = job.nextDeadline(getClock().time())
+            heapq.heappush(self._heap, (job.deadline, name, job.generation))
+            self._cond.notify_all()
+            
+        return job
+        
+    def reschedule(self, name, period, offset=None):
+        """
+        Change the period (and, optionally, the offset) of a registered job.
+        """
+        
+        with self._cond:
+            try:
+                job = self._jobs[name]
+            except KeyError:
+                return False
+                
+            job.period = float(period)
+            if offset is not None:
+                job.offset = float(offset)
+            job.generation = next(self._generation)
+            job.deadline = job.nextDeadline(getClock().time())
+            heapq.heappush(self._heap, (job.deadline, name, job.generation))
+            self._cond.notify_all()
+            
+        return True
+        
+    def unregister(self, name, wait=True, timeout=None):
+        """
+        Remove a job from the scheduler.  If wait is True this also waits for
+        any run in progress to finish, giving up after timeout seconds if 
+        timeout is not None.
+        """
+        
+        with self._cond:
+            job = self._jobs.pop(name, None)
+            if job is not None:
+                job.generation = next(self._generation)
+                self._cond.notify_all()
+                
+        if job is not None and wait and job.thread is not None:
+            if job.thread is not threading.current_thread():
+                job.thread.join(timeout)
+                if job.thread.is_alive():
+                    aspThreadsLogger.warning("%s: job '%s' is still running after %.1f s, no longer waiting for it", type(self).__name__, name, timeout)
+                
+        return job is not None
+        
+    def getStatistics(self, name=None):
+        """
+        Return the timing statistics for a single job or, if name is None, a
+        dictionary of statistics for all registered jobs.
+        """
+        
+        with self._cond:
+            if name is not None:
+                try:
+                    return self._jobs[name].getStatistics()
+                except KeyError:
+                    return None
+            return {n:j.getStatistics() for n,j in self._jobs.items()}
+            
+    def scheduleThread(self):
+        """
+        Scheduling thread that sleeps until the next job is due.
+        """
+        
+        with self._cond:
+            while self.alive.is_set():
+                # Drop heap entries that belong to removed or rescheduled jobs
+                while self._heap:
+                    deadline, name, generation = self._heap[0]
+                    job = self._jobs.get(name, None)
+                    if job is None or job.generation != generation:
+                        heapq.heappop(self._heap)
+                    else:
+                        break
+                        
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                    
+                # Sleep until the next job is due.  The wait is capped so that
+                # steps in the wall clock are noticed in a reasonable time.
+                deadline, name, generation = self._heap[0]
+                now = getClock().time()
+                if deadline > now:
+                    getClock().wait(self._cond, min(deadline - now, 10.0))
+                    continue
+                    
+                heapq.heappop(self._heap)
+                job = self._jobs[name]
+                lateness = now - deadline
+                
+                if job.isRunning():
+                    job.overruns += 1
+                    aspThreadsLogger.warning("%s: job '%s' is still running, skipping the run at %.3f", type(self).__name__, name, deadline)
+                elif lateness > self.maxJitter and job.runs > 0:
+                    job.skipped += 1
+                    aspThreadsLogger.warning("%s: job '%s' woke up %.3f s late, skipping to the next aligned time", type(self).__name__, name, lateness)
+                else:
+                    job.thread = threading.Thread(target=job.run, kwargs={'lateness': lateness})
+                    job.thread.daemon = 1
+                    job.thread.start()
+                    
+                job.deadline = job.nextDeadline(now)
+                heapq.heappush(self._heap, (job.deadline, name, job.generation))
+
+
+_MONITOR_SCHEDULER = None
+_MONITOR_SCHEDULER_LOCK = threading.Lock()
+
+
+def getMonitorScheduler():
+    """
+    Return the MonitorScheduler instance shared by all of the monitors.
+    """
+    
+    global _MONITOR_SCHEDULER
+    
+    with _MONITOR_SCHEDULER_LOCK:
+        if _MONITOR_SCHEDULER is None:
+            _MONITOR_SCHEDULER = MonitorScheduler()
+        return _MONITOR_SCHEDULER
+
+
 class TemperatureSensors(object):
     """
     Class for monitoring temperature for the power supplies via the I2C interface.
     """
     
-    def __init__(self, sub20SN, config, logfile='/data/temp.txt', ASPCallbackInstance=None):
+    def __init__(self, sub20SN, config, logfile='/data/temp.txt', ASPCallbackInstance=None, scheduler=None):
         self.sub20SN = str(sub20SN)
         self.logfile = logfile
+        
+        # Setup the scheduler
+        if scheduler is None:
+            scheduler = getMonitorScheduler()
+        self.scheduler = scheduler
+        self.jobName = '%s-%s' % (type(self).__name__, self.sub20SN)
+        self.job = None
+        self.cancelToken = CancelToken()
+        
+        # Setup the rolling statistics
+        self.tempStats = StatisticsBank()
+        
         self.updateConfig(config)
         
         # Setup the callback
@@ -48,7 +372,6 @@ class TemperatureSensors(object):
         self.coldCount = 0
         self.hotCount = 0
         
-        self.thread = None
         self.alive = threading.Event()
         
     def updateConfig(self, config=None):
@@ -63,135 +386,136 @@ class TemperatureSensors(object):
         self.minTemp  = config['temp_min']
         self.warnTemp = config['temp_warn']
         self.maxTemp  = config['temp_max']
+        self.tempStats.updateConfig(window=config.get('stats_window', 3600), tau=config.get('stats_tau', 180))
         
+        if self.job is not None:
+            self.scheduler.reschedule(self.jobName, self.monitorPeriod)
+            
     def start(self):
         """
-        Start the monitoring thread.
+        Start monitoring by registering with the monitor scheduler.
         """
         
-        if self.thread is not None:
+        if self.job is not None:
             self.stop()
             
-        self.nTemps = psuCountTemperature(self.sub20SN)
+        self.nTemps = getHardwareInventory().countThermometers(self.sub20SN)
         self.description = ["UNK" for i in range(self.nTemps)]
         self.temp = [0.0 for i in range(self.nTemps)]
+        self.tempStats.reset()
         self.coldCount = 0
         self.hotCount = 0
         
-        self.thread = threading.Thread(target=self.monitorThread)
-        self.thread.setDaemon(1)
         self.alive.set()
-        self.thread.start()
-        
-        time.sleep(1)
+        self.cancelToken = CancelToken()
+        self.job = self.scheduler.register(self.jobName, self.monitorThread, self.monitorPeriod)
         
     def stop(self):
         """
-        Stop the monitor thread, waiting until it's finished.
+        Stop monitoring, cancelling any poll in progress and waiting up to
+        MONITOR_STOP_TIMEOUT seconds for it to finish.
         """
         
-        os.system("pkill readThermometers")
-        
-        if self.thread is not None:
+        if self.job is not None:
             self.alive.clear()          #clear alive event for thread
-            self.thread.join()          #wait until thread has finished
-            self.thread = None
+            self.cancelToken.cancel()
+            self.scheduler.unregister(self.jobName, timeout=MONITOR_STOP_TIMEOUT)
+            self.job = None
+            getTelemetryWriter().flush(self.logfile)
             self.nTemps = 0
             self.lastError = None
             
     def monitorThread(self):
         """
-        Create a monitoring thread for the temperature.
+        Poll the temperatures once.  This is called every monitorPeriod seconds
+        by the monitor scheduler.
         """
         
-        while self.alive.isSet():
-            tStart = time.time()
+        tStart = getClock().time()
+        
+        try:
+            temps = getI2CSession(self.sub20SN).readTemperatures(maxAge=self.monitorPeriod/2.0, token=self.cancelToken)
+            if self.cancelToken.isCancelled():
+                ## Stopped while polling, there is nothing to report
+                return
+            if temps:
+                missingSUB20 = False
+                
+                for i,entry in enumerate(temps):
+                    self.description[i] = '%s %s' % (entry['address'], entry['description'])
+                    self.temp[i] = entry['temp_C']
+            else:
+                missingSUB20 = True
+                
+            # Save the temps to the log file and the history
+            tRead = getClock().time()
+            getTelemetryWriter().write(self.logfile, self.temp, fmt='%.2f', timestamp=tRead)
+            _recordHistory('temp', self.description, self.temp, timestamp=tRead)
             
-            try:
-                temps = psuTemperature(self.sub20SN)
-                if temps:
-                    missingSUB20 = False
+            # Update the rolling statistics.  These are only for reporting, the
+            # range checks below use the raw temperatures.
+            if missingSUB20:
+                self.tempStats.reset()
+            else:
+                self.tempStats.update(self.temp, timestamp=tRead)
+                
+            # Check the temperatures against the acceptable range
+            if max(self.temp) > self.maxTemp:
+                self.hotCount += 1
+                aspThreadsLogger.warning('%s: monitorThread max. temperature of %.1f C is above the acceptable range (hot count is %i)', type(self).__name__, max(self.temp), self.hotCount)
+            else:
+                self.hotCount = 0
+                
+            if min(self.temp) < self.minTemp:
+                self.coldCount += 1
+                aspThreadsLogger.warning('%s: monitorThread min. temperature of %.1f C is below the acceptable range (cold count is %i)', type(self).__name__, min(self.temp), self.coldCount)
+            else:
+                self.coldCount = 0
+                
+            # Issue a warning if we need to
+            if max(self.temp) <= self.maxTemp and max(self.temp) > self.warnTemp:
+                aspThreadsLogger.warning('%s: monitorThread max. temperature is %.1f C', type(self).__name__, max(self.temp))
+                
+            # Make sure we aren't critical (on either side of good)
+            if self.ASPCallbackInstance is not None and self.temp is not None:
+                if missingSUB20:
+                    self.ASPCallbackInstance.processMissingSUB20()
                     
-                    for i,entry in enumerate(temps):
-                        self.description[i] = '%s %s' % (entry['address'], entry['description'])
-                        self.temp[i] = entry['temp_C']
-                else:
-                    missingSUB20 = True
+                if self.hotCount >= 3:
+                    aspThreadsLogger.critical('%s: monitorThread max. temperature is %.1f C, notifying the system', type(self).__name__, max(self.temp))
                     
-                # Open the log file and save the temps
-                try:
-                    with open(self.logfile, 'a+') as log:
-                        log.write('%s,' % time.time())
-                        log.write('%s\n' % ','.join(["%.2f" % t for t in self.temp]))
-                        log.flush()
-                except IOError:
-                    aspThreadsLogger.error("%s: could not open flag logfile %s for writing", type(self).__name__, self.logfile)
-                    pass
+                    self.ASPCallbackInstance.processCriticalTemperature(temp=max(self.temp), high=True)
                     
-                # Check the temperatures against the acceptable range
-                if max(self.temp) > self.maxTemp:
-                    self.hotCount += 1
-                    aspThreadsLogger.warning('%s: monitorThread max. temperature of %.1f C is above the acceptable range (hot count is %i)', type(self).__name__, max(self.temp), self.hotCount)
-                else:
-                    self.hotCount = 0
+                if self.coldCount >= 3:
+                    aspThreadsLogger.critical('%s: monitorThread min. temperature is %.1f C, notifying the system', type(self).__name__, min(self.temp))
                     
-                if min(self.temp) < self.minTemp:
-                    self.coldCount += 1
-                    aspThreadsLogger.warning('%s: monitorThread min. temperature of %.1f C is below the acceptable range (cold count is %i)', type(self).__name__, max(self.temp), self.coldCount)
-                else:
-                    self.coldCount = 0
+                    self.ASPCallbackInstance.processCriticalTemperature(temp=min(self.temp), low=True)
                     
-                # Issue a warning if we need to
-                if max(self.temp) <= self.maxTemp and max(self.temp) > self.warnTemp:
-                    aspThreadsLogger.warning('%s: monitorThread max. temperature is %.1f C', type(self).__name__, max(self.temp))
+                if max(self.temp) > self.warnTemp:
+                    self.ASPCallbackInstance.processWarningTemperature(temp=max(self.temp))
+                else:
+                    self.ASPCallbackInstance.processWarningTemperature(clear=True)
                     
-                # Make sure we aren't critical (on either side of good)
-                if self.ASPCallbackInstance is not None and self.temp is not None:
-                    if missingSUB20:
-                        self.ASPCallbackInstance.processMissingSUB20()
-                        
-                    if self.hotCount >= 3:
-                        aspThreadsLogger.critical('%s: monitorThread max. temperature is %.1f C, notifying the system', type(self).__name__, max(self.temp))
-                        
-                        self.ASPCallbackInstance.processCriticalTemperature(temp=max(self.temp), high=True)
-                        
-                    if self.coldCount >= 3:
-                        aspThreadsLogger.critical('%s: monitorThread min. temperature is %.1f C, notifying the system', type(self).__name__, min(self.temp))
-                        
-                        self.ASPCallbackInstance.processCriticalTemperature(temp=min(self.temp), low=True)
-                        
-                    if max(self.temp) > self.warnTemp:
-                        self.ASPCallbackInstance.processWarningTemperature(temp=max(self.temp))
-                    else:
-                        self.ASPCallbackInstance.processWarningTemperature(clear=True)
-                        
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                aspThreadsLogger.error("%s: monitorThread failed with: %s at line %i", type(self).__name__, str(e), exc_traceback.tb_lineno)
-                
-                ## Grab the full traceback and save it to a string via StringIO
-                fileObject = StringIO()
-                traceback.print_tb(exc_traceback, file=fileObject)
-                tbString = fileObject.getvalue()
-                fileObject.close()
-                ## Print the traceback to the logger as a series of DEBUG messages
-                for line in tbString.split('\n'):
-                    aspThreadsLogger.debug("%s", line)
-                
-                self.temp = [None for temp in self.temp]
-                self.lastError = str(e)
-                
-            # Stop time
-            tStop = time.time()
-            aspThreadsLogger.debug('Finished updating temperatures in %.3f seconds', tStop - tStart)
-            
-            # Sleep for a bit
-            sleepCount = 0
-            sleepTime = self.monitorPeriod - (tStop - tStart)
-            while (self.alive.isSet() and sleepCount < sleepTime):
-                time.sleep(0.2)
-                sleepCount += 0.2
+        except Exception as e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            aspThreadsLogger.error("%s: monitorThread failed with: %s at line %i", type(self).__name__, str(e), exc_traceback.tb_lineno)
+            
+            ## Grab the full traceback and save it to a string via StringIO
+            fileObject = StringIO()
+            traceback.print_tb(exc_traceback, file=fileObject)
+            tbString = fileObject.getvalue()
+            fileObject.close()
+            ## Print the traceback to the logger as a series of DEBUG messages
+            for line in tbString.split('\n'):
+                aspThreadsLogger.debug("%s", line)
                 
+            self.temp = [None for temp in self.temp]
+            self.lastError = str(e)
+            
+        # Stop time
+        tStop = getClock().time()
+        aspThreadsLogger.debug('Finished updating temperatures in %.3f seconds', tStop - tStart)
+        
     def getSensorCount(self):
         """
         Convenience function to get the number of temperature sensors.
@@ -228,6 +552,18 @@ class TemperatureSensors(object):
         else:
             return self.temp[sensor]
             
+    def getTemperatureStatistics(self, sensor=0):
+        """
+        Convenience function to get the rolling statistics of a temperature as
+        a four-element tuple of EWMA, windowed min., windowed max. (all in C),
+        and rate of change (C/s).
+        """
+        
+        if sensor < 0 or sensor >= len(self.tempStats):
+            return (None, None, None, None)
+            
+        return self.tempStats.getStatistics(sensor)
+        
     def getOverallStatus(self):
         """
         Find out the overall temperature status.
@@ -256,11 +592,20 @@ class PowerStatus(object):
     for the power supplies via the I2C interface.
     """
     
-    def __init__(self, sub20SN, deviceAddress, config, logfile='/data/psu.txt', ASPCallbackInstance=None):
+    def __init__(self, sub20SN, deviceAddress, config, logfile='/data/psu.txt', ASPCallbackInstance=None, scheduler=None):
         self.sub20SN = str(sub20SN)
         self.deviceAddress = int(deviceAddress)
         base, ext = logfile.rsplit('.', 1)
         self.logfile = '%s-0x%02X.%s' % (base, self.deviceAddress, ext)
+        
+        # Setup the scheduler
+        if scheduler is None:
+            scheduler = getMonitorScheduler()
+        self.scheduler = scheduler
+        self.jobName = '%s-%s-0x%02X' % (type(self).__name__, self.sub20SN, self.deviceAddress)
+        self.job = None
+        self.cancelToken = CancelToken()
+        
         self.updateConfig(config)
         
         # Setup the callback
@@ -275,7 +620,6 @@ class PowerStatus(object):
         self.status = None
         self.lastError = None
         
-        self.thread = None
         self.alive = threading.Event()
         
     def updateConfig(self, config=None):
@@ -288,12 +632,15 @@ class PowerStatus(object):
             
         self.monitorPeriod = config['power_period']
         
+        if self.job is not None:
+            self.scheduler.reschedule(self.jobName, self.monitorPeriod)
+            
     def start(self):
         """
-        Start the monitoring thread.
+        Start monitoring by registering with the monitor scheduler.
         """
         
-        if self.thread is not None:
+        if self.job is not None:
             self.stop()
             
         self.description = "UNK"
@@ -302,103 +649,97 @@ class PowerStatus(object):
         self.onoff       = "UNK"
         self.status      = "UNK"
             
-        self.thread = threading.Thread(target=self.monitorThread)
-        self.thread.setDaemon(1)
         self.alive.set()
-        self.thread.start()
-        
-        time.sleep(1)
+        self.cancelToken = CancelToken()
+        self.job = self.scheduler.register(self.jobName, self.monitorThread, self.monitorPeriod)
         
     def stop(self):
         """
-        Stop the monitor thread, waiting until it's finished.
+        Stop monitoring, cancelling any poll in progress and waiting up to
+        MONITOR_STOP_TIMEOUT seconds for it to finish.
         """
         
-        if self.thread is not None:
+        if self.job is not None:
             self.alive.clear()          #clear alive event for thread
-            self.thread.join()          #wait until thread has finished
-            self.thread = None
+            self.cancelToken.cancel()
+            self.scheduler.unregister(self.jobName, timeout=MONITOR_STOP_TIMEOUT)
+            self.job = None
+            getTelemetryWriter().flush(self.logfile)
             self.nPSUs = 0
             self.lastError = None
             
     def monitorThread(self):
         """
-        Create a monitoring thread for the temperature.
+        Poll the power supply once.  This is called every monitorPeriod seconds
+        by the monitor scheduler.
         """
         
-        while self.alive.isSet():
-            tStart = time.time()
-            
-            try:
-                data = psuRead(self.sub20SN, self.deviceAddress)
-                if data:
-                    missingSUB20 = False
-                    
-                    self.description = '%s - %s' % (data['address'], data['description'])
-                    self.voltage = data['voltage']
-                    self.current = data['current']
-                    self.onoff = data['onoff']
-                    self.status = data['status']
-                else:
-                    missingSUB20 = True
-                    
-                    self.voltage = 0.0
-                    self.current = 0.0
-                    self.onoff = "UNK"
-                    self.status = "UNK"
-                    self.lastError = 'No data returned'
-                    
-                try:
-                    with open(self.logfile, 'a+') as log:
-                        log.write('%s,' % time.time())
-                        log.write('%s\n' % ','.join(["%.2f" % self.voltage, "%.3f" % self.current, self.onoff, self.status]))
-                        log.flush()
-                except IOError:
-                    aspThreadsLogger.error("%s: could not open flag logfile %s for writing", type(self).__name__, self.logfile)
-                    pass
-                    
-                # Deal with power supplies that are over temperature, current, or voltage; 
-                # or under voltage; or has a module fault
-                if self.ASPCallbackInstance is not None:
-                    if missingSUB20:
-                        self.ASPCallbackInstance.processMissingSUB20()
-                        
-                    for modeOfFailure in ('OverTemperature', 'OverCurrent', 'OverVolt', 'UnderVolt', 'ModuleFault'):
-                        if self.status.find(modeOfFailure) != -1:
-                            aspThreadsLogger.critical('%s: monitorThread PS at 0x%02X is in %s', type(self).__name__, self.deviceAddress, modeOfFailure)
-                            
-                            self.ASPCallbackInstance.processCriticalPowerSupply(self.deviceAddress, modeOfFailure)
-                            
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                aspThreadsLogger.error("%s: monitorThread 0x%02X failed with: %s at line %i", type(self).__name__, self.deviceAddress, str(e), exc_traceback.tb_lineno)
+        tStart = getClock().time()
+        
+        try:
+            data = getI2CSession(self.sub20SN).readPSU(self.deviceAddress, maxAge=self.monitorPeriod/2.0, token=self.cancelToken)
+            if self.cancelToken.isCancelled():
+                ## Stopped while polling, there is nothing to report
+                return
+            if data:
+                missingSUB20 = False
                 
-                ## Grab the full traceback and save it to a string via StringIO
-                fileObject = StringIO()
-                traceback.print_tb(exc_traceback, file=fileObject)
-                tbString = fileObject.getvalue()
-                fileObject.close()
-                ## Print the traceback to the logger as a series of DEBUG messages
-                for line in tbString.split('\n'):
-                    aspThreadsLogger.debug("%s", line)
+                self.description = '%s - %s' % (data['address'], data['description'])
+                self.voltage = data['voltage']
+                self.current = data['current']
+                self.onoff = data['onoff']
+                self.status = data['status']
+            else:
+                missingSUB20 = True
                 
                 self.voltage = 0.0
                 self.current = 0.0
                 self.onoff = "UNK"
                 self.status = "UNK"
-                self.lastError = str(e)
+                self.lastError = 'No data returned'
+                
+            tRead = getClock().time()
+            getTelemetryWriter().write(self.logfile, (self.voltage, self.current, self.onoff, self.status), 
+                                       fmt=('%.2f', '%.3f', '%s', '%s'), timestamp=tRead)
+            _recordHistory('psu-0x%02X' % self.deviceAddress, ('voltage', 'current', 'onoff', 'status'),
+                           (self.voltage, self.current) + encodePSUState(self.onoff, self.status),
+                           timestamp=tRead)
                 
-            # Stop time
-            tStop = time.time()
-            aspThreadsLogger.debug('Finished updating PSU status for 0x%02X in %.3f seconds', self.deviceAddress, tStop - tStart)
-            
-            # Sleep for a bit
-            sleepCount = 0
-            sleepTime = self.monitorPeriod - (tStop - tStart)
-            while (self.alive.isSet() and sleepCount < sleepTime):
-                time.sleep(0.2)
-                sleepCount += 0.2
+            # Deal with power supplies that are over temperature, current, or voltage; 
+            # or under voltage; or has a module fault
+            if self.ASPCallbackInstance is not None:
+                if missingSUB20:
+                    self.ASPCallbackInstance.processMissingSUB20()
+                    
+                for modeOfFailure in ('OverTemperature', 'OverCurrent', 'OverVolt', 'UnderVolt', 'ModuleFault'):
+                    if self.status.find(modeOfFailure) != -1:
+                        aspThreadsLogger.critical('%s: monitorThread PS at 0x%02X is in %s', type(self).__name__, self.deviceAddress, modeOfFailure)
+                        
+                        self.ASPCallbackInstance.processCriticalPowerSupply(self.deviceAddress, modeOfFailure)
+                        
+        except Exception as e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            aspThreadsLogger.error("%s: monitorThread 0x%02X failed with: %s at line %i", type(self).__name__, self.deviceAddress, str(e), exc_traceback.tb_lineno)
+            
+            ## Grab the full traceback and save it to a string via StringIO
+            fileObject = StringIO()
+            traceback.print_tb(exc_traceback, file=fileObject)
+            tbString = fileObject.getvalue()
+            fileObject.close()
+            ## Print the traceback to the logger as a series of DEBUG messages
+            for line in tbString.split('\n'):
+                aspThreadsLogger.debug("%s", line)
                 
+            self.voltage = 0.0
+            self.current = 0.0
+            self.onoff = "UNK"
+            self.status = "UNK"
+            self.lastError = str(e)
+            
+        # Stop time
+        tStop = getClock().time()
+        aspThreadsLogger.debug('Finished updating PSU status for 0x%02X in %.3f seconds', self.deviceAddress, tStop - tStart)
+        
     def getDeviceAddress(self):
         """
         Convenience function to get the I2C address of the PSU.
@@ -452,9 +793,21 @@ class ChassisStatus(object):
     
     def __init__(self, sub20SN, config, temp_logfile='/data/board-temp.txt',
                        fee_logfile='/data/fee-power.txt', pic_monitoring=True,
-                       ASPCallbackInstance=None):
+                       ASPCallbackInstance=None, scheduler=None):
         self.sub20SN = str(sub20SN)
         self.register = 0x000C
+        
+        # Setup the scheduler
+        if scheduler is None:
+            scheduler = getMonitorScheduler()
+        self.scheduler = scheduler
+        self.jobName = '%s-%s' % (type(self).__name__, self.sub20SN)
+        self.job = None
+        self.cancelToken = CancelToken()
+        
+        # Setup the rolling statistics
+        self.feeStats = StatisticsBank()
+        
         self.updateConfig(config)
         self.temp_logfile = temp_logfile
         self.fee_logfile = fee_logfile
@@ -465,11 +818,11 @@ class ChassisStatus(object):
         self.configured = False
         self.fee_currents = []
         self.rf_powers = []
+        self.loop_counter = 0
         
         # Setup the callback
         self.ASPCallbackInstance = ASPCallbackInstance
         
-        self.thread = None
         self.alive = threading.Event()
         
     def updateConfig(self, config=None):
@@ -484,129 +837,126 @@ class ChassisStatus(object):
         self.rs485_mapping = config['sub20_rs485_mapping']
         self.monitorPeriod = config['chassis_period']
         self.poll_rf_power = config.get('has_rf_power', False)
+        self.feeStats.updateConfig(window=config.get('stats_window', 3600), tau=config.get('stats_tau', 180))
         
+        if self.job is not None:
+            self.scheduler.reschedule(self.jobName, self.monitorPeriod)
+            
     def start(self):
         """
-        Start the monitoring thread.
+        Start monitoring by registering with the monitor scheduler.
         """
         
-        if self.thread is not None:
+        if self.job is not None:
             self.stop()
             
-        self.thread = threading.Thread(target=self.monitorThread)
-        self.thread.setDaemon(1)
-        self.alive.set()
-        self.thread.start()
+        self.loop_counter = 0
+        self.feeStats.reset()
         
-        time.sleep(1)
+        self.alive.set()
+        self.cancelToken = CancelToken()
+        self.job = self.scheduler.register(self.jobName, self.monitorThread, self.monitorPeriod)
         
     def stop(self):
         """
-        Stop the monitor thread, waiting until it's finished.
+        Stop monitoring, cancelling any poll in progress and waiting up to
+        MONITOR_STOP_TIMEOUT seconds for it to finish.
         """
         
-        if self.thread is not None:
+        if self.job is not None:
             self.alive.clear()          #clear alive event for thread
-            self.thread.join()          #wait until thread has finished
-            self.thread = None
+            self.cancelToken.cancel()
+            self.scheduler.unregister(self.jobName, timeout=MONITOR_STOP_TIMEOUT)
+            self.job = None
+            getTelemetryWriter().flush(self.temp_logfile)
+            getTelemetryWriter().flush(self.fee_logfile)
             self.configured = False
             self.lastError = None
             
     def monitorThread(self):
         """
-        Create a monitoring thread for the temperature.
+        Check the chassis configuration once.  This is called every 
+        monitorPeriod seconds by the monitor scheduler.
         """
         
-        loop_counter = 0
+        tStart = getClock().time()
         
-        while self.alive.isSet():
-            tStart = time.time()
-            
-            try:
-                resp = self._spi.read_register(1, self.register)
-                if resp is not None:
-                    missingSUB20 = False
-                    
-                    if resp == (self.register | 0x5500):
-                        self.configured = True
-                    else:
-                        self.configured = False
-                        
-                        aspThreadsLogger.error("%s: SUB-20 S/N %s lost SPI port configuation", type(self).__name__, self.sub20SN)
+        try:
+            resp = self._spi.read_register(1, self.register, token=self.cancelToken)
+            if self.cancelToken.isCancelled():
+                ## Stopped while polling, there is nothing to report
+                return
+            if resp is not None:
+                missingSUB20 = False
+                
+                if resp == (self.register | 0x5500):
+                    self.configured = True
                 else:
-                    missingSUB20 = True
-                    
                     self.configured = False
                     
-                if self.ASPCallbackInstance is not None:
-                    if missingSUB20:
-                        self.ASPCallbackInstance.processMissingSUB20()
-                        
-                    if not self.configured:
-                        self.ASPCallbackInstance.processUnconfiguredChassis(self.sub20SN)
+                    aspThreadsLogger.error("%s: SUB-20 S/N %s lost SPI port configuation", type(self).__name__, self.sub20SN)
+            else:
+                missingSUB20 = True
+                
+                self.configured = False
+                
+            if self.ASPCallbackInstance is not None:
+                if missingSUB20:
+                    self.ASPCallbackInstance.processMissingSUB20()
+                    
+                if not self.configured:
+                    self.ASPCallbackInstance.processUnconfiguredChassis(self.sub20SN)
+                    
+            ## Record the board temperatures and power consumption while we are at it
+            if self.pic_monitoring and self.loop_counter == 0:
+                #status, temps = rs485Temperature(self.rs485_mapping, maxRetry=MAX_RS485_RETRY, token=self.cancelToken)
+                status, temps = False, []
+                
+                if status:
+                    tRead = getClock().time()
+                    getTelemetryWriter().write(self.temp_logfile, temps, fmt='%.2f', timestamp=tRead)
+                    _recordHistory('board-temp', ['board%i' % (i+1) for i in range(len(temps))], temps, 
+                                   timestamp=tRead)
                         
-                ## Record the board temperatures and power consumption while we are at it
-                if self.pic_monitoring and loop_counter == 0:
-                    #status, temps = rs485Temperature(self.rs485_mapping, maxRetry=MAX_RS485_RETRY)
-                    status, temps = False, []
+                status, fees = rs485Power(self.rs485_mapping, maxRetry=MAX_RS485_RETRY, token=self.cancelToken)
+                
+                if status:
+                    self.fee_currents = fees
+                    tRead = getClock().time()
+                    self.feeStats.update([v if v >= 0 else None for v in self.fee_currents], timestamp=tRead)
                     
-                    if status:
-                        try:
-                            with open(self.temp_logfile, 'a') as log:
-                                log.write('%s,' % time.time())
-                                log.write('%s\n' % ','.join(['%.2f' % t for t in temps]))
-                                log.flush()
-                        except Exception as e:
-                            aspThreadsLogger.error("%s: monitorThread failed to update board temperature log - %s", type(self).__name__, str(e))
-                            
-                    status, fees = rs485Power(self.rs485_mapping, maxRetry=MAX_RS485_RETRY)
+                    getTelemetryWriter().write(self.fee_logfile, self.fee_currents, fmt='%.3f', timestamp=tRead)
+                    _recordHistory('fee-power', ['fee%i' % (i+1) for i in range(len(self.fee_currents))], 
+                                   self.fee_currents, timestamp=tRead)
+                        
+                if self.poll_rf_power:
+                    status, powers = rs485RFPower(self.rs485_mapping, maxRetry=MAX_RS485_RETRY, token=self.cancelToken)
                         
                     if status:
-                        self.fee_currents = fees
+                        self.rf_powers = powers
                         
-                        try:
-                            with open(self.fee_logfile, 'a') as log:
-                                log.write('%s,' % time.time())
-                                log.write('%s\n' % ','.join(['%.3f' % v for v in self.fee_currents]))
-                                log.flush()
-                        except Exception as e:
-                            aspThreadsLogger.error("%s: monitorThread failed to update FEE power log - %s", type(self).__name__, str(e))
-                            
-                    if self.poll_rf_power:
-                        status, powers = rs485RFPower(self.rs485_mapping, maxRetry=MAX_RS485_RETRY)
-                            
-                        if status:
-                            self.rf_powers = powers
-                            
-            except Exception as e:
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                aspThreadsLogger.error("%s: monitorThread SUB-20 S/N %s failed with: %s at line %i", type(self).__name__, self.sub20SN, str(e), exc_traceback.tb_lineno)
-                
-                ## Grab the full traceback and save it to a string via StringIO
-                fileObject = StringIO()
-                traceback.print_tb(exc_traceback, file=fileObject)
-                tbString = fileObject.getvalue()
-                fileObject.close()
-                ## Print the traceback to the logger as a series of DEBUG messages
-                for line in tbString.split('\n'):
-                    aspThreadsLogger.debug("%s", line)
-                    
-                self.lastError = str(e)
-                
-            loop_counter += 1
-            loop_counter %= 3
-            
-            # Stop time
-            tStop = time.time()
-            aspThreadsLogger.debug('Finished updating chassis status for SUB-20 S/N %s in %.3f seconds', self.sub20SN, tStop - tStart)
-            
-            # Sleep for a bit
-            sleepCount = 0
-            sleepTime = self.monitorPeriod - (tStop - tStart)
-            while (self.alive.isSet() and sleepCount < sleepTime):
-                time.sleep(0.2)
-                sleepCount += 0.2
+        except Exception as e:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            aspThreadsLogger.error("%s: monitorThread SUB-20 S/N %s failed with: %s at line %i", type(self).__name__, self.sub20SN, str(e), exc_traceback.tb_lineno)
+            
+            ## Grab the full traceback and save it to a string via StringIO
+            fileObject = StringIO()
+            traceback.print_tb(exc_traceback, file=fileObject)
+            tbString = fileObject.getvalue()
+            fileObject.close()
+            ## Print the traceback to the logger as a series of DEBUG messages
+            for line in tbString.split('\n'):
+                aspThreadsLogger.debug("%s", line)
                 
+            self.lastError = str(e)
+            
+        self.loop_counter += 1
+        self.loop_counter %= 3
+        
+        # Stop time
+        tStop = getClock().time()
+        aspThreadsLogger.debug('Finished updating chassis status for SUB-20 S/N %s in %.3f seconds', self.sub20SN, tStop - tStart)
+        
     def getStatus(self):
         """
         Convenience function to get the chassis status as a string
@@ -627,6 +977,22 @@ class ChassisStatus(object):
         except IndexError:
             return (None, None)
             
+    def getFEECurrentStatistics(self, stand):
+        """
+        Convenience function to get the rolling statistics of the current draw 
+        of a FEE.  The statistics are returned as a two-element tuple (pol 1, 
+        pol 2) of four-element tuples of EWMA, windowed min., windowed max. 
+        (all in amps), and rate of change (A/s).
+        """
+        
+        stats = []
+        for i in (2*(stand-1), 2*(stand-1)+1):
+            if i < 0 or i >= len(self.feeStats):
+                stats.append((None, None, None, None))
+            else:
+                stats.append(self.feeStats.getStatistics(i))
+        return tuple(stats)
+        
     def getRFPower(self, stand):
         """
         Convenience function to get the RF power from the square law detector in
@@ -0,0 +1,496 @@
+
+"""
+Module for recording the traffic between aspSUB20 and the hardware and for
+replaying it later without the hardware.
+
+RecordingTransport wraps one of the aspSUB20 transports and writes every
+operation that goes through it (SPI transfers and register reads, PSU reads
+and writes, thermometer reads, I2C passes, RS485 commands, and the external
+tools used for the hardware scans) to a trace file.  ReplayTransport reads
+a trace back and answers the same operations with the recorded results,
+errors, and timings.
+
+A trace file starts with a small header:
+  * a 4 byte magic string
+  * the format version as a little endian uint16
+  * the wall clock time when the recording started as a float64
+  * whether or not the recorded transport was batched as a uint8
+  * the length of the name of the recorded transport as a uint8
+  * the name of the recorded transport
+which is followed by one record per operation.  Each record has a fixed size
+header with the operation, the outcome, the start time relative to the start
+of the recording, the duration, and the sizes of the request and response.
+The request (SUB-20 S/N and arguments) and the response (result or error
+message) follow in a compact, tagged binary encoding.  Records are written
+in the order that the operations finish.
+"""
+
+import struct
+import logging
+import threading
+from collections import deque
+
+from aspSUB20 import OperationCancelled, Transport
+from aspClock import getClock
+
+
+__version__ = '0.1'
+__all__ = ['TRACE_OPERATIONS', 'RecordingTransport', 'ReplayTransport', 'readTrace']
+
+
+aspTraceLogger = logging.getLogger('__main__')
+
+
+# Transport operations that are recorded
+TRACE_OPERATIONS = ('spiTransfer', 'spiRead', 'psuRead', 'psuWrite', 'psuTemperature',
+                    'i2cSweep', 'rs485Send', 'rs485Echo', 'run')
+
+# Operation outcomes and the exceptions that go with them
+_OUTCOME_OK = 0
+_OUTCOME_RUNTIME = 1
+_OUTCOME_VALUE = 2
+_OUTCOME_CANCELLED = 3
+
+_OUTCOME_EXCEPTIONS = {_OUTCOME_RUNTIME:   RuntimeError,
+                       _OUTCOME_VALUE:     ValueError,
+                       _OUTCOME_CANCELLED: OperationCancelled}
+
+# File and record header layouts
+_TRACE_MAGIC = b'ASPT'
+_TRACE_VERSION = 1
+_HEADER_STRUCT = struct.Struct('<4sHdBB')
+_RECORD_STRUCT = struct.Struct('<BBdfII')
+
+_DOUBLE_STRUCT = struct.Struct('<d')
+
+
+def _encodeVarint(value, out):
+    """
+    Append an unsigned integer to a bytearray seven bits at a time.
+    """
+    
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decodeVarint(data, offset):
+    """
+    Decode an unsigned integer and return a two-element tuple of the value
+    and the offset of the next byte.
+    """
+    
+    value, shift = 0, 0
+    while True:
+        b = data[offset]
+        offset += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, offset
+        shift += 7
+
+
+def _encode(value, out):
+    """
+    Append a value to a bytearray.  None, booleans, integers, floats,
+    strings, bytes, and tuples, lists, and dictionaries of these are
+    supported.
+    """
+    
+    if value is None:
+        out.append(ord('N'))
+    elif value is True:
+        out.append(ord('T'))
+    elif value is False:
+        out.append(ord('F'))
+    elif isinstance(value, int):
+        ## Zig-zag so that small negative numbers stay small
+        out.append(ord('i'))
+        _encodeVarint((value << 1) if value >= 0 else ((-value << 1) - 1), out)
+    elif isinstance(value, float):
+        out.append(ord('f'))
+        out.extend(_DOUBLE_STRUCT.pack(value))
+    elif isinstance(value, str):
+        data = value.encode('utf-8')
+        out.append(ord('s'))
+        _encodeVarint(len(data), out)
+        out.extend(data)
+    elif isinstance(value, (bytes, bytearray)):
+        out.append(ord('b'))
+        _encodeVarint(len(value), out)
+        out.extend(value)
+    elif isinstance(value, dict):
+        out.append(ord('d'))
+        _encodeVarint(len(value), out)
+        for k,v in value.items():
+            _encode(k, out)
+            _encode(v, out)
+    elif isinstance(value, (tuple, list)):
+        out.append(ord('t') if isinstance(value, tuple) else ord('l'))
+        _encodeVarint(len(value), out)
+        for v in value:
+            _encode(v, out)
+    else:
+        raise TypeError("Cannot encode values of type %s" % type(value).__name__)
+
+
+def _decode(data, offset=0):
+    """
+    Decode a value and return a two-element tuple of the value and the offset
+    of the next byte.
+    """
+    
+    tag = data[offset]
+    offset += 1
+    if tag == ord('N'):
+        return None, offset
+    elif tag == ord('T'):
+        return True, offset
+    elif tag == ord('F'):
+        return False, offset
+    elif tag == ord('i'):
+        value, offset = _decodeVarint(data, offset)
+        return ((value >> 1) if not value & 1 else -((value + 1) >> 1)), offset
+    elif tag == ord('f'):
+        return _DOUBLE_STRUCT.unpack_from(data, offset)[0], offset + _DOUBLE_STRUCT.size
+    elif tag in (ord('s'), ord('b')):
+        size, offset = _decodeVarint(data, offset)
+        value = bytes(data[offset:offset+size])
+        return (value.decode('utf-8') if tag == ord('s') else value), offset + size
+    elif tag == ord('d'):
+        size, offset = _decodeVarint(data, offset)
+        value = {}
+        for i in range(size):
+            k, offset = _decode(data, offset)
+            value[k], offset = _decode(data, offset)
+        return value, offset
+    elif tag in (ord('t'), ord('l')):
+        size, offset = _decodeVarint(data, offset)
+        value = []
+        for i in range(size):
+            v, offset = _decode(data, offset)
+            value.append(v)
+        return (tuple(value) if tag == ord('t') else value), offset
+    raise ValueError("Unknown tag 0x%02X at offset %i" % (tag, offset-1))
+
+
+def _encodeRequest(sub20SN, args):
+    """
+    Encode the SUB-20 S/N and arguments of an operation.
+    """
+    
+    out = bytearray()
+    _encode((str(sub20SN), tuple(args)), out)
+    return bytes(out)
+
+
+def readTrace(filename):
+    """
+    Read a trace file and return a two-element tuple of a dictionary that
+    describes the recording ('start', 'transport', and 'batched') and a list
+    of the records.  Each record is a dictionary with the operation, the
+    outcome ('ok', 'error', 'invalid', or 'cancelled'), the start time in s
+    since the start of the recording, the duration in s, the SUB-20 S/N, the
+    arguments, and the result or error message.  A partially written record
+    at the end of the file is ignored.
+    """
+    
+    outcomes = {_OUTCOME_OK:        'ok',
+                _OUTCOME_RUNTIME:   'error',
+                _OUTCOME_VALUE:     'invalid',
+                _OUTCOME_CANCELLED: 'cancelled'}
+                
+    records = []
+    with open(filename, 'rb') as fh:
+        header = fh.read(_HEADER_STRUCT.size)
+        if len(header) < _HEADER_STRUCT.size:
+            raise ValueError("%s is not a trace file" % filename)
+        magic, version, start, batched, nameSize = _HEADER_STRUCT.unpack(header)
+        if magic != _TRACE_MAGIC or version != _TRACE_VERSION:
+            raise ValueError("%s is not a version %i trace file" % (filename, _TRACE_VERSION))
+        info = {'start': start,
+                'transport': fh.read(nameSize).decode('utf-8', 'replace'),
+                'batched': bool(batched)}
+                
+        while True:
+            header = fh.read(_RECORD_STRUCT.size)
+            if len(header) < _RECORD_STRUCT.size:
+                break
+            op, outcome, tStart, duration, requestSize, responseSize = _RECORD_STRUCT.unpack(header)
+            request = fh.read(requestSize)
+            response = fh.read(responseSize)
+            if len(request) < requestSize or len(response) < responseSize:
+                ## Partial write at the end of the file
+                break
+                
+            try:
+                (sub20SN, args), offset = _decode(request)
+                result, offset = _decode(response)
+                records.append({'operation': TRACE_OPERATIONS[op],
+                                'outcome': outcomes[outcome],
+                                'start': tStart,
+                                'duration': duration,
+                                'sub20SN': sub20SN,
+                                'args': args,
+                                'result': result,
+                                '_request': request,
+                                '_response': response,
+                                '_outcome': outcome})
+            except (IndexError, KeyError, ValueError) as e:
+                aspTraceLogger.warning("Corrupted record found in %s, stopping - %s", filename, str(e))
+                break
+                
+    return info, records
+
+
+class RecordingTransport(Transport):
+    """
+    Transport that passes every operation to another transport and records
+    it to a trace file.  The name and the batching of the wrapped transport
+    are kept so that the recording can be turned on and off without changing
+    how the SUB-20 functions behave.
+    """
+    
+    def __init__(self, transport, filename):
+        Transport.__init__(self)
+        self.transport = transport
+        self.filename = filename
+        
+        self.name = transport.name
+        self.batched = transport.batched
+        
+        self._lock = threading.Lock()
+        self._start = getClock().monotonic()
+        
+        name = self.name.encode('utf-8')[:255]
+        self._fh = open(self.filename, 'wb')
+        self._fh.write(_HEADER_STRUCT.pack(_TRACE_MAGIC, _TRACE_VERSION, getClock().time(), int(self.batched), len(name)))
+        self._fh.write(name)
+        self._fh.flush()
+        aspTraceLogger.info("%s: recording the '%s' transport to %s", type(self).__name__, self.name, self.filename)
+        
+        # Statistics
+        self.nRecords = 0
+        self.nBytes = self._fh.tell()
+        
+    def _write(self, op, outcome, tStart, duration, request, result):
+        """
+        Write a single record to the trace file.
+        """
+        
+        response = bytearray()
+        _encode(result, response)
+        
+        with self._lock:
+            if self._fh is None:
+                return
+            try:
+                self._fh.write(_RECORD_STRUCT.pack(op, outcome, tStart - self._start, duration, len(request), len(response)))
+                self._fh.write(request)
+                self._fh.write(response)
+                self._fh.flush()
+            except (IOError, OSError) as e:
+                aspTraceLogger.error("%s: could not write to %s, stopping the recording - %s", type(self).__name__, self.filename, str(e))
+                self._fh.close()
+                self._fh = None
+                return
+            self.nRecords += 1
+            self.nBytes += _RECORD_STRUCT.size + len(request) + len(response)
+            
+    def _call(self, name, sub20SN, args, func):
+        """
+        Run an operation on the wrapped transport and record it.
+        """
+        
+        op = TRACE_OPERATIONS.index(name)
+        request = _encodeRequest(sub20SN, args)
+        
+        tStart = getClock().monotonic()
+        try:
+            result = func()
+        except OperationCancelled as e:
+            self._write(op, _OUTCOME_CANCELLED, tStart, getClock().monotonic() - tStart, request, str(e))
+            raise
+        except RuntimeError as e:
+            self._write(op, _OUTCOME_RUNTIME, tStart, getClock().monotonic() - tStart, request, str(e))
+            raise
+        except ValueError as e:
+            self._write(op, _OUTCOME_VALUE, tStart, getClock().monotonic() - tStart, request, str(e))
+            raise
+        self._write(op, _OUTCOME_OK, tStart, getClock().monotonic() - tStart, request, result)
+        return result
+        
+    def spiTransfer(self, sub20SN, deviceCount, devices, values, token=None):
+        devices, values = list(devices), list(values)
+        return self._call('spiTransfer', sub20SN, (deviceCount, devices, values),
+                          lambda: self.transport.spiTransfer(sub20SN, deviceCount, devices, values, token=token))
+                          
+    def spiRead(self, sub20SN, deviceCount, devices, registers, token=None):
+        devices, registers = list(devices), list(registers)
+        return self._call('spiRead', sub20SN, (deviceCount, devices, registers),
+                          lambda: self.transport.spiRead(sub20SN, deviceCount, devices, registers, token=token))
+                          
+    def psuRead(self, sub20SN, psuAddress, token=None):
+        return self._call('psuRead', sub20SN, (psuAddress,),
+                          lambda: self.transport.psuRead(sub20SN, psuAddress, token=token))
+                          
+    def psuWrite(self, sub20SN, psuAddress, state, token=None):
+        return self._call('psuWrite', sub20SN, (psuAddress, int(state)),
+                          lambda: self.transport.psuWrite(sub20SN, psuAddress, state, token=token))
+                          
+    def psuTemperature(self, sub20SN, token=None):
+        return self._call('psuTemperature', sub20SN, (),
+                          lambda: self.transport.psuTemperature(sub20SN, token=token))
+                          
+    def i2cSweep(self, sub20SN, token=None):
+        return self._call('i2cSweep', sub20SN, (),
+                          lambda: self.transport.i2cSweep(sub20SN, token=token))
+                          
+    def rs485Send(self, sub20SN, address, command, decode=False, token=None):
+        return self._call('rs485Send', sub20SN, (int(address), command, bool(decode)),
+                          lambda: self.transport.rs485Send(sub20SN, address, command, decode=decode, token=token))
+                          
+    def rs485Echo(self, sub20SN, addresses, token=None):
+        addresses = list(addresses)
+        return self._call('rs485Echo', sub20SN, (addresses,),
+                          lambda: self.transport.rs485Echo(sub20SN, addresses, token=token))
+                          
+    def run(self, command, timeout, token=None):
+        command = [str(c) for c in command]
+        return self._call('run', 'tools', (command,),
+                          lambda: self.transport.run(command, timeout, token=token))
+                          
+    def release(self, sub20SN=None):
+        self.transport.release(sub20SN)
+        
+    def suspend(self):
+        return self.transport.suspend()
+        
+    def close(self):
+        self.transport.close()
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+                
+    def getModuleStatistics(self, sub20SN):
+        return self.transport.getModuleStatistics(sub20SN)
+        
+    def getStatistics(self, sub20SN):
+        stats = self.transport.getStatistics(sub20SN)
+        stats['recording'] = {'filename': self.filename,
+                              'records': self.nRecords,
+                              'bytes': self.nBytes}
+        return stats
+
+
+class ReplayTransport(Transport):
+    """
+    Transport that answers operations from a trace file.  Each operation is
+    matched to the next unused record with the same SUB-20 S/N, arguments,
+    and operation, so the order that the monitor threads happen to run in
+    does not matter.  The recorded results and errors are returned and,
+    unless speed is zero, each operation takes as long as it did when it was
+    recorded divided by speed.  If loop is True the records for an operation
+    are reused once they have all been used, otherwise a RuntimeError is
+    raised for operations that have no record left.
+    """
+    
+    name = 'replay'
+    
+    def __init__(self, filename, speed=1.0, loop=False):
+        Transport.__init__(self)
+        self.filename = filename
+        self.speed = float(speed)
+        self.loop = loop
+        
+        self.info, records = readTrace(self.filename)
+        self.batched = self.info['batched']
+        
+        self._records = {}
+        for record in records:
+            key = (record['operation'], record['_request'])
+            self._records.setdefault(key, []).append((record['_outcome'], record['duration'], record['_response']))
+        self._queues = dict([(key, deque(value)) for key,value in self._records.items()])
+        self._lock = threading.Lock()
+        aspTraceLogger.info("%s: replaying %i records of the '%s' transport from %s", type(self).__name__, len(records), self.info['transport'], self.filename)
+        
+        # Statistics
+        self.nMisses = 0
+        
+    def _call(self, name, sub20SN, args, token=None):
+        """
+        Answer an operation from the trace.
+        """
+        
+        if token is not None and token.isCancelled():
+            raise OperationCancelled("Cancelled before replaying %s for S/N %s" % (name, sub20SN))
+            
+        key = (name, _encodeRequest(sub20SN, args))
+        with self._lock:
+            queue = self._queues.get(key, None)
+            if not queue and self.loop and key in self._records:
+                queue = self._queues[key] = deque(self._records[key])
+            record = queue.popleft() if queue else None
+            if record is None:
+                self.nMisses += 1
+                
+        if record is None:
+            self._record(sub20SN, False)
+            raise RuntimeError("No recorded response for %s%s on S/N %s" % (name, repr(tuple(args)), sub20SN))
+            
+        outcome, duration, response = record
+        if self.speed > 0:
+            if token is not None:
+                token.wait(duration / self.speed)
+            else:
+                getClock().sleep(duration / self.speed)
+                
+        self._record(sub20SN, outcome == _OUTCOME_OK)
+        result, offset = _decode(response)
+        if outcome != _OUTCOME_OK:
+            raise _OUTCOME_EXCEPTIONS[outcome](result)
+        return result
+        
+    def spiTransfer(self, sub20SN, deviceCount, devices, values, token=None):
+        return self._call('spiTransfer', sub20SN, (deviceCount, list(devices), list(values)), token=token)
+        
+    def spiRead(self, sub20SN, deviceCount, devices, registers, token=None):
+        return self._call('spiRead', sub20SN, (deviceCount, list(devices), list(registers)), token=token)
+        
+    def psuRead(self, sub20SN, psuAddress, token=None):
+        return self._call('psuRead', sub20SN, (psuAddress,), token=token)
+        
+    def psuWrite(self, sub20SN, psuAddress, state, token=None):
+        return self._call('psuWrite', sub20SN, (psuAddress, int(state)), token=token)
+        
+    def psuTemperature(self, sub20SN, token=None):
+        return self._call('psuTemperature', sub20SN, (), token=token)
+        
+    def i2cSweep(self, sub20SN, token=None):
+        return self._call('i2cSweep', sub20SN, (), token=token)
+        
+    def rs485Send(self, sub20SN, address, command, decode=False, token=None):
+        return self._call('rs485Send', sub20SN, (int(address), command, bool(decode)), token=token)
+        
+    def rs485Echo(self, sub20SN, addresses, token=None):
+        return self._call('rs485Echo', sub20SN, (list(addresses),), token=token)
+        
+    def run(self, command, timeout, token=None):
+        return self._call('run', 'tools', ([str(c) for c in command],), token=token)
+        
+    def reset(self):
+        """
+        Start the replay over from the beginning of the trace.
+        """
+        
+        with self._lock:
+            self._queues = dict([(key, deque(value)) for key,value in self._records.items()])
+            
+    def getStatistics(self, sub20SN):
+        stats = Transport.getStatistics(self, sub20SN)
+        stats['replay'] = {'filename': self.filename,
+                           'remaining': sum([len(queue) for queue in self._queues.values()]),
+                           'misses': self.nMisses}
+        return stats
@@ -0,0 +1,295 @@
+
+"""
+Module for tracking which USB devices are present without having to run lsusb.
+
+The devices are found by scanning sysfs and the scan is repeated whenever the
+kernel sends a hotplug event for a USB device over a netlink socket.  The scan
+is also repeated every pollInterval seconds in case an event was missed or the
+netlink socket cannot be opened, i.e., inside some containers.  Presence 
+queries are answered from the results of the last scan.
+"""
+
+import os
+import time
+import errno
+import select
+import socket
+import logging
+import threading
+
+
+__version__ = '0.1'
+__all__ = ['SUB20_VENDOR_ID', 'USBPresenceTracker', 'getUSBPresenceTracker']
+
+
+aspUSBLogger = logging.getLogger('__main__')
+
+
+# USB vendor ID of the SUB-20/ATmega devices
+SUB20_VENDOR_ID = '2886'
+
+# Where the USB devices live in sysfs
+_SYSFS_USB_DEVICES = '/sys/bus/usb/devices'
+
+# Netlink protocol for kernel hotplug events
+_NETLINK_KOBJECT_UEVENT = 15
+
+
+def _readAttribute(path, name):
+    """
+    Read a single sysfs attribute, returning None if it cannot be read.
+    """
+    
+    try:
+        with open(os.path.join(path, name), 'r') as fh:
+            return fh.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+class USBPresenceTracker(object):
+    """
+    Class for keeping track of the USB devices that are present.  Callbacks
+    can be registered with addCallback() and are called with the action,
+    'add' or 'remove', and a dictionary describing the device whenever a
+    device with one of the vendor IDs of interest appears or disappears.
+    """
+    
+    def __init__(self, vendorIDs=(SUB20_VENDOR_ID,), pollInterval=5.0, sysfsPath=_SYSFS_USB_DEVICES):
+        self.vendorIDs = tuple([v.lower() for v in vendorIDs])
+        self.pollInterval = float(pollInterval)
+        self.sysfsPath = sysfsPath
+        
+        self._devices = {}
+        self._callbacks = []
+        self._lock = threading.Lock()
+        
+        self._socket = None
+        self._lastPoll = 0.0
+        self.thread = None
+        self.alive = threading.Event()
+        
+        # Statistics
+        self.nScans = 0
+        self.nEvents = 0
+        self.nChanges = 0
+        self.lastChange = None
+        
+        self._scan()
+        
+    def _scan(self):
+        """
+        Scan sysfs for USB devices with the vendor IDs of interest, update
+        the list of devices, and call the callbacks for any changes.
+        """
+        
+        devices = {}
+        try:
+            entries = os.listdir(self.sysfsPath)
+        except (IOError, OSError):
+            entries = []
+        for entry in entries:
+            if ':' in entry:
+                ## Interface, not a device
+                continue
+            path = os.path.join(self.sysfsPath, entry)
+            vendor = _readAttribute(path, 'idVendor')
+            if vendor is None or vendor.lower() not in self.vendorIDs:
+                continue
+            devices[entry] = {'path': entry,
+                              'vendor': vendor.lower(),
+                              'product': _readAttribute(path, 'idProduct'),
+                              'serial': _readAttribute(path, 'serial')}
+                              
+        with self._lock:
+            self.nScans += 1
+            added = [devices[k] for k in devices if k not in self._devices]
+            removed = [self._devices[k] for k in self._devices if k not in devices]
+            self._devices = devices
+            if added or removed:
+                self.nChanges += len(added) + len(removed)
+                self.lastChange = time.time()
+            callbacks = list(self._callbacks)
+            
+        for action,changed in (('remove', removed), ('add', added)):
+            for device in changed:
+                aspUSBLogger.info("%s: USB device %s:%s at %s was %s", type(self).__name__, device['vendor'], device['product'], device['path'], 'added' if action == 'add' else 'removed')
+                for callback in callbacks:
+                    try:
+                        callback(action, device)
+                    except Exception as e:
+                        aspUSBLogger.warning("%s: callback for %s failed: %s", type(self).__name__, action, str(e))
+                        
+    def _openSocket(self):
+        """
+        Open a netlink socket that receives the kernel hotplug events.
+        Returns None if this is not possible.
+        """
+        
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, _NETLINK_KOBJECT_UEVENT)
+            sock.bind((0, 1))
+        except (AttributeError, OSError) as e:
+            aspUSBLogger.warning("%s: cannot listen for hotplug events, polling every %.1f s instead - %s", type(self).__name__, self.pollInterval, str(e))
+            return None
+        return sock
+        
+    def start(self):
+        """
+        Start watching for devices being added or removed.
+        """
+        
+        if self.thread is not None:
+            self.stop()
+            
+        self._socket = self._openSocket()
+        
+        self.thread = threading.Thread(target=self.watchThread)
+        self.thread.daemon = 1
+        self.alive.set()
+        self.thread.start()
+        
+        ## Catch anything that changed before the socket was open
+        self._scan()
+        
+    def stop(self):
+        """
+        Stop watching for devices, waiting until the watcher has finished.
+        """
+        
+        if self.thread is not None:
+            self.alive.clear()
+            self.thread.join()
+            self.thread = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            
+    def watchThread(self):
+        """
+        Thread that rescans sysfs on hotplug events and every pollInterval
+        seconds.
+        """
+        
+        while self.alive.is_set():
+            if self._socket is not None:
+                try:
+                    ready, _, _ = select.select([self._socket,], [], [], 1.0)
+                except (OSError, ValueError) as e:
+                    if getattr(e, 'errno', None) != errno.EINTR:
+                        aspUSBLogger.warning("%s: hotplug events are no longer available - %s", type(self).__name__, str(e))
+                        self._socket.close()
+                        self._socket = None
+                    continue
+                    
+                if ready and self._isDeviceEvent():
+                    self.nEvents += 1
+                    self._lastPoll = time.time()
+                    self._scan()
+            else:
+                time.sleep(min(1.0, self.pollInterval))
+                
+            if time.time() - self._lastPoll >= self.pollInterval:
+                self._lastPoll = time.time()
+                self._scan()
+                
+    def _isDeviceEvent(self):
+        """
+        Read a single hotplug event and return whether or not it is for a USB
+        device being added or removed.
+        """
+        
+        try:
+            message = self._socket.recv(65536)
+        except OSError:
+            return False
+            
+        ## Messages look like "action@devpath\0KEY=value\0..." and we only
+        ## care about whole USB devices
+        fields = message.split(b'\x00')
+        properties = dict([f.split(b'=', 1) for f in fields[1:] if b'=' in f])
+        return properties.get(b'SUBSYSTEM', None) == b'usb' \
+               and properties.get(b'DEVTYPE', None) == b'usb_device' \
+               and properties.get(b'ACTION', None) in (b'add', b'remove')
+               
+    def rescan(self):
+        """
+        Rescan sysfs right away rather than waiting for the next hotplug
+        event or poll.
+        """
+        
+        self._lastPoll = time.time()
+        self._scan()
+        
+    def addCallback(self, callback):
+        """
+        Register a function to be called when a device is added or removed.
+        """
+        
+        with self._lock:
+            if callback not in self._callbacks:
+                self._callbacks.append(callback)
+                
+    def removeCallback(self, callback):
+        """
+        Remove a previously registered callback.
+        """
+        
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+                
+    def isPresent(self, vendor=SUB20_VENDOR_ID, serial=None):
+        """
+        Return whether or not there is at least one USB device with the
+        specified vendor ID (and, optionally, serial number) present.
+        """
+        
+        vendor = vendor.lower()
+        with self._lock:
+            for device in self._devices.values():
+                if device['vendor'] == vendor and (serial is None or device['serial'] == serial):
+                    return True
+        return False
+        
+    def getDevices(self):
+        """
+        Return a list of dictionaries describing the devices that are present.
+        """
+        
+        with self._lock:
+            return [dict(device) for device in self._devices.values()]
+            
+    def getStatistics(self):
+        """
+        Return a dictionary of the scan, event, and change counts.
+        """
+        
+        with self._lock:
+            return {'hotplug': self._socket is not None,
+                    'devices': len(self._devices),
+                    'scans': self.nScans,
+                    'events': self.nEvents,
+                    'changes': self.nChanges,
+                    'last_change': self.lastChange}
+
+
+_USB_PRESENCE_TRACKER = None
+_USB_PRESENCE_TRACKER_LOCK = threading.Lock()
+
+
+def getUSBPresenceTracker():
+    """
+    Return the USBPresenceTracker instance shared by INI and the monitors,
+    starting it if needed.
+    """
+    
+    global _USB_PRESENCE_TRACKER
+    
+    with _USB_PRESENCE_TRACKER_LOCK:
+        if _USB_PRESENCE_TRACKER is None:
+            _USB_PRESENCE_TRACKER = USBPresenceTracker()
+            _USB_PRESENCE_TRACKER.start()
+        return _USB_PRESENCE_TRACKER
@@ -177,6 +177,21 @@ class MCSCommunicate(Communicate):
                     else:
                         packed_data = self.SubSystemInstance.currentState['lastLog']
                         
+                    self.logger.debug('%s = exited with status %s', data, str(status))
+                ## Analog gain state - FEE current draw statistics in mA and mA/hr
+                elif data[0:13] in ('FEEPOL1STATS_', 'FEEPOL2STATS_'):
+                    stand = int(data[13:])
+                    pol = int(data[6]) - 1
+                    
+                    status, stats = self.SubSystemInstance.getFEECurrentStatistics(stand)
+                    if status:
+                        ewma, vmin, vmax, rate = stats[pol]
+                        if rate is None:
+                            rate = 0.0
+                        packed_data = "%.1f %.1f %.1f %.2f" % (ewma*1e3, vmin*1e3, vmax*1e3, rate*1e3*3600)
+                    else:
+                        packed_data = self.SubSystemInstance.currentState['lastLog']
+                        
                     self.logger.debug('%s = exited with status %s', data, str(status))
                 ## Analog gain state - RMS RF power into a 50 Ohm load in uW
                 elif data[0:6] == 'RFPWR_':
@@ -327,6 +342,20 @@ class MCSCommunicate(Communicate):
                         packed_data = self.SubSystemInstance.currentState['lastLog']
                         
                     self.logger.debug('%s = exited with status %s', data, str(status))
+                elif data[0:13] == 'SENSOR-STATS-':
+                    sensorNumb = int(data[13:])
+                    
+                    status, value = self.SubSystemInstance.getTempSensorStatistics(sensorNumb)
+                    if status:
+                        ewma, vmin, vmax, rate = value
+                        if rate is None:
+                            rate = 0.0
+                        packed_data = "%.2f %.2f %.2f %.2f" % (ewma, vmin, vmax, rate*3600)
+                        
+                    else:
+                        packed_data = self.SubSystemInstance.currentState['lastLog']
+                        
+                    self.logger.debug('%s = exited with status %s', data, str(status))
                 
                 else:
                     status = False
@@ -466,6 +495,30 @@ class MCSCommunicate(Communicate):
             return sender, status, command, reference, packed_data        
 
 
+def ShutdownASP(SubSystemInstance, mode='', timeout=20.0):
+    """
+    Issue a SHT to ASP and wait up to timeout seconds for it to complete.  If 
+    another blocking operation is in progress the SHT is retried until the 
+    timeout is reached.  Returns True if the SHT completed, False otherwise.
+    """
+    
+    tDeadline = time.time() + timeout
+    while True:
+        status, code = SubSystemInstance.sht(mode=mode)
+        if status:
+            return SubSystemInstance.waitForSHT(max(0.0, tDeadline - time.time()))
+            
+        # Something is in the way - wait for a SHT that is already in progress
+        # or for whatever else is running to finish
+        if 'SHT' in SubSystemInstance.currentState['activeProcess']:
+            if SubSystemInstance.waitForSHT(max(0.0, tDeadline - time.time())):
+                return True
+                
+        if time.time() + 0.5 >= tDeadline:
+            return False
+        time.sleep(0.5)
+
+
 def main(args):
     """
     Main function of asp_cmnd.py.  This sets up the various configuation options 
@@ -529,11 +582,10 @@ def main(args):
         # Shutdown ASP and close the communications channels
         tStop = time.time()
         logger.info('Shutting down ASP, please wait...')
-        MCSInstance.SubSystemInstance.sht(mode='SCRAM')
-        while MCSInstance.SubSystemInstance.currentState['info'] != 'System has been shut down':
-            time.sleep(5)
-            MCSInstance.SubSystemInstance.sht(mode='SCRAM')
-        logger.info('Shutdown completed in %.3f seconds', time.time() - tStop)
+        if ShutdownASP(MCSInstance.SubSystemInstance, mode='SCRAM', timeout=config.get('sht_timeout', 20.0)):
+            logger.info('Shutdown completed in %.3f seconds', time.time() - tStop)
+        else:
+            logger.warning('Shutdown did not complete after %.3f seconds', time.time() - tStop)
         MCSInstance.stop()
         
         # Exit
@@ -573,14 +625,10 @@ def main(args):
     tStop = time.time()
     print('\nShutting down ASP, please wait...')
     logger.info('Shutting down ASP, please wait...')
-    for attempt in range(5):
-        lwaASP.sht()
-        time.sleep(5)
-        
-        if lwaASP.currentState['info'] == 'System has been shut down':
-            break
-            
-    logger.info('Shutdown completed in %.3f seconds', time.time() - tStop)
+    if ShutdownASP(lwaASP, timeout=config.get('sht_timeout', 20.0)):
+        logger.info('Shutdown completed in %.3f seconds', time.time() - tStop)
+    else:
+        logger.warning('Shutdown did not complete after %.3f seconds', time.time() - tStop)
     mcsComms.stop()
     
     # Exit
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the ASP MCS software that run against the hardware simulator
+so that no hardware is needed.  The benchmarks are:
+ * spi-queue - queue_command() and building the SPI batches and frames for
+   256 and 1024 stands
+ * rs485-parse - parsing the CURA and POWA replies in rs485Power() and
+   rs485RFPower()
+ * atn-planning - turning AT1/AT2/AT3 settings into SPI commands
+ * mcs - parsePacket(), processCommand(), and sendResponse() throughput
+ * latency - time from an MCS FIL command being processed to the SPI
+   transfer that carries it finishing
+The results are written to a JSON file that can be compared against the
+results from an earlier run with --compare.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import timeit
+import random
+import logging
+import argparse
+import platform
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MCS import getTime
+from asp_cmnd import MCSCommunicate
+from aspFunctions import AnalogProcessor
+from aspSUB20 import SPI_P14_on, SPIProcessingThread, Transport, getSPIFrames, setTransport, rs485Power, rs485RFPower, _formatPICReply
+from aspSimulator import HardwareSimulator
+
+
+# Benchmarks that can be run
+BENCHMARKS = ('spi-queue', 'rs485-parse', 'atn-planning', 'mcs', 'latency')
+
+# Default configuration to benchmark with
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'defaults.json.LWA-SV')
+
+# Commands used for the MCS throughput benchmark
+MCS_COMMANDS = (('PNG', ''), ('RPT', 'SUMMARY'), ('RPT', 'INFO'), ('RPT', 'LASTLOG'),
+                ('RPT', 'FILTER_1'), ('RPT', 'AT1_1'), ('RPT', 'ARXSUPPLY'), ('RPT', 'TEMP-STATUS'))
+
+
+def _throughput(func, number, perCall=1, repeat=5):
+    """
+    Time func() number times, keeping the best of repeat tries, and return a
+    dictionary of the timing.  perCall is the number of operations in each
+    call to func().
+    """
+    
+    best = min(timeit.Timer(func).repeat(repeat, number))
+    nOps = number*perCall
+    return {'operations': nOps,
+            'seconds': best,
+            'per_second': nOps/best,
+            'mean_us': best/nOps*1e6}
+
+
+def _percentiles(values):
+    """
+    Return a dictionary of the nearest-rank percentiles, in ms, of a list of
+    values in seconds.
+    """
+    
+    values = sorted(values)
+    def rank(p):
+        return values[min(len(values)-1, max(0, int(round(p/100.0*len(values))) - 1))]*1e3
+        
+    return {'samples': len(values),
+            'mean_ms': sum(values)/len(values)*1e3,
+            'p50_ms': rank(50),
+            'p90_ms': rank(90),
+            'p99_ms': rank(99),
+            'max_ms': values[-1]*1e3}
+
+
+def _buildPacket(command, data, reference, destination='ASP'):
+    """
+    Build a MCS command packet.
+    """
+    
+    mjd, mpm = getTime()
+    return "%3s%3s%3s%9i%4i%6i%9i %s" % (destination, 'MCS', command, reference, len(data), mjd, mpm, data)
+
+
+class _CannedTransport(Transport):
+    """
+    Transport that answers every RS485 command with the same reply so that
+    only the parsing is timed.
+    """
+    
+    name = 'canned'
+    
+    def __init__(self, replies):
+        Transport.__init__(self)
+        self.replies = replies
+        
+    def _unavailable(self, *args, **kwds):
+        raise RuntimeError("Only RS485 commands are available")
+        
+    spiTransfer = spiRead = psuRead = psuWrite = psuTemperature = _unavailable
+    
+    def rs485Send(self, sub20SN, address, command, decode=False, token=None):
+        return self.replies[command]
+        
+    def rs485Echo(self, sub20SN, addresses, token=None):
+        pass
+
+
+def benchSPIQueue(config, number):
+    """
+    Time queueing a command for every stand, and for all stands at once, and
+    then building the batches and SPI frames for 256 and 1024 stands.
+    """
+    
+    results = {}
+    for nStands in (256, 1024):
+        ## One SPI chain per 256 stands
+        mapper = {}
+        for i in range(nStands//256):
+            mapper['%i' % (1000+i)] = [256*i+1, 256*(i+1)]
+        thread = SPIProcessingThread(mapper)
+        
+        def build():
+            for sub20SN in sorted(mapper):
+                batch = thread._take_batch(sub20SN)
+                if batch is not None:
+                    device_count, devices, commands, to_execute = batch
+                    for frame in getSPIFrames(sub20SN, device_count).plan(devices, commands):
+                        pass
+                        
+        def single():
+            for stand in range(1, nStands+1):
+                thread.queue_command(stand, SPI_P14_on)
+            build()
+            
+        def broadcast():
+            thread.queue_command(0, SPI_P14_on)
+            build()
+            
+        results['%i-stands' % nStands] = {'single': _throughput(single, number, perCall=nStands),
+                                           'broadcast': _throughput(broadcast, number)}
+    return results
+
+
+def benchRS485Parse(config, number, nBoards=16):
+    """
+    Time rs485Power() and rs485RFPower() for nBoards boards against a
+    transport that answers instantly.
+    """
+    
+    channels = 2*config['stands_per_board']
+    reply = ''.join(['%04X' % (300 + 10*i) for i in range(channels)])
+    setTransport(_CannedTransport({'CURA': _formatPICReply('CURA', 0, len(reply), reply, decode=True),
+                                   'POWA': _formatPICReply('POWA', 0, len(reply), reply, decode=True)}))
+                                   
+    mapper = {'1000': dict([('%i' % (i+1), []) for i in range(nBoards)])}
+    results = {}
+    for name,func in (('cura', rs485Power), ('powa', rs485RFPower)):
+        success, values = func(mapper, maxRetry=0)
+        if not success or len(values) != nBoards*channels:
+            raise RuntimeError("%s returned %i values, expected %i" % (func.__name__, len(values), nBoards*channels))
+        results[name] = _throughput(lambda: func(mapper, maxRetry=0), number, perCall=nBoards)
+        
+    setTransport('tools')
+    return results
+
+
+def benchAtnPlanning(asp, number):
+    """
+    Time turning every AT1/AT2/AT3 setting into SPI commands.  The commands
+    are queued on a SPI thread that is not running and are thrown away.
+    """
+    
+    thread = SPIProcessingThread(asp.config['sub20_antenna_mapping'])
+    saved, asp.currentState['spiThread'] = asp.currentState['spiThread'], thread
+    try:
+        results = {}
+        for mode in (1, 2, 3):
+            settings = list(range(asp.config['max_atten'][mode-1]+1))
+            
+            def plan():
+                for setting in settings:
+                    asp._AnalogProcessor__atnProcess(mode, 1, setting)
+                for sub20SN in asp.config['sub20_antenna_mapping']:
+                    thread._take_batch(sub20SN)
+                    
+            results['at%i' % mode] = _throughput(plan, number, perCall=len(settings))
+    finally:
+        asp.currentState['spiThread'] = saved
+    return results
+
+
+def _getCommunicator(asp):
+    """
+    Return a two-element tuple of a MCSCommunicate instance that sends its
+    responses to a local socket and that socket.
+    """
+    
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    
+    comm = MCSCommunicate(asp, asp.config, argparse.Namespace(config=None))
+    comm.socketOut = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    comm.destAddress = receiver.getsockname()
+    return comm, receiver
+
+
+def benchMCS(asp, number):
+    """
+    Time parsing, processing, and responding to a mix of MCS commands.
+    """
+    
+    comm, receiver = _getCommunicator(asp)
+    try:
+        packets = [_buildPacket(command, data, i+1) for i,(command,data) in enumerate(MCS_COMMANDS)]
+        responses = [comm.processCommand(packet) for packet in packets]
+        
+        results = {'parsePacket': _throughput(lambda: [comm.parsePacket(packet) for packet in packets], number, perCall=len(packets)),
+                   'processCommand': _throughput(lambda: [comm.processCommand(packet) for packet in packets], number, perCall=len(packets)),
+                   'sendResponse': _throughput(lambda: [comm.sendResponse(*response) for response in responses], number, perCall=len(responses))}
+    finally:
+        comm.socketOut.close()
+        receiver.close()
+    return results
+
+
+def benchLatency(asp, samples, timeout=30.0, seed=1):
+    """
+    Time how long it takes for MCS FIL commands to make it onto the SPI bus.
+    The commands are spaced randomly so that they arrive at different points
+    in the polling cycle of the SPI thread.  A command is done once the 
+    callback for its last SPI command has set the filter, which is checked 
+    every 0.5 ms.
+    """
+    
+    rng = random.Random(seed)
+    comm, receiver = _getCommunicator(asp)
+    try:
+        latencies = []
+        for i in range(samples):
+            stand = rng.randint(1, asp.num_stands)
+            filterCode = 3 if asp.currentState['filter'][stand] == 1 else 1
+            packet = _buildPacket('FIL', '%i%02i' % (stand, filterCode), i+1)
+            time.sleep(rng.uniform(0.0, asp.currentState['spiThread']._pollInterval))
+            
+            tStart = time.perf_counter()
+            sender, status, command, reference, packed_data = comm.processCommand(packet)
+            if not status:
+                raise RuntimeError("FIL was rejected: %s" % packed_data)
+            while asp.currentState['filter'][stand] != filterCode:
+                if time.perf_counter() - tStart > timeout:
+                    raise RuntimeError("FIL for stand %i did not finish within %.1f s" % (stand, timeout))
+                time.sleep(0.0005)
+            latencies.append(time.perf_counter() - tStart)
+    finally:
+        comm.socketOut.close()
+        receiver.close()
+    return _percentiles(latencies)
+
+
+def _flatten(results, prefix=''):
+    """
+    Flatten nested dictionaries of results into a single dictionary keyed by
+    '/' separated names.
+    """
+    
+    flat = {}
+    for key,value in results.items():
+        name = '%s/%s' % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+
+def main(args):
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL,
+                        format='%(asctime)s [%(levelname)-8s] %(message)s')
+    benchmarks = args.benchmark or BENCHMARKS
+    
+    # Setup a configuration that keeps everything in a temporary directory
+    with open(args.config, 'r') as fh:
+        config = json.load(fh)
+    tempdir = tempfile.mkdtemp(prefix='aspBenchmarks-')
+    config['inventory_file'] = os.path.join(tempdir, 'inventory.json')
+    config['archive_path'] = os.path.join(tempdir, 'archive')
+    config['transport'] = 'simulator'
+    config['transport_record'] = ''
+    
+    results = {}
+    if 'spi-queue' in benchmarks:
+        results['spi-queue'] = benchSPIQueue(config, args.number)
+    if 'rs485-parse' in benchmarks:
+        results['rs485-parse'] = benchRS485Parse(config, args.number)
+        
+    # Everything else needs an AnalogProcessor running on the simulator
+    sim = HardwareSimulator.fromConfig(config, seed=1)
+    sim.install()
+    try:
+        asp = AnalogProcessor(config)
+        if 'atn-planning' in benchmarks:
+            results['atn-planning'] = benchAtnPlanning(asp, args.number)
+            
+        if 'mcs' in benchmarks or 'latency' in benchmarks:
+            tStart = time.time()
+            asp.ini(config['max_stands'] // config['stands_per_board'])
+            while 'INI' in asp.currentState['activeProcess'] or asp.currentState['status'] == 'SHUTDWN':
+                time.sleep(0.1)
+            if asp.currentState['status'] != 'NORMAL':
+                raise RuntimeError("INI failed: %s" % asp.currentState['info'])
+            results['ini'] = {'seconds': time.time() - tStart}
+            
+            if 'mcs' in benchmarks:
+                results['mcs'] = benchMCS(asp, args.number)
+            if 'latency' in benchmarks:
+                results['latency'] = benchLatency(asp, args.samples)
+                
+            asp.sht()
+            asp.waitForSHT(120)
+    finally:
+        sim.uninstall()
+        
+    # Save
+    report = {'created': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+              'host': platform.node(),
+              'python': platform.python_version(),
+              'config': os.path.basename(args.config),
+              'results': results}
+    with open(args.output, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+        
+    # Report
+    current = _flatten(results)
+    previous = {}
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            previous = _flatten(json.load(fh)['results'])
+    for name in sorted(current):
+        line = '%-48s %14.3f' % (name, current[name])
+        if name in previous and previous[name] != 0:
+            line += ' %+8.1f%%' % ((current[name] - previous[name]) / previous[name] * 100)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the ASP MCS software against the hardware simulator',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('-f', '--config', type=str, default=DEFAULT_CONFIG,
+                        help='configuration file to benchmark with')
+    parser.add_argument('-b', '--benchmark', type=str, action='append', choices=BENCHMARKS,
+                        help='benchmark to run; can be specified multiple times, all are run if none are specified')
+    parser.add_argument('-n', '--number', type=int, default=100,
+                        help='number of calls to time for the throughput benchmarks')
+    parser.add_argument('-s', '--samples', type=int, default=20,
+                        help='number of MCS commands to time for the latency benchmark')
+    parser.add_argument('-o', '--output', type=str, default='benchmarks.json',
+                        help='JSON file to write the results to')
+    parser.add_argument('-c', '--compare', type=str,
+                        help='JSON file from an earlier run to compare against')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='show the log messages')
+    args = parser.parse_args()
+    main(args)
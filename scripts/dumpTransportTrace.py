@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import argparse
+sys.path.append('/lwa/software')
+
+from aspTrace import TRACE_OPERATIONS, readTrace
+
+
+def main(args):
+    # Read in the trace
+    info, records = readTrace(args.filename)
+    print("Transport: %s%s" % (info['transport'], ' (batched)' if info['batched'] else ''))
+    print("Started: %s UTC" % time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(info['start'])))
+    print("Records: %i" % len(records))
+    if args.operation:
+        records = [record for record in records if record['operation'] in args.operation]
+        
+    if args.verbose:
+        # Every record
+        for record in records:
+            print("%10.3f %8.3f ms %-14s %-9s %s %s -> %s" % (record['start'], record['duration']*1e3,
+                                                             record['operation'], record['outcome'],
+                                                             record['sub20SN'], repr(record['args']),
+                                                             repr(record['result'])))
+    else:
+        # Per-operation summary
+        print("%-14s %7s %7s %12s %12s" % ('Operation', 'Count', 'Failed', 'Mean [ms]', 'Max [ms]'))
+        for op in TRACE_OPERATIONS:
+            durations = [record['duration'] for record in records if record['operation'] == op]
+            if not durations:
+                continue
+            nFailed = len([record for record in records if record['operation'] == op and record['outcome'] != 'ok'])
+            print("%-14s %7i %7i %12.3f %12.3f" % (op, len(durations), nFailed,
+                                                   sum(durations)/len(durations)*1e3, max(durations)*1e3))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Utility to summarize a hardware I/O trace recorded by the ASP MCS software',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('filename', type=str,
+                        help='trace file to read')
+    parser.add_argument('-o', '--operation', type=str, action='append', choices=TRACE_OPERATIONS,
+                        help='only include this operation; can be specified multiple times')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print every record instead of a summary')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import argparse
+import calendar
+sys.path.append('/lwa/software')
+
+from aspArchive import ARCHIVE_PATH, queryArchive
+
+
+def _parse_time(value):
+    """
+    Convert a YYYY-MM-DD or YYYY-MM-DD HH:MM:SS UTC string into a timestamp.
+    """
+    
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("Invalid date/time '%s'" % value)
+
+
+def main(args):
+    # Query the archive
+    times, columns = queryArchive(args.series, args.start, args.stop, tier=args.tier,
+                                  channels=args.channel, path=args.path)
+                                  
+    # Write out the selected statistic as CSV
+    keys = ['count',] + [key for key in columns if key.endswith('/%s' % args.stat)]
+    sys.stdout.write('time,%s\n' % ','.join(keys))
+    for i,t in enumerate(times):
+        sys.stdout.write('%.0f,%s\n' % (t, ','.join(['%.3f' % columns[key][i] for key in keys])))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Utility to export the long-term ASP telemetry rollups as CSV',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+        )
+    parser.add_argument('series', type=str,
+                        help='telemetry series to export, i.e., temp, psu-0x1F, or fee-power')
+    parser.add_argument('start', type=_parse_time,
+                        help='UTC start date/time as YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('stop', type=_parse_time,
+                        help='UTC stop date/time as YYYY-MM-DD[ HH:MM:SS]')
+    parser.add_argument('-t', '--tier', type=str, default='1h', choices=('1m', '1h'),
+                        help='rollup tier to export')
+    parser.add_argument('-s', '--stat', type=str, default='mean', choices=('min', 'mean', 'max'),
+                        help='statistic to export')
+    parser.add_argument('-c', '--channel', type=str, action='append',
+                        help='channel to export; can be specified multiple times')
+    parser.add_argument('-p', '--path', type=str, default=ARCHIVE_PATH,
+                        help='archive location')
+    args = parser.parse_args()
+    main(args)
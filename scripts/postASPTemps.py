@@ -1,31 +1,32 @@
 #!/usr/bin/env python3
 
+import sys
 import time
-import subprocess
 from socket import gethostname
 
 from lwa_auth import KEYS as LWA_AUTH_KEYS
 from lwa_auth.signed_requests import post as signed_post
 
+sys.path.append('/lwa/software')
+from aspHistory import HistoryReader
+
 
 URL = "https://lwalab.phys.unm.edu/OpScreen/update"
 SITE = gethostname().split("-",1)[0]
 SUBSYSTEM = "ASP"
 
-# Get the last line of the log file
-test = subprocess.check_output(["tail", "-n1", '/data/temp.txt'], stderr=subprocess.DEVNULL)
-test = test.decode('ascii')
-test = test.replace('\n', '')
-
-# Check to see if the log is actually getting updated.  If not, send NaNs
+# Get the latest temperatures from the history
 try:
-    lastUpdated, junk = test.split(',', 1)
-except ValueError:
-    lastUpdated = 0
-    junk = []
-lastUpdated = float(lastUpdated)
-if time.time() > lastUpdated + 300:
+    with HistoryReader('temp') as history:
+        latest = history.latest()
+except (OSError, ValueError, RuntimeError):
+    latest = None
+
+# Check to see if the history is actually getting updated.  If not, send NaNs
+if latest is None or time.time() > latest[0] + 300:
     test = "%.2f,%s" % (time.time(), ','.join(["NaN" for i in range(4)]))
+else:
+    test = "%s,%s" % (latest[0], ','.join(["%.2f" % t for t in latest[1:]]))
 
 # Send the update to lwalab
 f = signed_post(LWA_AUTH_KEYS.get('asp', kind='private'), URL,
@@ -0,0 +1,46 @@
+
+"""
+Shared fixtures for the ASP tests.  The tests run against the hardware
+simulator in aspSimulator so no SUB-20s are needed.
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _ROOT)
+
+import aspSUB20
+from aspSimulator import HardwareSimulator
+
+
+@pytest.fixture
+def config():
+    """
+    The LWA-SV configuration.
+    """
+    
+    with open(os.path.join(_ROOT, 'defaults.json.LWA-SV'), 'r') as fh:
+        return json.load(fh)
+
+
+@pytest.fixture
+def simulator(config):
+    """
+    A HardwareSimulator that matches the configuration and that aspSUB20 is
+    routed through.  The retry policy is reset before and after each test.
+    """
+    
+    aspSUB20.getRetryPolicy().reset()
+    sim = HardwareSimulator.fromConfig(config, seed=1, libraryDelays=False)
+    sim.install()
+    aspSUB20.setTransport('simulator')
+    
+    yield sim
+    
+    sim.uninstall()
+    aspSUB20.setTransport('tools')
+    aspSUB20.getRetryPolicy().reset()
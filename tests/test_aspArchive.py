@@ -0,0 +1,126 @@
+
+"""
+Tests for the long-term telemetry rollups in aspArchive.
+"""
+
+import math
+
+import pytest
+
+from aspArchive import RollupSeries, TelemetryArchiver, queryArchive
+
+
+# 2023-11-14 22:00:00 UTC
+T0 = 1699999200.0
+
+
+def _fill(series, start, stop, step=30):
+    for t in range(int(start), int(stop), step):
+        series.add([t - T0, 2*(t - T0)], timestamp=float(t))
+
+
+def test_bins(tmp_path):
+    series = RollupSeries('temp', ['a', 'b'], path=str(tmp_path))
+    _fill(series, T0, T0 + 120)
+    series.add([float('nan'), 1000.0], timestamp=T0 + 150)
+    series.flush(final=True)
+    
+    times, columns = queryArchive('temp', T0, T0 + 3600, path=str(tmp_path))
+    assert list(times) == [T0, T0 + 60, T0 + 120]
+    assert list(columns['count']) == [2, 2, 1]
+    assert list(columns['a/min'][:2]) == [0.0, 60.0]
+    assert list(columns['a/mean'][:2]) == [15.0, 75.0]
+    assert list(columns['b/max'][:2]) == [60.0, 180.0]
+    
+    # NaN samples are counted but do not contribute to the statistics
+    assert math.isnan(columns['a/mean'][2])
+    assert columns['b/mean'][2] == 1000.0
+
+
+def test_channel_filter(tmp_path):
+    series = RollupSeries('temp', ['a', 'b'], path=str(tmp_path))
+    _fill(series, T0, T0 + 120)
+    series.flush(final=True)
+    
+    times, columns = queryArchive('temp', T0, T0 + 3600, channels=['b'], path=str(tmp_path))
+    assert sorted(columns) == ['b/max', 'b/mean', 'b/min', 'count']
+    with pytest.raises(ValueError):
+        queryArchive('temp', T0, T0 + 3600, tier='1d', path=str(tmp_path))
+
+
+def test_flush_keeps_partial_bins(tmp_path):
+    series = RollupSeries('temp', ['a', 'b'], path=str(tmp_path))
+    _fill(series, T0, T0 + 90)
+    
+    # A normal flush only writes finished bins
+    series.flush()
+    times, columns = queryArchive('temp', T0, T0 + 3600, path=str(tmp_path))
+    assert list(times) == [T0]
+    
+    # A final flush also writes the bins that are still accumulating
+    series.flush(final=True)
+    times, columns = queryArchive('temp', T0, T0 + 3600, path=str(tmp_path))
+    assert list(times) == [T0, T0 + 60]
+    times, columns = queryArchive('temp', T0, T0 + 3600, tier='1h', path=str(tmp_path))
+    assert list(times) == [T0]
+    assert list(columns['count']) == [3]
+
+
+def test_blocks_written_by_age(tmp_path):
+    series = RollupSeries('temp', ['a', 'b'], path=str(tmp_path), maxBlockAge=300)
+    
+    # Well short of a full 60 row block of 1m bins
+    _fill(series, T0, T0 + 1200)
+    times, columns = queryArchive('temp', T0, T0 + 3600, path=str(tmp_path))
+    assert 10 <= len(times) < 20
+    
+    # The 1h tier has bins longer than the age limit and is only written when
+    # a block fills up or at shutdown
+    _fill(series, T0 + 1200, T0 + 3*3600)
+    times, columns = queryArchive('temp', T0, T0 + 4*3600, tier='1h', path=str(tmp_path))
+    assert len(times) == 0
+    series.flush(final=True)
+    times, columns = queryArchive('temp', T0, T0 + 4*3600, tier='1h', path=str(tmp_path))
+    assert list(times) == [T0, T0 + 3600, T0 + 7200]
+    assert list(columns['count']) == [120, 120, 120]
+
+
+def test_restart_merges_bins(tmp_path):
+    series = RollupSeries('temp', ['a', 'b'], path=str(tmp_path))
+    series.add([1.0, 10.0], timestamp=T0)
+    series.flush(final=True)
+    
+    # The same bin continued after a restart
+    series = RollupSeries('temp', ['a', 'b'], path=str(tmp_path))
+    series.add([4.0, float('nan')], timestamp=T0 + 20)
+    series.add([7.0, float('nan')], timestamp=T0 + 40)
+    series.add([2.0, 20.0], timestamp=T0 + 60)
+    series.flush(final=True)
+    
+    times, columns = queryArchive('temp', T0, T0 + 3600, path=str(tmp_path))
+    assert list(times) == [T0, T0 + 60]
+    assert list(columns['count']) == [3, 1]
+    assert columns['a/min'][0] == 1.0
+    assert columns['a/max'][0] == 7.0
+    assert columns['a/mean'][0] == pytest.approx((1.0 + 2*5.5) / 3)
+    assert columns['b/mean'][0] == 10.0
+    
+    times, columns = queryArchive('temp', T0, T0 + 3600, tier='1h', path=str(tmp_path))
+    assert list(times) == [T0]
+    assert list(columns['count']) == [4]
+    assert columns['b/min'][0] == 10.0
+    assert columns['b/max'][0] == 20.0
+
+
+def test_archiver_channel_change(tmp_path):
+    archiver = TelemetryArchiver(path=str(tmp_path))
+    assert archiver.add('temp', ['a', 'b'], [1.0, 2.0], timestamp=T0)
+    
+    # Changing the channels closes out the old series
+    assert archiver.add('temp', ['a', 'b', 'c'], [1.0, 2.0, 3.0], timestamp=T0 + 10)
+    times, columns = queryArchive('temp', T0, T0 + 3600, path=str(tmp_path))
+    assert list(times) == [T0]
+    assert 'c/mean' not in columns
+    
+    assert not archiver.add('temp', ['a'], [1.0, 2.0], timestamp=T0 + 20)
+    assert archiver.flush(final=True)
@@ -0,0 +1,66 @@
+
+"""
+Tests for the AnalogProcessor in aspFunctions, run through a full INI,
+command, and SHT cycle against the hardware simulator.
+"""
+
+import time
+
+import pytest
+
+import aspFunctions
+
+
+def _waitFor(check, timeout):
+    """
+    Poll check() until it returns True or timeout seconds have passed.
+    """
+    
+    t0 = time.time()
+    while not check():
+        if time.time() - t0 > timeout:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+@pytest.fixture
+def asp(simulator, config, tmp_path):
+    """
+    An AnalogProcessor that uses the simulator and keeps its state files in
+    tmp_path.
+    """
+    
+    config['transport'] = 'simulator'
+    config['inventory_file'] = str(tmp_path / 'inventory.json')
+    config['archive_path'] = str(tmp_path / 'archive')
+    config['sht_settle_time'] = 0.5
+    
+    asp = aspFunctions.AnalogProcessor(config)
+    yield asp
+    
+    if asp.currentState['status'] != 'SHUTDWN':
+        asp.sht()
+        asp.waitForSHT(60)
+
+
+def test_ini_commands_sht(asp, simulator, config):
+    nBoards = config['max_boards']
+    atm = simulator.getDevice(str(config['sub20_i2c_mapping']))
+    
+    assert asp.ini(nBoards) == (True, 0)
+    assert _waitFor(lambda: 'INI' not in asp.currentState['activeProcess'], 120)
+    assert asp.currentState['status'] == 'NORMAL'
+    assert atm.psus[config['arx_ps_address']].on
+    
+    # The state is only updated once the SPI batch has gone out
+    assert asp.setFilter(1, 1) == (True, 0)
+    assert asp.setAttenuator(1, 1, 5) == (True, 0)
+    assert _waitFor(lambda: asp.getFilter(1) == (True, 1), 10)
+    assert _waitFor(lambda: asp.getAttenuators(1)[1][0] == 5, 10)
+    
+    assert asp.sht() == (True, 0)
+    assert asp.waitForSHT(120)
+    assert asp.currentState['status'] == 'SHUTDWN'
+    assert not atm.psus[config['arx_ps_address']].on
+    assert not atm.psus[config['fee_ps_address']].on
@@ -0,0 +1,120 @@
+
+"""
+Tests for the memory-mapped ring buffers in aspHistory.
+"""
+
+import math
+
+import pytest
+
+import aspHistory
+from aspHistory import HistoryStore, HistoryReader, HistoryRecorder, encodePSUState
+
+
+def test_append_and_read(tmp_path):
+    store = HistoryStore('temp', ['a', 'b'], capacity=4, path=str(tmp_path))
+    for i in range(6):
+        store.append([i, 10*i], timestamp=100.0+i)
+        
+    with HistoryReader('temp', path=str(tmp_path)) as reader:
+        assert reader.channels == ['a', 'b']
+        assert len(reader) == 4
+        assert reader.latest() == (105.0, 5.0, 50.0)
+        assert reader.latest('b') == (105.0, 50.0)
+        
+        # Only the last four rows survive the wrap
+        assert [row[0] for row in reader.range()] == [102.0, 103.0, 104.0, 105.0]
+        assert [row[0] for row in reader.range(start=103.0, stop=105.0)] == [103.0, 104.0]
+        
+        with pytest.raises(KeyError):
+            reader.latest('c')
+    store.close()
+
+
+def test_decimate(tmp_path):
+    store = HistoryStore('temp', ['a'], capacity=10, path=str(tmp_path))
+    for t,v in ((0.0, 1.0), (1.0, 3.0), (10.0, float('nan')), (11.0, 5.0)):
+        store.append([v], timestamp=t)
+        
+    rows = store.decimate(10.0)
+    assert rows == [(0.0, 2.0), (10.0, 5.0)]
+    store.close()
+
+
+def test_wrong_row_length(tmp_path):
+    store = HistoryStore('temp', ['a', 'b'], capacity=4, path=str(tmp_path))
+    with pytest.raises(ValueError):
+        store.append([1.0])
+    store.close()
+
+
+def test_reopen_keeps_history(tmp_path):
+    store = HistoryStore('temp', ['UNK', 'UNK'], capacity=4, path=str(tmp_path))
+    store.append([1.0, 2.0], timestamp=1.0)
+    store.close()
+    
+    # New channel names do not wipe the ring
+    store = HistoryStore('temp', ['0x1F ARX', '0x1E FEE'], capacity=4, path=str(tmp_path))
+    assert len(store) == 1
+    assert store.channels == ['0x1F ARX', '0x1E FEE']
+    with HistoryReader('temp', path=str(tmp_path)) as reader:
+        assert reader.channels == ['0x1F ARX', '0x1E FEE']
+        assert reader.latest() == (1.0, 1.0, 2.0)
+    store.close()
+
+
+def test_reopen_after_interrupted_write(tmp_path):
+    store = HistoryStore('temp', ['a'], capacity=4, path=str(tmp_path))
+    store.append([1.0], timestamp=1.0)
+    
+    # Leave the sequence counter odd like a crash in the middle of append()
+    aspHistory._U64.pack_into(store._mm, aspHistory._SEQ_OFFSET, store._getSequence() + 1)
+    store.close()
+    with HistoryReader('temp', path=str(tmp_path)) as reader:
+        with pytest.raises(RuntimeError):
+            reader.latest()
+            
+    store = HistoryStore('temp', ['a'], capacity=4, path=str(tmp_path))
+    assert store._getSequence() % 2 == 0
+    with HistoryReader('temp', path=str(tmp_path)) as reader:
+        assert reader.latest() == (1.0, 1.0)
+    store.close()
+
+
+def test_new_layout_leaves_old_readers_alone(tmp_path):
+    store = HistoryStore('temp', ['a'], capacity=4, path=str(tmp_path))
+    store.append([1.0], timestamp=1.0)
+    reader = HistoryReader('temp', path=str(tmp_path))
+    
+    # A different layout replaces the file rather than truncating it
+    store2 = HistoryStore('temp', ['a', 'b'], capacity=4, path=str(tmp_path))
+    assert len(store2) == 0
+    assert reader.latest() == (1.0, 1.0)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['temp.ring']
+    
+    reader.close()
+    store2.close()
+    store.close()
+
+
+def test_recorder_relabels(tmp_path):
+    recorder = HistoryRecorder(capacity=4, path=str(tmp_path))
+    assert recorder.record('temp', ['UNK', 'UNK'], [1.0, 2.0], timestamp=1.0)
+    assert recorder.record('temp', ['x', 'y'], [3.0, 4.0], timestamp=2.0)
+    
+    with HistoryReader('temp', path=str(tmp_path)) as reader:
+        assert reader.channels == ['x', 'y']
+        assert len(reader) == 2
+        
+    # A different number of channels starts a new ring
+    assert recorder.record('temp', ['x', 'y', 'z'], [5.0, 6.0, 7.0], timestamp=3.0)
+    with HistoryReader('temp', path=str(tmp_path)) as reader:
+        assert len(reader) == 1
+    recorder.close()
+
+
+def test_encode_psu_state():
+    assert encodePSUState('ON ', 'OverVolt OverCurrent') == (1.0, 6.0)
+    assert encodePSUState('OFF', '') == (0.0, 0.0)
+    onoff, status = encodePSUState('???', 'UNK')
+    assert math.isnan(onoff) and math.isnan(status)
@@ -0,0 +1,175 @@
+
+"""
+Tests for the retry policy and circuit breakers in aspSUB20, including the
+PSU functions run against the hardware simulator.
+"""
+
+import pytest
+
+import aspSUB20
+from aspSUB20 import RetryPolicy, psuRead, psuSend
+from aspClock import VirtualClock, setClock
+
+
+@pytest.fixture
+def clock():
+    """
+    A VirtualClock that only moves when it is advanced.
+    """
+    
+    clock = setClock(VirtualClock(start=1e9, autoAdvance=False))
+    yield clock
+    setClock(None)
+
+
+def _fail(policy, key, maxRetry=3):
+    """
+    Run one operation where every attempt fails and return the number of
+    attempts made.
+    """
+    
+    op = policy.operation(key, maxRetry, 0.0)
+    for attempt in op:
+        pass
+    return op.attempts
+
+
+def _succeed(policy, key, maxRetry=3):
+    """
+    Run one operation where the first attempt works and return the number
+    of attempts made.
+    """
+    
+    op = policy.operation(key, maxRetry, 0.0)
+    for attempt in op:
+        op.success()
+        break
+    return op.attempts
+
+
+def test_healthy_device_gets_full_budget():
+    policy = RetryPolicy()
+    for i in range(10):
+        assert _succeed(policy, 'dev') == 1
+    assert policy._begin('dev', 4) == 5
+    assert policy._begin('dev', 0) == 1
+    
+    stats = policy.getStatistics()['dev']
+    assert stats['state'] == 'closed'
+    assert stats['operations'] == 10
+    assert stats['successes'] == 10
+
+
+def test_failing_device_gets_fewer_retries():
+    policy = RetryPolicy(threshold=100)
+    assert _fail(policy, 'dev', maxRetry=4) == 5
+    attempts = [_fail(policy, 'dev', maxRetry=4) for i in range(5)]
+    assert attempts == sorted(attempts, reverse=True)
+    assert attempts[-1] < 5
+    
+    # One success restores the full budget
+    _succeed(policy, 'dev', maxRetry=4)
+    assert policy._begin('dev', 4) == 5
+
+
+def test_breaker_opens_and_probes(clock):
+    policy = RetryPolicy(threshold=3, cooldown=10.0, maxCooldown=40.0)
+    for i in range(3):
+        _fail(policy, 'dev')
+    assert policy.getStatistics()['dev']['state'] == 'open'
+    
+    # Open - rejected without an attempt
+    assert _fail(policy, 'dev') == 0
+    assert policy.getStatistics()['dev']['rejected'] == 1
+    
+    # Half-open - a single failed probe reopens it for twice as long
+    clock.advance(10.0)
+    assert _fail(policy, 'dev') == 1
+    stats = policy.getStatistics()['dev']
+    assert stats['state'] == 'open'
+    assert stats['trips'] == 2
+    clock.advance(10.0)
+    assert _fail(policy, 'dev') == 0
+    
+    # A successful probe closes it again
+    clock.advance(10.0)
+    assert _succeed(policy, 'dev') == 1
+    assert policy.getStatistics()['dev']['state'] == 'closed'
+
+
+def test_bypass_ignores_breaker():
+    policy = RetryPolicy(threshold=3, cooldown=10.0)
+    for i in range(3):
+        _fail(policy, 'dev')
+    assert policy._begin('dev', 3) == 0
+    
+    op = policy.operation('dev', 3, 0.0, bypass=True)
+    for attempt in op:
+        pass
+    assert op.attempts == 4
+    
+    # Bypassing failures are counted but do not trip the breaker
+    policy2 = RetryPolicy(threshold=3)
+    for i in range(5):
+        op = policy2.operation('dev', 0, 0.0, bypass=True)
+        for attempt in op:
+            pass
+    stats = policy2.getStatistics()['dev']
+    assert stats['state'] == 'closed'
+    assert stats['failures'] == 5
+
+
+def test_incomplete_transport():
+    class _SPIOnly(aspSUB20.Transport):
+        def spiTransfer(self, sub20SN, deviceCount, devices, values, token=None):
+            pass
+            
+    with pytest.raises(TypeError):
+        _SPIOnly()
+
+
+def test_psu_power_off_after_failed_reads(simulator, config):
+    sn = str(config['sub20_i2c_mapping'])
+    addr = config['arx_ps_address']
+    atm = simulator.getDevice(sn)
+    
+    assert psuSend(sn, addr, 11, waitRetry=0.0)
+    assert atm.psus[addr].on
+    
+    # Fail enough reads to open the breaker for reads
+    atm.addFault('i2c', 'error')
+    for i in range(3):
+        assert psuRead(sn, addr, maxRetry=0) == {}
+    assert aspSUB20.getRetryPolicy().getStatistics()['%s/0x%02X' % (sn, addr)]['state'] == 'open'
+    atm.clearFaults()
+    
+    # Reads are now rejected but turning the supply off still goes through
+    assert psuRead(sn, addr, maxRetry=0) == {}
+    assert psuSend(sn, addr, 00, waitRetry=0.0)
+    assert not atm.psus[addr].on
+
+
+def test_psu_power_off_after_failed_writes(simulator, config):
+    sn = str(config['sub20_i2c_mapping'])
+    addr = config['fee_ps_address']
+    atm = simulator.getDevice(sn)
+    
+    assert psuSend(sn, addr, 11, waitRetry=0.0)
+    
+    # Fail enough writes to open the breaker for writes
+    fault = atm.addFault('i2c', 'error')
+    for i in range(3):
+        assert not psuSend(sn, addr, 11, maxRetry=0)
+    stats = aspSUB20.getRetryPolicy().getStatistics()['%s/0x%02X/write' % (sn, addr)]
+    assert stats['state'] == 'open'
+    
+    # Power-off keeps trying even while the device is failing...
+    calls = fault.nFired
+    assert not psuSend(sn, addr, 00, maxRetry=2, waitRetry=0.0)
+    assert fault.nFired > calls
+    atm.removeFault(fault)
+    
+    # ...and works as soon as the device does
+    assert not psuSend(sn, addr, 11, waitRetry=0.0)
+    assert psuSend(sn, addr, 00, waitRetry=0.0)
+    assert not atm.psus[addr].on
@@ -0,0 +1,72 @@
+
+"""
+Tests for the rolling statistics in aspStatistics.
+"""
+
+import math
+
+import pytest
+
+from aspStatistics import RollingStatistics, StatisticsBank
+
+
+def test_empty():
+    stats = RollingStatistics()
+    assert stats.getStatistics() == (None, None, None, None)
+
+
+def test_ewma_irregular_sampling():
+    stats = RollingStatistics(tau=60.0)
+    stats.update(10.0, timestamp=0.0)
+    assert stats.getEWMA() == 10.0
+    
+    # One time constant later the EWMA has moved 1-1/e of the way
+    stats.update(20.0, timestamp=60.0)
+    assert stats.getEWMA() == pytest.approx(10.0 + 10.0*(1 - math.exp(-1)))
+    
+    # A repeated timestamp does not move the EWMA
+    ewma = stats.getEWMA()
+    stats.update(100.0, timestamp=60.0)
+    assert stats.getEWMA() == ewma
+
+
+def test_window_min_max_rate():
+    stats = RollingStatistics(window=100.0)
+    for t,v in ((0, 5.0), (10, 1.0), (20, 9.0), (30, 3.0)):
+        stats.update(v, timestamp=t)
+    assert stats.getMin() == 1.0
+    assert stats.getMax() == 9.0
+    assert stats.getRate() == pytest.approx((3.0 - 5.0) / 30)
+    
+    # Age the extremes out of the window
+    stats.update(4.0, timestamp=125.0)
+    assert stats.getMin() == 3.0
+    assert stats.getMax() == 4.0
+    assert stats.getRate() == pytest.approx((4.0 - 3.0) / 95)
+
+
+def test_invalid_values_ignored():
+    stats = RollingStatistics()
+    assert not stats.update(None, timestamp=0.0)
+    assert not stats.update(float('nan'), timestamp=1.0)
+    assert stats.getEWMA() is None
+    
+    stats.update(2.0, timestamp=2.0)
+    assert stats.getStatistics() == (2.0, 2.0, 2.0, None)
+
+
+def test_bank():
+    bank = StatisticsBank(window=60.0, tau=10.0)
+    bank.update([1.0, None, 3.0], timestamp=0.0)
+    assert len(bank) == 3
+    assert bank.getEWMA() == [1.0, None, 3.0]
+    
+    bank.updateConfig(window=30.0)
+    assert all(s.window == 30.0 for s in bank)
+    
+    # Changing the number of channels starts over
+    bank.update([5.0, 6.0], timestamp=1.0)
+    assert bank.getEWMA() == [5.0, 6.0]
+    
+    bank.reset()
+    assert len(bank) == 0